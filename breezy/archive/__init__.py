@@ -18,6 +18,9 @@
 """
 
 import os
+import queue
+import sys
+import threading
 import time
 import warnings
 
@@ -29,6 +32,14 @@ from .. import (
     )
 
 
+# Largest chunk of file content passed on in one go by the archivers.
+_CHUNK_SIZE = 1024 * 1024
+
+# Number of chunks that may be waiting between the thread that extracts
+# tree contents and the thread that compresses them.
+_QUEUE_SIZE = 16
+
+
 class ArchiveFormatInfo(object):
 
     def __init__(self, extensions):
@@ -76,6 +87,84 @@ class ArchiveFormatRegistry(registry.Registry):
             return None
 
 
+def split_chunks(chunks, size=None):
+    """Split content chunks so none is larger than size bytes.
+
+    :param chunks: Iterable over byte strings
+    :param size: Maximum chunk size; defaults to _CHUNK_SIZE
+    :return: Iterator over byte strings
+    """
+    if size is None:
+        size = _CHUNK_SIZE
+    for chunk in chunks:
+        if len(chunk) <= size:
+            yield chunk
+        else:
+            for start in range(0, len(chunk), size):
+                yield chunk[start:start + size]
+
+
+def iter_in_thread(iterable, maxsize=None):
+    """Consume an iterable in a separate thread.
+
+    This allows the items to be produced (e.g. extracted from a repository)
+    while the caller is processing earlier items (e.g. compressing them).
+    At most maxsize items are buffered; exceptions raised while producing
+    items are re-raised in the caller.
+
+    The caller must not access the objects used by the iterable until it
+    has finished iterating.
+
+    :param iterable: Iterable to consume
+    :param maxsize: Maximum number of buffered items; defaults to
+        _QUEUE_SIZE
+    :return: Iterator over the items of iterable
+    """
+    if maxsize is None:
+        maxsize = _QUEUE_SIZE
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((True, item)):
+                    break
+            else:
+                put((False, None))
+        except BaseException:
+            put((False, sys.exc_info()[1]))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name='archive-producer')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 def create_archive(format, tree, name, root=None, subdir=None,
                    force_mtime=None):
     try:
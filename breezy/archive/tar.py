@@ -16,7 +16,6 @@
 
 """Export a tree to a tarball."""
 
-from contextlib import closing
 from io import BytesIO
 import os
 import sys
@@ -26,7 +25,11 @@ from .. import (
     errors,
     osutils,
     )
-from ..export import _export_iter_entries
+from ..export import _export_iter_contents
+from . import (
+    iter_in_thread,
+    split_chunks,
+    )
 
 
 def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=None):
@@ -41,6 +44,24 @@ def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=N
 
     Returns a (tarinfo, fileobj) tuple
     """
+    if entry.kind == "file":
+        content = tree.get_file_text(tree_path)
+        size = len(content)
+        fileobj = BytesIO(content)
+    else:
+        size = None
+        fileobj = None
+    item = _make_tarinfo(tree, root, final_path, tree_path, entry, size,
+                         force_mtime)
+    return (item, fileobj)
+
+
+def _make_tarinfo(tree, root, final_path, tree_path, entry, size,
+                  force_mtime=None):
+    """Create the tarinfo for an entry.
+
+    :param size: Size of the file contents, for files
+    """
     file_id = getattr(entry, 'file_id', None)
     filename = osutils.pathjoin(root, final_path)
     item = tarfile.TarInfo(filename)
@@ -54,29 +75,73 @@ def prepare_tarball_item(tree, root, final_path, tree_path, entry, force_mtime=N
             item.mode = 0o755
         else:
             item.mode = 0o644
-        # This brings the whole file into memory, but that's almost needed for
-        # the tarfile contract, which wants the size of the file up front.  We
-        # want to make sure it doesn't change, and we need to read it in one
-        # go for content filtering.
-        content = tree.get_file_text(tree_path)
-        item.size = len(content)
-        fileobj = BytesIO(content)
+        item.size = size
     elif entry.kind in ("directory", "tree-reference"):
         item.type = tarfile.DIRTYPE
         item.name += '/'
         item.size = 0
         item.mode = 0o755
-        fileobj = None
     elif entry.kind == "symlink":
         item.type = tarfile.SYMTYPE
         item.size = 0
         item.mode = 0o755
         item.linkname = tree.get_symlink_target(tree_path)
-        fileobj = None
     else:
         raise errors.BzrError("don't know how to export {%s} of kind %r"
                               % (file_id, entry.kind))
-    return (item, fileobj)
+    return item
+
+
+def _tar_stream(tree, root, subdir=None, force_mtime=None):
+    """Generate an uncompressed tarball.
+
+    Unlike tarfile.TarFile, this passes file contents on as they come
+    rather than buffering each member, so the memory use is bounded by the
+    size of the largest file text.
+    """
+    offset = 0
+    with tree.lock_read():
+        for final_path, tree_path, entry, chunks in _export_iter_contents(
+                tree, subdir):
+            if chunks is not None:
+                size = sum(map(len, chunks))
+            else:
+                size = None
+            item = _make_tarinfo(tree, root, final_path, tree_path, entry,
+                                 size, force_mtime)
+            header = item.tobuf(
+                tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+            offset += len(header)
+            yield header
+            if chunks is not None:
+                for chunk in split_chunks(chunks):
+                    yield chunk
+                del chunks
+                remainder = size % tarfile.BLOCKSIZE
+                if remainder:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+                    size += tarfile.BLOCKSIZE - remainder
+                offset += size
+    # End of archive marker, padded to a full record like TarFile.close().
+    trailer = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    offset += len(trailer)
+    remainder = offset % tarfile.RECORDSIZE
+    if remainder:
+        trailer += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    yield trailer
+
+
+def _compressed_stream(chunks, compressor):
+    """Compress chunks while they are still being generated.
+
+    The chunks are generated in a separate thread, so that extracting
+    tree contents and compressing them use separate cores.
+    """
+    for chunk in iter_in_thread(chunks):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 def tarball_generator(tree, root, subdir=None, force_mtime=None, format=''):
@@ -90,18 +155,28 @@ def tarball_generator(tree, root, subdir=None, force_mtime=None, format=''):
 
     :param force_mtime: Option mtime to force, instead of using tree
         timestamps.
+
+    :param format: Compression to use: '', 'gz', 'bz2' or 'xz'
     """
-    buf = BytesIO()
-    with closing(tarfile.open(None, "w:%s" % format, buf)) as ball, tree.lock_read():
-        for final_path, tree_path, entry in _export_iter_entries(tree, subdir):
-            (item, fileobj) = prepare_tarball_item(
-                tree, root, final_path, tree_path, entry, force_mtime)
-            ball.addfile(item, fileobj)
-            # Yield the data that was written so far, rinse, repeat.
-            yield buf.getvalue()
-            buf.truncate(0)
-            buf.seek(0)
-    yield buf.getvalue()
+    chunks = _tar_stream(tree, root, subdir, force_mtime)
+    if format == '':
+        return chunks
+    elif format == 'gz':
+        import zlib
+        # wbits of 16 + MAX_WBITS selects a gzip header and trailer.
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif format == 'bz2':
+        import bz2
+        compressor = bz2.BZ2Compressor(9)
+    elif format == 'xz':
+        try:
+            import lzma
+        except ImportError as e:
+            raise errors.DependencyNotPresent('lzma', e)
+        compressor = lzma.LZMACompressor(lzma.FORMAT_XZ)
+    else:
+        raise ValueError('unknown tarball compression %r' % format)
+    return _compressed_stream(chunks, compressor)
 
 
 def tgz_generator(tree, dest, root, subdir, force_mtime=None):
@@ -133,12 +208,14 @@ def tgz_generator(tree, dest, root, subdir, force_mtime=None):
         buf = BytesIO()
         zipstream = gzip.GzipFile(basename, 'w', fileobj=buf,
                                   mtime=root_mtime)
-        for chunk in tarball_generator(tree, root, subdir, force_mtime):
+        for chunk in iter_in_thread(
+                tarball_generator(tree, root, subdir, force_mtime)):
             zipstream.write(chunk)
             # Yield the data that was written so far, rinse, repeat.
-            yield buf.getvalue()
-            buf.truncate(0)
-            buf.seek(0)
+            if buf.tell():
+                yield buf.getvalue()
+                buf.truncate(0)
+                buf.seek(0)
         # Closing zipstream may trigger writes to stream
         zipstream.close()
         yield buf.getvalue()
@@ -188,8 +265,6 @@ def tar_lzma_generator(tree, dest, root, subdir, force_mtime=None,
             'alone': lzma.FORMAT_ALONE,
             }[compression_format])
 
-    for chunk in tarball_generator(
-            tree, root, subdir, force_mtime=force_mtime):
-        yield compressor.compress(chunk)
-
-    yield compressor.flush()
+    return _compressed_stream(
+        tarball_generator(tree, root, subdir, force_mtime=force_mtime),
+        compressor)
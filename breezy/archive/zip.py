@@ -21,15 +21,18 @@ from contextlib import closing
 import os
 import stat
 import sys
-import tempfile
 import time
 import zipfile
 
 from .. import (
     osutils,
     )
-from ..export import _export_iter_entries
+from ..export import _export_iter_contents
 from ..trace import mutter
+from . import (
+    iter_in_thread,
+    split_chunks,
+    )
 
 
 # Windows expects this bit to be set in the 'external_attr' section,
@@ -42,6 +45,70 @@ _FILE_ATTR = stat.S_IFREG | FILE_PERMISSIONS
 _DIR_ATTR = stat.S_IFDIR | ZIP_DIRECTORY_BIT | DIR_PERMISSIONS
 
 
+class _ZipStream(object):
+    """Write-only file object that collects what the zipfile writes.
+
+    Since it can not seek, zipfile.ZipFile writes sizes and checksums
+    after the contents of each member, so members can be written out as
+    they are compressed.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks = self._chunks
+        self._chunks = []
+        return chunks
+
+
+def _zip_entries(tree, dest, root, subdir, force_mtime, compression):
+    """Generate zipinfo objects and contents for the entries in tree."""
+    for dp, tp, ie, chunks in _export_iter_contents(tree, subdir):
+        mutter("  export {%s} kind %s to %s", tp, ie.kind, dest)
+
+        # zipfile.ZipFile switches all paths to forward
+        # slashes anyway, so just stick with that.
+        if force_mtime is not None:
+            mtime = force_mtime
+        else:
+            mtime = tree.get_file_mtime(tp)
+        date_time = time.localtime(mtime)[:6]
+        filename = osutils.pathjoin(root, dp)
+        if ie.kind == "file":
+            zinfo = zipfile.ZipInfo(
+                filename=filename,
+                date_time=date_time)
+            zinfo.compress_type = compression
+            zinfo.external_attr = _FILE_ATTR
+            zinfo.file_size = sum(map(len, chunks))
+            yield zinfo, chunks
+        elif ie.kind in ("directory", "tree-reference"):
+            # Directories must contain a trailing slash, to indicate
+            # to the zip routine that they are really directories and
+            # not just empty files.
+            zinfo = zipfile.ZipInfo(
+                filename=filename + '/',
+                date_time=date_time)
+            zinfo.compress_type = compression
+            zinfo.external_attr = _DIR_ATTR
+            yield zinfo, None
+        elif ie.kind == "symlink":
+            zinfo = zipfile.ZipInfo(
+                filename=(filename + '.lnk'),
+                date_time=date_time)
+            zinfo.compress_type = compression
+            zinfo.external_attr = _FILE_ATTR
+            yield zinfo, [tree.get_symlink_target(tp).encode('utf-8')]
+
+
 def zip_archive_generator(tree, dest, root, subdir=None,
                           force_mtime=None):
     """ Export this tree to a new zip file.
@@ -50,47 +117,24 @@ def zip_archive_generator(tree, dest, root, subdir=None,
     already exists, it will be overwritten".
     """
     compression = zipfile.ZIP_DEFLATED
-    with tempfile.SpooledTemporaryFile() as buf:
-        with closing(zipfile.ZipFile(buf, "w", compression)) as zipf, \
-                tree.lock_read():
-            for dp, tp, ie in _export_iter_entries(tree, subdir):
-                mutter("  export {%s} kind %s to %s", tp, ie.kind, dest)
-
-                # zipfile.ZipFile switches all paths to forward
-                # slashes anyway, so just stick with that.
-                if force_mtime is not None:
-                    mtime = force_mtime
-                else:
-                    mtime = tree.get_file_mtime(tp)
-                date_time = time.localtime(mtime)[:6]
-                filename = osutils.pathjoin(root, dp)
-                if ie.kind == "file":
-                    zinfo = zipfile.ZipInfo(
-                        filename=filename,
-                        date_time=date_time)
-                    zinfo.compress_type = compression
-                    zinfo.external_attr = _FILE_ATTR
-                    content = tree.get_file_text(tp)
-                    zipf.writestr(zinfo, content)
-                elif ie.kind in ("directory", "tree-reference"):
-                    # Directories must contain a trailing slash, to indicate
-                    # to the zip routine that they are really directories and
-                    # not just empty files.
-                    zinfo = zipfile.ZipInfo(
-                        filename=filename + '/',
-                        date_time=date_time)
-                    zinfo.compress_type = compression
-                    zinfo.external_attr = _DIR_ATTR
-                    zipf.writestr(zinfo, '')
-                elif ie.kind == "symlink":
-                    zinfo = zipfile.ZipInfo(
-                        filename=(filename + '.lnk'),
-                        date_time=date_time)
-                    zinfo.compress_type = compression
-                    zinfo.external_attr = _FILE_ATTR
-                    zipf.writestr(zinfo, tree.get_symlink_target(tp))
-        # Urgh, headers are written last since they include e.g. file size.
-        # So we have to buffer it all :(
-        buf.seek(0)
-        for chunk in osutils.file_iterator(buf):
-            yield chunk
+    out = _ZipStream()
+    with tree.lock_read():
+        # Tree contents are extracted in a separate thread while the
+        # zipfile compresses earlier members.
+        entries = iter_in_thread(_zip_entries(
+            tree, dest, root, subdir, force_mtime, compression))
+        with closing(zipfile.ZipFile(out, "w", compression)) as zipf:
+            for zinfo, chunks in entries:
+                if chunks is None:
+                    zipf.writestr(zinfo, b'')
+                    continue
+                with zipf.open(zinfo, 'w') as f:
+                    for chunk in split_chunks(chunks):
+                        f.write(chunk)
+                        for data in out.pop():
+                            yield data
+                del chunks
+                for data in out.pop():
+                    yield data
+    for data in out.pop():
+        yield data
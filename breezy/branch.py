@@ -381,6 +381,26 @@ class Branch(controldir.ControlComponent):
         with self.lock_read():
             return self._do_revision_id_to_dotted_revno(revision_id)
 
+    def revision_ids_to_dotted_revnos(self, revision_ids):
+        """Given several revision ids, return their dotted revnos.
+
+        Revisions which are not in this branch, or which have no revno, are
+        left out of the result.
+
+        :return: a dict mapping revision ids to tuples like (1,) or (400,1,3).
+        """
+        result = {}
+        with self.lock_read():
+            for revision_id in revision_ids:
+                try:
+                    result[revision_id] = self.revision_id_to_dotted_revno(
+                        revision_id)
+                except (errors.NoSuchRevision,
+                        errors.GhostRevisionsHaveNoRevno,
+                        errors.UnsupportedOperation):
+                    pass
+        return result
+
     def _do_revision_id_to_dotted_revno(self, revision_id):
         """Worker function for revision_id_to_revno."""
         # Try the caches if they are loaded
@@ -490,11 +510,8 @@ class Branch(controldir.ControlComponent):
             # we need the full graph to get stable numbers, regardless of the
             # start_revision_id.
             if self._merge_sorted_revisions_cache is None:
-                last_revision = self.last_revision()
-                known_graph = self.repository.get_known_graph_ancestry(
-                    [last_revision])
-                self._merge_sorted_revisions_cache = known_graph.merge_sort(
-                    last_revision)
+                self._merge_sorted_revisions_cache = (
+                    self._merge_sort_revisions())
             filtered = self._filter_merge_sorted_revisions(
                 self._merge_sorted_revisions_cache, start_revision_id,
                 stop_revision_id, stop_rule)
@@ -508,6 +525,20 @@ class Branch(controldir.ControlComponent):
             else:
                 raise ValueError('invalid direction %r' % direction)
 
+    def _merge_sort_revisions(self):
+        """Merge sort the ancestry of the branch tip.
+
+        This is the worker function for iter_merge_sorted_revisions, which
+        caches the return value.
+
+        :return: A list of nodes with key, merge_depth, revno and
+            end_of_merge attributes, starting at the tip.
+        """
+        last_revision = self.last_revision()
+        known_graph = self.repository.get_known_graph_ancestry(
+            [last_revision])
+        return known_graph.merge_sort(last_revision)
+
     def _filter_merge_sorted_revisions(self, merge_sorted_revisions,
                                        start_revision_id, stop_revision_id,
                                        stop_rule):
@@ -5149,16 +5149,25 @@ class cmd_pack(Command):
     takes_options = [
         Option('clean-obsolete-packs',
                'Delete obsolete packs to save disk space.'),
+        Option('jobs',
+               help='Number of processes to use when recompressing data. '
+                    'Defaults to the number of CPUs.',
+               type=int),
         ]
 
-    def run(self, branch_or_repo='.', clean_obsolete_packs=False):
+    def run(self, branch_or_repo='.', clean_obsolete_packs=False, jobs=None):
         dir = controldir.ControlDir.open_containing(branch_or_repo)[0]
         try:
             branch = dir.open_branch()
             repository = branch.repository
         except errors.NotBranchError:
             repository = dir.open_repository()
-        repository.pack(clean_obsolete_packs=clean_obsolete_packs)
+        if jobs is None:
+            jobs = osutils.local_concurrency()
+        elif jobs < 1:
+            raise errors.BzrCommandError(
+                gettext('--jobs must be at least 1.'))
+        repository.pack(clean_obsolete_packs=clean_obsolete_packs, jobs=jobs)
 
 
 class cmd_plugins(Command):
@@ -6093,17 +6102,16 @@ class cmd_tags(Command):
         sort(branch, tags)
         if not show_ids:
             # [ (tag, revid), ... ] -> [ (tag, dotted_revno), ... ]
+            revnos = branch.revision_ids_to_dotted_revnos(
+                set(revid for (tag, revid) in tags))
             for index, (tag, revid) in enumerate(tags):
-                try:
-                    revno = branch.revision_id_to_dotted_revno(revid)
-                    if isinstance(revno, tuple):
-                        revno = '.'.join(map(str, revno))
-                except (errors.NoSuchRevision,
-                        errors.GhostRevisionsHaveNoRevno,
-                        errors.UnsupportedOperation):
+                revno = revnos.get(revid)
+                if revno is None:
                     # Bad tag data/merges can lead to tagged revisions
                     # which are not in this branch. Fail gracefully ...
                     revno = '?'
+                elif isinstance(revno, tuple):
+                    revno = '.'.join(map(str, revno))
                 tags[index] = (tag, revno)
         else:
             tags = [(tag, revid.decode('utf-8')) for (tag, revid) in tags]
@@ -7092,6 +7100,7 @@ def _register_lazy_builtins():
             ('cmd_resolve', ['resolved'], 'breezy.conflicts'),
             ('cmd_conflicts', [], 'breezy.conflicts'),
             ('cmd_ping', [], 'breezy.bzr.smart.ping'),
+            ('cmd_monitor_changes', [], 'breezy.bzr.changemonitor'),
             ('cmd_sign_my_commits', [], 'breezy.commit_signature_commands'),
             ('cmd_verify_signatures', [], 'breezy.commit_signature_commands'),
             ('cmd_test_script', [], 'breezy.cmd_test_script'),
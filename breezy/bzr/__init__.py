@@ -319,6 +319,33 @@ register_metadir(
     experimental=True,
     hidden=True,
     )
+register_metadir(
+    controldir.format_registry, 'development-bloom',
+    'breezy.bzr.groupcompress_repo.RepositoryFormat2aBloom',
+    help='Current development format, 2a variant whose indices have bloom '
+         'filters, to skip packs that do not have a key. Repositories in '
+         'this format can only be read by bzr.dev. Please read '
+         'https://www.breezy-vcs.org/developers/development-repo.html '
+         'before use.',
+    branch_format='breezy.bzr.branch.BzrBranchFormat7',
+    tree_format='breezy.bzr.workingtree_4.WorkingTreeFormat6',
+    experimental=True,
+    hidden=True,
+    )
+register_metadir(
+    controldir.format_registry, 'development-dirstate5',
+    'breezy.bzr.groupcompress_repo.RepositoryFormat2a',
+    help='Current development format, 2a variant whose working trees store '
+         'the dirstate in a binary format that can be read without parsing '
+         'all of it. Working trees in this format can only be read by '
+         'bzr.dev. Please read '
+         'https://www.breezy-vcs.org/developers/development-repo.html '
+         'before use.',
+    branch_format='breezy.bzr.branch.BzrBranchFormat7',
+    tree_format='breezy.bzr.workingtree_4.WorkingTreeFormat7',
+    experimental=True,
+    hidden=True,
+    )
 register_metadir(
     controldir.format_registry, 'development5-subtree',
     'breezy.bzr.knitpack_repo.RepositoryFormatPackDevelopment2Subtree',
@@ -29,6 +29,7 @@ from breezy import (
     shelf,
     )
 from breezy.bzr import (
+    revno_cache,
     tag as _mod_tag,
     )
 """)
@@ -379,6 +380,9 @@ class BzrBranch(Branch, _RelockDebugMixin):
                 return old_tip
             return None
 
+    def _merge_sort_revisions(self):
+        return revno_cache.merge_sort(self)
+
     def _read_last_revision_info(self):
         revision_string = self._transport.get_bytes('last-revision')
         revno, revision_id = revision_string.rstrip(b'\n').split(b' ', 1)
@@ -23,13 +23,17 @@ from ..lazy_import import lazy_import
 lazy_import(globals(), """
 import bisect
 import math
+import mmap
 import tempfile
 import zlib
 """)
+import sys
+import threading
 
 from .. import (
     chunk_writer,
     debug,
+    errors,
     fifo_cache,
     lru_cache,
     osutils,
@@ -44,7 +48,10 @@ from .index import _OPTION_NODE_REFS, _OPTION_KEY_ELEMENTS, _OPTION_LEN
 
 
 _BTSIGNATURE = b"B+Tree Graph Index 2\n"
+# Revision 3 adds a bloom filter of the keys after the last page.
+_BTSIGNATURE_BLOOM = b"B+Tree Graph Index 3\n"
 _OPTION_ROW_LENGTHS = b"row_lengths="
+_OPTION_BLOOM = b"bloom="
 _LEAF_FLAG = b"type=leaf\n"
 _INTERNAL_FLAG = b"type=internal\n"
 _INTERNAL_OFFSET = b"offset="
@@ -55,6 +62,128 @@ _PAGE_SIZE = 4096
 # 4K per page: 4MB - 1000 entries
 _NODE_CACHE_SIZE = 1000
 
+# Indices on local disk that are at least this large are memory-mapped, so
+# reading a page does not need a system call or a copy of the data. Smaller
+# indices are read with a few readv calls anyway.
+_MMAP_MIN_SIZE = 64 * _PAGE_SIZE
+
+
+class _BloomFilter(object):
+    """A bloom filter of the keys in an index.
+
+    Each key sets hash_count bits, picked by double hashing the md5 of the
+    serialised key.
+    """
+
+    def __init__(self, hash_count, bits):
+        """Create a _BloomFilter.
+
+        :param hash_count: The number of bits set for each key.
+        :param bits: The bytes (or bytearray) of the filter.
+        """
+        self.hash_count = hash_count
+        self.bits = bits
+        self._bit_count = len(bits) * 8
+
+    @classmethod
+    def for_key_count(cls, key_count, bits_per_key):
+        """Create an empty filter sized for key_count keys."""
+        hash_count = max(1, int(round(bits_per_key * math.log(2))))
+        return cls(hash_count,
+                   bytearray(max(1, (key_count * bits_per_key + 7) // 8)))
+
+    def _positions(self, key):
+        digest = osutils.md5(b'\x00'.join(key)).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        bit_count = self._bit_count
+        return [(h1 + i * h2) % bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class _SharedNodeCache(object):
+    """A byte-bounded cache of parsed nodes shared by BTreeGraphIndex objects.
+
+    Only indices that are never modified once named (such as those of named
+    packs) use this cache. Nodes are keyed on (index name, index size, page
+    offset). The size of each node is taken to be its uncompressed size.
+
+    This is used from several threads at once by the smart server, so all
+    access is serialised.
+    """
+
+    def __init__(self, max_size):
+        self._cache = lru_cache.LRUSizeCache(
+            max_size, compute_size=lambda entry: entry[2])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return (node, header, size) for key, or None."""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def add(self, key, node, header, size):
+        with self._lock:
+            self._cache[key] = (node, header, size)
+
+    def invalidate(self, names):
+        """Drop all nodes from the indices with the given names."""
+        names = set(names)
+        with self._lock:
+            for key in self._cache.keys():
+                if key[0] in names:
+                    self._cache.remove(key)
+
+
+# The process-wide cache used by indices with _shared_nodes set, if any.
+_shared_node_cache = None
+
+
+def set_shared_node_cache(max_size):
+    """Share parsed nodes of immutable indices across the process.
+
+    Long running processes like the smart server open the same repositories
+    over and over, and would otherwise read and parse the same index pages
+    each time.
+
+    :param max_size: Approximately how many bytes of nodes to keep, or None
+        to stop sharing nodes.
+    """
+    global _shared_node_cache
+    if max_size is None:
+        _shared_node_cache = None
+    else:
+        _shared_node_cache = _SharedNodeCache(max_size)
+
+
+def invalidate_shared_nodes(names):
+    """Forget any shared nodes of the indices named names.
+
+    This should be called when indices are removed, e.g. because a pack has
+    been removed from pack-names.
+    """
+    cache = _shared_node_cache
+    if cache is not None:
+        cache.invalidate(names)
+
 
 class _BuilderRow(object):
     """The stored state accumulated while writing out a row in the index.
@@ -135,15 +264,21 @@ class BTreeBuilder(index.GraphIndexBuilder):
     VALUE          := no-newline-no-null-bytes
     """
 
-    def __init__(self, reference_lists=0, key_elements=1, spill_at=100000):
+    def __init__(self, reference_lists=0, key_elements=1, spill_at=100000,
+                 bloom_bits_per_key=0):
         """See GraphIndexBuilder.__init__.
 
         :param spill_at: Optional parameter controlling the maximum number
             of nodes that BTreeBuilder will hold in memory.
+        :param bloom_bits_per_key: If not 0, write a bloom filter of the keys
+            using this many bits per key, so readers can reject most absent
+            keys without reading leaf pages. Such indices need a reader that
+            understands index revision 3.
         """
         index.GraphIndexBuilder.__init__(self, reference_lists=reference_lists,
                                          key_elements=key_elements)
         self._spill_at = spill_at
+        self._bloom_bits_per_key = bloom_bits_per_key
         self._backing_indices = []
         # A map of {key: (node_refs, value)}
         self._nodes = {}
@@ -363,7 +498,8 @@ class BTreeBuilder(index.GraphIndexBuilder):
             self._add_key(string_key, line, rows,
                           allow_optimize=allow_optimize)
 
-    def _write_nodes(self, node_iterator, allow_optimize=True):
+    def _write_nodes(self, node_iterator, allow_optimize=True,
+                     bloom_bits_per_key=0):
         """Write node_iterator out as a B+Tree.
 
         :param node_iterator: An iterator of sorted nodes. Each node should
@@ -371,6 +507,8 @@ class BTreeBuilder(index.GraphIndexBuilder):
         :param allow_optimize: If set to False, prevent setting the optimize
             flag when writing out. This is used by the _spill_mem_keys_to_disk
             functionality.
+        :param bloom_bits_per_key: If not 0, append a bloom filter of the keys
+            with this many bits per key.
         :return: A file handle for a temporary file containing a B+Tree for
             the nodes.
         """
@@ -384,6 +522,7 @@ class BTreeBuilder(index.GraphIndexBuilder):
         # A stack with the number of nodes of each size. 0 is the root node
         # and must always be 1 (if there are any nodes in the tree).
         self.row_lengths = []
+        bloom_keys = []
         # Loop over all nodes adding them to the bottom row
         # (rows[-1]). When we finish a chunk in a row,
         # propagate the key that didn't fit (comes after the chunk) to the
@@ -393,20 +532,38 @@ class BTreeBuilder(index.GraphIndexBuilder):
                 # First key triggers the first row
                 rows.append(_LeafBuilderRow())
             key_count += 1
+            if bloom_bits_per_key:
+                bloom_keys.append(node[1])
             string_key, line = _btree_serializer._flatten_node(
                 node, self.reference_lists)
             self._add_key(string_key, line, rows,
                           allow_optimize=allow_optimize)
+        if bloom_keys:
+            bloom = _BloomFilter.for_key_count(key_count, bloom_bits_per_key)
+            for key in bloom_keys:
+                bloom.add(key)
+            del bloom_keys
+        else:
+            bloom = None
         for row in reversed(rows):
-            pad = (not isinstance(row, _LeafBuilderRow))
+            # The bloom filter starts on a page boundary, so pad the last
+            # leaf page.
+            pad = (bloom is not None
+                   or not isinstance(row, _LeafBuilderRow))
             row.finish_node(pad=pad)
-        lines = [_BTSIGNATURE]
+        if bloom is None:
+            lines = [_BTSIGNATURE]
+        else:
+            lines = [_BTSIGNATURE_BLOOM]
         lines.append(b'%s%d\n' % (_OPTION_NODE_REFS, self.reference_lists))
         lines.append(b'%s%d\n' % (_OPTION_KEY_ELEMENTS, self._key_length))
         lines.append(b'%s%d\n' % (_OPTION_LEN, key_count))
         row_lengths = [row.nodes for row in rows]
         lines.append(_OPTION_ROW_LENGTHS + ','.join(
             map(str, row_lengths)).encode('ascii') + b'\n')
+        if bloom is not None:
+            lines.append(b'%s%d,%d\n' % (_OPTION_BLOOM, bloom.hash_count,
+                                          len(bloom.bits)))
         if row_lengths and row_lengths[-1] > 1:
             result = tempfile.NamedTemporaryFile(prefix='bzr-index-')
         else:
@@ -436,6 +593,8 @@ class BTreeBuilder(index.GraphIndexBuilder):
                                          " expected: %d, got: %d"
                                          % ((row.nodes - 1) * _PAGE_SIZE,
                                             copied_len))
+        if bloom is not None:
+            result.write(bloom.bits)
         result.flush()
         size = result.tell()
         result.seek(0)
@@ -447,7 +606,9 @@ class BTreeBuilder(index.GraphIndexBuilder):
         :return: A file handle for a temporary file containing the nodes added
             to the index.
         """
-        return self._write_nodes(self.iter_all_entries())[0]
+        return self._write_nodes(
+            self.iter_all_entries(),
+            bloom_bits_per_key=self._bloom_bits_per_key)[0]
 
     def iter_all_entries(self):
         """Iterate over all keys within the index
@@ -643,6 +804,20 @@ class _InternalNode(object):
         return nodes
 
 
+class BloomBTreeBuilder(BTreeBuilder):
+    """A BTreeBuilder that writes bloom filters by default.
+
+    Repository formats whose indices carry bloom filters use this as their
+    index_builder_class.
+    """
+
+    def __init__(self, reference_lists=0, key_elements=1, spill_at=100000,
+                 bloom_bits_per_key=10):
+        super(BloomBTreeBuilder, self).__init__(
+            reference_lists=reference_lists, key_elements=key_elements,
+            spill_at=spill_at, bloom_bits_per_key=bloom_bits_per_key)
+
+
 class BTreeGraphIndex(object):
     """Access to nodes via the standard GraphIndex interface for B+Tree's.
 
@@ -671,6 +846,9 @@ class BTreeGraphIndex(object):
         self._name = name
         self._size = size
         self._file = None
+        # An mmap of the index file; None until tried, False if the file
+        # cannot be mapped.
+        self._mmap = None
         self._recommended_pages = self._compute_recommended_pages()
         self._root_node = None
         self._base_offset = offset
@@ -689,6 +867,12 @@ class BTreeGraphIndex(object):
         self._key_count = None
         self._row_lengths = None
         self._row_offsets = None  # Start of each row, [-1] is the end
+        # (hash_count, length) of the bloom filter, if the index has one.
+        self._bloom_header = None
+        self._bloom = None
+        # Set by users that know this index is immutable, so that its nodes
+        # may be shared through _shared_node_cache.
+        self._shared_nodes = False
 
     def __hash__(self):
         return id(self)
@@ -727,7 +911,12 @@ class BTreeGraphIndex(object):
         """
         found = {}
         start_of_leaves = None
-        for node_pos, node in self._read_nodes(sorted(nodes)):
+        shared_cache = self._get_shared_node_cache()
+        if shared_cache is not None:
+            sizes = {}
+        else:
+            sizes = None
+        for node_pos, node in self._read_nodes(sorted(nodes), sizes):
             if node_pos == 0:  # Special case
                 self._root_node = node
             else:
@@ -737,9 +926,55 @@ class BTreeGraphIndex(object):
                     self._internal_node_cache[node_pos] = node
                 else:
                     self._leaf_node_cache[node_pos] = node
+            if shared_cache is not None:
+                if node_pos == 0:
+                    header = (self.node_ref_lists, self._key_length,
+                              self._key_count, self._row_lengths,
+                              self._bloom_header)
+                else:
+                    header = None
+                shared_cache.add(self._shared_node_key(node_pos), node,
+                                 header, sizes[node_pos])
             found[node_pos] = node
         return found
 
+    def _get_shared_node_cache(self):
+        """Return the process-wide node cache, if this index may use it."""
+        if not self._shared_nodes or self._size is None:
+            return None
+        return _shared_node_cache
+
+    def _shared_node_key(self, node_pos):
+        return (self._name, self._size,
+                self._base_offset + node_pos * _PAGE_SIZE)
+
+    def _get_shared_nodes(self, cache, node_indexes, found):
+        """Find nodes in the process-wide node cache.
+
+        Nodes that are found are added to cache and found.
+
+        :return: A list of the node indexes that were not found.
+        """
+        shared_cache = self._get_shared_node_cache()
+        if shared_cache is None:
+            return node_indexes
+        needed = []
+        for idx in node_indexes:
+            entry = shared_cache.get(self._shared_node_key(idx))
+            if entry is None:
+                needed.append(idx)
+                continue
+            node, header, size = entry
+            if idx == 0:
+                (self.node_ref_lists, self._key_length, self._key_count,
+                 self._row_lengths, self._bloom_header) = header
+                self._compute_row_offsets()
+                self._root_node = node
+            else:
+                cache[idx] = node
+            found[idx] = node
+        return needed
+
     def _compute_recommended_pages(self):
         """Convert transport's recommended_page_size into btree pages.
 
@@ -892,6 +1127,7 @@ class BTreeGraphIndex(object):
         # round-trips in the future. We may re-evaluate this if InternalNode
         # memory starts to be an issue.
         self._leaf_node_cache.clear()
+        self._close_mmap()
 
     def external_references(self, ref_list_num):
         if self._root_node is None:
@@ -947,6 +1183,8 @@ class BTreeGraphIndex(object):
                 found[idx] = cache[idx]
             except KeyError:
                 needed.append(idx)
+        if needed:
+            needed = self._get_shared_nodes(cache, needed, found)
         if not needed:
             return found
         needed = self._expand_offsets(needed)
@@ -1178,7 +1416,7 @@ class BTreeGraphIndex(object):
                 else:
                     needed_keys.append(key)
 
-        needed_keys = keys
+        needed_keys = self._filter_with_bloom(keys)
         if not needed_keys:
             return
         nodes, nodes_and_keys = self._walk_through_internal_nodes(needed_keys)
@@ -1194,6 +1432,35 @@ class BTreeGraphIndex(object):
                     else:
                         yield (self, next_sub_key, value)
 
+    def _get_bloom(self):
+        """Return the bloom filter of this index, or None if it has none."""
+        if self._bloom is None and self._bloom_header is not None:
+            hash_count, length = self._bloom_header
+            start = self._base_offset + self._row_offsets[-1] * _PAGE_SIZE
+            if self._get_mmap():
+                bits = self._mmap[start:start + length]
+            else:
+                bits = next(iter(
+                    self._transport.readv(self._name, [(start, length)])))[1]
+            if len(bits) != length:
+                raise index.BadIndexData(self)
+            self._bloom = _BloomFilter(hash_count, bits)
+        return self._bloom
+
+    def _filter_with_bloom(self, keys):
+        """Drop the keys that the bloom filter shows are not in this index.
+
+        The root node must have been read already.
+
+        :return: A collection of the keys that may be present.
+        """
+        if self._bloom_header is None or len(self._row_lengths) < 2:
+            # Either there is no filter, or all keys are in the root node
+            # that has already been read.
+            return keys
+        bloom = self._get_bloom()
+        return [key for key in keys if key in bloom]
+
     def _find_ancestors(self, keys, ref_list_num, parent_map, missing_keys):
         """Find the parent_map information for the set of keys.
 
@@ -1227,6 +1494,12 @@ class BTreeGraphIndex(object):
         if ref_list_num >= self.node_ref_lists:
             raise ValueError('No ref list %d, index has %d ref lists'
                              % (ref_list_num, self.node_ref_lists))
+        present_keys = self._filter_with_bloom(keys)
+        if len(present_keys) != len(keys):
+            missing_keys.update(set(keys).difference(present_keys))
+            keys = present_keys
+            if not keys:
+                return set()
 
         # The main trick we are trying to accomplish is that when we find a
         # key listing its parents, we expect that the parent key is also likely
@@ -1424,7 +1697,11 @@ class BTreeGraphIndex(object):
             data. (which may be of length 0).
         """
         signature = bytes[0:len(self._signature())]
-        if not signature == self._signature():
+        if signature == _BTSIGNATURE_BLOOM:
+            option_count = 5
+        elif signature == self._signature():
+            option_count = 4
+        else:
             raise index.BadIndexFormatSignature(self._name, BTreeGraphIndex)
         lines = bytes[len(self._signature()):].splitlines()
         options_line = lines[0]
@@ -1459,12 +1736,79 @@ class BTreeGraphIndex(object):
         except ValueError:
             raise index.BadIndexOptions(self)
         self._compute_row_offsets()
+        if option_count == 5:
+            options_line = lines[4]
+            if not options_line.startswith(_OPTION_BLOOM):
+                raise index.BadIndexOptions(self)
+            try:
+                hash_count, length = map(
+                    int, options_line[len(_OPTION_BLOOM):].split(b','))
+            except ValueError:
+                raise index.BadIndexOptions(self)
+            self._bloom_header = (hash_count, length)
 
         # calculate the bytes we have processed
-        header_end = (len(signature) + sum(map(len, lines[0:4])) + 4)
+        header_end = (len(signature) + sum(map(len, lines[0:option_count]))
+                      + option_count)
         return header_end, bytes[header_end:]
 
-    def _read_nodes(self, nodes):
+    def _get_mmap(self):
+        """Map the index file into memory, if it is large and local.
+
+        :return: The mmap, or False if the index is not mapped.
+        """
+        if self._mmap is not None:
+            return self._mmap
+        self._mmap = False
+        # Mapped files cannot be renamed or deleted on Windows, which would
+        # get in the way of repacking.
+        if (self._size is None or self._size < _MMAP_MIN_SIZE
+                or sys.platform == 'win32'):
+            return False
+        try:
+            path = self._transport.local_abspath(self._name)
+        except errors.NotLocalUrl:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError) as e:
+            trace.mutter('not mapping %s: %s', path, e)
+            return False
+        if len(mapped) < self._base_offset + self._size:
+            # Let reading through the transport report the short file.
+            mapped.close()
+            return False
+        self._mmap = mapped
+        return mapped
+
+    def _close_mmap(self):
+        """Unmap the index file, if it is mapped.
+
+        It is mapped again by the next read that needs it.
+        """
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Something still refers to the mapped data; the file is
+                # unmapped once that reference goes away.
+                pass
+        self._mmap = None
+
+    def _read_mapped_ranges(self, ranges):
+        """Read ranges from the mapped index file, as readv would."""
+        view = memoryview(self._mmap)
+        data_ranges = []
+        for offset, size in ranges:
+            if offset == self._base_offset:
+                # The header is parsed with bytes methods.
+                data_ranges.append((offset, self._mmap[offset:offset + size]))
+            else:
+                data_ranges.append((offset, view[offset:offset + size]))
+        return data_ranges
+
+    def _read_nodes(self, nodes, sizes=None):
         """Read some nodes from disk into the LRU cache.
 
         This performs a readv to get the node data into memory, and parses each
@@ -1473,6 +1817,8 @@ class BTreeGraphIndex(object):
         a read may improve performance.
 
         :param nodes: The nodes to read. 0 - first node, 1 - second node etc.
+        :param sizes: If not None, a dict that will be updated with the
+            uncompressed size of each node read.
         :return: None
         """
         # may be the byte string of the whole file
@@ -1512,13 +1858,15 @@ class BTreeGraphIndex(object):
             # already have the whole file
             data_ranges = [(start, bytes[start:start + size])
                            for start, size in ranges]
-        elif self._file is None:
-            data_ranges = self._transport.readv(self._name, ranges)
-        else:
+        elif self._file is not None:
             data_ranges = []
             for offset, size in ranges:
                 self._file.seek(offset)
                 data_ranges.append((offset, self._file.read(size)))
+        elif self._get_mmap():
+            data_ranges = self._read_mapped_ranges(ranges)
+        else:
+            data_ranges = self._transport.readv(self._name, ranges)
         for offset, data in data_ranges:
             offset -= base_offset
             if offset == 0:
@@ -1526,6 +1874,11 @@ class BTreeGraphIndex(object):
                 offset, data = self._parse_header_from_bytes(data)
                 if len(data) == 0:
                     continue
+            elif (self._bloom_header is not None
+                    and offset >= self._row_offsets[-1] * _PAGE_SIZE):
+                # Before the header was read, these pages of the bloom filter
+                # looked like nodes.
+                continue
             bytes = zlib.decompress(data)
             if bytes.startswith(_LEAF_FLAG):
                 node = self._leaf_factory(bytes, self._key_length,
@@ -1534,6 +1887,8 @@ class BTreeGraphIndex(object):
                 node = _InternalNode(bytes)
             else:
                 raise AssertionError("Unknown node type for %r" % bytes)
+            if sizes is not None:
+                sizes[offset // _PAGE_SIZE] = len(bytes)
             yield offset // _PAGE_SIZE, node
 
     def _signature(self):
@@ -1552,6 +1907,7 @@ class BTreeGraphIndex(object):
         node_end = self._row_offsets[-1]
         for node in self._read_nodes(list(range(start_node, node_end))):
             pass
+        self._get_bloom()
 
 
 _gcchk_factory = _LeafNode
@@ -1806,6 +1806,11 @@ class ConvertMetaToMeta(controldir.Converter):
                     and isinstance(self.target_format.workingtree_format,
                                    workingtree_4.WorkingTreeFormat6)):
                     workingtree_4.Converter4or5to6().convert(tree)
+                if (isinstance(tree, workingtree_4.DirStateWorkingTree)
+                    and not isinstance(tree, workingtree_4.WorkingTree7)
+                    and isinstance(self.target_format.workingtree_format,
+                                   workingtree_4.WorkingTreeFormat7)):
+                    workingtree_4.Converter6to7().convert(tree)
         return to_convert
 
 
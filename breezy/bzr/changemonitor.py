@@ -0,0 +1,561 @@
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Watch a working tree for changes, so that status does not have to scan it.
+
+A change monitor is a long-running process (started with
+``brz monitor-changes``) that uses inotify to record which paths in a
+working tree changed. It answers queries on a unix socket in the control
+directory of the tree.
+
+Queries use tokens, made up of a random epoch and a generation number. A
+client sends the token it got earlier, and gets back a new token and the
+paths that changed since the old one; or "reset" if the monitor can't tell,
+for example because the kernel event queue overflowed.
+
+After a full comparison of the tree with its basis, the tree stores the
+token together with the paths that were reported as changed. The next
+comparison only has to look at those paths and the paths that changed on
+disk since, as long as the dirstate itself did not change.
+"""
+
+import errno
+import os
+import struct
+
+from ..lazy_import import lazy_import
+lazy_import(globals(), """
+import select
+import socket
+""")
+
+from .. import (
+    errors,
+    osutils,
+    trace,
+    )
+from ..commands import Command
+from ..option import Option
+
+
+SOCKET_NAME = 'change-monitor.sock'
+
+STATE_NAME = 'change-monitor-state'
+
+_STATE_HEADER = b'brz change monitor state 1\n'
+
+# Number of distinct changed paths that are remembered, before the monitor
+# gives up and tells clients to scan the whole tree.
+MAX_CHANGED_PATHS = 100000
+
+# Seconds to wait for a monitor to answer.
+CLIENT_TIMEOUT = 5.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR |
+    IN_DONT_FOLLOW)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyUnavailable(errors.BzrError):
+
+    _fmt = "inotify is not available on this platform: %(reason)s"
+
+    def __init__(self, reason):
+        errors.BzrError.__init__(self, reason=reason)
+
+
+class Inotify(object):
+    """Minimal wrapper around the Linux inotify API."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(
+                ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise InotifyUnavailable(str(e))
+        self._add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._get_errno = ctypes.get_errno
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = self._get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a directory.
+
+        :return: The watch descriptor
+        """
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = self._get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        """Read the events that are queued, without blocking.
+
+        :return: List of (wd, mask, cookie, name) tuples
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _is_control_path(relpath):
+    return b'.bzr' in relpath.split(b'/')
+
+
+class ChangeMonitor(object):
+    """Record the paths that change in a working tree.
+
+    :ivar epoch: Random identifier that changes whenever changes may have
+        been missed.
+    :ivar generation: Number that increases with every batch of events.
+    """
+
+    def __init__(self, basedir, control_dir):
+        self.basedir = osutils.safe_utf8(basedir)
+        self.control_dir = osutils.safe_utf8(control_dir)
+        self._inotify = Inotify()
+        self._reset()
+
+    def _reset(self):
+        """Forget all changes and (re)create all watches."""
+        self.epoch = osutils.rand_chars(16).encode('ascii')
+        self.generation = 0
+        self.complete = True
+        self._changed = {}
+        if getattr(self, '_paths', None):
+            self._inotify.close()
+            self._inotify = Inotify()
+        self._paths = {}
+        self._watch_tree(b'')
+        self._watch(self.control_dir, None)
+
+    def _watch(self, abspath, relpath):
+        try:
+            wd = self._inotify.add_watch(abspath)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                # Removed again before we could watch it; its parent will
+                # have seen that.
+                return
+            if e.errno == errno.ENOSPC:
+                trace.warning(
+                    'Not enough inotify watches to monitor %s',
+                    self.basedir.decode('utf-8', 'replace'))
+            else:
+                trace.warning('Unable to watch %s: %s', abspath, e)
+            self.complete = False
+            return
+        self._paths[wd] = relpath
+
+    def _watch_tree(self, relpath):
+        top = osutils.pathjoin(self.basedir, relpath)
+        for dirpath, dirnames, filenames in os.walk(top):
+            dir_relpath = dirpath[len(self.basedir) + 1:]
+            if not dir_relpath:
+                if b'.bzr' in dirnames:
+                    dirnames.remove(b'.bzr')
+            self._watch(dirpath, dir_relpath)
+
+    def _record(self, relpath):
+        self._changed[relpath] = self.generation
+        if len(self._changed) > MAX_CHANGED_PATHS:
+            self.epoch = osutils.rand_chars(16).encode('ascii')
+            self._changed.clear()
+
+    def process_events(self):
+        """Process the events queued by the kernel."""
+        events = self._inotify.read_events()
+        if not events:
+            return
+        self.generation += 1
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Changes were lost, make all clients scan the tree.
+                self.epoch = osutils.rand_chars(16).encode('ascii')
+                self._changed.clear()
+                continue
+            try:
+                dir_relpath = self._paths[wd]
+            except KeyError:
+                continue
+            if mask & IN_IGNORED:
+                del self._paths[wd]
+                continue
+            if dir_relpath is None:
+                # The control directory; only the dirstate matters
+                if name == b'dirstate':
+                    self._record(b'.bzr')
+                continue
+            if name:
+                relpath = osutils.pathjoin(dir_relpath, name)
+            else:
+                relpath = dir_relpath
+            self._record(relpath)
+            if mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_MOVED_TO):
+                # The watches below a moved directory have stale paths.
+                self._reset()
+                return
+            if mask & IN_ISDIR and mask & IN_CREATE:
+                self._watch_tree(relpath)
+
+    def changes_since(self, token):
+        """Return the paths that changed since a token was handed out.
+
+        :param token: A token from an earlier call, or None
+        :return: Tuple with a new token and the set of changed paths, or
+            None if they are not known.
+        """
+        self.process_events()
+        new_token = b'%s:%d' % (self.epoch, self.generation)
+        if not self.complete or token is None:
+            return new_token, None
+        try:
+            epoch, generation = token.split(b':', 1)
+            generation = int(generation)
+        except ValueError:
+            return new_token, None
+        if epoch != self.epoch:
+            return new_token, None
+        return new_token, set(
+            path for (path, g) in self._changed.items() if g > generation)
+
+    def _handle(self, conn):
+        conn.settimeout(CLIENT_TIMEOUT)
+        with conn, conn.makefile('rb') as f:
+            request = f.readline().rstrip(b'\n').split(b' ')
+            if len(request) != 2 or request[0] != b'changes':
+                conn.sendall(b'error unknown request\n')
+                return
+            token = request[1]
+            if token == b'-':
+                token = None
+            new_token, paths = self.changes_since(token)
+            if paths is None:
+                conn.sendall(b'reset %s\n' % new_token)
+            else:
+                conn.sendall(b'changes %s\n' % new_token)
+                conn.sendall(b'\0'.join(sorted(paths)))
+
+    def serve(self, sock, should_stop=None):
+        """Answer queries on a listening socket.
+
+        :param sock: Listening socket
+        :param should_stop: Optional function; serving stops when it
+            returns True
+        """
+        while should_stop is None or not should_stop():
+            readable = select.select([self._inotify, sock], [], [], 0.5)[0]
+            if self._inotify in readable:
+                self.process_events()
+            if sock in readable:
+                conn = sock.accept()[0]
+                try:
+                    self._handle(conn)
+                except (OSError, socket.timeout) as e:
+                    trace.mutter('error answering change monitor query: %s',
+                                 e)
+
+    def close(self):
+        self._inotify.close()
+
+
+def _socket_call(fn, socket_path):
+    """Bind or connect a unix socket.
+
+    Unix socket paths are limited to about a hundred bytes, so longer paths
+    are reached through a file descriptor for their directory.
+    """
+    if len(osutils.safe_utf8(socket_path)) < 100:
+        return fn(socket_path)
+    dirname, basename = os.path.split(socket_path)
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        return fn('/proc/self/fd/%d/%s' % (fd, basename))
+    finally:
+        os.close(fd)
+
+
+def query_monitor(socket_path, token):
+    """Ask a change monitor for the paths that changed.
+
+    :param socket_path: Path of the monitor's socket
+    :param token: Token from an earlier query, or None
+    :return: None if there is no monitor, or a tuple with the new token and
+        the set of changed paths (None if they are not known)
+    """
+    af_unix = getattr(socket, 'AF_UNIX', None)
+    if af_unix is None or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(af_unix, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CLIENT_TIMEOUT)
+        _socket_call(sock.connect, socket_path)
+        sock.sendall(b'changes %s\n' % (token or b'-'))
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    except (OSError, socket.timeout) as e:
+        trace.mutter('unable to query change monitor %s: %s',
+                     socket_path, e)
+        return None
+    finally:
+        sock.close()
+    header, _, body = b''.join(chunks).partition(b'\n')
+    try:
+        kind, new_token = header.split(b' ')
+    except ValueError:
+        return None
+    if kind == b'reset':
+        return new_token, None
+    if kind != b'changes':
+        return None
+    if body:
+        return new_token, set(body.split(b'\0'))
+    return new_token, set()
+
+
+def read_state(transport):
+    """Read the state stored after the last comparison.
+
+    :return: Tuple with token, source revision id and the paths that were
+        reported as changed; or None
+    """
+    try:
+        data = transport.get_bytes(STATE_NAME)
+    except errors.NoSuchFile:
+        return None
+    if not data.startswith(_STATE_HEADER):
+        return None
+    lines = data[len(_STATE_HEADER):].split(b'\n', 2)
+    if len(lines) != 3:
+        return None
+    token, revid, paths = lines
+    if paths:
+        paths = set(paths.split(b'\0'))
+    else:
+        paths = set()
+    return token, revid, paths
+
+
+def write_state(transport, token, revid, paths):
+    transport.put_bytes(
+        STATE_NAME,
+        _STATE_HEADER + token + b'\n' + revid + b'\n' +
+        b'\0'.join(sorted(paths)))
+
+
+def _versioned_dir_checker(state):
+    """Return a function that checks whether a path is a versioned directory.
+    """
+    versioned_dirs = {b'': True}
+
+    def is_versioned_dir(path):
+        try:
+            return versioned_dirs[path]
+        except KeyError:
+            entry = state._get_entry(0, path_utf8=path)
+            ret = entry[0] is not None and entry[1][0][0] == b'd'
+            versioned_dirs[path] = ret
+            return ret
+    return is_versioned_dir
+
+
+def _collapse_unversioned(is_versioned_dir, paths):
+    """Replace paths below unversioned directories with those directories.
+
+    A full comparison reports unversioned directories, but not their
+    contents.
+    """
+    ret = set()
+    for path in paths:
+        parts = path.split(b'/')
+        for i in range(1, len(parts)):
+            parent = b'/'.join(parts[:i])
+            if not is_versioned_dir(parent):
+                path = parent
+                break
+        ret.add(path)
+    return ret
+
+
+def iter_changes_with_monitor(tree, state, source_revid, want_unversioned,
+                              make_iter_changes):
+    """Compare a dirstate tree with a basis, using a change monitor.
+
+    :param tree: The working tree
+    :param state: The locked dirstate of the tree
+    :param source_revid: Revision id of the tree compared with
+    :param want_unversioned: Whether unversioned files are reported
+    :param make_iter_changes: Function that takes a set of utf8 paths to
+        search, and returns an iterator over the changes at or below those
+        paths
+    :return: Iterator over the changes, or None if there is no monitor
+    """
+    control_transport = tree._transport
+    try:
+        socket_path = control_transport.local_abspath(SOCKET_NAME)
+    except errors.NotLocalUrl:
+        return None
+    if not os.path.exists(socket_path):
+        return None
+    stored = read_state(control_transport)
+    if stored is not None and stored[1] != source_revid:
+        stored = None
+    reply = query_monitor(socket_path, stored[0] if stored else None)
+    if reply is None:
+        return None
+    token, changed = reply
+    if (stored is None or changed is None or
+            any(_is_control_path(path) for path in changed)):
+        # Compare the whole tree
+        trace.mutter('change monitor: comparing the whole tree')
+        changes = make_iter_changes({b''})
+    else:
+        is_versioned_dir = _versioned_dir_checker(state)
+        search = stored[2] | _collapse_unversioned(is_versioned_dir, changed)
+        trace.mutter('change monitor: comparing %d paths', len(search))
+        if not search:
+            changes = iter([])
+        else:
+            changes = _skip_unversioned_children(
+                is_versioned_dir, make_iter_changes(search))
+    return _record_changes(
+        control_transport, token, source_revid, want_unversioned, changes)
+
+
+def _skip_unversioned_children(is_versioned_dir, changes):
+    """Filter out the contents of unversioned directories.
+
+    When an unversioned directory is compared explicitly its children are
+    reported too, which a comparison of the whole tree does not do.
+    """
+    for change in changes:
+        if change.versioned == (False, False):
+            parent = osutils.dirname(change.path[1].encode('utf-8'))
+            if not is_versioned_dir(parent):
+                continue
+        yield change
+
+
+def _record_changes(transport, token, source_revid, want_unversioned,
+                    changes):
+    paths = set()
+    for change in changes:
+        for path in change.path:
+            if path is not None:
+                paths.add(path.encode('utf-8'))
+        yield change
+    if want_unversioned:
+        # Only now is the set of paths that differ from the basis complete.
+        write_state(transport, token, source_revid, paths)
+
+
+class cmd_monitor_changes(Command):
+    __doc__ = """Watch a working tree for changes.
+
+    This runs until interrupted, and makes commands that compare the tree
+    with its basis, like status, only look at the files that changed since
+    the previous comparison. It uses inotify, so only works on Linux and
+    on local file systems.
+    """
+
+    hidden = True
+    takes_args = ['directory?']
+    takes_options = [
+        Option('detach', help='Run in the background.'),
+        ]
+
+    def run(self, directory='.', detach=False):
+        from ..workingtree import WorkingTree
+        tree = WorkingTree.open_containing(directory)[0]
+        control_transport = tree._transport
+        socket_path = control_transport.local_abspath(SOCKET_NAME)
+        try:
+            monitor = ChangeMonitor(
+                tree.basedir, control_transport.local_abspath('.'))
+        except InotifyUnavailable as e:
+            raise errors.BzrCommandError(str(e))
+        if os.path.exists(socket_path):
+            if query_monitor(socket_path, None) is not None:
+                raise errors.BzrCommandError(
+                    'A change monitor is already running for %s' %
+                    tree.basedir)
+            os.unlink(socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _socket_call(sock.bind, socket_path)
+        sock.listen(5)
+        if detach and os.fork() != 0:
+            sock.close()
+            return
+        try:
+            monitor.serve(sock)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            monitor.close()
+            os.unlink(socket_path)
+            if detach:
+                os._exit(0)
@@ -48,6 +48,24 @@ are not - this is done for clarity of reading. All string data is in utf8.
     size = WHOLE_NUMBER;
     fingerprint = a nonempty utf8 sequence with meaning defined by minikind.
 
+There is also a binary variant (used by working tree format 7), which starts
+with "#bazaar dirstate binary format 5" and has the same checksum, row count,
+parent and ghost lines. The entries are stored as a table of fixed-width
+records, in the same order as in the flat format, followed by a heap with
+the strings they refer to::
+
+    entries = {record}, heap;
+    record = string_ref, string_ref, string_ref, {tree_details};
+    tree_details = MINIKIND, executable, size, string_ref, string_ref;
+    string_ref = offset, length;
+
+where offsets and lengths are big endian 32 bit integers relative to the
+start of the heap, executable is a byte (0 or 1) and size a big endian
+64 bit integer. The checksum covers the parent and ghost lines, the
+records and the heap. Because
+records are fixed width, single entries can be found by bisecting through
+a memory map of the file, without reading the rest of it.
+
 Given this definition, the following is useful to know::
 
     entry (aka row) - all the data for a given key.
@@ -219,12 +237,16 @@ desired.
 """
 
 import bisect
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import errno
+import itertools
+import mmap
 import operator
 import os
 from stat import S_IEXEC
 import stat
+import struct
 import sys
 import time
 import zlib
@@ -285,6 +307,18 @@ class SHA1Provider(object):
         """
         raise NotImplementedError(self.stat_and_sha1)
 
+    def prepare_stat_and_sha1(self, abspath):
+        """Prepare to get the stat and sha1 of a file from another thread.
+
+        Anything that is not safe to do from another thread is done before
+        returning.
+
+        :return: A function without arguments that returns the same as
+            stat_and_sha1(abspath), or None if this provider can not be
+            used from other threads.
+        """
+        return None
+
 
 class DefaultSHA1Provider(SHA1Provider):
     """A SHA1Provider that reads directly from the filesystem."""
@@ -293,6 +327,10 @@ class DefaultSHA1Provider(SHA1Provider):
         """Return the sha1 of a file given its absolute path."""
         return osutils.sha_file_by_name(abspath)
 
+    def prepare_stat_and_sha1(self, abspath):
+        """See SHA1Provider.prepare_stat_and_sha1()."""
+        return lambda: self.stat_and_sha1(abspath)
+
     def stat_and_sha1(self, abspath):
         """Return the stat and sha1 of a file given its absolute path."""
         with open(abspath, 'rb') as file_obj:
@@ -359,9 +397,13 @@ class DirState(object):
 
     HEADER_FORMAT_2 = b'#bazaar dirstate flat format 2\n'
     HEADER_FORMAT_3 = b'#bazaar dirstate flat format 3\n'
+    HEADER_FORMAT_5 = b'#bazaar dirstate binary format 5\n'
+
+    # The start of a binary record: references to dirname, basename, file id
+    _BINARY_KEY = struct.Struct('>LLLLLL')
 
     def __init__(self, path, sha1_provider, worth_saving_limit=0,
-                 use_filesystem_for_exec=True):
+                 use_filesystem_for_exec=True, binary=False):
         """Create a  DirState object.
 
         :param path: The path at which the dirstate file on disk should live.
@@ -372,6 +414,8 @@ class DirState(object):
             -1 means never save hash changes, 0 means always save hash changes.
         :param use_filesystem_for_exec: Whether to trust the filesystem
             for executable bit information
+        :param binary: Whether to write the binary format. When an existing
+            file is read, the format of that file is used instead.
         """
         # _header_state and _dirblock_state represent the current state
         # of the dirstate metadata and the per-row data respectiely.
@@ -421,6 +465,7 @@ class DirState(object):
         self._config_stack = config.LocationStack(urlutils.local_path_to_url(
             path))
         self._use_filesystem_for_exec = use_filesystem_for_exec
+        self._binary = binary
 
     def __repr__(self):
         return "%s(%r)" % \
@@ -435,11 +480,16 @@ class DirState(object):
             dirblocks.
         """
         #trace.mutter_callsite(3, "modified hash entries: %s", hash_changed_entries)
-        if hash_changed_entries:
+        if (hash_changed_entries and
+                self._dirblock_state == DirState.NOT_IN_MEMORY):
+            # The entries were found by bisecting through the file (see
+            # _get_entry_binary), so are not in the dirblocks. Their hashes
+            # are only cached, so drop the changes.
+            pass
+        elif hash_changed_entries:
             self._known_hash_changes.update(
                 [e[0] for e in hash_changed_entries])
-            if self._dirblock_state in (DirState.NOT_IN_MEMORY,
-                                        DirState.IN_MEMORY_UNMODIFIED):
+            if self._dirblock_state == DirState.IN_MEMORY_UNMODIFIED:
                 # If the dirstate is already marked a IN_MEMORY_MODIFIED, then
                 # that takes precedence.
                 self._dirblock_state = DirState.IN_MEMORY_HASH_MODIFIED
@@ -614,6 +664,8 @@ class DirState(object):
         if self._dirblock_state != DirState.NOT_IN_MEMORY:
             raise AssertionError("bad dirblock state %r" %
                                  self._dirblock_state)
+        if self._binary:
+            return self._bisect_binary(paths)
 
         # The disk representation is generally info + '\0\n\0' at the end. But
         # for bisecting, it is easier to treat this as '\0' + info + '\0\n'
@@ -808,6 +860,8 @@ class DirState(object):
         if self._dirblock_state != DirState.NOT_IN_MEMORY:
             raise AssertionError("bad dirblock state %r" %
                                  self._dirblock_state)
+        if self._binary:
+            return self._bisect_dirblocks_binary(dir_list)
         # The disk representation is generally info + '\0\n\0' at the end. But
         # for bisecting, it is easier to treat this as '\0' + info + '\0\n'
         # Because it means we can sync on the '\n'
@@ -966,6 +1020,93 @@ class DirState(object):
 
         return found
 
+    @contextlib.contextmanager
+    def _binary_records(self):
+        """Map the records of a binary dirstate into memory.
+
+        :return: A context manager that yields a function to look up the
+            dirname and basename of a record, and a function to turn a record
+            into an entry.
+        """
+        record = self._binary_record_struct()
+        key_struct = self._BINARY_KEY
+        records_start = self._end_of_header
+        heap_start = records_start + record.size * self._num_entries
+        strings = {}
+
+        def get_string(offset, length):
+            try:
+                return strings[offset, length]
+            except KeyError:
+                s = strings[offset, length] = bytes(
+                    data[heap_start + offset:heap_start + offset + length])
+                return s
+
+        def dir_name(i):
+            (dir_offset, dir_length, name_offset, name_length, _,
+             _) = key_struct.unpack_from(data, records_start + i * record.size)
+            return (get_string(dir_offset, dir_length),
+                    get_string(name_offset, name_length))
+
+        def read_entry(i):
+            return self._binary_fields_to_entry(
+                record.unpack_from(data, records_start + i * record.size),
+                get_string)
+
+        data = mmap.mmap(self._state_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield dir_name, read_entry
+        finally:
+            data.close()
+
+    def _bisect_binary(self, paths):
+        """Find the entries for specific paths in a binary dirstate.
+
+        See _bisect.
+        """
+        found = {}
+        with self._binary_records() as (dir_name, read_entry):
+            for path in paths:
+                dirname, basename = osutils.split(path)
+                key = (dirname.split(b'/'), basename)
+                lo = 0
+                hi = self._num_entries
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    mid_dirname, mid_basename = dir_name(mid)
+                    if (mid_dirname.split(b'/'), mid_basename) < key:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                while lo < self._num_entries and dir_name(lo) == (
+                        dirname, basename):
+                    found.setdefault(path, []).append(read_entry(lo))
+                    lo += 1
+        return found
+
+    def _bisect_dirblocks_binary(self, dir_list):
+        """Find the entries in specific directories in a binary dirstate.
+
+        See _bisect_dirblocks.
+        """
+        found = {}
+        with self._binary_records() as (dir_name, read_entry):
+            for dirname in dir_list:
+                key = dirname.split(b'/')
+                lo = 0
+                hi = self._num_entries
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if dir_name(mid)[0].split(b'/') < key:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                while (lo < self._num_entries and
+                       dir_name(lo)[0] == dirname):
+                    found.setdefault(dirname, []).append(read_entry(lo))
+                    lo += 1
+        return found
+
     def _bisect_recursive(self, paths):
         """Bisect for entries for all paths and their children.
 
@@ -1465,14 +1606,74 @@ class DirState(object):
                                             "not deleted.")
 
     def _apply_insertions(self, adds):
+        adds = sorted(adds)
+        id_index = self._get_id_index()
+        if len(adds) > 1 and not any(id_index.get(add[0][2]) for add in adds):
+            # Only new file ids, as when adding files: nothing else in the
+            # dirstate needs to point at them.
+            self._insert_new_entries(adds)
+            return
         try:
-            for key, minikind, executable, fingerprint, path_utf8 in sorted(adds):
+            for key, minikind, executable, fingerprint, path_utf8 in adds:
                 self.update_minimal(key, minikind, executable, fingerprint,
                                     path_utf8=path_utf8)
         except errors.NotVersionedError:
             self._raise_invalid(path_utf8.decode('utf8'), key[2],
                                 "Missing parent")
 
+    def _insert_new_entries(self, adds):
+        """Insert entries for file ids that are not in the dirstate at all.
+
+        This has the same effect as calling update_minimal for each entry,
+        but the blocks for new directories are added in one go and the new
+        entries for each block are merged into it in a single sort, rather
+        than being bisected for and inserted one at a time.
+
+        :param adds: A sorted list of (key, minikind, executable,
+            fingerprint, path_utf8) tuples.
+        """
+        id_index = self._get_id_index()
+        parent_info = self._empty_parent_info()
+        new_blocks = []
+        for key, minikind, _, _, path_utf8 in adds:
+            if minikind == b'd':
+                if not self._find_block_index_from_key(
+                        (path_utf8, b'', b''))[1]:
+                    new_blocks.append((path_utf8, []))
+        if new_blocks:
+            # Block 0 is the root, block 1 is its contents; everything else
+            # is sorted by path segments.
+            self._dirblocks[2:] = sorted(
+                self._dirblocks[2:] + new_blocks,
+                key=lambda block: block[0].split(b'/'))
+            self._last_block_index = None
+        # The root entry is in a block of its own, ahead of the other
+        # entries with an empty dirname.
+        for _, group in itertools.groupby(
+                adds, key=lambda add: (add[0][0], add[0][0:2] == (b'', b''))):
+            group = list(group)
+            try:
+                block = self._find_block(group[0][0])[1]
+            except errors.NotVersionedError:
+                self._raise_invalid(group[0][4].decode('utf8'),
+                                    group[0][0][2], "Missing parent")
+            occupied = dict(
+                (entry[0][1], entry[0][2]) for entry in block
+                if entry[1][0][0] not in (b'a', b'r'))
+            for key, minikind, executable, fingerprint, path_utf8 in group:
+                if key[1] in occupied:
+                    self._raise_invalid(
+                        path_utf8.decode('utf8'), key[2],
+                        "Attempt to add item at path already occupied by "
+                        "id %r" % occupied[key[1]])
+                block.append(
+                    (key, [(minikind, fingerprint, 0, executable,
+                            DirState.NULLSTAT)] + parent_info))
+                self._add_to_id_index(id_index, key)
+            block.sort(key=operator.itemgetter(0))
+        self._last_entry_index = None
+        self._mark_modified()
+
     def update_basis_by_delta(self, delta, new_revid):
         """Update the parents of this tree after a commit.
 
@@ -1980,12 +2181,106 @@ class DirState(object):
             # read what's on disk.
             self._state_file.seek(0)
             return self._state_file.readlines()
+        if self._binary:
+            return self._get_binary_output_lines()
         lines = []
         lines.append(self._get_parents_line(self.get_parent_ids()))
         lines.append(self._get_ghosts_line(self._ghosts))
         lines.extend(self._iter_entry_lines())
         return self._get_output_lines(lines)
 
+    def _binary_record_struct(self):
+        """Return the struct for the records of a binary dirstate."""
+        return struct.Struct(
+            '>' + 'LL' * 3 + 'cBQLLLL' * (1 + self._num_present_parents()))
+
+    def _get_binary_output_lines(self):
+        """Serialise the dirstate in the binary format."""
+        parent_ids = self.get_parent_ids()
+        record = self._binary_record_struct()
+        heap = []
+        refs = {}
+        heap_size = 0
+        records = []
+        for key, trees in self._iter_entries():
+            fields = []
+            for s in key:
+                try:
+                    fields.extend(refs[s])
+                except KeyError:
+                    ref = refs[s] = (heap_size, len(s))
+                    heap.append(s)
+                    heap_size += len(s)
+                    fields.extend(ref)
+            for minikind, fingerprint, size, executable, tree_data in trees:
+                fields.extend((minikind, executable, size))
+                for s in (fingerprint, tree_data):
+                    try:
+                        fields.extend(refs[s])
+                    except KeyError:
+                        ref = refs[s] = (heap_size, len(s))
+                        heap.append(s)
+                        heap_size += len(s)
+                        fields.extend(ref)
+            records.append(record.pack(*fields))
+        parents_line = self._get_parents_line(parent_ids) + b'\0\n'
+        ghosts_line = b'\0' + self._get_ghosts_line(self._ghosts) + b'\0\n'
+        body = b''.join(records) + b''.join(heap)
+        crc = zlib.crc32(body, zlib.crc32(ghosts_line,
+                                          zlib.crc32(parents_line)))
+        return [DirState.HEADER_FORMAT_5,
+                b'crc32: %d\n' % (crc,),
+                b'num_entries: %d\n' % (len(records),),
+                parents_line,
+                ghosts_line,
+                body]
+
+    def _binary_fields_to_entry(self, fields, get_string):
+        """Convert the fields of a binary record into an entry.
+
+        :param fields: The unpacked record
+        :param get_string: Function that returns the string at an offset (and
+            with a length) in the heap
+        """
+        key = (get_string(fields[0], fields[1]),
+               get_string(fields[2], fields[3]),
+               get_string(fields[4], fields[5]))
+        trees = [(fields[cur],                                  # minikind
+                  get_string(fields[cur + 3], fields[cur + 4]),  # fingerprint
+                  fields[cur + 2],                              # size
+                  bool(fields[cur + 1]),                        # executable
+                  get_string(fields[cur + 5], fields[cur + 6]),  # stat or rev
+                  ) for cur in range(6, len(fields), 7)]
+        return key, trees
+
+    def _read_binary_dirblocks(self):
+        """Read in all the dirblocks from a binary dirstate."""
+        # The checksum also covers the parent and ghost lines.
+        self._state_file.seek(self._end_of_prelude)
+        data = self._state_file.read()
+        if zlib.crc32(data) != self.crc_expected:
+            raise DirstateCorrupt(self, 'checksum mismatch')
+        data = data[self._end_of_header - self._end_of_prelude:]
+        record = self._binary_record_struct()
+        records_size = record.size * self._num_entries
+        if records_size > len(data):
+            raise DirstateCorrupt(self, 'file too short')
+        heap = data[records_size:]
+        strings = {}
+
+        def get_string(offset, length):
+            try:
+                return strings[offset, length]
+            except KeyError:
+                s = strings[offset, length] = heap[offset:offset + length]
+                return s
+        fields_to_entry = self._binary_fields_to_entry
+        entries = [fields_to_entry(fields, get_string)
+                   for fields in record.iter_unpack(
+                       memoryview(data)[:records_size])]
+        self._entries_to_current_state(entries)
+        self._dirblock_state = DirState.IN_MEMORY_UNMODIFIED
+
     def _get_ghosts_line(self, ghost_ids):
         """Create a line for the state file for ghost information."""
         return b'\0'.join([b'%d' % len(ghost_ids)] + ghost_ids)
@@ -2121,6 +2416,27 @@ class DirState(object):
             entry_index += 1
         return block_index, entry_index, True, False
 
+    def _get_entry_binary(self, tree_index, fileid_utf8, path_utf8):
+        """Look up the entry for a path in a binary dirstate on disk.
+
+        This bisects through the file rather than reading in the dirblocks,
+        so the entry returned is not part of them. That is fine while only
+        a read lock is held, as the dirblocks can not be changed then.
+
+        See _get_entry.
+        """
+        for entry in self._bisect_binary([path_utf8]).get(path_utf8, ()):
+            if entry[1][tree_index][0] in (b'a', b'r'):
+                continue
+            if not entry[0][2]:
+                raise AssertionError('unversioned entry?')
+            if fileid_utf8 and entry[0][2] != fileid_utf8:
+                self._changes_aborted = True
+                raise errors.BzrError('integrity error ? : mismatching'
+                                      ' tree_index, file_id and path')
+            return entry
+        return None, None
+
     def _get_entry(self, tree_index, fileid_utf8=None, path_utf8=None,
                    include_deleted=False):
         """Get the dirstate entry for path in tree tree_index.
@@ -2141,11 +2457,16 @@ class DirState(object):
             (absent) paths.
         :return: The dirstate entry tuple for path, or (None, None)
         """
+        if path_utf8 is not None and not isinstance(path_utf8, bytes):
+            raise errors.BzrError('path_utf8 is not bytes: %s %r'
+                                  % (type(path_utf8), path_utf8))
+        self._read_header_if_needed()
+        if (path_utf8 is not None and self._binary and
+                self._dirblock_state == DirState.NOT_IN_MEMORY and
+                self._lock_state == 'r'):
+            return self._get_entry_binary(tree_index, fileid_utf8, path_utf8)
         self._read_dirblocks_if_needed()
         if path_utf8 is not None:
-            if not isinstance(path_utf8, bytes):
-                raise errors.BzrError('path_utf8 is not bytes: %s %r'
-                                      % (type(path_utf8), path_utf8))
             # path lookups are faster
             dirname, basename = osutils.split(path_utf8)
             block_index, entry_index, dir_present, file_present = \
@@ -2203,7 +2524,7 @@ class DirState(object):
             return None, None
 
     @classmethod
-    def initialize(cls, path, sha1_provider=None):
+    def initialize(cls, path, sha1_provider=None, binary=False):
         """Create a new dirstate on path.
 
         The new dirstate will be an empty tree - that is it has no parents,
@@ -2212,6 +2533,7 @@ class DirState(object):
         :param path: The name of the file for the dirstate.
         :param sha1_provider: an object meeting the SHA1Provider interface.
             If None, a DefaultSHA1Provider is used.
+        :param binary: Whether to use the binary format.
         :return: A write-locked DirState object.
         """
         # This constructs a new DirState object on a path, sets the _state_file
@@ -2222,6 +2544,7 @@ class DirState(object):
         if sha1_provider is None:
             sha1_provider = DefaultSHA1Provider()
         result = cls(path, sha1_provider)
+        result._binary = binary
         # root dir and root dir contents with no children.
         empty_tree_dirblocks = [(b'', []), (b'', [])]
         # a new root directory, with a NULLSTAT.
@@ -2424,7 +2747,10 @@ class DirState(object):
         """
         self._read_header_if_needed()
         if self._dirblock_state == DirState.NOT_IN_MEMORY:
-            _read_dirblocks(self)
+            if self._binary:
+                self._read_binary_dirblocks()
+            else:
+                _read_dirblocks(self)
 
     def _read_header(self):
         """This reads in the metadata header, and the parent ids.
@@ -2464,7 +2790,11 @@ class DirState(object):
         and their ids. Followed by a newline.
         """
         header = self._state_file.readline()
-        if header != DirState.HEADER_FORMAT_3:
+        if header == DirState.HEADER_FORMAT_3:
+            self._binary = False
+        elif header == DirState.HEADER_FORMAT_5:
+            self._binary = True
+        else:
             raise errors.BzrError(
                 'invalid header line: %r' % (header,))
         crc_line = self._state_file.readline()
@@ -2475,6 +2805,7 @@ class DirState(object):
         if not num_entries_line.startswith(b'num_entries: '):
             raise errors.BzrError('missing num_entries line')
         self._num_entries = int(num_entries_line[len(b'num_entries: '):-1])
+        self._end_of_prelude = self._state_file.tell()
 
     def sha1_from_stat(self, path, stat_result):
         """Find a sha1 given a stat lookup."""
@@ -3523,6 +3854,85 @@ def py_update_entry(state, entry, abspath, stat_value,
     return link_or_sha1
 
 
+# Number of directories read ahead per thread by a parallel iter_changes.
+_READAHEAD_PER_JOB = 4
+
+
+class _SHA1Prefetcher(object):
+    """Hash files that iter_changes is about to compare, in a thread pool.
+
+    While installed, this replaces the SHA1 provider of the dirstate and
+    hands out the precomputed hashes when they are asked for. Files that
+    were not prefetched are hashed on demand.
+    """
+
+    def __init__(self, state, executor):
+        self.state = state
+        self.provider = state._sha1_provider
+        self.executor = executor
+        self._pending = {}
+        self._saved = None
+
+    def install(self):
+        state = self.state
+        self._saved = (state._sha1_provider, state._sha1_file)
+        state._sha1_provider = self
+        if state._sha1_file == self.provider.sha1:
+            state._sha1_file = self.sha1
+
+    def uninstall(self):
+        self.state._sha1_provider, self.state._sha1_file = self._saved
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def prefetch(self, block, dir_info):
+        """Start hashing the files in a directory that may have changed.
+
+        :param block: The dirblock for the directory
+        :param dir_info: The directory listing, as yielded by
+            osutils._walkdirs_utf8
+        """
+        on_disk = {}
+        for path_info in dir_info[1]:
+            if path_info[2] == 'file':
+                on_disk[path_info[1]] = path_info
+        for entry in block[1]:
+            path_info = on_disk.get(entry[0][1])
+            if path_info is None:
+                continue
+            details = entry[1]
+            if details[0][0] != b'f':
+                continue
+            if not any(d[0] == b'f' for d in details[1:]):
+                # Nothing to compare the contents with
+                continue
+            stat_value = path_info[3]
+            if (details[0][4] == pack_stat(stat_value) and
+                    details[0][2] == stat_value.st_size):
+                continue
+            abspath = path_info[4]
+            if abspath in self._pending:
+                continue
+            stat_and_sha1 = self.provider.prepare_stat_and_sha1(abspath)
+            if stat_and_sha1 is not None:
+                self._pending[abspath] = self.executor.submit(stat_and_sha1)
+
+    def sha1(self, abspath):
+        """See SHA1Provider.sha1()."""
+        future = self._pending.pop(abspath, None)
+        if future is None:
+            return self.provider.sha1(abspath)
+        return future.result()[1]
+
+    def stat_and_sha1(self, abspath):
+        """See SHA1Provider.stat_and_sha1()."""
+        future = self._pending.pop(abspath, None)
+        if future is None:
+            return self.provider.stat_and_sha1(abspath)
+        return future.result()
+
+
 class ProcessEntryPython(object):
 
     __slots__ = ["old_dirname_to_file_id", "new_dirname_to_file_id",
@@ -3530,11 +3940,12 @@ class ProcessEntryPython(object):
                  "partial", "use_filesystem_for_exec", "utf8_decode",
                  "searched_specific_files", "search_specific_files",
                  "searched_exact_paths", "search_specific_file_parents", "seen_ids",
-                 "state", "source_index", "target_index", "want_unversioned", "tree"]
+                 "state", "source_index", "target_index", "want_unversioned", "tree",
+                 "jobs"]
 
     def __init__(self, include_unchanged, use_filesystem_for_exec,
                  search_specific_files, state, source_index, target_index,
-                 want_unversioned, tree):
+                 want_unversioned, tree, jobs=1):
         self.old_dirname_to_file_id = {}
         self.new_dirname_to_file_id = {}
         # Are we doing a partial iter_changes?
@@ -3568,6 +3979,9 @@ class ProcessEntryPython(object):
             raise errors.BzrError('unsupported target index')
         self.want_unversioned = want_unversioned
         self.tree = tree
+        # When more than one, the number of threads used to read directories
+        # and hash files.
+        self.jobs = jobs
 
     def _process_entry(self, entry, path_info, pathjoin=osutils.pathjoin):
         """Compare an entry and real disk to generate delta information.
@@ -3871,6 +4285,27 @@ class ProcessEntryPython(object):
 
     def iter_changes(self):
         """Iterate over the changes."""
+        if self.jobs <= 1:
+            return self._iter_changes()
+        return self._iter_changes_in_threads()
+
+    def _iter_changes_in_threads(self):
+        """Iterate over the changes, reading the disk in a thread pool.
+
+        The changes are produced in the same order as by a sequential
+        iter_changes.
+        """
+        executor = ThreadPoolExecutor(self.jobs)
+        prefetcher = _SHA1Prefetcher(self.state, executor)
+        prefetcher.install()
+        try:
+            for result in self._iter_changes(executor, prefetcher):
+                yield result
+        finally:
+            prefetcher.uninstall()
+            executor.shutdown(wait=False)
+
+    def _iter_changes(self, executor=None, prefetcher=None):
         utf8_decode = cache_utf8._utf8_decode
         _lt_by_dirs = lt_by_dirs
         _process_entry = self._process_entry
@@ -3981,7 +4416,8 @@ class ProcessEntryPython(object):
                 current_dir_info = None
             else:
                 dir_iterator = osutils._walkdirs_utf8(
-                    root_abspath, prefix=current_root)
+                    root_abspath, prefix=current_root, executor=executor,
+                    readahead=self.jobs * _READAHEAD_PER_JOB)
                 try:
                     current_dir_info = next(dir_iterator)
                 except OSError as e:
@@ -4092,6 +4528,11 @@ class ProcessEntryPython(object):
                         else:
                             current_block = None
                     continue
+                if (prefetcher is not None and current_block and
+                        current_dir_info):
+                    # Start hashing the files in this directory whose stat
+                    # changed, before comparing them one by one.
+                    prefetcher.prefetch(current_block, current_dir_info)
                 entry_index = 0
                 if current_block and entry_index < len(current_block[1]):
                     current_entry = current_block[1][entry_index]
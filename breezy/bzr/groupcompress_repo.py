@@ -18,6 +18,11 @@
 
 import time
 
+from ..lazy_import import lazy_import
+lazy_import(globals(), """
+import multiprocessing
+""")
+
 from .. import (
     controldir,
     debug,
@@ -36,12 +41,14 @@ from ..bzr import (
     versionedfile,
     )
 from ..bzr.btree_index import (
+    BloomBTreeBuilder,
     BTreeGraphIndex,
     BTreeBuilder,
     )
 from ..bzr.groupcompress import (
     _GCGraphIndex,
     GroupCompressVersionedFiles,
+    sort_gc_optimal,
     )
 from .pack_repo import (
     _DirectPackAccess,
@@ -188,14 +195,173 @@ class ResumedGCPack(ResumedPack):
         return set()
 
 
+class _CollectedBlocks(object):
+    """Access and index for a GroupCompressVersionedFiles kept in memory.
+
+    Worker processes of a parallel pack or insert compress their texts into
+    one of these, and send the resulting blocks back to be written to the
+    target pack.
+    """
+
+    def __init__(self):
+        # A list of [block_bytes, [(key, b'start end', refs), ...]]
+        self.blocks = []
+
+    def add_raw_record(self, key, size, raw_data):
+        self.blocks.append([b''.join(raw_data), []])
+        # The block number stands in for its offset in the pack.
+        return None, len(self.blocks) - 1, size
+
+    def add_records(self, records, random_id=False):
+        nodes = self.blocks[-1][1]
+        for key, value, refs in records:
+            # Drop the block offset and length; only the location of the text
+            # within the block is known here.
+            nodes.append((key, value.split(b' ', 2)[2], refs))
+
+
+def _add_collected_blocks(target_vf, blocks, random_id=True):
+    """Write blocks collected by _CollectedBlocks to target_vf."""
+    for block_bytes, nodes in blocks:
+        _, start, length = target_vf._access.add_raw_record(
+            None, len(block_bytes), [block_bytes])
+        target_vf._index.add_records(
+            [(key, b'%d %d %s' % (start, length, reads), refs)
+             for key, reads, refs in nodes],
+            random_id=random_id)
+
+
+def partition_gc_optimal(parent_map, partition_size):
+    """Split keys into groups that can be compressed independently.
+
+    The keys are put in groupcompress order, and split into partitions of
+    about partition_size keys. All texts for a file are kept in the same
+    partition, so they can still be delta compressed against each other.
+
+    :param parent_map: A dict mapping keys to their parents.
+    :return: A list of lists of keys.
+    """
+    partitions = []
+    current = []
+    last_prefix = None
+    for key in sort_gc_optimal(parent_map):
+        if len(key) > 1:
+            prefix = key[0]
+        else:
+            prefix = None
+        if (len(current) >= partition_size
+                and (prefix is None or prefix != last_prefix)):
+            partitions.append(current)
+            current = []
+        current.append(key)
+        last_prefix = prefix
+    if current:
+        partitions.append(current)
+    return partitions
+
+
+def can_compress_in_processes(jobs):
+    """Check whether texts can be compressed in jobs worker processes."""
+    if jobs is None or jobs < 2:
+        return False
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        trace.mutter('cannot compress in parallel without fork()')
+        return False
+    return True
+
+
+# The partitions of records and delta flag of the parallel insert in
+# progress. Worker processes inherit this when they are forked.
+_records_state = None
+
+
+def _compress_records(idx):
+    """Compress a partition of records into new groupcompress blocks.
+
+    This runs in a worker process of insert_records_in_processes.
+
+    :return: A list of [block_bytes, nodes] as collected by _CollectedBlocks.
+    """
+    partitions, delta = _records_state
+    collected = _CollectedBlocks()
+    target_vf = GroupCompressVersionedFiles(collected, collected, delta=delta)
+    for _ in target_vf._insert_record_stream(
+            partitions[idx], random_id=True, reuse_blocks=False):
+        pass
+    return collected.blocks
+
+
+def insert_records_in_processes(target_vf, partitions, jobs,
+                                message='compressing texts'):
+    """Compress records in worker processes and insert them into target_vf.
+
+    Each partition is compressed on its own, so records that should be
+    delta compressed against each other belong in the same partition (see
+    partition_gc_optimal). The resulting blocks are written in the order of
+    the partitions, so the result does not depend on the number of workers.
+
+    :param target_vf: A GroupCompressVersionedFiles in a write group.
+    :param partitions: A list of lists of content factories, which must
+        be fulltexts (e.g. 'chunked' or 'fulltext').
+    :param jobs: The number of worker processes to use.
+    """
+    global _records_state
+    jobs = min(jobs, len(partitions))
+    trace.mutter('compressing %d partitions of records in %d processes',
+                 len(partitions), jobs)
+    _records_state = (partitions, target_vf._delta)
+    pool = multiprocessing.get_context('fork').Pool(jobs)
+    try:
+        with ui.ui_factory.nested_progress_bar() as child_pb:
+            results = pool.imap(_compress_records, range(len(partitions)))
+            for idx, blocks in enumerate(results):
+                _add_collected_blocks(target_vf, blocks, random_id=False)
+                child_pb.update(message, idx + 1, len(partitions))
+    finally:
+        pool.terminate()
+        pool.join()
+        _records_state = None
+
+
+# The packer, source versioned files, delta flag, message and stream
+# function of the parallel copy in progress. Worker processes inherit this
+# when they are forked.
+_partition_state = None
+
+
+def _compress_partition(keys):
+    """Compress the texts for keys into new groupcompress blocks.
+
+    This runs in a worker process of GCCHKPacker._copy_stream_parallel.
+
+    :return: A tuple of (blocks, chk_id_roots, chk_p_id_roots), where blocks
+        is a list of [block_bytes, nodes] as collected by _CollectedBlocks
+        and the roots are those found by the inventory stream, if any.
+    """
+    packer, source_vf, delta, message, vf_to_stream = _partition_state
+    packer._chk_id_roots = []
+    packer._chk_p_id_roots = []
+    collected = _CollectedBlocks()
+    target_vf = GroupCompressVersionedFiles(collected, collected, delta=delta)
+    stream = vf_to_stream(source_vf, keys, message, None)
+    for _ in target_vf._insert_record_stream(
+            stream, random_id=True, reuse_blocks=False):
+        pass
+    return collected.blocks, packer._chk_id_roots, packer._chk_p_id_roots
+
+
 class GCCHKPacker(Packer):
     """This class understand what it takes to collect a GCCHK repo."""
 
+    # The number of keys to aim for in each partition compressed by a worker
+    # process. Texts for the same file are never split across partitions.
+    _partition_size = 1000
+
     def __init__(self, pack_collection, packs, suffix, revision_ids=None,
-                 reload_func=None):
+                 reload_func=None, jobs=None):
         super(GCCHKPacker, self).__init__(pack_collection, packs, suffix,
                                           revision_ids=revision_ids,
-                                          reload_func=reload_func)
+                                          reload_func=reload_func, jobs=jobs)
         self._pack_collection = pack_collection
         # ATM, We only support this for GCCHK repositories
         if pack_collection.chk_index is None:
@@ -404,12 +570,76 @@ class GCCHKPacker(Packer):
                      pb_offset):
         trace.mutter('repacking %d %s', len(keys), message)
         self.pb.update('repacking %s' % (message,), pb_offset)
+        if self._can_copy_in_parallel():
+            partitions = self._partition_keys(source_vf, keys)
+            if len(partitions) > 1:
+                self._copy_stream_parallel(source_vf, target_vf, partitions,
+                                           message, vf_to_stream)
+                return
         with ui.ui_factory.nested_progress_bar() as child_pb:
             stream = vf_to_stream(source_vf, keys, message, child_pb)
             for _, _ in target_vf._insert_record_stream(
                     stream, random_id=True, reuse_blocks=False):
                 pass
 
+    def _can_copy_in_parallel(self):
+        return can_compress_in_processes(self._jobs)
+
+    def _partition_keys(self, source_vf, keys):
+        """Split keys into groups that can be compressed independently.
+
+        The keys are put in groupcompress order, and split into partitions of
+        about _partition_size keys. All texts for a file are kept in the same
+        partition, so they can still be delta compressed against each other.
+
+        :return: A list of lists of keys.
+        """
+        parent_map = source_vf.get_parent_map(keys)
+        if len(parent_map) != len(keys):
+            # Leave it to the copy in this process to report missing keys.
+            return [list(keys)]
+        return partition_gc_optimal(parent_map, self._partition_size)
+
+    def _copy_stream_parallel(self, source_vf, target_vf, partitions, message,
+                              vf_to_stream):
+        """Copy partitions of keys, compressing them in worker processes.
+
+        The blocks made by the workers are written to the new pack in the
+        order of the partitions, so the result does not depend on the number
+        of workers.
+        """
+        global _partition_state
+        jobs = min(self._jobs, len(partitions))
+        trace.mutter('compressing %d partitions of %s in %d processes',
+                     len(partitions), message, jobs)
+        roots_sets = None
+        _partition_state = (self, source_vf, target_vf._delta, message,
+                            vf_to_stream)
+        pool = multiprocessing.get_context('fork').Pool(jobs)
+        try:
+            with ui.ui_factory.nested_progress_bar() as child_pb:
+                results = pool.imap(_compress_partition, partitions)
+                for idx, (blocks, id_roots, p_id_roots) in enumerate(results):
+                    _add_collected_blocks(target_vf, blocks)
+                    if id_roots or p_id_roots:
+                        # The inventory stream found chk roots.
+                        if roots_sets is None:
+                            roots_sets = (set(self._chk_id_roots),
+                                          set(self._chk_p_id_roots))
+                        for roots, keys, seen in (
+                                (self._chk_id_roots, id_roots, roots_sets[0]),
+                                (self._chk_p_id_roots, p_id_roots,
+                                 roots_sets[1])):
+                            for key in keys:
+                                if key not in seen:
+                                    seen.add(key)
+                                    roots.append(key)
+                    child_pb.update(message, idx + 1, len(partitions))
+        finally:
+            pool.terminate()
+            pool.join()
+            _partition_state = None
+
     def _copy_revision_texts(self):
         source_vf, target_vf = self._build_vfs('revision', True, False)
         if not self.revision_keys:
@@ -1429,3 +1659,33 @@ class RepositoryFormat2aSubtree(RepositoryFormat2a):
 
     experimental = True
     supports_tree_reference = True
+
+
+class RepositoryFormat2aBloom(RepositoryFormat2a):
+    """A 2a repository format whose indices have bloom filters.
+
+    The filters let lookups skip the packs that do not contain a key without
+    reading their leaf pages.
+    """
+
+    index_builder_class = BloomBTreeBuilder
+
+    def _get_matching_bzrdir(self):
+        return controldir.format_registry.make_controldir('development-bloom')
+
+    def _ignore_setting_bzrdir(self, format):
+        pass
+
+    _matchingcontroldir = property(
+        _get_matching_bzrdir, _ignore_setting_bzrdir)
+
+    @classmethod
+    def get_format_string(cls):
+        return b'Bazaar development format 9 (2a with bloom filter indices)\n'
+
+    def get_format_description(self):
+        """See RepositoryFormat.get_format_description()."""
+        return ("Development repository format 9 - 2a with bloom filter "
+                "indices")
+
+    experimental = True
@@ -17,8 +17,10 @@
 """Tree classes, representing directory at point in time.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import os
 import re
+import stat
 
 from .. import (
     branch as _mod_branch,
@@ -444,7 +446,9 @@ class MutableInventoryTree(MutableTree, InventoryTree):
                     conflicts_related.update(c.associated_filenames())
             else:
                 conflicts_related = None
-            adder = _SmartAddHelper(self, action, conflicts_related)
+            jobs = self.get_config_stack().get('add.jobs')
+            adder = _SmartAddHelper(self, action, conflicts_related,
+                                    jobs=jobs)
             adder.add(file_list, recurse=recurse)
             if save:
                 invdelta = adder.get_inventory_delta()
@@ -593,8 +597,9 @@ class _SmartAddHelper(object):
                 yield (path, inv_path, this_ie, None)
             prev_dir = path
 
-    def __init__(self, tree, action, conflicts_related=None):
+    def __init__(self, tree, action, conflicts_related=None, jobs=1):
         self.tree = tree
+        self.jobs = jobs
         if action is None:
             self.action = add.AddAction()
         else:
@@ -650,7 +655,41 @@ class _SmartAddHelper(object):
             # no need to walk any directories at all.
             return
 
+        if self.jobs > 1:
+            executor = ThreadPoolExecutor(self.jobs)
+        else:
+            executor = None
+        try:
+            self._add_recursive(user_dirs, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    @staticmethod
+    def _read_dir(abspath, want_stat):
+        """List a directory.
+
+        :return: A sorted list of (name, lstat) tuples. The lstat is None
+            unless want_stat is True.
+        """
+        names = sorted(os.listdir(abspath))
+        if not want_stat:
+            return [(name, None) for name in names]
+        return [(name, os.lstat(osutils.pathjoin(abspath, name)))
+                for name in names]
+
+    def _add_recursive(self, user_dirs, executor):
+        """Add the unversioned contents of the directories in user_dirs.
+
+        :param executor: Optional concurrent.futures executor. If given,
+            directories are listed and their contents stat'ed in it ahead
+            of being visited.
+        """
         things_to_add = list(self._gather_dirs_to_add(user_dirs))
+        # The lstat of paths read ahead of time, and the pending listings
+        # of directories, both by tree relative path.
+        stat_cache = {}
+        dir_reads = {}
 
         illegalpath_re = re.compile(r'[\r\n]')
         for directory, inv_path, this_ie, parent_ie in things_to_add:
@@ -663,7 +702,9 @@ class _SmartAddHelper(object):
             # for reuse
             stat_value = None
             if this_ie is None:
-                stat_value = osutils.file_stat(abspath)
+                stat_value = stat_cache.pop(directory, None)
+                if stat_value is None:
+                    stat_value = osutils.file_stat(abspath)
                 kind = osutils.file_kind_from_stat_mode(stat_value.st_mode)
             else:
                 kind = this_ie.kind
@@ -718,7 +759,13 @@ class _SmartAddHelper(object):
                 if this_ie.kind != 'directory':
                     this_ie = self._convert_to_directory(this_ie, inv_path)
 
-                for subf in sorted(os.listdir(abspath)):
+                future = dir_reads.pop(directory, None)
+                if future is not None:
+                    children = future.result()
+                else:
+                    children = self._read_dir(abspath, executor is not None)
+                candidates = []
+                for subf, sub_stat in children:
                     inv_f, _ = osutils.normalized_filename(subf)
                     # here we could use TreeDirectory rather than
                     # string concatenation.
@@ -736,20 +783,38 @@ class _SmartAddHelper(object):
                         sub_ie = entry[3]
                     else:
                         sub_ie = this_ie.children.get(inv_f)
+                    candidates.append((subp, sub_invp, sub_ie, sub_stat))
+                # user selection overrides ignores
+                # ignore while selecting files - if we globbed in the
+                # outer loop we would ignore user files.
+                ignore_globs = self.tree._iter_ignored(
+                    [c[0] for c in candidates if c[2] is None])
+                for subp, sub_invp, sub_ie, sub_stat in candidates:
                     if sub_ie is not None:
                         # recurse into this already versioned subdir.
                         things_to_add.append((subp, sub_invp, sub_ie, this_ie))
+                        if sub_ie.kind == 'directory':
+                            self._read_ahead(
+                                executor, dir_reads, subp, sub_stat)
+                        continue
+                    ignore_glob = next(ignore_globs)
+                    if ignore_glob is not None:
+                        self.ignored.setdefault(
+                            ignore_glob, []).append(subp)
                     else:
-                        # user selection overrides ignores
-                        # ignore while selecting files - if we globbed in the
-                        # outer loop we would ignore user files.
-                        ignore_glob = self.tree.is_ignored(subp)
-                        if ignore_glob is not None:
-                            self.ignored.setdefault(
-                                ignore_glob, []).append(subp)
-                        else:
-                            things_to_add.append(
-                                (subp, sub_invp, None, this_ie))
+                        things_to_add.append(
+                            (subp, sub_invp, None, this_ie))
+                        if sub_stat is not None:
+                            stat_cache[subp] = sub_stat
+                            self._read_ahead(
+                                executor, dir_reads, subp, sub_stat)
+
+    def _read_ahead(self, executor, dir_reads, path, stat_value):
+        """Start listing path in executor if it is a directory."""
+        if (executor is not None and stat_value is not None and
+                stat.S_ISDIR(stat_value.st_mode)):
+            dir_reads[path] = executor.submit(
+                self._read_dir, self.tree.abspath(path), True)
 
 
 class InventoryRevisionTree(RevisionTree, InventoryTree):
@@ -585,10 +585,10 @@ class KnitPacker(Packer):
     """Packer that works with knit packs."""
 
     def __init__(self, pack_collection, packs, suffix, revision_ids=None,
-                 reload_func=None):
+                 reload_func=None, jobs=None):
         super(KnitPacker, self).__init__(pack_collection, packs, suffix,
                                          revision_ids=revision_ids,
-                                         reload_func=reload_func)
+                                         reload_func=reload_func, jobs=jobs)
 
     def _pack_map_and_index_list(self, index_attribute):
         """Convert a list of packs to an index pack map and index list.
@@ -36,6 +36,7 @@ from breezy.bzr import (
 from breezy.bzr.index import (
     CombinedGraphIndex,
     )
+from breezy.transport.cache import CachingTransportDecorator
 """)
 from .. import (
     errors,
@@ -206,6 +207,9 @@ class Pack(object):
                                  unlimited_cache=unlimited_cache)
         if index_type == 'chk':
             index._leaf_factory = btree_index._gcchk_factory
+        if self.index_class is btree_index.BTreeGraphIndex:
+            # The pack has been named, so its indices will not change.
+            index._shared_nodes = True
         setattr(self, index_type + '_index', index)
 
     def __lt__(self, other):
@@ -617,6 +621,8 @@ class AggregateIndex(object):
     def clear(self):
         """Reset all the aggregate data to nothing."""
         self.data_access.set_writer(None, None, (None, None))
+        for index in self.index_to_pack:
+            index.clear_cache()
         self.index_to_pack.clear()
         del self.combined_index._indices[:]
         del self.combined_index._index_names[:]
@@ -628,6 +634,7 @@ class AggregateIndex(object):
         :param index: An index from the pack parameter.
         """
         del self.index_to_pack[index]
+        index.clear_cache()
         pos = self.combined_index._indices.index(index)
         del self.combined_index._indices[pos]
         del self.combined_index._index_names[pos]
@@ -641,7 +648,7 @@ class Packer(object):
     """Create a pack from packs."""
 
     def __init__(self, pack_collection, packs, suffix, revision_ids=None,
-                 reload_func=None):
+                 reload_func=None, jobs=None):
         """Create a Packer.
 
         :param pack_collection: A RepositoryPackCollection object where the
@@ -652,6 +659,9 @@ class Packer(object):
         :param reload_func: A function to call if a pack file/index goes
             missing. The side effect of calling this function should be to
             update self.packs. See also AggregateIndex
+        :param jobs: The number of processes to use to compress the new pack,
+            for packers that can compress in parallel. None or 1 compresses
+            in this process.
         """
         self.packs = packs
         self.suffix = suffix
@@ -660,6 +670,7 @@ class Packer(object):
         self.new_pack = None
         self._pack_collection = pack_collection
         self._reload_func = reload_func
+        self._jobs = jobs
         # The index layer keys for the revisions being copied. None for 'all
         # objects'.
         self._revision_keys = None
@@ -788,6 +799,10 @@ class RepositoryPackCollection(object):
         self._index_transport = index_transport
         self._upload_transport = upload_transport
         self._pack_transport = pack_transport
+        # Named packs and their indices never change, so reads from remote
+        # repositories can be served from a local cache.
+        self._index_read_transport = self._read_through_cache(index_transport)
+        self._pack_read_transport = self._read_through_cache(pack_transport)
         self._index_builder_class = index_builder_class
         self._index_class = index_class
         self._suffix_offsets = {'.rix': 0, '.iix': 1, '.tix': 2, '.six': 3,
@@ -920,11 +935,12 @@ class RepositoryPackCollection(object):
         return result
 
     def _execute_pack_operations(self, pack_operations, packer_class,
-                                 reload_func=None):
+                                 reload_func=None, jobs=None):
         """Execute a series of pack operations.
 
         :param pack_operations: A list of [revision_count, packs_to_combine].
         :param packer_class: The class of packer to use
+        :param jobs: The number of processes the packer may use.
         :return: The new pack names.
         """
         for revision_count, packs in pack_operations:
@@ -932,7 +948,7 @@ class RepositoryPackCollection(object):
             if len(packs) == 0:
                 continue
             packer = packer_class(self, packs, '.autopack',
-                                  reload_func=reload_func)
+                                  reload_func=reload_func, jobs=jobs)
             try:
                 result = packer.pack()
             except errors.RetryWithNewPacks:
@@ -972,7 +988,7 @@ class RepositoryPackCollection(object):
         """Is the collection already packed?"""
         return not (self.repo._format.pack_compresses or (len(self._names) > 1))
 
-    def pack(self, hint=None, clean_obsolete_packs=False):
+    def pack(self, hint=None, clean_obsolete_packs=False, jobs=None):
         """Pack the pack collection totally."""
         self.ensure_loaded()
         total_packs = len(self._names)
@@ -986,7 +1002,7 @@ class RepositoryPackCollection(object):
                total_revisions, hint)
         while True:
             try:
-                self._try_pack_operations(hint)
+                self._try_pack_operations(hint, jobs=jobs)
             except RetryPackOperations:
                 continue
             break
@@ -994,7 +1010,7 @@ class RepositoryPackCollection(object):
         if clean_obsolete_packs:
             self._clear_obsolete_packs()
 
-    def _try_pack_operations(self, hint):
+    def _try_pack_operations(self, hint, jobs=None):
         """Calculate the pack operations based on the hint (if any), and
         execute them.
         """
@@ -1008,7 +1024,8 @@ class RepositoryPackCollection(object):
                 pack_operations[-1][1].append(pack)
         self._execute_pack_operations(pack_operations,
                                       packer_class=self.optimising_packer_class,
-                                      reload_func=self._restart_pack_operations)
+                                      reload_func=self._restart_pack_operations,
+                                      jobs=jobs)
 
     def plan_autopack_combinations(self, existing_packs, pack_distribution):
         """Plan a pack operation.
@@ -1106,7 +1123,7 @@ class RepositoryPackCollection(object):
                 chk_index = self._make_index(name, '.cix', is_chk=True)
             else:
                 chk_index = None
-            result = ExistingPack(self._pack_transport, name, rev_index,
+            result = ExistingPack(self._pack_read_transport, name, rev_index,
                                   inv_index, txt_index, sig_index, chk_index)
             self.add_pack_to_memory(result)
             return result
@@ -1172,14 +1189,34 @@ class RepositoryPackCollection(object):
             transport = self._upload_transport
             index_size = transport.stat(index_name).st_size
         else:
-            transport = self._index_transport
+            transport = self._index_read_transport
             index_size = self._names[name][size_offset]
         index = self._index_class(transport, index_name, index_size,
                                   unlimited_cache=is_chk)
-        if is_chk and self._index_class is btree_index.BTreeGraphIndex:
-            index._leaf_factory = btree_index._gcchk_factory
+        if self._index_class is btree_index.BTreeGraphIndex:
+            if is_chk:
+                index._leaf_factory = btree_index._gcchk_factory
+            # The indices of named packs never change.
+            index._shared_nodes = not resume
         return index
 
+    def _read_through_cache(self, transport):
+        """Return a transport caching the data read from transport locally.
+
+        Local transports and a zero transport.cache_size are left alone.
+        """
+        try:
+            transport.local_abspath('.')
+        except errors.NotLocalUrl:
+            pass
+        else:
+            return transport
+        if not config.GlobalStack().get('transport.cache_size'):
+            return transport
+        return CachingTransportDecorator(
+            CachingTransportDecorator._get_url_prefix() + transport.base,
+            transport)
+
     def _max_pack_count(self, total_revisions):
         """Return the maximum number of packs to use for total revisions.
 
@@ -1389,6 +1426,10 @@ class RepositoryPackCollection(object):
                 self._names[name] = sizes
                 self.get_pack_by_name(name)
                 added.append(name)
+        if removed or modified:
+            btree_index.invalidate_shared_nodes(
+                [name + suffix for name in removed + modified
+                 for suffix in self._suffix_offsets])
         return removed, added, modified
 
     def _save_pack_names(self, clear_obsolete_packs=False, obsolete_packs=None):
@@ -1801,7 +1842,7 @@ class PackRepository(MetaDirVersionedFileRepository):
         # not supported - raise an error
         raise NotImplementedError(self.dont_leave_lock_in_place)
 
-    def pack(self, hint=None, clean_obsolete_packs=False):
+    def pack(self, hint=None, clean_obsolete_packs=False, jobs=None):
         """Compress the data within the repository.
 
         This will pack all the data to a single pack. In future it may
@@ -1809,7 +1850,8 @@ class PackRepository(MetaDirVersionedFileRepository):
         """
         with self.lock_write():
             self._pack_collection.pack(
-                hint=hint, clean_obsolete_packs=clean_obsolete_packs)
+                hint=hint, clean_obsolete_packs=clean_obsolete_packs,
+                jobs=jobs)
 
     def reconcile(self, other=None, thorough=False):
         """Reconcile this repository."""
@@ -2643,8 +2643,11 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
         self._ensure_real()
         return self._real_repository.inventories
 
-    def pack(self, hint=None, clean_obsolete_packs=False):
+    def pack(self, hint=None, clean_obsolete_packs=False, jobs=None):
         """Compress the data within the repository.
+
+        The jobs parameter is only used when falling back to packing via
+        VFS calls; the server decides how to pack its repositories.
         """
         if hint is None:
             body = b""
@@ -2659,7 +2662,8 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
             except errors.UnknownSmartMethod:
                 self._ensure_real()
                 return self._real_repository.pack(hint=hint,
-                                                  clean_obsolete_packs=clean_obsolete_packs)
+                                                  clean_obsolete_packs=clean_obsolete_packs,
+                                                  jobs=jobs)
             handler.cancel_read_body()
             if response != (b'ok', ):
                 raise errors.UnexpectedSmartServerResponse(response)
@@ -2819,19 +2823,65 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
                 return True
         return False
 
+    def _has_signatures(self, revision_ids):
+        """Return the set of revision_ids that have a signature.
+
+        This asks about all of them in one batch of pipelined requests.
+        """
+        path = self.controldir._path_for_remote_call(self._client)
+        responses = self._client.call_many(
+            [(b'Repository.has_signature_for_revision_id', (path, revision_id))
+             for revision_id in revision_ids])
+        signed = set()
+        for revision_id, response in zip(revision_ids, responses):
+            if isinstance(response, errors.UnknownSmartMethod):
+                self._ensure_real()
+                if self._real_repository.has_signature_for_revision_id(
+                        revision_id):
+                    signed.add(revision_id)
+                continue
+            if isinstance(response, errors.ErrorFromSmartServer):
+                self._translate_error(response)
+            if response[0] not in (b'yes', b'no'):
+                raise SmartProtocolError(
+                    'unexpected response code %s' % (response,))
+            if response[0] == b'yes':
+                signed.add(revision_id)
+                continue
+            for fallback in self._fallback_repositories:
+                if fallback.has_signature_for_revision_id(revision_id):
+                    signed.add(revision_id)
+                    break
+        return signed
+
     def verify_revision_signature(self, revision_id, gpg_strategy):
         with self.lock_read():
             if not self.has_signature_for_revision_id(revision_id):
                 return gpg.SIGNATURE_NOT_SIGNED, None
-            signature = self.get_signature_text(revision_id)
+            return self._verify_signature(revision_id, gpg_strategy)
 
-            testament = _mod_testament.Testament.from_revision(
-                self, revision_id)
+    def verify_revision_signatures(self, revision_ids, gpg_strategy):
+        with self.lock_read():
+            revision_ids = list(revision_ids)
+            signed = self._has_signatures(revision_ids)
+            for revision_id in revision_ids:
+                if revision_id in signed:
+                    (result, key) = self._verify_signature(
+                        revision_id, gpg_strategy)
+                else:
+                    (result, key) = (gpg.SIGNATURE_NOT_SIGNED, None)
+                yield revision_id, result, key
 
-            (status, key, signed_plaintext) = gpg_strategy.verify(signature)
-            if testament.as_short_text() != signed_plaintext:
-                return gpg.SIGNATURE_NOT_VALID, None
-            return (status, key)
+    def _verify_signature(self, revision_id, gpg_strategy):
+        signature = self.get_signature_text(revision_id)
+
+        testament = _mod_testament.Testament.from_revision(
+            self, revision_id)
+
+        (status, key, signed_plaintext) = gpg_strategy.verify(signature)
+        if testament.as_short_text() != signed_plaintext:
+            return gpg.SIGNATURE_NOT_VALID, None
+        return (status, key)
 
     def item_keys_introduced_by(self, revision_ids, _files_pb=None):
         self._ensure_real()
@@ -4039,24 +4089,55 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
         """
         with self.lock_read():
             try:
-                response = self._call(b'Branch.revision_id_to_revno',
-                                      self._remote_path(), revision_id)
+                response = self._client.call(b'Branch.revision_id_to_revno',
+                                             self._remote_path(), revision_id)
             except errors.UnknownSmartMethod:
                 self._ensure_real()
                 return self._real_branch.revision_id_to_dotted_revno(revision_id)
-            except errors.UnknownErrorFromSmartServer as e:
-                # Deal with older versions of bzr/brz that didn't explicitly
-                # wrap GhostRevisionsHaveNoRevno.
-                if e.error_tuple[1] == b'GhostRevisionsHaveNoRevno':
-                    (revid, ghost_revid) = re.findall(b"{([^}]+)}", e.error_tuple[2])
-                    raise errors.GhostRevisionsHaveNoRevno(
-                        revid, ghost_revid)
-                raise
+            except errors.ErrorFromSmartServer as err:
+                self._translate_revision_id_to_revno_error(err)
             if response[0] == b'ok':
                 return tuple([int(x) for x in response[1:]])
             else:
                 raise errors.UnexpectedSmartServerResponse(response)
 
+    def revision_ids_to_dotted_revnos(self, revision_ids):
+        """See Branch.revision_ids_to_dotted_revnos."""
+        revision_ids = list(revision_ids)
+        with self.lock_read():
+            path = self._remote_path()
+            responses = self._client.call_many(
+                [(b'Branch.revision_id_to_revno', (path, revision_id))
+                 for revision_id in revision_ids])
+            result = {}
+            for revision_id, response in zip(revision_ids, responses):
+                if isinstance(response, errors.UnknownSmartMethod):
+                    self._ensure_real()
+                    return self._real_branch.revision_ids_to_dotted_revnos(
+                        revision_ids)
+                if isinstance(response, errors.ErrorFromSmartServer):
+                    try:
+                        self._translate_revision_id_to_revno_error(response)
+                    except (errors.NoSuchRevision,
+                            errors.GhostRevisionsHaveNoRevno):
+                        continue
+                if response[0] != b'ok':
+                    raise errors.UnexpectedSmartServerResponse(response)
+                result[revision_id] = tuple([int(x) for x in response[1:]])
+            return result
+
+    def _translate_revision_id_to_revno_error(self, err):
+        try:
+            self._translate_error(err)
+        except errors.UnknownErrorFromSmartServer as e:
+            # Deal with older versions of bzr/brz that didn't explicitly
+            # wrap GhostRevisionsHaveNoRevno.
+            if e.error_tuple[1] == b'GhostRevisionsHaveNoRevno':
+                (revid, ghost_revid) = re.findall(b"{([^}]+)}", e.error_tuple[2])
+                raise errors.GhostRevisionsHaveNoRevno(
+                    revid, ghost_revid)
+            raise
+
     def revision_id_to_revno(self, revision_id):
         """Given a revision id on the branch mainline, return its revno.
 
@@ -0,0 +1,197 @@
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Persistent cache of the merge sorted revisions of a branch.
+
+Computing dotted revnos requires a merge sort of the entire ancestry of the
+branch tip, which is expensive for branches with a long history. The result
+is stored in the branch control directory, together with the branch tip it
+was computed for. When the tip has since advanced along a linear mainline,
+or has been moved back to an older mainline revision, the stored result is
+adjusted rather than recomputed.
+
+Results are only stored for ancestries without ghosts; filling in a ghost
+would change the numbering without changing the branch tip.
+"""
+
+import zlib
+
+from .. import (
+    errors,
+    revision as _mod_revision,
+    )
+from ..trace import mutter
+
+
+FILENAME = 'revno-cache'
+
+_SIGNATURE = b'Breezy revno cache 1\n'
+
+# Histories smaller than this are cheap enough to merge sort on the fly.
+_MIN_CACHED_REVISIONS = 1000
+
+# The largest number of new mainline revisions to walk when trying to extend
+# a stored result, before giving up and merge sorting the whole ancestry.
+_MAX_LINEAR_EXTENSION = 1000
+
+
+class MergeSortedRevision(object):
+    """A revision as returned by KnownGraph.merge_sort."""
+
+    __slots__ = ('key', 'merge_depth', 'revno', 'end_of_merge')
+
+    def __init__(self, key, merge_depth, revno, end_of_merge):
+        self.key = key
+        self.merge_depth = merge_depth
+        self.revno = revno
+        self.end_of_merge = end_of_merge
+
+
+def serialize(last_revno, last_revision_id, nodes):
+    """Serialize merge sorted revisions.
+
+    :param last_revno: Revno of the tip the nodes were computed for.
+    :param last_revision_id: Revision id of that tip.
+    :param nodes: Merge sorted nodes, tip first.
+    :return: Bytes suitable for passing to deserialize.
+    """
+    lines = [_SIGNATURE, b'%d %s\n' % (last_revno, last_revision_id)]
+    for node in nodes:
+        lines.append(b'%s %d %d %s\n' % (
+            b'.'.join(b'%d' % n for n in node.revno), node.merge_depth,
+            node.end_of_merge, node.key))
+    return zlib.compress(b''.join(lines))
+
+
+def deserialize(data):
+    """Deserialize merge sorted revisions.
+
+    :raises ValueError: if the data is not a valid revno cache.
+    :return: Tuple with last revno, last revision id and list of nodes.
+    """
+    try:
+        lines = zlib.decompress(data).split(b'\n')
+    except zlib.error as e:
+        raise ValueError('corrupt revno cache: %s' % e)
+    if lines[0] + b'\n' != _SIGNATURE or lines[-1] != b'':
+        raise ValueError('invalid revno cache signature')
+    last_revno, last_revision_id = lines[1].split(b' ', 1)
+    nodes = []
+    for line in lines[2:-1]:
+        revno, depth, end_of_merge, key = line.split(b' ', 3)
+        nodes.append(MergeSortedRevision(
+            key, int(depth), tuple(int(n) for n in revno.split(b'.')),
+            end_of_merge == b'1'))
+    return int(last_revno), last_revision_id, nodes
+
+
+def _has_ghosts(known_graph, nodes):
+    present = {node.key for node in nodes}
+    for node in nodes:
+        for parent in known_graph.get_parent_keys(node.key):
+            if parent not in present:
+                return True
+    return False
+
+
+def _extend(repository, cached_revno, cached_revision_id, nodes,
+            last_revno, last_revision_id):
+    """Try to adjust stored nodes for a new branch tip.
+
+    :return: The nodes for the new tip, or None if they can not be derived
+        from the stored nodes.
+    """
+    if last_revno <= cached_revno:
+        # The tip moved back; the ancestry of an older mainline revision is
+        # a suffix of the stored nodes and its numbering is unchanged.
+        for i, node in enumerate(nodes):
+            if node.merge_depth == 0 and node.revno == (last_revno,):
+                if node.key == last_revision_id:
+                    return nodes[i:]
+                return None
+        return None
+    if last_revno - cached_revno > _MAX_LINEAR_EXTENSION:
+        return None
+    graph = repository.get_graph()
+    new_nodes = []
+    revision_id = last_revision_id
+    for revno in range(last_revno, cached_revno, -1):
+        parents = graph.get_parent_map([revision_id]).get(revision_id)
+        if parents is None or len(parents) != 1:
+            # A ghost, or a merge which introduces revisions that need
+            # numbering.
+            return None
+        new_nodes.append(
+            MergeSortedRevision(revision_id, 0, (revno,), False))
+        revision_id = parents[0]
+    if revision_id != cached_revision_id:
+        return None
+    return new_nodes + nodes
+
+
+def _load(transport):
+    try:
+        data = transport.get_bytes(FILENAME)
+    except errors.NoSuchFile:
+        return None
+    try:
+        return deserialize(data)
+    except ValueError as e:
+        mutter('ignoring revno cache: %s', e)
+        return None
+
+
+def _save(transport, last_revno, last_revision_id, nodes, mode=None):
+    if any(b'\n' in node.key for node in nodes):
+        return
+    try:
+        transport.put_bytes(
+            FILENAME, serialize(last_revno, last_revision_id, nodes),
+            mode=mode)
+    except (errors.TransportNotPossible, errors.PermissionDenied) as e:
+        mutter('unable to write revno cache: %s', e)
+
+
+def merge_sort(branch):
+    """Merge sort the ancestry of the tip of a branch, using the cache.
+
+    :param branch: A BzrBranch, locked for reading.
+    :return: List of nodes with key, merge_depth, revno and end_of_merge
+        attributes, tip first.
+    """
+    last_revno, last_revision_id = branch.last_revision_info()
+    if _mod_revision.is_null(last_revision_id):
+        return []
+    cached = _load(branch._transport)
+    if cached is not None:
+        cached_revno, cached_revision_id, nodes = cached
+        if (cached_revno, cached_revision_id) == (
+                last_revno, last_revision_id):
+            return nodes
+        nodes = _extend(branch.repository, cached_revno, cached_revision_id,
+                        nodes, last_revno, last_revision_id)
+        if nodes is not None:
+            _save(branch._transport, last_revno, last_revision_id, nodes,
+                  branch.controldir._get_file_mode())
+            return nodes
+    known_graph = branch.repository.get_known_graph_ancestry(
+        [last_revision_id])
+    nodes = known_graph.merge_sort(last_revision_id)
+    if (len(nodes) >= _MIN_CACHED_REVISIONS and
+            not _has_ghosts(known_graph, nodes)):
+        _save(branch._transport, last_revno, last_revision_id, nodes,
+              branch.controldir._get_file_mode())
+    return nodes
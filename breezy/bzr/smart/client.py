@@ -16,9 +16,12 @@
 
 from ... import lazy_import
 lazy_import.lazy_import(globals(), """
+from breezy import config as _mod_config
 from breezy.bzr.smart import request as _mod_request
 """)
 
+from collections import deque
+
 import breezy
 from . import message, protocol
 from ... import (
@@ -31,15 +34,28 @@ from ... import (
 
 class _SmartClient(object):
 
+    # The most requests call_many will write before reading their responses.
+    # Bounds how much the server may have to buffer, and how much data is in
+    # flight.
+    _max_pipelined_requests = 100
+
     def __init__(self, medium, headers=None):
         """Constructor.
 
         :param medium: a SmartClientMedium
         """
         self._medium = medium
+        self._body_compression = _get_body_compression()
         if headers is None:
             self._headers = {
                 b'Software version': breezy.__version__.encode('utf-8')}
+            if self._body_compression is not None:
+                # Ask the server to compress the body streams it sends us.
+                codec, level = self._body_compression
+                if level is not None:
+                    codec = '%s:%d' % (codec, level)
+                self._headers[b'Accept body compression'] = codec.encode(
+                    'ascii')
         else:
             self._headers = dict(headers)
 
@@ -70,6 +86,71 @@ class _SmartClient(object):
         return self._call_and_read_response(
             method, args, expect_response_body=True)
 
+    def call_many(self, calls):
+        """Call several independent methods on the remote server.
+
+        If the medium and server support it the requests are pipelined: they
+        are all written before any response is read, so the whole batch costs
+        about one round trip rather than one per call.
+
+        :param calls: A sequence of (method, args) tuples.
+        :return: A list with an item for each call, in order: the response
+            tuple, or the ErrorFromSmartServer or UnknownSmartMethod the server
+            answered that call with.
+        """
+        calls = deque(calls)
+        results = []
+        while calls:
+            if len(calls) > 1 and self._can_pipeline():
+                batch = [calls.popleft() for i in range(
+                    min(len(calls), self._max_pipelined_requests))]
+                results.extend(self._call_pipelined(batch))
+            else:
+                method, args = calls.popleft()
+                results.append(self._call_catching_errors(method, args))
+        return results
+
+    def _can_pipeline(self):
+        return (self._medium._supports_pipelining and
+                self._medium._protocol_version == 3 and
+                self._medium._remote_accepts_pipelining and
+                'nopipeline' not in debug.debug_flags)
+
+    def _call_catching_errors(self, method, args):
+        try:
+            return self.call(method, *args)
+        except (errors.ErrorFromSmartServer, errors.UnknownSmartMethod) as e:
+            return e
+
+    def _call_pipelined(self, calls):
+        requests = [
+            _SmartClientRequest(self, method, args, expect_response_body=False)
+            for (method, args) in calls]
+        response_handlers = []
+        results = []
+        try:
+            for request in requests:
+                response_handlers.append(request.send_pipelined())
+            for response_handler in response_handlers:
+                try:
+                    results.append(response_handler.read_response_tuple(
+                        expect_body=False))
+                except (errors.ErrorFromSmartServer,
+                        errors.UnknownSmartMethod) as e:
+                    results.append(e)
+        except errors.ConnectionReset:
+            self._medium.reset()
+            unanswered = requests[len(results):]
+            if not all(request._is_safe_to_send_twice()
+                       for request in unanswered):
+                raise
+            trace.warning('ConnectionReset during pipelined calls, retrying')
+            trace.log_exception_quietly()
+            for request in unanswered:
+                results.append(
+                    self._call_catching_errors(request.method, request.args))
+        return results
+
     def call_with_body_bytes(self, method, args, body):
         """Call a method on the remote server with body bytes."""
         if not isinstance(method, bytes):
@@ -117,6 +198,18 @@ class _SmartClient(object):
         return self._medium.remote_path_from_transport(transport).encode('utf-8')
 
 
+def _get_body_compression():
+    """Return the (codec, level) configured for body streams, if any."""
+    value = _mod_config.GlobalStack().get('smart.compression')
+    if not value:
+        return None
+    try:
+        return message.parse_body_compression(value)
+    except ValueError as e:
+        trace.warning('Ignoring smart.compression: %s' % (e,))
+        return None
+
+
 class _SmartClientRequest(object):
     """Encapsulate the logic for a single request.
 
@@ -155,6 +248,20 @@ class _SmartClientRequest(object):
         else:
             return self._call(protocol_version)
 
+    def send_pipelined(self):
+        """Send the request without waiting for earlier responses.
+
+        The protocol version must already be known, and the response to this
+        request must only be read after those of the requests sent before it.
+
+        :return: the response_handler to read the response with.
+        """
+        self._run_call_hooks()
+        encoder, response_handler = self._construct_protocol(
+            self.client._medium._protocol_version, pipelined=True)
+        self._send_no_retry(encoder)
+        return response_handler
+
     def _is_safe_to_send_twice(self):
         """Check if the current method is re-entrant safe."""
         if self.body_stream is not None or 'noretry' in debug.debug_flags:
@@ -201,8 +308,19 @@ class _SmartClientRequest(object):
             self._send_no_retry(encoder)
             response_tuple = response_handler.read_response_tuple(
                 expect_body=self.expect_response_body)
+        if protocol_version == 3 and response_handler.headers:
+            self._note_server_capabilities(response_handler.headers)
         return (response_tuple, response_handler)
 
+    def _note_server_capabilities(self, headers):
+        medium = self.client._medium
+        if headers.get(b'Pipelining') == b'yes':
+            medium._remote_accepts_pipelining = True
+        codecs = headers.get(b'Body compression codecs')
+        if codecs is not None:
+            medium._remote_body_compression_codecs = tuple(
+                codecs.decode('ascii', 'replace').split())
+
     def _call_determining_protocol_version(self):
         """Determine what protocol the remote server supports.
 
@@ -237,9 +355,12 @@ class _SmartClientRequest(object):
         raise errors.SmartProtocolError(
             'Server is not a Bazaar server: ' + str(last_err))
 
-    def _construct_protocol(self, version):
+    def _construct_protocol(self, version, pipelined=False):
         """Build the encoding stack for a given protocol version."""
-        request = self.client._medium.get_request()
+        if pipelined:
+            request = self.client._medium.get_request(pipelined=True)
+        else:
+            request = self.client._medium.get_request()
         if version == 3:
             request_encoder = protocol.ProtocolThreeRequester(request)
             response_handler = message.ConventionalResponseHandler()
@@ -311,6 +432,12 @@ class _SmartClientRequest(object):
             encoder.call_with_body_readv_array((self.method, ) + self.args,
                                                self.readv_body)
         elif self.body_stream is not None:
+            compression = self.client._body_compression
+            if (compression is not None and
+                    isinstance(encoder, protocol.ProtocolThreeRequester) and
+                    compression[0] in
+                    self.client._medium._remote_body_compression_codecs):
+                encoder.set_body_compression(*compression)
             encoder.call_with_body_stream((self.method, ) + self.args,
                                           self.body_stream)
         else:
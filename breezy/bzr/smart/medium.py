@@ -24,6 +24,7 @@ over SSH), and pass them to and from the protocol logic.  See the overview in
 breezy/transport/smart/__init__.py.
 """
 
+from collections import deque
 import errno
 import io
 import os
@@ -294,7 +295,10 @@ class SmartServerStreamMedium(SmartMedium):
 
         :returns: a SmartServerRequestProtocol.
         """
-        self._wait_for_bytes_with_timeout(self._client_timeout)
+        if self._push_back_buffer is None:
+            # If the client pipelined its requests we may already have read
+            # (part of) this one, in which case there is nothing to wait for.
+            self._wait_for_bytes_with_timeout(self._client_timeout)
         if self.finished:
             # We're stopping, so don't try to do any more work
             return None
@@ -599,6 +603,13 @@ class SmartClientMediumRequest(object):
         """
         raise NotImplementedError(self._finished_reading)
 
+    def _push_back(self, data):
+        """Return bytes read past the end of this request's response.
+
+        They belong to the responses of requests pipelined after this one.
+        """
+        self._medium._push_back(data)
+
     def finished_writing(self):
         """Finish the writing phase of this request.
 
@@ -704,8 +715,8 @@ class _DebugCounter(object):
         """
         medium_repr = repr(medium)
         # Add this medium to the WeakKeyDictionary
-        self.counts[medium] = dict(count=0, vfs_count=0,
-                                   medium_repr=medium_repr)
+        self.counts[medium] = dict(count=0, vfs_count=0, body_bytes=0,
+                                   wire_body_bytes=0, medium_repr=medium_repr)
         # Weakref callbacks are fired in reverse order of their association
         # with the referenced object.  So we add a weakref *after* adding to
         # the WeakKeyDict so that we can report the value from it before the
@@ -724,18 +735,38 @@ class _DebugCounter(object):
         if issubclass(request_method, vfs.VfsRequest):
             value['vfs_count'] += 1
 
+    def count_body_bytes(self, medium, body_bytes, wire_body_bytes):
+        """Count the bytes of a body stream sent or received on medium.
+
+        :param body_bytes: The size of the body stream.
+        :param wire_body_bytes: The number of bytes it took on the wire, after
+            any compression.
+        """
+        value = self.counts.get(medium)
+        if value is None:
+            return
+        value['body_bytes'] += body_bytes
+        value['wire_body_bytes'] += wire_body_bytes
+
     def done(self, ref):
         value = self.counts[ref]
         count, vfs_count, medium_repr = (
             value['count'], value['vfs_count'], value['medium_repr'])
+        body_bytes, wire_body_bytes = (
+            value['body_bytes'], value['wire_body_bytes'])
         # In case this callback is invoked for the same ref twice (by the
         # weakref callback and by the atexit function), set the call count back
         # to 0 so this item won't be reported twice.
         value['count'] = 0
         value['vfs_count'] = 0
+        value['body_bytes'] = value['wire_body_bytes'] = 0
         if count != 0:
             trace.note(gettext('HPSS calls: {0} ({1} vfs) {2}').format(
                        count, vfs_count, medium_repr))
+        if body_bytes != 0:
+            trace.note(gettext(
+                'HPSS body streams: {0} bytes, {1} bytes on the wire {2}').format(
+                body_bytes, wire_body_bytes, medium_repr))
 
     def flush_all(self):
         for ref in list(self.counts.keys()):
@@ -746,15 +777,31 @@ _debug_counter = None
 _vfs_refuser = None
 
 
+def _count_body_bytes(medium, body_bytes, wire_body_bytes):
+    """Count a body stream for the -Dhpss summary of medium."""
+    if _debug_counter is not None:
+        _debug_counter.count_body_bytes(medium, body_bytes, wire_body_bytes)
+
+
 class SmartClientMedium(SmartMedium):
     """Smart client is a medium for sending smart protocol requests over."""
 
+    # Can several requests be written before the first response is read? See
+    # get_request.
+    _supports_pipelining = False
+
     def __init__(self, base):
         super(SmartClientMedium, self).__init__()
         self.base = base
         self._protocol_version_error = None
         self._protocol_version = None
         self._done_hello = False
+        # Set once the remote side has told us it can serve pipelined
+        # requests.
+        self._remote_accepts_pipelining = False
+        # The codecs the remote side told us it can decompress request body
+        # streams with.
+        self._remote_body_compression_codecs = ()
         # Be optimistic: we assume the remote end can accept new remote
         # requests until we get an error saying otherwise.
         # _remote_version_is_before tracks the bzr version the remote side
@@ -878,9 +925,12 @@ class SmartClientStreamMedium(SmartClientMedium):
     receive bytes.
     """
 
+    _supports_pipelining = True
+
     def __init__(self, base):
         SmartClientMedium.__init__(self, base)
         self._current_request = None
+        self._pipelined_requests = deque()
 
     def accept_bytes(self, bytes):
         self._accept_bytes(bytes)
@@ -899,13 +949,17 @@ class SmartClientStreamMedium(SmartClientMedium):
         """
         raise NotImplementedError(self._flush)
 
-    def get_request(self):
+    def get_request(self, pipelined=False):
         """See SmartClientMedium.get_request().
 
         SmartClientStreamMedium always returns a SmartClientStreamMediumRequest
         for get_request.
+
+        :param pipelined: If True, the request may be started while earlier
+            requests are still waiting for their responses. Their responses
+            must then be read in the order the requests were made.
         """
-        return SmartClientStreamMediumRequest(self)
+        return SmartClientStreamMediumRequest(self, pipelined=pipelined)
 
     def reset(self):
         """We have been disconnected, reset current state.
@@ -914,6 +968,7 @@ class SmartClientStreamMedium(SmartClientMedium):
         """
         self.disconnect()
         self._current_request = None
+        self._pipelined_requests.clear()
 
 
 class SmartSimplePipesClientMedium(SmartClientStreamMedium):
@@ -1182,16 +1237,17 @@ class SmartClientAlreadyConnectedSocketMedium(SmartClientSocketMedium):
 class SmartClientStreamMediumRequest(SmartClientMediumRequest):
     """A SmartClientMediumRequest that works with an SmartClientStreamMedium."""
 
-    def __init__(self, medium):
+    def __init__(self, medium, pipelined=False):
         SmartClientMediumRequest.__init__(self, medium)
-        # check that we are safe concurrency wise. If some streams start
-        # allowing concurrent requests - i.e. via multiplexing - then this
-        # assert should be moved to SmartClientStreamMedium.get_request,
-        # and the setting/unsetting of _current_request likewise moved into
-        # that class : but its unneeded overhead for now. RBC 20060922
-        if self._medium._current_request is not None:
+        # check that we are safe concurrency wise. Pipelined requests queue
+        # up behind the current one, and become current in turn as the
+        # responses before them are read.
+        if self._medium._current_request is None:
+            self._medium._current_request = self
+        elif pipelined:
+            self._medium._pipelined_requests.append(self)
+        else:
             raise errors.TooManyConcurrentRequests(self._medium)
-        self._medium._current_request = self
 
     def _accept_bytes(self, bytes):
         """See SmartClientMediumRequest._accept_bytes.
@@ -1205,11 +1261,15 @@ class SmartClientStreamMediumRequest(SmartClientMediumRequest):
         """See SmartClientMediumRequest._finished_reading.
 
         This clears the _current_request on self._medium to allow a new
-        request to be created.
+        request to be created, or makes the next pipelined request current.
         """
         if self._medium._current_request is not self:
             raise AssertionError()
-        self._medium._current_request = None
+        if self._medium._pipelined_requests:
+            self._medium._current_request = (
+                self._medium._pipelined_requests.popleft())
+        else:
+            self._medium._current_request = None
 
     def _finished_writing(self):
         """See SmartClientMediumRequest._finished_writing.
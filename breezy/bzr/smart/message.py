@@ -22,14 +22,160 @@ except ImportError:  # python < 3.7
 from io import (
     BytesIO,
     )
+import zlib
 
 from ... import (
     debug,
     errors,
+    registry,
     )
 from ...trace import mutter
 
 
+# The largest a compressed body part may become when it is decompressed.
+# Senders split larger parts, so a small part cannot expand into a huge one on
+# the receiving end.
+MAX_BODY_PART_SIZE = 4 * 1024 * 1024
+
+
+def _body_part_too_large(max_size):
+    return errors.SmartProtocolError(
+        'Compressed body part expands to more than %d bytes' % (max_size,))
+
+
+def _zlib_compressor(level):
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(level)
+
+    def compress(bytes):
+        # Flush after each part, so the other end can decode it as soon as it
+        # arrives.
+        return compressor.compress(bytes) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compress
+
+
+def _zlib_decompressor(max_size):
+    decompressor = zlib.decompressobj()
+
+    def decompress(bytes):
+        result = decompressor.decompress(bytes, max_size + 1)
+        if len(result) > max_size:
+            raise _body_part_too_large(max_size)
+        return result
+    return decompress
+
+
+class _BoundedWriter(object):
+    """Collect the output of a streaming decompressor, up to a limit."""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        self._size += len(data)
+        if self._size > self._max_size:
+            raise _body_part_too_large(self._max_size)
+        self._chunks.append(data)
+        return len(data)
+
+    def take(self):
+        """Return and forget what has been written so far."""
+        result = b''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return result
+
+
+def _zstd_compressor(level):
+    import zstandard
+    if level is None:
+        level = 3
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(bytes):
+        return (compressor.compress(bytes) +
+                compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+    return compress
+
+
+def _zstd_decompressor(max_size):
+    import zstandard
+    # The decompression writer hands over its output in small chunks, so the
+    # limit is enforced before all of it is in memory.
+    output = _BoundedWriter(max_size)
+    writer = zstandard.ZstdDecompressor().stream_writer(output)
+
+    def decompress(bytes):
+        writer.write(bytes)
+        return output.take()
+    return decompress
+
+
+def _zstd_available():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+# Codecs that can compress the body streams of protocol v3 messages. The
+# values are (compressor factory, decompressor factory, availability check).
+# A compressor factory takes a compression level (or None for the default)
+# and returns a function compressing one body part; a decompressor factory
+# takes the largest size a part may decompress to and returns a function
+# decompressing one body part, which raises SmartProtocolError for parts that
+# get larger than that.
+body_compression_codecs = registry.Registry()
+body_compression_codecs.register(
+    'zlib', (_zlib_compressor, _zlib_decompressor, lambda: True))
+body_compression_codecs.register(
+    'zstd', (_zstd_compressor, _zstd_decompressor, _zstd_available))
+
+
+def available_body_compression_codecs():
+    """Return the names of the body compression codecs usable here."""
+    return [name for name in sorted(body_compression_codecs.keys())
+            if body_compression_codecs.get(name)[2]()]
+
+
+def parse_body_compression(value):
+    """Parse a body compression setting like 'zlib' or 'zstd:9'.
+
+    :return: a (codec, level) tuple; level is None if not specified.
+    :raises ValueError: if the codec is unknown or the level not an int.
+    """
+    codec, sep, level = value.partition(':')
+    if codec not in body_compression_codecs:
+        raise ValueError('unknown body compression codec %r' % (codec,))
+    if sep:
+        level = int(level)
+    else:
+        level = None
+    return codec, level
+
+
+def make_body_compressor(codec, level):
+    return body_compression_codecs.get(codec)[0](level)
+
+
+def _body_decompressor_for_headers(headers):
+    """Return a decompressor for the body of a message with headers.
+
+    :return: None if the body is not compressed.
+    """
+    if not headers or b'Body compression' not in headers:
+        return None
+    codec = headers[b'Body compression'].decode('ascii', 'replace')
+    if codec not in available_body_compression_codecs():
+        raise errors.SmartProtocolError(
+            'Unsupported body compression: %r' % (codec,))
+    return body_compression_codecs.get(codec)[1](MAX_BODY_PART_SIZE)
+
+
 class MessageHandler(object):
     """Base class for handling messages received via the smart protocol.
 
@@ -106,6 +252,14 @@ class ConventionalRequestHandler(MessageHandler):
         self.expecting = 'args'
         self._should_finish_body = False
         self._response_sent = False
+        self._body_decompressor = None
+
+    def headers_received(self, headers):
+        MessageHandler.headers_received(self, headers)
+        self._body_decompressor = _body_decompressor_for_headers(headers)
+        accepted = headers.get(b'Accept body compression')
+        if accepted is not None:
+            self.responder.accept_body_compression(accepted)
 
     def protocol_error(self, exception):
         if self.responder.response_sent:
@@ -155,6 +309,8 @@ class ConventionalRequestHandler(MessageHandler):
     def bytes_part_received(self, bytes):
         if self.expecting == 'body':
             self._should_finish_body = True
+            if self._body_decompressor is not None:
+                bytes = self._body_decompressor(bytes)
             self.request_handler.accept_body(bytes)
         else:
             raise errors.SmartProtocolError(
@@ -226,6 +382,13 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
         self._body = None
         self._body_error_args = None
         self.finished_reading = False
+        self._body_decompressor = None
+        # Bytes of the body as sent over the wire, and after decompression.
+        self.wire_body_bytes = self.body_bytes = 0
+
+    def headers_received(self, headers):
+        MessageHandler.headers_received(self, headers)
+        self._body_decompressor = _body_decompressor_for_headers(headers)
 
     def setProtoAndMediumRequest(self, protocol_decoder, medium_request):
         self._protocol_decoder = protocol_decoder
@@ -250,6 +413,10 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
 
     def bytes_part_received(self, bytes):
         self._body_started = True
+        self.wire_body_bytes += len(bytes)
+        if self._body_decompressor is not None:
+            bytes = self._body_decompressor(bytes)
+        self.body_bytes += len(bytes)
         self._bytes_parts.append(bytes)
 
     def structure_part_received(self, structure):
@@ -282,6 +449,16 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
         if next_read_size == 0:
             # a complete request has been read.
             self.finished_reading = True
+            if self.wire_body_bytes and 'hpss' in debug.debug_flags:
+                from . import medium
+                medium._count_body_bytes(
+                    self._medium_request._medium, self.body_bytes,
+                    self.wire_body_bytes)
+            if self._protocol_decoder.unused_data:
+                # The start of the response to a pipelined request.
+                self._medium_request._push_back(
+                    self._protocol_decoder.unused_data)
+                self._protocol_decoder.unused_data = b''
             self._medium_request.finished_reading()
             return
         data = self._medium_request.read_bytes(next_read_size)
@@ -331,7 +508,8 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
             self._wait_for_response_end()
             body_bytes = b''.join(self._bytes_parts)
             if 'hpss' in debug.debug_flags:
-                mutter('              %d body bytes read', len(body_bytes))
+                mutter('              %d body bytes read (%d on the wire)',
+                       len(body_bytes), self.wire_body_bytes)
             self._body = BytesIO(body_bytes)
             self._bytes_parts = None
         return self._body.read(count)
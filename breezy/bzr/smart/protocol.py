@@ -1086,6 +1086,38 @@ class _ProtocolThreeEncoder(object):
         self._buf = []
         self._buf_len = 0
         self._real_write_func = write_func
+        self._body_compression = None
+        self._body_compressor = None
+
+    def _headers_for_body_stream(self, headers):
+        """Start compressing body parts, if a codec has been chosen.
+
+        :return: the headers to send with the message.
+        """
+        if self._body_compression is None:
+            return headers
+        codec, level = self._body_compression
+        self._body_compressor = message.make_body_compressor(codec, level)
+        headers = dict(headers)
+        headers[b'Body compression'] = codec.encode('ascii')
+        return headers
+
+    def _write_body_stream_part(self, bytes):
+        """Write a part of a body stream.
+
+        :return: the number of bytes written for it.
+        """
+        if self._body_compressor is None:
+            self._write_prefixed_body(bytes)
+            return len(bytes)
+        # Keep each part small enough for the receiver to decompress it.
+        max_size = message.MAX_BODY_PART_SIZE
+        wire_bytes = 0
+        for start in range(0, max(len(bytes), 1), max_size):
+            compressed = self._body_compressor(bytes[start:start + max_size])
+            self._write_prefixed_body(compressed)
+            wire_bytes += len(compressed)
+        return wire_bytes
 
     def _write_func(self, bytes):
         # TODO: Another possibility would be to turn this into an async model.
@@ -1157,7 +1189,14 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
         _ProtocolThreeEncoder.__init__(self, write_func)
         self.response_sent = False
         self._headers = {
-            b'Software version': breezy.__version__.encode('utf-8')}
+            b'Software version': breezy.__version__.encode('utf-8'),
+            # Tell clients they may write requests before reading the
+            # responses to earlier ones.
+            b'Pipelining': b'yes',
+            # And which codecs they may compress request bodies with.
+            b'Body compression codecs': b' '.join(
+                codec.encode('ascii') for codec in
+                message.available_body_compression_codecs())}
         if 'hpss' in debug.debug_flags:
             self._thread_id = _thread.get_ident()
             self._response_start_time = None
@@ -1178,6 +1217,20 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
         mutter('%12s: [%s] %s%s%s'
                % (action, self._thread_id, t, message, extra))
 
+    def accept_body_compression(self, value):
+        """Compress a response body stream as the client asked.
+
+        :param value: the client's 'Accept body compression' header, like
+            b'zlib' or b'zlib:9'.
+        """
+        try:
+            codec, level = message.parse_body_compression(
+                value.decode('ascii'))
+        except (UnicodeDecodeError, ValueError):
+            return
+        if codec in message.available_body_compression_codecs():
+            self._body_compression = (codec, level)
+
     def send_error(self, exception):
         if self.response_sent:
             raise AssertionError(
@@ -1205,7 +1258,10 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
                 % (response,))
         self.response_sent = True
         self._write_protocol_version()
-        self._write_headers(self._headers)
+        if response.body_stream is not None:
+            self._write_headers(self._headers_for_body_stream(self._headers))
+        else:
+            self._write_headers(self._headers)
         if response.is_successful():
             self._write_success_status()
         else:
@@ -1219,7 +1275,7 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
                 self._trace('body', '%d bytes' % (len(response.body),),
                             response.body, include_time=True)
         elif response.body_stream is not None:
-            count = num_bytes = 0
+            count = num_bytes = wire_bytes = 0
             first_chunk = None
             for exc_info, chunk in _iter_with_errors(response.body_stream):
                 count += 1
@@ -1236,7 +1292,7 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
                     num_bytes += len(chunk)
                     if first_chunk is None:
                         first_chunk = chunk
-                    self._write_prefixed_body(chunk)
+                    wire_bytes += self._write_body_stream_part(chunk)
                     self.flush()
                     if 'hpssdetail' in debug.debug_flags:
                         # Not worth timing separately, as _write_func is
@@ -1246,7 +1302,8 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
                                     chunk, suppress_time=True)
             if 'hpss' in debug.debug_flags:
                 self._trace('body stream',
-                            '%d bytes %d chunks' % (num_bytes, count),
+                            '%d bytes (%d on the wire) %d chunks'
+                            % (num_bytes, wire_bytes, count),
                             first_chunk)
         self._write_end()
         if 'hpss' in debug.debug_flags:
@@ -1303,6 +1360,13 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
     def set_headers(self, headers):
         self._headers = headers.copy()
 
+    def set_body_compression(self, codec, level=None):
+        """Compress the body stream of the request with codec.
+
+        The server must have said that it supports codec.
+        """
+        self._body_compression = (codec, level)
+
     def call(self, *args):
         if 'hpss' in debug.debug_flags:
             mutter('hpss call:   %s', repr(args)[1:-1])
@@ -1366,7 +1430,7 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
             self._request_start_time = osutils.perf_counter()
         self.body_stream_started = False
         self._write_protocol_version()
-        self._write_headers(self._headers)
+        self._write_headers(self._headers_for_body_stream(self._headers))
         self._write_structure(args)
         # TODO: notice if the server has sent an early error reply before we
         #       have finished sending the stream.  We would notice at the end
@@ -1375,6 +1439,7 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
         # Provoke any ConnectionReset failures before we start the body stream.
         self.flush()
         self.body_stream_started = True
+        num_bytes = wire_bytes = 0
         for exc_info, part in _iter_with_errors(stream):
             if exc_info is not None:
                 # Iterating the stream failed.  Cleanly abort the request.
@@ -1390,7 +1455,14 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
                 finally:
                     del exc_info
             else:
-                self._write_prefixed_body(part)
+                num_bytes += len(part)
+                wire_bytes += self._write_body_stream_part(part)
                 self.flush()
+        if 'hpss' in debug.debug_flags:
+            mutter('              %d bytes in body stream (%d on the wire)',
+                   num_bytes, wire_bytes)
+            from . import medium
+            medium._count_body_bytes(
+                self._medium_request._medium, num_bytes, wire_bytes)
         self._write_end()
         self._medium_request.finished_writing()
@@ -16,9 +16,14 @@
 
 """Server for smart-server protocol."""
 
+import collections
 import errno
 import os.path
+import queue
+import selectors
+import signal
 import socket
+import struct
 import sys
 import time
 import threading
@@ -26,6 +31,7 @@ import threading
 from ...hooks import Hooks
 from ... import (
     errors,
+    osutils,
     trace,
     transport as _mod_transport,
 )
@@ -34,6 +40,7 @@ from ...lazy_import import lazy_import
 lazy_import(globals(), """
 from breezy.bzr.smart import (
     medium,
+    protocol,
     signals,
     )
 from breezy.transport import (
@@ -62,11 +69,14 @@ class SmartTCPServer(object):
     _ACCEPT_TIMEOUT = 1.0
     _SHUTDOWN_POLL_TIMEOUT = 1.0
     _LOG_WAITING_TIMEOUT = 10.0
+    # The number of connections the kernel will queue for us before we get
+    # around to accept()ing them.
+    _LISTEN_BACKLOG = 128
 
     _timer = time.time
 
     def __init__(self, backing_transport, root_client_path='/',
-                 client_timeout=None):
+                 client_timeout=None, listen_backlog=None):
         """Construct a new server.
 
         To actually start it running, call either start_background_thread or
@@ -77,10 +87,15 @@ class SmartTCPServer(object):
             of backing_transport.
         :param client_timeout: See SmartServerSocketStreamMedium's timeout
             parameter.
+        :param listen_backlog: The backlog to pass to listen(), or None to
+            use the default.
         """
         self.backing_transport = backing_transport
         self.root_client_path = root_client_path
         self._client_timeout = client_timeout
+        if listen_backlog is None:
+            listen_backlog = self._LISTEN_BACKLOG
+        self._listen_backlog = listen_backlog
         self._active_connections = []
         # This is set to indicate we want to wait for clients to finish before
         # we disconnect.
@@ -92,30 +107,38 @@ class SmartTCPServer(object):
         :param host: Name of the interface to listen on.
         :param port: TCP port to listen on, or 0 to allocate a transient port.
         """
-        # let connections timeout so that we get a chance to terminate
-        # Keep a reference to the exceptions we want to catch because the socket
-        # module's globals get set to None during interpreter shutdown.
-        from socket import timeout as socket_timeout
-        from socket import error as socket_error
-        self._socket_error = socket_error
-        self._socket_timeout = socket_timeout
         addrs = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
                                    socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
 
         (family, socktype, proto, canonname, sockaddr) = addrs
 
-        self._server_socket = socket.socket(family, socktype, proto)
+        server_socket = socket.socket(family, socktype, proto)
         # SO_REUSERADDR has a different meaning on Windows
         if sys.platform != 'win32':
-            self._server_socket.setsockopt(socket.SOL_SOCKET,
-                                           socket.SO_REUSEADDR, 1)
+            server_socket.setsockopt(socket.SOL_SOCKET,
+                                     socket.SO_REUSEADDR, 1)
         try:
-            self._server_socket.bind(sockaddr)
-        except self._socket_error as message:
+            server_socket.bind(sockaddr)
+        except socket.error as message:
             raise errors.CannotBindAddress(host, port, message)
+        server_socket.listen(self._listen_backlog)
+        self._use_server_socket(server_socket)
+
+    def _use_server_socket(self, server_socket):
+        """Accept connections on an already listening socket.
+
+        :param server_socket: A bound socket that listen() has been called on.
+        """
+        # let connections timeout so that we get a chance to terminate
+        # Keep a reference to the exceptions we want to catch because the socket
+        # module's globals get set to None during interpreter shutdown.
+        from socket import timeout as socket_timeout
+        from socket import error as socket_error
+        self._socket_error = socket_error
+        self._socket_timeout = socket_timeout
+        self._server_socket = server_socket
         self._sockname = self._server_socket.getsockname()
         self.port = self._sockname[1]
-        self._server_socket.listen(1)
         self._server_socket.settimeout(self._ACCEPT_TIMEOUT)
         # Once we start accept()ing connections, we set started.
         self._started = threading.Event()
@@ -202,27 +225,7 @@ class SmartTCPServer(object):
         self._started.set()
         try:
             try:
-                while not self._should_terminate:
-                    try:
-                        conn, client_addr = self._server_socket.accept()
-                    except self._socket_timeout:
-                        # just check if we're asked to stop
-                        pass
-                    except self._socket_error as e:
-                        # if the socket is closed by stop_background_thread
-                        # we might get a EBADF here, or if we get a signal we
-                        # can get EINTR, any other socket errors should get
-                        # logged.
-                        if e.args[0] not in (errno.EBADF, errno.EINTR):
-                            trace.warning(gettext("listening socket error: %s")
-                                          % (e,))
-                    else:
-                        if self._should_terminate:
-                            conn.close()
-                            break
-                        self.serve_conn(conn, thread_name_suffix)
-                    # Cleanout any threads that have finished processing.
-                    self._poll_active_connections()
+                self._serve_connections(thread_name_suffix)
             except KeyboardInterrupt:
                 # dont log when CTRL-C'd.
                 raise
@@ -243,6 +246,30 @@ class SmartTCPServer(object):
             self._wait_for_clients_to_disconnect()
         self._fully_stopped.set()
 
+    def _serve_connections(self, thread_name_suffix):
+        """Accept and serve connections until asked to terminate."""
+        while not self._should_terminate:
+            try:
+                conn, client_addr = self._server_socket.accept()
+            except self._socket_timeout:
+                # just check if we're asked to stop
+                pass
+            except self._socket_error as e:
+                # if the socket is closed by stop_background_thread
+                # we might get a EBADF here, or if we get a signal we
+                # can get EINTR, any other socket errors should get
+                # logged.
+                if e.args[0] not in (errno.EBADF, errno.EINTR):
+                    trace.warning(gettext("listening socket error: %s")
+                                  % (e,))
+            else:
+                if self._should_terminate:
+                    conn.close()
+                    break
+                self.serve_conn(conn, thread_name_suffix)
+            # Cleanout any threads that have finished processing.
+            self._poll_active_connections()
+
     def get_url(self):
         """Return the url of the server"""
         return "bzr://%s:%s/" % (self._sockname[0], self._sockname[1])
@@ -265,7 +292,7 @@ class SmartTCPServer(object):
         still_active = []
         for handler, thread in self._active_connections:
             thread.join(timeout)
-            if thread.isAlive():
+            if thread.is_alive():
                 still_active.append((handler, thread))
         self._active_connections = still_active
 
@@ -319,6 +346,568 @@ class SmartTCPServer(object):
         self._server_thread.join()
 
 
+def _request_complete(data):
+    """Check whether data starts with a complete request.
+
+    Only version three of the protocol frames its requests. For older
+    versions, the request line is all that is checked for; any body is read
+    by the worker serving the request.
+    """
+    prefix = protocol.MESSAGE_VERSION_THREE
+    if not data.startswith(prefix):
+        if prefix.startswith(data):
+            return False
+        if data.startswith(protocol.REQUEST_VERSION_TWO):
+            return data.count(b'\n') >= 2
+        return b'\n' in data
+    # The headers, followed by message parts up to the end marker.
+    pos = len(prefix)
+    kind = b'h'
+    while True:
+        if kind in (b'h', b's', b'b'):
+            if len(data) < pos + 4:
+                return False
+            (length,) = struct.unpack('!L', data[pos:pos + 4])
+            pos += 4 + length
+        elif kind == b'o':
+            pos += 1
+        elif kind == b'e':
+            return True
+        else:
+            # Let the worker report the protocol error.
+            return True
+        if len(data) <= pos:
+            return False
+        kind = data[pos:pos + 1]
+        pos += 1
+
+
+class PooledSmartTCPServer(SmartTCPServer):
+    """A SmartTCPServer that serves all clients from a fixed pool of threads.
+
+    Rather than dedicating a thread to each connection, connections that are
+    waiting for their next request are parked in a selector, which buffers
+    what the clients send. Once a client has sent a complete request its
+    connection is queued for the next free worker thread, which serves that
+    single request and then hands the connection back. Clients that are slow
+    to send their requests therefore do not hold up the workers.
+
+    At most max_connections clients are admitted at once. Further clients are
+    accepted into a queue of at most max_pending connections, and are
+    disconnected if that queue is full as well.
+    """
+
+    # Requests larger than this are handed to a worker before they have been
+    # received in full, rather than buffered; think of streamed bodies.
+    _MAX_BUFFERED_REQUEST = 1024 * 1024
+
+    def __init__(self, backing_transport, root_client_path='/',
+                 client_timeout=None, listen_backlog=None, workers=4,
+                 max_connections=None, max_pending=None, max_requests=None):
+        """Construct a new server.
+
+        :param workers: The number of threads serving requests.
+        :param max_connections: The maximum number of clients to serve at
+            once, or None for no limit.
+        :param max_pending: The maximum number of clients to keep waiting
+            once max_connections has been reached, or None for no limit.
+        :param max_requests: Stop gracefully after serving this many
+            requests, or None to keep serving.
+        """
+        super(PooledSmartTCPServer, self).__init__(
+            backing_transport, root_client_path=root_client_path,
+            client_timeout=client_timeout, listen_backlog=listen_backlog)
+        if workers < 1:
+            raise ValueError('workers must be at least 1, not %r' % (workers,))
+        self._workers = workers
+        self._max_connections = max_connections
+        self._max_pending = max_pending
+        self._max_requests = max_requests
+        # Protects _busy, _returned, _dispatching and _stats; workers and the
+        # dispatching thread both touch those.
+        self._lock = threading.Lock()
+        self._idle_changed = threading.Condition(self._lock)
+        # Connections waiting for a request, mapping handler to the time
+        # after which the client is considered idle and is disconnected.
+        self._idle = {}
+        # Connections queued for or being served by a worker.
+        self._busy = set()
+        # Connections handed back by workers after serving a request.
+        self._returned = collections.deque()
+        # Accepted sockets waiting to be admitted.
+        self._pending = collections.deque()
+        self._ready = queue.Queue()
+        self._worker_threads = []
+        self._dispatching = False
+        self._stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'queued': 0,
+            'requests': 0,
+            'queue_wait': 0.0,
+            'max_queue_depth': 0,
+            }
+
+    def get_stats(self):
+        """Return a snapshot of the pool statistics.
+
+        :return: A dict with the cumulative counters 'accepted', 'rejected',
+            'queued' (clients that had to wait for admission), 'requests',
+            'queue_wait' (total seconds requests waited for a worker) and
+            'max_queue_depth', as well as the current number of 'idle',
+            'busy' and 'pending' connections.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['busy'] = len(self._busy)
+        stats['idle'] = len(self._idle)
+        stats['pending'] = len(self._pending)
+        return stats
+
+    def _connection_count(self):
+        return len(self._idle) + len(self._busy)
+
+    def _serve_connections(self, thread_name_suffix):
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        selector = selectors.DefaultSelector()
+        selector.register(self._server_socket, selectors.EVENT_READ)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._selector = selector
+        # Never block in accept(): another process sharing the listening
+        # socket may have taken the connection we were woken up for.
+        self._server_socket.setblocking(False)
+        self._dispatching = True
+        for i in range(self._workers):
+            worker = threading.Thread(
+                None, self._serve_requests,
+                name='smart-server-worker' + thread_name_suffix, daemon=True)
+            worker.start()
+            self._worker_threads.append(worker)
+        try:
+            while not self._should_terminate:
+                try:
+                    events = selector.select(self._ACCEPT_TIMEOUT)
+                except (OSError, ValueError) as e:
+                    # The listening socket may have been closed by
+                    # stop_background_thread.
+                    if getattr(e, 'errno', None) not in (errno.EBADF,
+                                                         errno.EINTR, None):
+                        raise
+                    continue
+                for key, mask in events:
+                    if key.fileobj is self._server_socket:
+                        self._accept_connection()
+                    elif key.fileobj is self._wakeup_recv:
+                        self._wakeup_recv.recv(4096)
+                    else:
+                        self._receive(key.data)
+                self._process_returned()
+                self._disconnect_idle()
+                self._admit_pending()
+        finally:
+            self._stop_dispatching()
+
+    def _accept_connection(self):
+        try:
+            conn, client_addr = self._server_socket.accept()
+        except self._socket_timeout:
+            return
+        except self._socket_error as e:
+            if e.args[0] not in (errno.EBADF, errno.EINTR, errno.EAGAIN,
+                                 errno.EWOULDBLOCK):
+                trace.warning(gettext("listening socket error: %s") % (e,))
+            return
+        if self._should_terminate:
+            conn.close()
+            return
+        with self._lock:
+            self._stats['accepted'] += 1
+        if (self._max_connections is None or
+                self._connection_count() < self._max_connections):
+            self._add_connection(conn)
+        elif self._max_pending is None or (
+                len(self._pending) < self._max_pending):
+            with self._lock:
+                self._stats['queued'] += 1
+            self._pending.append(conn)
+        else:
+            with self._lock:
+                self._stats['rejected'] += 1
+            for hook in SmartTCPServer.hooks['connection_rejected']:
+                hook(self, client_addr)
+            try:
+                conn.close()
+            except self._socket_error:
+                pass
+
+    def _admit_pending(self):
+        while self._pending and (
+                self._max_connections is None or
+                self._connection_count() < self._max_connections):
+            self._add_connection(self._pending.popleft())
+
+    def _add_connection(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handler = self._make_handler(conn)
+        # Requests too large to buffer are read by the workers; don't let a
+        # client that stops sending (or reading) hold on to one forever.
+        conn.settimeout(handler._client_timeout)
+        self._park(handler)
+
+    def _park(self, handler):
+        """Wait for the next request from handler's client in the selector."""
+        self._idle[handler] = self._timer() + handler._client_timeout
+        self._selector.register(
+            handler.socket, selectors.EVENT_READ, handler)
+
+    def _unpark(self, handler):
+        self._selector.unregister(handler.socket)
+        del self._idle[handler]
+
+    def _request_received(self, handler):
+        """Check whether a worker can serve handler's next request."""
+        buffered = handler._push_back_buffer
+        return buffered is not None and (
+            len(buffered) >= self._MAX_BUFFERED_REQUEST or
+            _request_complete(buffered))
+
+    def _receive(self, handler):
+        """Buffer what a parked client sent, dispatching complete requests.
+        """
+        try:
+            data = osutils.read_bytes_from_socket(handler.socket)
+        except self._socket_error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            trace.mutter('%s terminating on exception %s' % (handler, e))
+            data = b''
+        if not data:
+            # The client hung up.
+            self._unpark(handler)
+            handler._disconnect_client()
+            return
+        if handler._push_back_buffer is not None:
+            data = handler._push_back_buffer + data
+        handler._push_back_buffer = data
+        if self._request_received(handler):
+            self._unpark(handler)
+            self._dispatch(handler)
+
+    def _dispatch(self, handler):
+        """Queue handler to have its next request served by a worker."""
+        with self._lock:
+            self._busy.add(handler)
+            depth = self._ready.qsize() + 1
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+        self._ready.put((handler, self._timer()))
+
+    def _process_returned(self):
+        while True:
+            with self._lock:
+                if not self._returned:
+                    return
+                handler = self._returned.popleft()
+                self._busy.discard(handler)
+            if self._request_received(handler):
+                # The client pipelined its next request.
+                self._dispatch(handler)
+            else:
+                self._park(handler)
+
+    def _disconnect_idle(self):
+        now = self._timer()
+        for handler, deadline in list(self._idle.items()):
+            if now < deadline and not handler.finished:
+                continue
+            if not handler.finished:
+                trace.note('%s' % (errors.ConnectionTimeout(
+                    'disconnecting client after %.1f seconds'
+                    % (handler._client_timeout,)),))
+            self._unpark(handler)
+            handler._disconnect_client()
+
+    def _stop_dispatching(self):
+        """Stop handing connections to and from the workers."""
+        with self._lock:
+            self._dispatching = False
+            returned = list(self._returned)
+            self._returned.clear()
+            self._busy.difference_update(returned)
+            self._idle_changed.notify_all()
+        # Nothing will pick these up any more, so hang up on them.
+        for handler in list(self._idle) + returned:
+            handler._disconnect_client()
+        self._idle.clear()
+        while self._pending:
+            self._pending.popleft().close()
+        for worker in self._worker_threads:
+            self._ready.put(None)
+        self._selector.close()
+        self._wakeup_send.close()
+        self._wakeup_recv.close()
+
+    def _serve_requests(self):
+        """Serve queued requests until told to stop. Run by each worker."""
+        while True:
+            item = self._ready.get()
+            if item is None:
+                return
+            handler, queued_at = item
+            wait = self._timer() - queued_at
+            with self._lock:
+                self._stats['requests'] += 1
+                self._stats['queue_wait'] += wait
+                served = self._stats['requests']
+            for hook in SmartTCPServer.hooks['request_dispatched']:
+                hook(self, wait, self._ready.qsize())
+            self._serve_one_request(handler)
+            if (self._max_requests is not None and
+                    served == self._max_requests):
+                self._stop_gracefully()
+            with self._lock:
+                if self._dispatching and not handler.finished:
+                    self._returned.append(handler)
+                    try:
+                        self._wakeup_send.send(b'\0')
+                    except self._socket_error:
+                        pass
+                    continue
+                self._busy.discard(handler)
+                self._idle_changed.notify_all()
+            handler._disconnect_client()
+
+    def _serve_one_request(self, handler):
+        try:
+            server_protocol = handler._build_protocol()
+            handler._serve_one_request(server_protocol)
+        except errors.ConnectionTimeout as e:
+            trace.note('%s' % (e,))
+            trace.log_exception_quietly()
+            handler.finished = True
+        except Exception as e:
+            trace.mutter('%s terminating on exception %s' % (handler, e))
+            trace.log_exception_quietly()
+            handler.finished = True
+
+    def _stop_gracefully(self):
+        trace.note(gettext('Requested to stop gracefully'))
+        self._should_terminate = True
+        self._gracefully_stopping = True
+        with self._lock:
+            busy = list(self._busy)
+            if self._dispatching:
+                # Don't leave the dispatcher waiting in select().
+                try:
+                    self._wakeup_send.send(b'\0')
+                except self._socket_error:
+                    pass
+        for handler in busy:
+            handler._stop_gracefully()
+
+    def _wait_for_clients_to_disconnect(self):
+        with self._lock:
+            if self._busy:
+                trace.note(gettext('Waiting for %d client(s) to finish')
+                           % (len(self._busy),))
+            t_next_log = self._timer() + self._LOG_WAITING_TIMEOUT
+            while self._busy:
+                now = self._timer()
+                if now >= t_next_log:
+                    trace.note(gettext('Still waiting for %d client(s) to '
+                                       'finish') % (len(self._busy),))
+                    t_next_log = now + self._LOG_WAITING_TIMEOUT
+                self._idle_changed.wait(self._SHUTDOWN_POLL_TIMEOUT)
+        # All clients are gone, so the workers only have to notice they
+        # have been asked to stop.
+        for worker in self._worker_threads:
+            worker.join()
+
+
+class _PreforkedSmartTCPServer(PooledSmartTCPServer):
+    """The server run in each process forked by PreforkingSmartTCPServer.
+
+    The supervising process runs the server hooks on behalf of the whole
+    server, so they are not run again by every worker process.
+    """
+
+    def run_server_started_hooks(self, backing_urls=None):
+        pass
+
+    def run_server_stopped_hooks(self, backing_urls=None):
+        pass
+
+
+class PreforkingSmartTCPServer(SmartTCPServer):
+    """A SmartTCPServer that serves clients from several processes.
+
+    The listening socket is created by a supervising process, which forks a
+    number of worker processes that all accept connections from it. Each
+    worker serves its clients with a PooledSmartTCPServer.
+
+    Workers that exit, for example because they have served their quota of
+    requests, are replaced. A graceful stop is passed on to all workers by
+    closing a pipe they watch, and the supervisor waits for them to finish
+    their clients before exiting. Workers also stop if the supervisor dies.
+    """
+
+    _SIGTERM = getattr(signal, 'SIGTERM', None)
+
+    def __init__(self, backing_transport, root_client_path='/',
+                 client_timeout=None, listen_backlog=None, processes=2,
+                 max_requests_per_process=None, workers=4,
+                 max_connections=None, max_pending=None):
+        """Construct a new server.
+
+        :param processes: The number of worker processes to run.
+        :param max_requests_per_process: Replace a worker process after it
+            has served this many requests, or None to keep it running. This
+            caps the memory held on to by caches in the workers.
+        :param workers, max_connections, max_pending: Passed on to the
+            PooledSmartTCPServer in each worker process.
+        """
+        if getattr(os, 'fork', None) is None:
+            raise errors.BzrError(
+                'Serving from multiple processes requires os.fork().')
+        super(PreforkingSmartTCPServer, self).__init__(
+            backing_transport, root_client_path=root_client_path,
+            client_timeout=client_timeout, listen_backlog=listen_backlog)
+        if processes < 1:
+            raise ValueError(
+                'processes must be at least 1, not %r' % (processes,))
+        self._processes = processes
+        self._max_requests_per_process = max_requests_per_process
+        self._workers = workers
+        self._max_connections = max_connections
+        self._max_pending = max_pending
+        # The pids of the running worker processes.
+        self._children = set()
+        # The number of worker processes started over the server's lifetime.
+        self.processes_started = 0
+        self._children_changed = threading.Event()
+        self._stop_write = None
+
+    def _make_process_server(self):
+        """Create the server run by a worker process."""
+        server = _PreforkedSmartTCPServer(
+            self.backing_transport, root_client_path=self.root_client_path,
+            client_timeout=self._client_timeout,
+            listen_backlog=self._listen_backlog, workers=self._workers,
+            max_connections=self._max_connections,
+            max_pending=self._max_pending,
+            max_requests=self._max_requests_per_process)
+        server._ACCEPT_TIMEOUT = self._ACCEPT_TIMEOUT
+        server._use_server_socket(self._server_socket)
+        return server
+
+    def _serve_in_process(self, thread_name_suffix):
+        """Serve clients in a newly forked worker process."""
+        # Start with fresh SIGHUP callbacks, rather than those copied from
+        # the supervisor.
+        signals.install_sighup_handler()
+        if self._SIGTERM is not None:
+            signal.signal(self._SIGTERM, signal.SIG_DFL)
+        self._close_stop_pipe()
+        server = self._make_process_server()
+        watcher = threading.Thread(
+            None, self._watch_supervisor, args=(server,),
+            name='smart-server-supervisor' + thread_name_suffix, daemon=True)
+        watcher.start()
+        server.serve(thread_name_suffix)
+
+    def _watch_supervisor(self, server):
+        """Stop server gracefully once the supervisor wants us to stop.
+
+        The supervisor closes the write end of the stop pipe to ask its
+        workers to stop. That end is also closed if the supervisor dies.
+        """
+        while os.read(self._stop_read, 1):
+            pass
+        server._started.wait()
+        server._stop_gracefully()
+
+    def _start_process(self, thread_name_suffix):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._serve_in_process(thread_name_suffix)
+            except BaseException:
+                trace.log_exception_quietly()
+                status = 1
+            finally:
+                os._exit(status)
+        self._children.add(pid)
+        self.processes_started += 1
+        trace.mutter('started smart server process %d' % (pid,))
+
+    def _reap_processes(self):
+        """Forget about worker processes that have exited."""
+        for pid in list(self._children):
+            try:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                reaped = pid
+            if reaped:
+                trace.mutter('smart server process %d exited' % (pid,))
+                self._children.discard(pid)
+
+    def _signal_processes(self, signum):
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _close_stop_pipe(self):
+        if self._stop_write is not None:
+            os.close(self._stop_write)
+            self._stop_write = None
+
+    def _serve_connections(self, thread_name_suffix):
+        self._stop_read, self._stop_write = os.pipe()
+        try:
+            while not self._should_terminate:
+                self._reap_processes()
+                while (len(self._children) < self._processes and
+                        not self._should_terminate):
+                    self._start_process(thread_name_suffix)
+                self._children_changed.wait(self._ACCEPT_TIMEOUT)
+                self._children_changed.clear()
+        finally:
+            if not self._gracefully_stopping:
+                self._signal_processes(self._SIGTERM)
+                for pid in list(self._children):
+                    os.waitpid(pid, 0)
+                self._children.clear()
+            self._close_stop_pipe()
+            os.close(self._stop_read)
+
+    def _stop_gracefully(self):
+        trace.note(gettext('Requested to stop gracefully'))
+        self._should_terminate = True
+        self._gracefully_stopping = True
+        self._close_stop_pipe()
+        self._children_changed.set()
+
+    def _wait_for_clients_to_disconnect(self):
+        self._reap_processes()
+        if not self._children:
+            return
+        trace.note(gettext('Waiting for %d server process(es) to finish')
+                   % (len(self._children),))
+        t_next_log = self._timer() + self._LOG_WAITING_TIMEOUT
+        while self._children:
+            now = self._timer()
+            if now >= t_next_log:
+                trace.note(gettext('Still waiting for %d server process(es) '
+                                   'to finish') % (len(self._children),))
+                t_next_log = now + self._LOG_WAITING_TIMEOUT
+            time.sleep(self._SHUTDOWN_POLL_TIMEOUT / 10.0)
+            self._reap_processes()
+
+
 class SmartServerHooks(Hooks):
     """Hooks for the smart server."""
 
@@ -348,6 +937,19 @@ class SmartServerHooks(Hooks):
                       "server_exception is called with the sys.exc_info() tuple "
                       "return true for the hook if the exception has been handled, "
                       "in which case the server will exit normally.", (2, 4))
+        self.add_hook('connection_rejected',
+                      "Called by a pooled bzr server when it turns away a "
+                      "client because it is already serving the maximum "
+                      "number of connections and its admission queue is "
+                      "full. connection_rejected is called with "
+                      "(server_obj, client_address).", (3, 2))
+        self.add_hook('request_dispatched',
+                      "Called by a pooled bzr server when a worker thread "
+                      "starts serving a request. request_dispatched is "
+                      "called with (server_obj, queue_wait, queue_depth), "
+                      "where queue_wait is the number of seconds the request "
+                      "waited for a free worker and queue_depth the number "
+                      "of requests still waiting.", (3, 2))
 
 
 SmartTCPServer.hooks = SmartServerHooks()
@@ -436,8 +1038,8 @@ class BzrServerFactory(object):
         return sys.stdin.buffer, sys.stdout.buffer
 
     def _make_smart_server(self, host, port, inet, timeout):
+        c = config.GlobalStack()
         if timeout is None:
-            c = config.GlobalStack()
             timeout = c.get('serve.client_timeout')
         if inet:
             stdin, stdout = self._get_stdin_stdout()
@@ -448,8 +1050,29 @@ class BzrServerFactory(object):
                 host = medium.BZR_DEFAULT_INTERFACE
             if port is None:
                 port = medium.BZR_DEFAULT_PORT
-            smart_server = SmartTCPServer(self.transport,
-                                          client_timeout=timeout)
+            workers = c.get('serve.workers')
+            processes = c.get('serve.processes')
+            if processes:
+                smart_server = PreforkingSmartTCPServer(
+                    self.transport, client_timeout=timeout,
+                    listen_backlog=c.get('serve.listen_backlog'),
+                    processes=processes,
+                    max_requests_per_process=c.get(
+                        'serve.max_requests_per_process'),
+                    workers=workers or 4,
+                    max_connections=c.get('serve.max_connections'),
+                    max_pending=c.get('serve.max_pending_connections'))
+            elif workers:
+                smart_server = PooledSmartTCPServer(
+                    self.transport, client_timeout=timeout,
+                    listen_backlog=c.get('serve.listen_backlog'),
+                    workers=workers,
+                    max_connections=c.get('serve.max_connections'),
+                    max_pending=c.get('serve.max_pending_connections'))
+            else:
+                smart_server = SmartTCPServer(
+                    self.transport, client_timeout=timeout,
+                    listen_backlog=c.get('serve.listen_backlog'))
             smart_server.start_server(host, port)
             trace.note(gettext('listening on port: %s'),
                        str(smart_server.port))
@@ -457,6 +1080,7 @@ class BzrServerFactory(object):
 
     def _change_globals(self):
         from breezy import lockdir, ui
+        from breezy.bzr import btree_index
         # For the duration of this server, no UI output is permitted. note
         # that this may cause problems with blackbox tests. This should be
         # changed with care though, as we dont want to use bandwidth sending
@@ -470,6 +1094,15 @@ class BzrServerFactory(object):
         self.cleanups.append(restore_default_ui_factory_and_lockdir_timeout)
         ui.ui_factory = ui.SilentUIFactory()
         lockdir._DEFAULT_TIMEOUT_SECONDS = 0
+        # Requests reopen the same repositories over and over, so share
+        # parsed index pages between them.
+        old_node_cache = btree_index._shared_node_cache
+
+        def restore_shared_node_cache():
+            btree_index._shared_node_cache = old_node_cache
+        self.cleanups.append(restore_shared_node_cache)
+        btree_index.set_shared_node_cache(
+            config.GlobalStack().get('serve.index_cache_size') or None)
         orig = signals.install_sighup_handler()
 
         def restore_signals():
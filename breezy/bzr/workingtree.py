@@ -628,10 +628,17 @@ class InventoryWorkingTree(WorkingTree, MutableInventoryTree):
         If the file is ignored, returns the pattern which caused it to
         be ignored, otherwise None.  So this can simply be used as a
         boolean if desired."""
+        return self._get_ignoreglobster().match(filename)
+
+    def _iter_ignored(self, filenames):
+        """See Tree._iter_ignored."""
+        return iter(self._get_ignoreglobster().match_many(filenames))
+
+    def _get_ignoreglobster(self):
         if getattr(self, '_ignoreglobster', None) is None:
             self._ignoreglobster = globbing.ExceptionGlobster(
                 self.get_ignore_list())
-        return self._ignoreglobster.match(filename)
+        return self._ignoreglobster
 
     def read_basis_inventory(self):
         """Read the cached basis inventory."""
@@ -29,6 +29,7 @@ from ..lazy_import import lazy_import
 lazy_import(globals(), """
 import contextlib
 import errno
+import functools
 import stat
 
 from breezy import (
@@ -45,6 +46,7 @@ from breezy import (
     views,
     )
 from breezy.bzr import (
+    changemonitor,
     dirstate,
     generate_ids,
     )
@@ -1395,6 +1397,16 @@ class ContentFilterAwareSHA1Provider(dirstate.SHA1Provider):
         """See dirstate.SHA1Provider.stat_and_sha1()."""
         filters = self.tree._content_filter_stack(
             self.tree.relpath(osutils.safe_unicode(abspath)))
+        return self._stat_and_sha1(abspath, filters)
+
+    def prepare_stat_and_sha1(self, abspath):
+        """See dirstate.SHA1Provider.prepare_stat_and_sha1()."""
+        # Looking up the filters uses the tree, so do it in this thread.
+        filters = self.tree._content_filter_stack(
+            self.tree.relpath(osutils.safe_unicode(abspath)))
+        return lambda: self._stat_and_sha1(abspath, filters)
+
+    def _stat_and_sha1(self, abspath, filters):
         with open(abspath, 'rb', 65000) as file_obj:
             statvalue = os.fstat(file_obj.fileno())
             if filters:
@@ -1467,6 +1479,14 @@ class WorkingTree6(ContentFilteringDirStateWorkingTree):
         return views.PathBasedViews(self)
 
 
+class WorkingTree7(WorkingTree6):
+    """This is the Format 7 working tree.
+
+    This differs from WorkingTree6 by:
+     - Storing the dirstate in a binary format with fixed-width records.
+    """
+
+
 class DirStateWorkingTreeFormat(WorkingTreeFormatMetaDir):
 
     missing_parent_conflicts = True
@@ -1476,6 +1496,9 @@ class DirStateWorkingTreeFormat(WorkingTreeFormatMetaDir):
     _lock_class = LockDir
     _lock_file_name = 'lock'
 
+    # Whether new dirstate files use the binary format
+    _binary_dirstate = False
+
     def _open_control_files(self, a_controldir):
         transport = a_controldir.get_workingtree_transport(None)
         return LockableFiles(transport, self._lock_file_name,
@@ -1513,7 +1536,8 @@ class DirStateWorkingTreeFormat(WorkingTreeFormatMetaDir):
             revision_id = branch.last_revision()
         local_path = transport.local_abspath('dirstate')
         # write out new dirstate (must exist when we create the tree)
-        state = dirstate.DirState.initialize(local_path)
+        state = dirstate.DirState.initialize(
+            local_path, binary=self._binary_dirstate)
         state.unlock()
         del state
         wt = self._tree_class(a_controldir.root_transport.local_abspath('.'),
@@ -1704,6 +1728,27 @@ class WorkingTreeFormat6(DirStateWorkingTreeFormat):
         return controldir.format_registry.make_controldir('development-subtree')
 
 
+class WorkingTreeFormat7(WorkingTreeFormat6):
+    """WorkingTree format with a binary dirstate.
+
+    The fixed-width records of the binary dirstate can be bisected through
+    without reading the whole file.
+    """
+
+    _tree_class = WorkingTree7
+
+    _binary_dirstate = True
+
+    @classmethod
+    def get_format_string(cls):
+        """See WorkingTreeFormat.get_format_string()."""
+        return b"Bazaar Working Tree Format 7 (bzr 3.2)\n"
+
+    def get_format_description(self):
+        """See WorkingTreeFormat.get_format_description()."""
+        return "Working tree format 7"
+
+
 class DirStateRevisionTree(InventoryTree):
     """A revision tree pulling the inventory from a dirstate.
 
@@ -2198,6 +2243,14 @@ class InterDirStateTree(InterTree):
         result[1]._iter_changes = dirstate.ProcessEntryPython
         return result
 
+    @classmethod
+    def make_source_parent_tree_threaded_dirstate(klass, test_case, source,
+                                                  target):
+        result = klass.make_source_parent_tree(source, target)
+        result[1]._iter_changes = functools.partial(
+            dirstate.ProcessEntryPython, jobs=4)
+        return result
+
     @classmethod
     def make_source_parent_tree_compiled_dirstate(klass, test_case, source,
                                                   target):
@@ -2265,7 +2318,8 @@ class InterDirStateTree(InterTree):
             source_index = 1 + parent_ids.index(self.source._revision_id)
             indices = (source_index, target_index)
 
-        if specific_files is None:
+        whole_tree = specific_files is None
+        if whole_tree:
             specific_files = {''}
 
         # -- get the state object and prepare it.
@@ -2304,11 +2358,30 @@ class InterDirStateTree(InterTree):
             # would be good here.
             search_specific_files_utf8.add(path.encode('utf8'))
 
-        iter_changes = self.target._iter_changes(
-            include_unchanged, self.target._supports_executable(),
-            search_specific_files_utf8, state, source_index, target_index,
-            want_unversioned, self.target)
-        return iter_changes.iter_changes()
+        jobs = self.target.get_config_stack().get('dirstate.iter_changes_jobs')
+
+        def make_iter_changes(search_specific_files_utf8):
+            if jobs > 1:
+                # Only the Python implementation can use several threads.
+                iter_changes = dirstate.ProcessEntryPython(
+                    include_unchanged, self.target._supports_executable(),
+                    search_specific_files_utf8, state, source_index,
+                    target_index, want_unversioned, self.target, jobs=jobs)
+            else:
+                iter_changes = self.target._iter_changes(
+                    include_unchanged, self.target._supports_executable(),
+                    search_specific_files_utf8, state, source_index,
+                    target_index, want_unversioned, self.target)
+            return iter_changes.iter_changes()
+
+        if whole_tree and not include_unchanged:
+            # A change monitor may know which paths can have changed.
+            changes = changemonitor.iter_changes_with_monitor(
+                self.target, state, self.source._revision_id,
+                want_unversioned, make_iter_changes)
+            if changes is not None:
+                return changes
+        return make_iter_changes(search_specific_files_utf8)
 
     @staticmethod
     def is_compatible(source, target):
@@ -2426,3 +2499,41 @@ class Converter4or5to6(object):
         tree._transport.put_bytes('format',
                                   self.target_format.as_string(),
                                   mode=tree.controldir._get_file_mode())
+
+
+class Converter6to7(object):
+    """Perform an in-place upgrade of format 6 to format 7 trees."""
+
+    def __init__(self):
+        self.target_format = WorkingTreeFormat7()
+
+    def convert(self, tree):
+        # lock the control files not the tree, so that we don't get tree
+        # on-unlock behaviours, and so that no-one else diddles with the
+        # tree during upgrade.
+        tree._control_files.lock_write()
+        try:
+            self.convert_dirstate(tree)
+            self.update_format(tree)
+        finally:
+            tree._control_files.unlock()
+
+    def convert_dirstate(self, tree):
+        """Rewrite the dirstate in the binary format."""
+        local_path = tree.controldir.get_workingtree_transport(
+            None).local_abspath('dirstate')
+        state = dirstate.DirState.on_file(local_path)
+        state.lock_write()
+        try:
+            state._read_dirblocks_if_needed()
+            state._binary = True
+            state._mark_modified(header_modified=True)
+            state.save()
+        finally:
+            state.unlock()
+
+    def update_format(self, tree):
+        """Change the format marker."""
+        tree._transport.put_bytes('format',
+                                  self.target_format.as_string(),
+                                  mode=tree.controldir._get_file_mode())
@@ -2395,6 +2395,17 @@ option_registry.register(
                help="""\
 List of GPG key patterns which are acceptable for verification.
 """))
+option_registry.register(
+    Option('add.jobs', default=1,
+           from_unicode=int_from_store,
+           help='''\
+Number of threads used to scan directories when adding files.
+
+When greater than one, "brz add" lists directories and stats their
+contents in that many threads ahead of time. This mostly helps when
+adding large trees, particularly on network file systems. The result
+does not change.
+'''))
 option_registry.register(
     Option('add.maximum_file_size',
            default=u'20MB', from_unicode=int_SI_from_store,
@@ -2504,6 +2515,16 @@ If true (default), working tree metadata changes are flushed through the
 OS buffers to physical disk.  This is somewhat slower, but means data
 should not be lost if the machine crashes.  See also repository.fdatasync.
 '''))
+option_registry.register(
+    Option('dirstate.iter_changes_jobs', default=1,
+           from_unicode=int_from_store,
+           help='''\
+Number of threads used to compare a working tree with its basis.
+
+When greater than one, commands like status read directories ahead of
+time and hash modified files in that many threads. This mostly helps on
+large trees and on network file systems. The output does not change.
+'''))
 option_registry.register(
     ListOption('debug_flags', default=[],
                help='Debug flags to activate.'))
@@ -2516,6 +2537,16 @@ option_registry.register(
 option_registry.register(
     Option('email', override_from_env=['BRZ_EMAIL'],
            default=bedding.default_email, help='The users identity'))
+option_registry.register(
+    Option('git.fetch_jobs', default=1,
+           from_unicode=int_from_store,
+           help='''\
+Number of processes used to compress file texts fetched from Git.
+
+When greater than one, fetching from Git into a Bazaar repository splits
+the compression of large batches of new file texts over that many worker
+processes. The result does not change.
+'''))
 option_registry.register(
     Option('gpg_signing_key',
            default=None,
@@ -2609,6 +2640,17 @@ If true (default), repository changes are flushed through the OS buffers
 to physical disk.  This is somewhat slower, but means data should not be
 lost if the machine crashes.  See also dirstate.fdatasync.
 '''))
+option_registry.register(
+    Option('smart.compression',
+           default=None,
+           help='''\
+Compress smart protocol body streams with this codec.
+
+Either ``zlib`` or ``zstd`` (which needs the zstandard module), optionally
+followed by a compression level, e.g. ``zlib:6``. Streams are only
+compressed when the server supports the codec. This mostly helps pushing
+and pulling over slow network links.
+'''))
 option_registry.register_lazy('smtp_server',
                               'breezy.smtp_connection', 'smtp_server')
 option_registry.register_lazy('smtp_password',
@@ -2637,6 +2679,57 @@ option_registry.register(
            default=300.0, from_unicode=float_from_store,
            help="If we wait for a new request from a client for more than"
                 " X seconds, consider the client idle, and hangup."))
+option_registry.register(
+    Option('serve.index_cache_size',
+           default=u'64MB', from_unicode=int_SI_from_store,
+           help="""\
+Size of the index page cache shared by all requests of the server.
+
+Parsed pages of pack indices are kept in memory, so requests do not have to
+read them again. Set to 0 to disable the cache.
+"""))
+option_registry.register(
+    Option('serve.listen_backlog',
+           default=128, from_unicode=int_from_store,
+           help="The number of incoming connections the server lets the"
+                " operating system queue before refusing new ones."))
+option_registry.register(
+    Option('serve.max_connections',
+           default=None, from_unicode=int_from_store,
+           help="With serve.workers set, the maximum number of clients"
+                " served at once. Further clients wait for a free slot."))
+option_registry.register(
+    Option('serve.max_pending_connections',
+           default=None, from_unicode=int_from_store,
+           help="With serve.max_connections set, the maximum number of"
+                " clients that wait for a free slot. Clients beyond this are"
+                " disconnected."))
+option_registry.register(
+    Option('serve.max_requests_per_process',
+           default=None, from_unicode=int_from_store,
+           help="With serve.processes set, replace a server process after"
+                " it has served this many requests. This limits the memory"
+                " server processes can hold on to."))
+option_registry.register(
+    Option('serve.processes',
+           default=0, from_unicode=int_from_store,
+           help="If non-zero, serve clients from this many forked processes,"
+                " each running serve.workers threads (4 if unset). Sending"
+                " SIGHUP to the server stops all of them gracefully."))
+option_registry.register(
+    Option('serve.workers',
+           default=0, from_unicode=int_from_store,
+           help="If non-zero, serve all clients from a pool of this many"
+                " threads rather than using a thread per connection."))
+option_registry.register(
+    Option('sftp.request_window',
+           default=128, from_unicode=int_from_store,
+           help="""\
+Number of SFTP read or write requests kept in flight.
+
+Reads and uploads are split into 32kB requests. Up to this many are sent
+before waiting for the first reply, which keeps high latency links busy.
+"""))
 option_registry.register(
     Option('ssh',
            default=None, override_from_env=['BRZ_SSH'],
@@ -2665,6 +2758,17 @@ option_registry.register(
     Option('validate_signatures_in_log', default=False,
            from_unicode=bool_from_store, invalid='warning',
            help='''Whether to validate signatures in brz log.'''))
+option_registry.register_lazy('http.readv_connections',
+                              'breezy.transport.http',
+                              'opt_http_readv_connections')
+
+option_registry.register_lazy('http.readv_window',
+                              'breezy.transport.http', 'opt_http_readv_window')
+
+option_registry.register_lazy('transport.cache_size',
+                              'breezy.transport.cache',
+                              'opt_transport_cache_size')
+
 option_registry.register_lazy('ssl.ca_certs',
                               'breezy.transport.http', 'opt_ssl_ca_certs')
 
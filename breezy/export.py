@@ -165,6 +165,68 @@ def _export_iter_entries(tree, subdir, skip_special=True):
         yield final_path, path, entry
 
 
+# Upper bounds on the number of entries and on the size of the file texts
+# that are fetched from a tree in one go while exporting.
+_EXPORT_BATCH_COUNT = 1000
+_EXPORT_BATCH_SIZE = 16 * 1024 * 1024
+
+
+def _export_iter_contents(tree, subdir, skip_special=True):
+    """Iter the entries for tree along with the contents of files.
+
+    File contents are retrieved with Tree.iter_files_bytes, in batches so
+    that the texts can be extracted together without holding the contents
+    of the whole tree in memory. Entries are returned in the same order as
+    by _export_iter_entries.
+
+    :param tree: A tree object.
+    :param subdir: None or the path of an entry to start exporting from.
+    :param skip_special: Whether to skip .bzr files.
+    :return: iterator over tuples with final path, tree path, inventory
+        entry and a list of content chunks (None for anything but files)
+    """
+    batch = []
+    batch_size = 0
+    for final_path, tree_path, entry in _export_iter_entries(
+            tree, subdir, skip_special):
+        batch.append((final_path, tree_path, entry))
+        if entry.kind == 'file':
+            try:
+                batch_size += tree.get_file_size(tree_path) or 0
+            except NotImplementedError:
+                pass
+        if (len(batch) >= _EXPORT_BATCH_COUNT or
+                batch_size >= _EXPORT_BATCH_SIZE):
+            for item in _export_fetch_contents(tree, batch):
+                yield item
+            batch = []
+            batch_size = 0
+    for item in _export_fetch_contents(tree, batch):
+        yield item
+
+
+def _export_fetch_contents(tree, batch):
+    desired_files = [(tree_path, i)
+                     for i, (final_path, tree_path, entry) in enumerate(batch)
+                     if entry.kind == 'file']
+    if not desired_files:
+        for final_path, tree_path, entry in batch:
+            yield final_path, tree_path, entry, None
+        return
+    # iter_files_bytes returns texts in whatever order is cheapest; only
+    # texts that arrive ahead of their turn are kept around.
+    results = tree.iter_files_bytes(desired_files)
+    contents = {}
+    for i, (final_path, tree_path, entry) in enumerate(batch):
+        if entry.kind != 'file':
+            yield final_path, tree_path, entry, None
+            continue
+        while i not in contents:
+            identifier, chunks = next(results)
+            contents[identifier] = list(chunks)
+        yield final_path, tree_path, entry, contents.pop(i)
+
+
 def dir_exporter_generator(tree, dest, root, subdir=None,
                            force_mtime=None, fileobj=None):
     """Return a generator that exports this tree to a new directory.
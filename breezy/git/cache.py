@@ -147,6 +147,24 @@ class GitShaMap(object):
         """List the SHA1s."""
         raise NotImplementedError(self.sha1s)
 
+    def lookup_last_change(self, commit_sha, path):
+        """Look up the commit that last changed a path.
+
+        :param commit_sha: Git SHA of the commit to look in
+        :param path: Path of the file or directory in that commit
+        :return: Git SHA of the commit in which path was last changed
+        :raise KeyError: if no such entry is present
+        """
+        raise NotImplementedError(self.lookup_last_change)
+
+    def add_last_changes(self, entries):
+        """Record the commits that last changed paths.
+
+        :param entries: Iterable over (commit_sha, path, last_change_sha)
+            tuples
+        """
+        raise NotImplementedError(self.add_last_changes)
+
     def start_write_group(self):
         """Start writing changes."""
 
@@ -322,6 +340,7 @@ class DictGitShaMap(GitShaMap):
         self._by_sha = {}
         self._by_fileid = {}
         self._by_revid = {}
+        self._last_changes = {}
 
     def lookup_blob_id(self, fileid, revision):
         return self._by_fileid[revision][fileid]
@@ -347,6 +366,13 @@ class DictGitShaMap(GitShaMap):
     def sha1s(self):
         return self._by_sha.keys()
 
+    def lookup_last_change(self, commit_sha, path):
+        return self._last_changes[(commit_sha, path)]
+
+    def add_last_changes(self, entries):
+        for commit_sha, path, last_change_sha in entries:
+            self._last_changes[(commit_sha, path)] = last_change_sha
+
 
 class SqliteCacheUpdater(CacheUpdater):
 
@@ -383,17 +409,12 @@ class SqliteCacheUpdater(CacheUpdater):
     def finish(self):
         if self._commit is None:
             raise AssertionError("No commit object added")
-        self.db.executemany(
-            "replace into trees (sha1, fileid, revid) values (?, ?, ?)",
-            self._trees)
-        self.db.executemany(
-            "replace into blobs (sha1, fileid, revid) values (?, ?, ?)",
-            self._blobs)
-        self.db.execute(
-            "replace into commits (sha1, revid, tree_sha, testament3_sha1) "
-            "values (?, ?, ?, ?)",
+        idmap = self.cache.idmap
+        idmap._add_rows("trees", self._trees)
+        idmap._add_rows("blobs", self._blobs)
+        idmap._add_rows("commits", [
             (self._commit.id, self.revid, self._commit.tree,
-                self._testament3_sha1))
+             self._testament3_sha1)])
         return self._commit
 
 
@@ -415,10 +436,26 @@ class SqliteGitCacheFormat(BzrGitCacheFormat):
 
 
 class SqliteGitShaMap(GitShaMap):
-    """Bazaar GIT Sha map that uses a sqlite database for storage."""
+    """Bazaar GIT Sha map that uses a sqlite database for storage.
+
+    Rows added by the cache updaters are buffered, and inserted in bulk
+    before the next lookup or when the write group is committed.
+    """
+
+    _insert_statements = {
+        "commits": "replace into commits (sha1, revid, tree_sha, "
+                   "testament3_sha1) values (?, ?, ?, ?)",
+        "trees": "replace into trees (sha1, fileid, revid) values (?, ?, ?)",
+        "blobs": "replace into blobs (sha1, fileid, revid) values (?, ?, ?)",
+        }
+
+    # Number of buffered rows after which they are inserted.
+    _max_pending_rows = 10000
 
     def __init__(self, path=None):
         self.path = path
+        self._pending = {}
+        self._pending_count = 0
         if path is None:
             self.db = sqlite3.connect(":memory:")
         else:
@@ -450,6 +487,13 @@ class SqliteGitShaMap(GitShaMap):
         create unique index if not exists trees_sha1 on trees(sha1);
         create unique index if not exists trees_fileid_revid on trees(
             fileid, revid);
+        create table if not exists last_changes(
+            commit_sha text not null check(length(commit_sha) == 40),
+            path blob not null,
+            last_change_sha text not null check(length(last_change_sha) == 40)
+        );
+        create unique index if not exists last_changes_commit_path on
+            last_changes(commit_sha, path);
 """)
         try:
             self.db.executescript(
@@ -460,7 +504,27 @@ class SqliteGitShaMap(GitShaMap):
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
 
+    def _add_rows(self, table, rows):
+        self._pending.setdefault(table, []).extend(rows)
+        self._pending_count += len(rows)
+        if self._pending_count >= self._max_pending_rows:
+            self._flush()
+
+    def _flush(self):
+        """Insert the buffered rows."""
+        if not self._pending_count:
+            return
+        pending = self._pending
+        self._pending = {}
+        self._pending_count = 0
+        # Trees and blobs go in before the commit that refers to them.
+        for table in ("trees", "blobs", "commits"):
+            rows = pending.get(table)
+            if rows:
+                self.db.executemany(self._insert_statements[table], rows)
+
     def lookup_commit(self, revid):
+        self._flush()
         cursor = self.db.execute("select sha1 from commits where revid = ?",
                                  (revid,))
         row = cursor.fetchone()
@@ -469,9 +533,16 @@ class SqliteGitShaMap(GitShaMap):
         raise KeyError
 
     def commit_write_group(self):
+        self._flush()
         self.db.commit()
 
+    def abort_write_group(self):
+        self._pending = {}
+        self._pending_count = 0
+        self.db.rollback()
+
     def lookup_blob_id(self, fileid, revision):
+        self._flush()
         row = self.db.execute(
             "select sha1 from blobs where fileid = ? and revid = ?",
             (fileid, revision)).fetchone()
@@ -480,6 +551,7 @@ class SqliteGitShaMap(GitShaMap):
         raise KeyError(fileid)
 
     def lookup_tree_id(self, fileid, revision):
+        self._flush()
         row = self.db.execute(
             "select sha1 from trees where fileid = ? and revid = ?",
             (fileid, revision)).fetchone()
@@ -496,6 +568,7 @@ class SqliteGitShaMap(GitShaMap):
             tree: fileid, revid
             blob: fileid, revid
         """
+        self._flush()
         found = False
         cursor = self.db.execute(
             "select revid, tree_sha, testament3_sha1 from commits where "
@@ -522,10 +595,25 @@ class SqliteGitShaMap(GitShaMap):
 
     def revids(self):
         """List the revision ids known."""
+        self._flush()
         return (row for (row,) in self.db.execute("select revid from commits"))
 
+    def lookup_last_change(self, commit_sha, path):
+        row = self.db.execute(
+            "select last_change_sha from last_changes where commit_sha = ? "
+            "and path = ?", (commit_sha, path)).fetchone()
+        if row is not None:
+            return row[0]
+        raise KeyError((commit_sha, path))
+
+    def add_last_changes(self, entries):
+        self.db.executemany(
+            "replace into last_changes (commit_sha, path, last_change_sha) "
+            "values (?, ?, ?)", entries)
+
     def sha1s(self):
         """List the SHA1s."""
+        self._flush()
         for table in ("blobs", "commits", "trees"):
             for (sha,) in self.db.execute("select sha1 from %s" % table):
                 yield sha.encode('ascii')
@@ -621,6 +709,7 @@ class TdbGitShaMap(GitShaMap):
     "commit revid" -> "<sha1> <tree-id>"
     "tree fileid revid" -> "<sha1>"
     "blob fileid revid" -> "<sha1>"
+    "lastchange <sha1> path" -> "<sha1>"
     """
 
     TDB_MAP_VERSION = 3
@@ -703,6 +792,16 @@ class TdbGitShaMap(GitShaMap):
                 ret.add(revid)
         return ret
 
+    def lookup_last_change(self, commit_sha, path):
+        return sha_to_hex(self.db[b"\0".join(
+            (b"lastchange", hex_to_sha(commit_sha), path))])
+
+    def add_last_changes(self, entries):
+        for commit_sha, path, last_change_sha in entries:
+            self.db[b"\0".join(
+                (b"lastchange", hex_to_sha(commit_sha), path))] = (
+                    hex_to_sha(last_change_sha))
+
     def _keys(self):
         return self.db.keys()
 
@@ -804,25 +903,36 @@ class IndexGitShaMap(GitShaMap):
     ("git", <sha1>, "X") -> "<type> <type-data1> <type-data2>"
     ("commit", <revid>, "X") -> "<sha1> <tree-id>"
     ("blob", <fileid>, <revid>) -> <sha1>
+    ("lastchange", <sha1>, <sha1 of path>) -> <sha1>
 
+    Nodes added in a write group are kept in memory. When the write group
+    is committed, the ones that are not yet present are written to a new
+    index file. Once there are more than _max_index_files index files, they
+    are merged into one.
     """
 
+    _max_index_files = 10
+
     def __init__(self, transport=None):
         self._name = None
+        self._pending = None
+        # Names of the index files in self._index, newest first.
+        self._index_names = []
         if transport is None:
             self._transport = None
             self._index = _mod_index.InMemoryGraphIndex(0, key_elements=3)
-            self._builder = self._index
         else:
-            self._builder = None
             self._transport = transport
             self._index = _mod_index.CombinedGraphIndex([])
             for name in self._transport.list_dir("."):
                 if not name.endswith(".rix"):
                     continue
-                x = _mod_btree_index.BTreeGraphIndex(
-                    self._transport, name, self._transport.stat(name).st_size)
-                self._index.insert_index(0, x)
+                self._insert_index(name, self._transport.stat(name).st_size)
+
+    def _insert_index(self, name, size):
+        self._index.insert_index(0, _mod_btree_index.BTreeGraphIndex(
+            self._transport, name, size))
+        self._index_names.insert(0, name)
 
     @classmethod
     def from_repository(cls, repository):
@@ -842,72 +952,111 @@ class IndexGitShaMap(GitShaMap):
             return "%s()" % (self.__class__.__name__)
 
     def repack(self):
-        if self._builder is not None:
+        """Merge all index files into one.
+
+        The merged index files are renamed to .old rather than removed, so
+        that other processes that have them open can still read them; .old
+        files left by an earlier repack are removed.
+        """
+        if self._pending is not None:
             raise bzr_errors.BzrError('builder already open')
-        self.start_write_group()
-        self._builder.add_nodes(
-            ((key, value) for (_, key, value) in
-                self._index.iter_all_entries()))
-        to_remove = []
-        for name in self._transport.list_dir('.'):
-            if name.endswith('.rix'):
-                to_remove.append(name)
-        self.commit_write_group()
-        del self._index.indices[1:]
-        for name in to_remove:
-            self._transport.rename(name, name + '.old')
+        names = list(self._index_names)
+        if len(names) < 2:
+            return
+        trace.mutter('merging %d git sha map indices in %r', len(names),
+                     self._transport.base)
+        builder = _mod_btree_index.BTreeBuilder(0, key_elements=3)
+        # Keys are unique across the indices, since commit_write_group only
+        # writes keys that were not present yet.
+        builder.add_nodes(
+            (key, value) for (_, key, value) in
+            self._index.iter_all_entries())
+        name = osutils.sha_strings(
+            name.encode('ascii') for name in sorted(names)).decode('ascii')
+        name += ".rix"
+        size = self._transport.put_file(name, builder.finish())
+        self._index = _mod_index.CombinedGraphIndex([])
+        self._index_names = []
+        self._insert_index(name, size)
+        for old_name in self._transport.list_dir('.'):
+            if old_name.endswith('.rix.old'):
+                try:
+                    self._transport.delete(old_name)
+                except bzr_errors.NoSuchFile:
+                    pass
+        for old_name in names:
+            try:
+                self._transport.rename(old_name, old_name + '.old')
+            except bzr_errors.NoSuchFile:
+                # Merged by another process.
+                pass
 
     def start_write_group(self):
-        if self._builder is not None:
+        if self._pending is not None:
             raise bzr_errors.BzrError('builder already open')
-        self._builder = _mod_btree_index.BTreeBuilder(0, key_elements=3)
+        self._pending = {}
         self._name = osutils.sha()
 
     def commit_write_group(self):
-        if self._builder is None:
+        if self._pending is None:
             raise bzr_errors.BzrError('builder not open')
-        stream = self._builder.finish()
+        pending = self._pending
         name = self._name.hexdigest() + ".rix"
-        size = self._transport.put_file(name, stream)
-        index = _mod_btree_index.BTreeGraphIndex(self._transport, name, size)
-        self._index.insert_index(0, index)
-        self._builder = None
+        self._pending = None
         self._name = None
+        # Look up all keys in one go, rather than one at a time as they are
+        # added.
+        for entry in self._index.iter_entries(list(pending)):
+            del pending[entry[1]]
+        if not pending:
+            return
+        if self._transport is None:
+            self._index.add_nodes(pending.items())
+            return
+        builder = _mod_btree_index.BTreeBuilder(0, key_elements=3)
+        builder.add_nodes(pending.items())
+        size = self._transport.put_file(name, builder.finish())
+        self._insert_index(name, size)
+        if len(self._index_names) > self._max_index_files:
+            self.repack()
 
     def abort_write_group(self):
-        if self._builder is None:
+        if self._pending is None:
             raise bzr_errors.BzrError('builder not open')
-        self._builder = None
+        self._pending = None
         self._name = None
 
     def _add_node(self, key, value):
-        try:
-            self._get_entry(key)
-        except KeyError:
-            self._builder.add_node(key, value)
-            return False
+        if self._pending is None:
+            # An in-memory map, updated outside of a write group.
+            try:
+                self._get_entry(key)
+            except KeyError:
+                self._index.add_nodes([(key, value)])
         else:
-            return True
+            self._pending.setdefault(key, value)
 
     def _get_entry(self, key):
         entries = self._index.iter_entries([key])
         try:
             return next(entries)[2]
         except StopIteration:
-            if self._builder is None:
-                raise KeyError
-            entries = self._builder.iter_entries([key])
-            try:
-                return next(entries)[2]
-            except StopIteration:
+            if self._pending is None:
                 raise KeyError
+            return self._pending[key]
 
     def _iter_entries_prefix(self, prefix):
+        seen = set()
         for entry in self._index.iter_entries_prefix([prefix]):
+            seen.add(entry[1])
             yield (entry[1], entry[2])
-        if self._builder is not None:
-            for entry in self._builder.iter_entries_prefix([prefix]):
-                yield (entry[1], entry[2])
+        if self._pending is not None:
+            for key, value in self._pending.items():
+                if key in seen:
+                    continue
+                if all(element is None or element == key_element
+                       for (element, key_element) in zip(prefix, key)):
+                    yield (key, value)
 
     def lookup_commit(self, revid):
         return self._get_entry((b"commit", revid, b"X"))[:40]
@@ -960,6 +1109,10 @@ class IndexGitShaMap(GitShaMap):
         for _, key, value in self._index.iter_entries((
                 (b"commit", revid, b"X") for revid in revids)):
             missing_revids.remove(key[1])
+        if self._pending is not None:
+            missing_revids.difference_update(
+                revid for revid in list(missing_revids)
+                if (b"commit", revid, b"X") in self._pending)
         return missing_revids
 
     def sha1s(self):
@@ -967,6 +1120,20 @@ class IndexGitShaMap(GitShaMap):
         for key, value in self._iter_entries_prefix((b"git", None, None)):
             yield key[1]
 
+    def lookup_last_change(self, commit_sha, path):
+        # Paths may contain whitespace, which is not allowed in index keys.
+        return self._get_entry(
+            (b"lastchange", commit_sha, osutils.sha_string(path)))
+
+    def add_last_changes(self, entries):
+        for commit_sha, path, last_change_sha in entries:
+            if self._name is not None:
+                self._name.update(b"lastchange" + commit_sha + path +
+                                  last_change_sha)
+            self._add_node(
+                (b"lastchange", commit_sha, osutils.sha_string(path)),
+                last_change_sha)
+
 
 formats = registry.Registry()
 formats.register(TdbGitCacheFormat().get_format_string(),
@@ -1025,3 +1192,27 @@ def from_repository(repository):
         except bzr_errors.ReadOnlyError:
             pass  # Not much we can do
     return BzrGitCacheFormat.from_repository(repository)
+
+
+def from_git_repository(repository):
+    """Open the cache for a local Git repository.
+
+    The cache is stored in a ``breezy`` directory inside the Git control
+    directory.
+
+    :param repository: A LocalGitRepository
+    :return: A `BzrGitCache`, or None if the control directory is not
+        writable
+    """
+    try:
+        transport = remove_readonly_transport_decorator(
+            repository.controldir.control_transport)
+        try:
+            transport.mkdir('breezy')
+        except bzr_errors.FileExists:
+            pass
+        return BzrGitCacheFormat.from_transport(transport.clone('breezy'))
+    except (bzr_errors.ReadOnlyError, bzr_errors.PermissionDenied,
+            bzr_errors.TransportNotPossible) as e:
+        trace.mutter('not using cache for %r: %s', repository, e)
+        return None
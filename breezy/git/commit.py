@@ -203,6 +203,7 @@ class GitCommitBuilder(CommitBuilder):
             c.gpgsig = strategy.sign(c.as_raw_string(), gpg.MODE_DETACH)
         self.store.add_object(c)
         self.repository.commit_write_group()
+        self.repository._file_change_scanner.record_commit(c)
         self._new_revision_id = self._mapping.revision_id_foreign_to_bzr(c.id)
         return self._new_revision_id
 
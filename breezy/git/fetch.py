@@ -29,8 +29,10 @@ from dulwich.object_store import (
     )
 import posixpath
 import stat
+import time
 
 from .. import (
+    config,
     debug,
     errors,
     osutils,
@@ -49,6 +51,14 @@ from ..revision import (
     NULL_REVISION,
     )
 from ..bzr.inventorytree import InventoryRevisionTree
+from ..bzr.groupcompress import (
+    GroupCompressVersionedFiles,
+    )
+from ..bzr.groupcompress_repo import (
+    can_compress_in_processes,
+    insert_records_in_processes,
+    partition_gc_optimal,
+    )
 from ..bzr.testament import (
     StrictTestament3,
     )
@@ -125,7 +135,7 @@ def import_git_blob(texts, mapping, path, name, hexshas,
     for ptree in parent_bzr_trees:
         intertree = InterTree.get(ptree, base_bzr_tree)
         try:
-            ppath = intertree.find_source_paths(decoded_path, recurse='none')
+            ppath = intertree.find_source_path(decoded_path, recurse='none')
         except errors.NoSuchFile:
             continue
         if ppath is None:
@@ -380,7 +390,10 @@ def ensure_inventories_in_repo(repo, trees):
 
 
 def import_git_commit(repo, mapping, head, lookup_object,
-                      target_git_object_retriever, trees_cache, strict):
+                      target_git_object_retriever, trees_cache, strict,
+                      texts=None):
+    if texts is None:
+        texts = repo.texts
     o = lookup_object(head)
     # Note that this uses mapping.revision_id_foreign_to_bzr. If the parents
     # were bzr roundtripped revisions they would be specified in the
@@ -405,7 +418,7 @@ def import_git_commit(repo, mapping, head, lookup_object,
         base_mode = stat.S_IFDIR
     store_updater = target_git_object_retriever._get_updater(rev)
     inv_delta, unusual_modes = import_git_tree(
-        repo.texts, mapping, b"", b"", (base_tree, o.tree), base_bzr_tree,
+        texts, mapping, b"", b"", (base_tree, o.tree), base_bzr_tree,
         None, rev.revision_id, parent_trees, lookup_object,
         (base_mode, stat.S_IFDIR), store_updater,
         mapping.generate_file_id,
@@ -445,19 +458,109 @@ def import_git_commit(repo, mapping, head, lookup_object,
     trees_cache.add(ret_tree)
     repo.add_revision(rev.revision_id, rev)
     if "verify" in debug.debug_flags:
+        if texts is not repo.texts:
+            # Reconstructing the commit reads the file texts back.
+            texts.flush()
         verify_commit_reconstruction(
             target_git_object_retriever, lookup_object, o, rev, ret_tree,
             parent_trees, mapping, unusual_modes, verifiers)
 
 
+# The number of new file texts to compress in each worker process.
+_TEXT_PARTITION_SIZE = 1000
+
+# The size of the new file texts to keep in memory before compressing them.
+_MAX_PENDING_TEXT_BYTES = 64 << 20
+
+
+class _ImportStats(object):
+    """Time spent in, and items handled by, the stages of an import."""
+
+    def __init__(self):
+        self._stages = {}
+
+    def add(self, stage, seconds, count, size=None):
+        totals = self._stages.setdefault(stage, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += count
+        if size is not None:
+            totals[2] += size
+
+    def describe(self, stages):
+        descriptions = []
+        for stage, unit in stages:
+            try:
+                seconds, count, size = self._stages[stage]
+            except KeyError:
+                continue
+            description = '%s %d %s in %.1fs (%.1f/s' % (
+                stage, count, unit, seconds, count / max(seconds, 0.001))
+            if size:
+                description += ', %.1f MB/s' % (
+                    size / max(seconds, 0.001) / (1 << 20))
+            descriptions.append(description + ')')
+        return '; '.join(descriptions)
+
+
+class _PendingTexts(object):
+    """Collects new file texts to insert into a VersionedFiles in bulk.
+
+    Nothing reads the texts back while revisions are being converted, so
+    they can be compressed later on, in worker processes if there are
+    enough of them.
+    """
+
+    def __init__(self, texts, jobs, stats):
+        self.texts = texts
+        self._jobs = jobs
+        self._stats = stats
+        self._records = {}
+        self._size = 0
+
+    def insert_record_stream(self, stream):
+        for record in stream:
+            self._records[record.key] = record
+            self._size += record.size
+        if self._size >= _MAX_PENDING_TEXT_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Insert the collected texts into the target VersionedFiles."""
+        if not self._records:
+            return
+        start = time.time()
+        records = self._records
+        size = self._size
+        self.discard()
+        partitions = partition_gc_optimal(
+            {key: record.parents for (key, record) in records.items()},
+            _TEXT_PARTITION_SIZE)
+        if (len(partitions) > 1 and can_compress_in_processes(self._jobs)
+                and isinstance(self.texts, GroupCompressVersionedFiles)):
+            insert_records_in_processes(
+                self.texts,
+                [[records[key] for key in keys] for keys in partitions],
+                self._jobs)
+        else:
+            self.texts.insert_record_stream(
+                records[key] for keys in partitions for key in keys)
+        self._stats.add('compressed', time.time() - start, len(records), size)
+
+    def discard(self):
+        self._records = {}
+        self._size = 0
+
+
 def import_git_objects(repo, mapping, object_iter,
                        target_git_object_retriever, heads, pb=None,
-                       limit=None):
+                       limit=None, jobs=None):
     """Import a set of git objects into a bzr repository.
 
     :param repo: Target Bazaar repository
     :param mapping: Mapping to use
     :param object_iter: Iterator over Git objects.
+    :param jobs: Number of processes to use to compress file texts; defaults
+        to the git.fetch_jobs option.
     :return: Tuple with pack hints and last imported revision id
     """
     def lookup_object(sha):
@@ -505,25 +608,34 @@ def import_git_objects(repo, mapping, object_iter,
     pack_hints = []
     if limit is not None:
         revision_ids = revision_ids[:limit]
+    if jobs is None:
+        jobs = config.GlobalStack().get('git.fetch_jobs')
+    stats = _ImportStats()
+    texts = _PendingTexts(repo.texts, jobs, stats)
     last_imported = None
     for offset in range(0, len(revision_ids), batch_size):
         target_git_object_retriever.start_write_group()
         try:
             repo.start_write_group()
             try:
-                for i, head in enumerate(
-                        revision_ids[offset:offset + batch_size]):
+                batch = revision_ids[offset:offset + batch_size]
+                start = time.time()
+                for i, head in enumerate(batch):
                     if pb is not None:
                         pb.update("fetching revisions", offset + i,
                                   len(revision_ids))
                     import_git_commit(repo, mapping, head, lookup_object,
                                       target_git_object_retriever, trees_cache,
-                                      strict=True)
+                                      strict=True, texts=texts)
                     last_imported = head
+                stats.add('converted', time.time() - start, len(batch))
+                texts.flush()
             except BaseException:
+                texts.discard()
                 repo.abort_write_group()
                 raise
             else:
+                start = time.time()
                 hint = repo.commit_write_group()
                 if hint is not None:
                     pack_hints.extend(hint)
@@ -532,6 +644,10 @@ def import_git_objects(repo, mapping, object_iter,
             raise
         else:
             target_git_object_retriever.commit_write_group()
+            stats.add('committed', time.time() - start, len(batch))
+        trace.mutter('git import: %s', stats.describe([
+            ('converted', 'revisions'), ('compressed', 'texts'),
+            ('committed', 'revisions')]))
     return pack_hints, last_imported
 
 
@@ -17,58 +17,289 @@
 
 """File graph access."""
 
+import heapq
+import posixpath
 import stat
 
-from dulwich.errors import (
-    NotTreeError,
-    )
-from dulwich.object_store import (
-    tree_lookup_path,
+from dulwich.diff_tree import (
+    CHANGE_ADD,
+    CHANGE_MODIFY,
+    tree_changes,
     )
 
+from .. import (
+    lru_cache,
+    )
 from ..revision import (
     NULL_REVISION,
     )
 
 
+# Number of Git tree objects to keep around while walking history.
+_TREE_CACHE_SIZE = 1000
+
+# Git paths are never absolute, so this can be used to record which commits
+# have been scanned.
+_SCANNED_MARKER = b'/'
+
+# Number of newly found last changes to keep in memory before writing them
+# to the persistent cache.
+_MAX_PENDING_LAST_CHANGES = 1000
+
+
 class GitFileLastChangeScanner(object):
+    """Find the commits in which paths were last changed.
+
+    Results are remembered, and also stored in the cache databases (see
+    breezy.git.cache) of the repository, so that lookups for later commits
+    only have to walk the history up to a commit that was already scanned.
+    """
 
     def __init__(self, repository):
         self.repository = repository
         self.store = self.repository._git.object_store
+        self._trees = lru_cache.LRUCache(_TREE_CACHE_SIZE)
+        self._last_changes = {}
+        self._scanned = {}
+        self._pending = []
+        self._cache = None
+
+    def _get_idmap(self):
+        if self._cache is None:
+            from .cache import from_git_repository
+            self._cache = from_git_repository(self.repository) or False
+        if self._cache is False:
+            return None
+        return self._cache.idmap
+
+    def _was_scanned(self, commit_id):
+        """Check whether the last changes of any paths in a commit are known.
+        """
+        try:
+            return self._scanned[commit_id]
+        except KeyError:
+            pass
+        try:
+            self._lookup_known(commit_id, _SCANNED_MARKER)
+        except KeyError:
+            scanned = False
+        else:
+            scanned = True
+        self._scanned[commit_id] = scanned
+        return scanned
+
+    def _lookup_known(self, commit_id, path):
+        try:
+            return self._last_changes[(commit_id, path)]
+        except KeyError:
+            pass
+        idmap = self._get_idmap()
+        if idmap is None:
+            raise KeyError((commit_id, path))
+        last_change = idmap.lookup_last_change(commit_id, path)
+        self._last_changes[(commit_id, path)] = last_change
+        return last_change
+
+    def _record(self, commit_id, path, last_change):
+        if path == _SCANNED_MARKER:
+            self._scanned[commit_id] = True
+        self._last_changes[(commit_id, path)] = last_change
+        self._pending.append((commit_id, path, last_change))
+        if len(self._pending) >= _MAX_PENDING_LAST_CHANGES:
+            self.flush()
+
+    def flush(self):
+        """Write newly found last changes to the persistent cache."""
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        idmap = self._get_idmap()
+        if idmap is None:
+            return
+        idmap.start_write_group()
+        try:
+            idmap.add_last_changes(pending)
+        except BaseException:
+            idmap.abort_write_group()
+            raise
+        else:
+            idmap.commit_write_group()
+
+    def record_commit(self, commit):
+        """Record the paths that were last changed in a new commit.
+
+        Only files changed by the commit itself are recorded; the last
+        changes of other paths are found by walking from the commit later
+        on, as for any commit that was scanned before.
+
+        :param commit: Commit object, with its trees in the object store
+        """
+        if self._was_scanned(commit.id):
+            return
+        if not commit.parents:
+            changed = set(
+                entry.path for entry in self.store.iter_tree_contents(
+                    commit.tree))
+        else:
+            changed = set()
+            added = None
+            for parent_id in commit.parents:
+                parent_added = set()
+                for change in tree_changes(
+                        self.store, self.store[parent_id].tree, commit.tree,
+                        change_type_same=True):
+                    if change.type == CHANGE_ADD:
+                        parent_added.add(change.new.path)
+                    elif change.type == CHANGE_MODIFY:
+                        changed.add(change.new.path)
+                if added is None:
+                    added = parent_added
+                else:
+                    added.intersection_update(parent_added)
+            # Paths that none of the parents have
+            changed.update(added)
+        for path in sorted(changed):
+            self._record(commit.id, path, commit.id)
+        self._record(commit.id, _SCANNED_MARKER, commit.id)
+
+    def _get_tree(self, tree_id):
+        try:
+            return self._trees[tree_id]
+        except KeyError:
+            tree = self.store[tree_id]
+            self._trees[tree_id] = tree
+            return tree
+
+    def _lookup_path(self, tree_id, path):
+        """Look up a path in a tree.
+
+        :return: Tuple with mode and sha; the mode of the root is always
+            reported as a directory
+        :raise KeyError: if path does not exist in the tree
+        """
+        mode = stat.S_IFDIR
+        sha = tree_id
+        if path == b'':
+            return mode, sha
+        for name in path.split(b'/'):
+            if not stat.S_ISDIR(mode):
+                raise KeyError(path)
+            mode, sha = self._get_tree(sha)[name]
+        return mode, sha
 
     def find_last_change_revision(self, path, commit_id):
         if not isinstance(path, bytes):
             raise TypeError(path)
-        commit = self.store[commit_id]
-        target_mode, target_sha = tree_lookup_path(self.store.__getitem__,
-                                                   commit.tree, path)
-        if path == b'':
-            target_mode = stat.S_IFDIR
-        if target_mode is None:
-            raise AssertionError("sha %r for %r in %r" %
-                                 (target_sha, path, commit_id))
-        while True:
-            parent_commits = []
-            for parent_commit in [self.store[c] for c in commit.parents]:
-                try:
-                    mode, sha = tree_lookup_path(self.store.__getitem__,
-                                                 parent_commit.tree, path)
-                except (NotTreeError, KeyError):
-                    continue
+        return (path, self.find_last_change_revisions([path], commit_id)[path])
+
+    def find_last_change_revisions(self, paths, commit_id):
+        """Find the commits in which several paths were last changed.
+
+        History is walked once for all paths, rather than once per path.
+        Paths are traced per directory, so that commits which did not touch
+        a directory are passed without looking at the paths inside it.
+
+        :param paths: Paths in the tree of commit_id, as bytes
+        :param commit_id: Git SHA of the commit to start at
+        :return: Dictionary mapping paths to the Git SHA of the commit in
+            which they were last changed
+        :raise KeyError: if one of the paths does not exist in commit_id
+        """
+        ret = {}
+        # Paths that still need to be traced, by the commit they have been
+        # traced to and their directory, with their mode and sha.
+        todo = {}
+        commits = {}
+        # Visit the most recent commits first, so that paths that reach a
+        # commit along different routes are processed together.
+        queue = []
+
+        def follow(commit, dirname, targets):
+            if self._was_scanned(commit.id):
+                remaining = {}
+                for path, target in targets.items():
+                    try:
+                        ret[path] = self._lookup_known(commit.id, path)
+                    except KeyError:
+                        remaining[path] = target
+                targets = remaining
+                if not targets:
+                    return
+            by_dir = todo.get(commit.id)
+            if by_dir is None:
+                by_dir = todo[commit.id] = {}
+                commits[commit.id] = commit
+                heapq.heappush(queue, (-commit.commit_time, commit.id))
+            if dirname in by_dir:
+                by_dir[dirname].update(targets)
+            else:
+                by_dir[dirname] = targets
+
+        paths = list(paths)
+        start = self.store[commit_id]
+        by_dir = {}
+        for path in paths:
+            if not isinstance(path, bytes):
+                raise TypeError(path)
+            by_dir.setdefault(posixpath.dirname(path), {})[path] = (
+                self._lookup_path(start.tree, path))
+        for dirname, targets in by_dir.items():
+            follow(start, dirname, targets)
+        new_paths = [path for path in paths if path not in ret]
+
+        while queue:
+            unused_time, commit_id = heapq.heappop(queue)
+            commit = commits.pop(commit_id)
+            parents = [self.store[p] for p in commit.parents]
+            for dirname, targets in todo.pop(commit_id).items():
+                dir_sha = self._lookup_path(commit.tree, dirname)[1]
+                next_commit = None
+                for parent in parents:
+                    try:
+                        parent_dir_sha = self._lookup_path(
+                            parent.tree, dirname)[1]
+                    except KeyError:
+                        continue
+                    if parent_dir_sha != dir_sha:
+                        break
+                    if next_commit is None:
+                        next_commit = parent
                 else:
-                    parent_commits.append(parent_commit)
-                if path == b'':
-                    mode = stat.S_IFDIR
-                # Candidate found iff, mode or text changed,
-                # or is a directory that didn't previously exist.
-                if mode != target_mode or (
-                        not stat.S_ISDIR(target_mode) and sha != target_sha):
-                    return (path, commit.id)
-            if parent_commits == []:
-                break
-            commit = parent_commits[0]
-        return (path, commit.id)
+                    # The directory is the same in every parent that has
+                    # it, so are all paths in it.
+                    if next_commit is None:
+                        for path in targets:
+                            ret[path] = commit_id
+                    else:
+                        follow(next_commit, dirname, targets)
+                    continue
+                for path, (target_mode, target_sha) in targets.items():
+                    next_commit = None
+                    for parent in parents:
+                        try:
+                            mode, sha = self._lookup_path(parent.tree, path)
+                        except KeyError:
+                            continue
+                        if next_commit is None:
+                            next_commit = parent
+                        # Candidate found iff, mode or text changed,
+                        # or is a directory that didn't previously exist.
+                        if mode != target_mode or (
+                                not stat.S_ISDIR(target_mode) and
+                                sha != target_sha):
+                            break
+                    else:
+                        if next_commit is not None:
+                            follow(next_commit, dirname,
+                                   {path: (target_mode, target_sha)})
+                            continue
+                    ret[path] = commit_id
+        for path in new_paths:
+            self._record(start.id, path, ret[path])
+        if new_paths and not self._scanned.get(start.id):
+            self._record(start.id, _SCANNED_MARKER, start.id)
+        return ret
 
 
 class GitFileParentProvider(object):
@@ -312,7 +312,11 @@ class InterToLocalGitRepository(InterToGitRepository):
                             self.target_refs[refname] = git_sha
                     revidmap[old_revid] = (git_sha, new_revid)
                 self.target_store.add_objects(object_generator)
-                return revidmap
+            scanner = self.target._file_change_scanner
+            for git_sha, new_revid in revidmap.values():
+                scanner.record_commit(self.target_store[git_sha])
+            scanner.flush()
+            return revidmap
 
     def fetch(self, revision_id=None, pb=None, find_ghosts=False,
               fetch_spec=None, mapped_refs=None, lossy=False):
@@ -17,10 +17,14 @@
 
 """Map from Git sha's to Bazaar objects."""
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from dulwich.objects import (
     Blob,
     Commit,
     Tree,
+    hex_to_sha,
     sha_to_hex,
     ZERO_SHA,
     )
@@ -45,9 +49,19 @@ from ..revision import (
     NULL_REVISION,
     )
 from ..tree import InterTree
+from ..bzr.inventorytree import (
+    InventoryRevisionTree,
+    )
 from ..bzr.testament import (
     StrictTestament3,
     )
+from ..bzr._groupcompress_py import (
+    encode_base128_int,
+    )
+try:
+    from ..bzr._groupcompress_pyx import make_delta
+except ImportError:
+    from ..bzr._groupcompress_py import make_delta
 
 from .cache import (
     from_repository as cache_from_repository,
@@ -65,42 +79,158 @@ from .unpeel_map import (
 
 import posixpath
 import stat
+import threading
 
 
 BANNED_FILENAMES = ['.git']
 
+# Maximum number of deltas that have to be applied to reconstruct an object
+# from a generated pack.
+_MAX_DELTA_DEPTH = 50
+
+# Objects smaller than this are always stored as full texts.
+_MIN_DELTA_SIZE = 64
+
+# Maximum total size of the object texts kept around as delta bases while
+# generating a pack.
+_DELTA_BASE_CACHE_SIZE = 32 * 1024 * 1024
 
-def get_object_store(repo, mapping=None):
+
+def get_object_store(repo, mapping=None, shared_cache=None):
     git = getattr(repo, "_git", None)
     if git is not None:
         git.object_store.unlock = lambda: None
         git.object_store.lock_read = lambda: LogicalLockResult(lambda: None)
         git.object_store.lock_write = lambda: LogicalLockResult(lambda: None)
         return git.object_store
-    return BazaarObjectStore(repo, mapping)
+    return BazaarObjectStore(repo, mapping, shared_cache=shared_cache)
 
 
 MAX_TREE_CACHE_SIZE = 50 * 1024 * 1024
 
+MAX_OBJECT_CACHE_SIZE = 50 * 1024 * 1024
+
+
+def _approx_inventory_size(inv):
+    # Very rough estimate, 250 per inventory entry
+    return len(inv) * 250
+
+
+def _approx_object_size(obj):
+    return sum(map(len, obj.as_raw_chunks()))
+
+
+class SharedExportCache(object):
+    """Process-wide cache of data used to export Bazaar revisions to Git.
+
+    Inventories are kept by (repository, revision id) and Git objects by
+    (repository, SHA1), so that a long-running server can answer repeated
+    fetches of the same revisions from memory. Both are bounded by an
+    approximate size in bytes.
+
+    Only data for committed revisions should be added, since entries are
+    never invalidated.
+    """
+
+    def __init__(self, max_tree_size=MAX_TREE_CACHE_SIZE,
+                 max_object_size=MAX_OBJECT_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._inventories = lru_cache.LRUSizeCache(
+            max_size=max_tree_size, after_cleanup_size=None,
+            compute_size=_approx_inventory_size)
+        self._objects = lru_cache.LRUSizeCache(
+            max_size=max_object_size, after_cleanup_size=None,
+            compute_size=_approx_object_size)
+        self.hits = {"tree": 0, "object": 0}
+        self.misses = {"tree": 0, "object": 0}
+
+    def _get(self, kind, cache, key):
+        with self._lock:
+            try:
+                value = cache[key]
+            except KeyError:
+                self.misses[kind] += 1
+                raise
+            self.hits[kind] += 1
+            return value
+
+    def get_inventory(self, repository, revid):
+        """Return the cached inventory for a revision.
+
+        :raises KeyError: if the inventory is not cached
+        """
+        return self._get(
+            "tree", self._inventories, (repository.control_url, revid))
+
+    def add_inventory(self, repository, revid, inv):
+        with self._lock:
+            self._inventories[(repository.control_url, revid)] = inv
+
+    def get_object(self, repository, sha):
+        """Return a cached Git object.
+
+        :raises KeyError: if the object is not cached
+        """
+        return self._get(
+            "object", self._objects, (repository.control_url, sha))
+
+    def add_object(self, repository, obj):
+        with self._lock:
+            self._objects[(repository.control_url, obj.id)] = obj
+
+    def clear(self):
+        with self._lock:
+            self._inventories.clear()
+            self._objects.clear()
+
+    def stats(self):
+        """Return a dictionary with cache statistics."""
+        with self._lock:
+            return {
+                "tree_hits": self.hits["tree"],
+                "tree_misses": self.misses["tree"],
+                "tree_size": self._inventories._value_size,
+                "object_hits": self.hits["object"],
+                "object_misses": self.misses["object"],
+                "object_size": self._objects._value_size,
+                }
+
+
+# Cache shared by the object stores used to serve Git clients
+export_cache = SharedExportCache()
+
 
 class LRUTreeCache(object):
 
-    def __init__(self, repository):
+    def __init__(self, repository, shared_cache=None):
+        """Create a tree cache.
+
+        :param repository: Repository to retrieve trees from
+        :param shared_cache: Optional SharedExportCache to keep the trees
+            in, rather than a cache private to this object
+        """
         def approx_tree_size(tree):
-            # Very rough estimate, 250 per inventory entry
             try:
                 inv = tree.root_inventory
             except AttributeError:
                 inv = tree.inventory
-            return len(inv) * 250
+            return _approx_inventory_size(inv)
         self.repository = repository
-        self._cache = lru_cache.LRUSizeCache(
-            max_size=MAX_TREE_CACHE_SIZE, after_cleanup_size=None,
-            compute_size=approx_tree_size)
+        self._shared_cache = shared_cache
+        if shared_cache is None:
+            self._cache = lru_cache.LRUSizeCache(
+                max_size=MAX_TREE_CACHE_SIZE, after_cleanup_size=None,
+                compute_size=approx_tree_size)
+
+    def _get(self, revid):
+        if self._shared_cache is None:
+            return self._cache[revid]
+        inv = self._shared_cache.get_inventory(self.repository, revid)
+        return InventoryRevisionTree(self.repository, inv, revid)
 
     def revision_tree(self, revid):
         try:
-            tree = self._cache[revid]
+            tree = self._get(revid)
         except KeyError:
             tree = self.repository.revision_tree(revid)
             self.add(tree)
@@ -111,7 +241,7 @@ class LRUTreeCache(object):
         todo = []
         for revid in revids:
             try:
-                tree = self._cache[revid]
+                tree = self._get(revid)
             except KeyError:
                 todo.append(revid)
             else:
@@ -129,7 +259,15 @@ class LRUTreeCache(object):
         return list(self.iter_revision_trees(revids))
 
     def add(self, tree):
-        self._cache[tree.get_revision_id()] = tree
+        if self._shared_cache is None:
+            self._cache[tree.get_revision_id()] = tree
+            return
+        try:
+            inv = tree.root_inventory
+        except AttributeError:
+            return
+        self._shared_cache.add_inventory(
+            self.repository, tree.get_revision_id(), inv)
 
 
 def _find_missing_bzr_revids(graph, want, have):
@@ -379,6 +517,136 @@ def _tree_to_objects(tree, parent_trees, idmap, unusual_modes,
             shamap[path] = obj.id
 
 
+def create_git_delta(base, target):
+    """Create a Git pack delta between two object texts.
+
+    The groupcompress delta instructions are the same as those used in Git
+    packs, so this only has to add the size of the base text.
+
+    :param base: Raw text of the base object
+    :param target: Raw text of the object to encode
+    :return: The delta as bytes, or None if it is not at least half the
+        size of target
+    """
+    delta = make_delta(base, target)
+    if delta is None:
+        return None
+    delta = encode_base128_int(len(base)) + delta
+    if len(delta) > len(target) // 2:
+        return None
+    return delta
+
+
+class PackRecordGenerator(object):
+    """Generate the records for a pack, using deltas where possible.
+
+    Blobs and trees are stored as deltas against an object that was written
+    earlier in the same pack; preferably the blob of a parent text of the
+    same file, as found through the Git SHA map, and otherwise the last
+    object written for the same path.
+
+    Deltas are computed in a pool of threads; the compiled delta encoder
+    releases the GIL.
+    """
+
+    def __init__(self, store, jobs=None):
+        self.store = store
+        if jobs is None:
+            jobs = osutils.local_concurrency()
+        self.jobs = jobs
+        self._texts = lru_cache.LRUSizeCache(
+            max_size=_DELTA_BASE_CACHE_SIZE)
+        # Delta chain length for each object written so far
+        self._depths = {}
+        self._last_at_path = {}
+
+    def _find_parent_blob_ids(self, sha):
+        idmap = self.store._cache.idmap
+        keys = []
+        try:
+            for (kind, type_data) in idmap.lookup_git_sha(sha):
+                if kind == "blob":
+                    keys.append(tuple(type_data[:2]))
+        except KeyError:
+            return []
+        ret = []
+        parent_map = self.store.repository.texts.get_parent_map(keys)
+        for parent_keys in parent_map.values():
+            for (file_id, revision) in parent_keys or ():
+                try:
+                    ret.append(idmap.lookup_blob_id(file_id, revision))
+                except KeyError:
+                    pass
+        return ret
+
+    def _find_delta_base(self, obj, path):
+        """Find the object to use as delta base for obj.
+
+        :return: Tuple with SHA1 and text of the base, or (None, None)
+        """
+        candidates = []
+        if obj.type_num == Blob.type_num:
+            candidates.extend(self._find_parent_blob_ids(obj.id))
+        if path is not None:
+            candidates.append(self._last_at_path.get((obj.type_num, path)))
+        for base_sha in candidates:
+            if self._depths.get(base_sha, _MAX_DELTA_DEPTH) >= _MAX_DELTA_DEPTH:
+                continue
+            base = self._texts.get(base_sha)
+            if base:
+                return base_sha, base
+        return None, None
+
+    def iter_records(self, objects):
+        """Iterate over the pack records for a set of objects.
+
+        :param objects: Iterable over (object, path) tuples
+        :return: Iterator over (type_num, sha, delta base, chunks) tuples,
+            as expected by dulwich's PackChunkGenerator
+        """
+        if self.jobs > 1:
+            executor = ThreadPoolExecutor(self.jobs)
+        else:
+            executor = None
+        pending = deque()
+        try:
+            for obj, path in objects:
+                raw = obj.as_raw_string()
+                base_sha = delta = None
+                if (obj.type_num in (Blob.type_num, Tree.type_num) and
+                        len(raw) >= _MIN_DELTA_SIZE):
+                    base_sha, base = self._find_delta_base(obj, path)
+                    self._texts[obj.id] = raw
+                    if path is not None:
+                        self._last_at_path[(obj.type_num, path)] = obj.id
+                if base_sha is None:
+                    self._depths[obj.id] = 0
+                else:
+                    # Assume the delta will be used, until it is known.
+                    self._depths[obj.id] = self._depths[base_sha] + 1
+                    if executor is not None:
+                        delta = executor.submit(create_git_delta, base, raw)
+                    else:
+                        delta = create_git_delta(base, raw)
+                pending.append((obj, raw, base_sha, delta))
+                while len(pending) > self.jobs * 4:
+                    yield self._finish(*pending.popleft())
+            while pending:
+                yield self._finish(*pending.popleft())
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _finish(self, obj, raw, base_sha, delta):
+        if isinstance(delta, Future):
+            delta = delta.result()
+        if delta is None:
+            self._depths[obj.id] = 0
+            return (obj.type_num, obj.sha().digest(), None, [raw])
+        return (obj.type_num, obj.sha().digest(), hex_to_sha(base_sha),
+                [delta])
+
+
 class PackTupleIterable(object):
 
     def __init__(self, store):
@@ -403,8 +671,16 @@ class PackTupleIterable(object):
 class BazaarObjectStore(BaseObjectStore):
     """A Git-style object store backed onto a Bazaar repository."""
 
-    def __init__(self, repository, mapping=None):
+    def __init__(self, repository, mapping=None, shared_cache=None):
+        """Create a new object store.
+
+        :param repository: Bazaar repository to export from
+        :param mapping: Mapping to use, defaults to the default mapping
+        :param shared_cache: Optional SharedExportCache to keep revision
+            trees and exported objects in
+        """
         self.repository = repository
+        self._shared_cache = shared_cache
         self._map_updated = False
         self._locked = None
         if mapping is None:
@@ -416,7 +692,7 @@ class BazaarObjectStore(BaseObjectStore):
         self.start_write_group = self._cache.idmap.start_write_group
         self.abort_write_group = self._cache.idmap.abort_write_group
         self.commit_write_group = self._cache.idmap.commit_write_group
-        self.tree_cache = LRUTreeCache(self.repository)
+        self.tree_cache = LRUTreeCache(self.repository, shared_cache)
         self.unpeel_map = UnpeelMap.from_repository(self.repository)
 
     def _missing_revisions(self, revisions):
@@ -710,6 +986,18 @@ class BazaarObjectStore(BaseObjectStore):
         return self.lookup_git_shas([sha])[sha]
 
     def __getitem__(self, sha):
+        if self._shared_cache is None:
+            return self._get_object(sha)
+        if len(sha) == 20:
+            sha = sha_to_hex(sha)
+        try:
+            return self._shared_cache.get_object(self.repository, sha)
+        except KeyError:
+            obj = self._get_object(sha)
+            self._shared_cache.add_object(self.repository, obj)
+            return obj
+
+    def _get_object(self, sha):
         for (kind, type_data) in self.lookup_git_sha(sha):
             # convert object to git object
             if kind == "commit":
@@ -755,11 +1043,34 @@ class BazaarObjectStore(BaseObjectStore):
         else:
             raise KeyError(sha)
 
+    def _pack_objects_to_data(self, objects, ofs_delta):
+        if not ofs_delta:
+            # dulwich writes all deltas against objects earlier in the
+            # pack as OFS deltas.
+            return pack_objects_to_data(objects)
+        return (len(objects),
+                PackRecordGenerator(self).iter_records(objects))
+
     def generate_lossy_pack_data(self, have, want, progress=None,
                                  get_tagged=None, ofs_delta=False):
-        return pack_objects_to_data(
-            self.generate_pack_contents(have, want, progress, get_tagged,
-                                        lossy=True))
+        return self._pack_objects_to_data(
+            self.generate_pack_contents(
+                have, want, progress, get_tagged=get_tagged, lossy=True),
+            ofs_delta)
+
+    def generate_pack_data(self, have, want, shallow=None, progress=None,
+                           ofs_delta=True):
+        """Generate pack data for a set of wants/haves.
+
+        :param have: List of SHA1s of objects that should not be sent
+        :param want: List of SHA1s of objects that should be sent
+        :param shallow: Set of shallow commit SHA1s (ignored)
+        :param progress: Optional progress reporting method
+        :param ofs_delta: Whether OFS deltas can be included
+        :return: Tuple with number of records and iterator over records
+        """
+        return self._pack_objects_to_data(
+            self.generate_pack_contents(have, want, progress), ofs_delta)
 
     def generate_pack_contents(self, have, want, progress=None,
                                ofs_delta=False, get_tagged=None, lossy=False):
@@ -804,6 +1115,8 @@ class BazaarObjectStore(BaseObjectStore):
                 tree = self.tree_cache.revision_tree(revid)
                 for path, obj in self._revision_to_objects(
                         rev, tree, lossy=lossy):
+                    if self._shared_cache is not None:
+                        self._shared_cache.add_object(self.repository, obj)
                     ret.add(obj.id, path)
             return ret
 
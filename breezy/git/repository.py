@@ -243,6 +243,12 @@ class LocalGitRepository(GitRepository):
         self._file_change_scanner = GitFileLastChangeScanner(self)
         self._transaction = None
 
+    @only_raises(errors.LockNotHeld, errors.LockBroken)
+    def unlock(self):
+        super(LocalGitRepository, self).unlock()
+        if not self.is_locked():
+            self._file_change_scanner.flush()
+
     def get_commit_builder(self, branch, parents, config, timestamp=None,
                            timezone=None, committer=None, revprops=None,
                            revision_id=None, lossy=False):
@@ -424,7 +430,7 @@ class LocalGitRepository(GitRepository):
         result.check(callback_refs)
         return result
 
-    def pack(self, hint=None, clean_obsolete_packs=False):
+    def pack(self, hint=None, clean_obsolete_packs=False, jobs=None):
         self._git.object_store.pack_loose_objects()
 
     def lookup_foreign_revision_id(self, foreign_revid, mapping=None):
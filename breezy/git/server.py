@@ -34,6 +34,7 @@ from .mapping import (
     )
 from .object_store import (
     BazaarObjectStore,
+    export_cache,
     get_object_store,
     )
 from .refs import (
@@ -69,7 +70,8 @@ class BzrBackendRepo(BackendRepo):
         self.mapping = mapping
         self.repo_dir = ControlDir.open_from_transport(transport)
         self.repo = self.repo_dir.find_repository()
-        self.object_store = get_object_store(self.repo)
+        self.object_store = get_object_store(
+            self.repo, shared_cache=export_cache)
         self.refs = get_refs_container(self.repo_dir, self.object_store)
 
     def get_refs(self):
@@ -91,6 +93,7 @@ class BzrBackendRepo(BackendRepo):
             if wants is None:
                 return
             if isinstance(self.object_store, BazaarObjectStore):
+                trace.mutter('git export cache: %r', export_cache.stats())
                 return self.object_store.generate_pack_contents(
                     have, wants, progress, get_tagged=get_tagged, lossy=True)
             else:
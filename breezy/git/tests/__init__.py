@@ -213,6 +213,7 @@ def test_suite():
         'test_cache',
         'test_dir',
         'test_fetch',
+        'test_filegraph',
         'test_git_remote_helper',
         'test_mapping',
         'test_memorytree',
@@ -136,6 +136,23 @@ class TestGitShaMap:
         self.assertEqual(set([b"lala", b"bla"]),
                          set(self.map.missing_revisions([b"myrevid", b"lala", b"bla"])))
 
+    def test_last_changes(self):
+        commit = b"cc9462f7f8263ef5adfbeff2fb936bb36b504cba"
+        other = b"e6a9bb46a2e8c8ec8a0bc83a7aa8f0a3e5f7d02c"
+        self.map.start_write_group()
+        self.map.add_last_changes([
+            (commit, b"a file", other),
+            (commit, b"dir/\xc3\xa5", commit),
+            ])
+        self.map.commit_write_group()
+        self.assertEqual(other, self.map.lookup_last_change(commit, b"a file"))
+        self.assertEqual(
+            commit, self.map.lookup_last_change(commit, b"dir/\xc3\xa5"))
+        self.assertRaises(
+            KeyError, self.map.lookup_last_change, commit, b"dir")
+        self.assertRaises(
+            KeyError, self.map.lookup_last_change, other, b"a file")
+
 
 class DictGitShaMapTests(TestCase, TestGitShaMap):
 
@@ -152,6 +169,15 @@ class SqliteGitShaMapTests(TestCaseInTempDir, TestGitShaMap):
         self.cache = SqliteBzrGitCache(os.path.join(self.test_dir, 'foo.db'))
         self.map = self.cache.idmap
 
+    def test_abort(self):
+        self.map.start_write_group()
+        updater = self.cache.get_updater(Revision(b"myrevid"))
+        updater.add_object(self._get_test_commit(), {}, None)
+        updater.finish()
+        self.assertEqual([b"myrevid"], list(self.map.revids()))
+        self.map.abort_write_group()
+        self.assertEqual([], list(self.map.revids()))
+
 
 class TdbGitShaMapTests(TestCaseInTempDir, TestGitShaMap):
 
@@ -172,3 +198,71 @@ class IndexGitShaMapTests(TestCaseInTempDir, TestGitShaMap):
         IndexGitCacheFormat().initialize(transport)
         self.cache = IndexBzrGitCache(transport)
         self.map = self.cache.idmap
+
+    def add_commit(self, revid, message):
+        self.map.start_write_group()
+        updater = self.cache.get_updater(Revision(revid))
+        c = self._get_test_commit()
+        c.message = message
+        updater.add_object(c, {}, None)
+        updater.finish()
+        self.map.commit_write_group()
+        return c.id
+
+    def index_files(self, suffix='.rix'):
+        return sorted(name for name in os.listdir('index')
+                      if name.endswith(suffix))
+
+    def test_lookup_in_write_group(self):
+        self.map.start_write_group()
+        updater = self.cache.get_updater(Revision(b"myrevid"))
+        c = self._get_test_commit()
+        updater.add_object(c, {}, None)
+        updater.finish()
+        self.assertEqual(c.id, self.map.lookup_commit(b"myrevid"))
+        self.assertEqual([b"myrevid"], list(self.map.revids()))
+        self.assertEqual(set(), self.map.missing_revisions([b"myrevid"]))
+        self.map.abort_write_group()
+        self.assertRaises(KeyError, self.map.lookup_commit, b"myrevid")
+        self.assertEqual([], self.index_files())
+
+    def test_existing_nodes_not_written(self):
+        self.add_commit(b"myrevid", b"message")
+        self.assertEqual(1, len(self.index_files()))
+        self.add_commit(b"myrevid", b"message")
+        self.assertEqual(1, len(self.index_files()))
+        self.assertEqual([b"myrevid"], list(self.map.revids()))
+
+    def test_last_changes_in_separate_write_groups(self):
+        commit = b"cc9462f7f8263ef5adfbeff2fb936bb36b504cba"
+        other = b"e6a9bb46a2e8c8ec8a0bc83a7aa8f0a3e5f7d02c"
+        self.map.start_write_group()
+        self.map.add_last_changes([(commit, b"a file", other)])
+        self.map.commit_write_group()
+        self.map.start_write_group()
+        self.map.add_last_changes([(commit, b"other file", commit)])
+        self.map.commit_write_group()
+        self.assertEqual(2, len(self.index_files()))
+        map = IndexBzrGitCache(get_transport(self.test_dir)).idmap
+        self.assertEqual(other, map.lookup_last_change(commit, b"a file"))
+        self.assertEqual(commit, map.lookup_last_change(commit, b"other file"))
+
+    def test_merges_indices(self):
+        self.overrideAttr(self.map, '_max_index_files', 3)
+        shas = []
+        for i in range(3):
+            shas.append(self.add_commit(b"rev-%d" % i, b"message %d" % i))
+            self.assertEqual(i + 1, len(self.index_files()))
+        shas.append(self.add_commit(b"rev-3", b"message 3"))
+        self.assertEqual(1, len(self.index_files()))
+        self.assertEqual(4, len(self.index_files('.rix.old')))
+        map = IndexBzrGitCache(get_transport(self.test_dir)).idmap
+        for i, sha in enumerate(shas):
+            self.assertEqual(sha, map.lookup_commit(b"rev-%d" % i))
+        for i in range(4, 7):
+            self.add_commit(b"rev-%d" % i, b"message %d" % i)
+        self.assertEqual(1, len(self.index_files()))
+        # Only the indices merged most recently are kept around.
+        self.assertEqual(4, len(self.index_files('.rix.old')))
+        self.assertEqual(
+            set([b"rev-%d" % i for i in range(7)]), set(self.map.revids()))
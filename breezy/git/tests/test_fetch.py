@@ -26,11 +26,15 @@ from dulwich.objects import (
 from dulwich.repo import (
     Repo as GitRepo,
     )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
 import os
 import stat
 import time
 
 from ... import (
+    config,
     osutils,
     )
 from ...bzr import (
@@ -53,14 +57,22 @@ from ...tests import (
     TestCaseWithTransport,
     )
 
+from .. import (
+    fetch,
+    )
 from ..fetch import (
     import_git_blob,
+    import_git_objects,
     import_git_tree,
     import_git_submodule,
     )
 from ..mapping import (
     BzrGitMappingv1,
     DEFAULT_FILE_MODE,
+    default_mapping,
+    )
+from ..object_store import (
+    get_object_store,
     )
 from . import (
     GitBranchBuilder,
@@ -361,6 +373,33 @@ class ImportObjects(TestCaseWithTransport):
                               self._mapping.generate_file_id)
         self.assertEqual(set([(b'git:bla', b'somerevid')]), self._texts.keys())
 
+    def test_import_blob_text_parents(self):
+        builder = self.make_branch_builder('br')
+        builder.start_series()
+        rev_root = builder.build_snapshot(None, [
+            ('add', ('', b'rootid', 'directory', ''))])
+        rev1 = builder.build_snapshot([rev_root], [
+            ('add', ('bla', self._mapping.generate_file_id('bla'), 'file', b'content'))])
+        rev2 = builder.build_snapshot([rev_root], [])
+        builder.finish_series()
+        branch = builder.get_branch()
+
+        blob = Blob.from_string(b"bar")
+        objs = {"blobname": blob}
+        import_git_blob(self._texts, self._mapping, b"bla", b"bla",
+                        (None, "blobname"),
+                        branch.repository.revision_tree(rev1), b'rootid',
+                        b"somerevid",
+                        [branch.repository.revision_tree(r)
+                         for r in [rev2, rev1]],
+                        objs.__getitem__,
+                        (None, DEFAULT_FILE_MODE), DummyStoreUpdater(),
+                        self._mapping.generate_file_id)
+        # The text in the parent that has the file is the text parent
+        self.assertEqual(
+            {(b'git:bla', b'somerevid'): ((b'git:bla', rev1),)},
+            self._texts.get_parent_map([(b'git:bla', b'somerevid')]))
+
     def test_import_blob_simple(self):
         blob = Blob.from_string(b"bar")
         objs = {"blobname": blob}
@@ -504,3 +543,86 @@ class ImportObjects(TestCaseWithTransport):
                                       self._mapping.generate_file_id("foo")))
         ie = ret[1][3]
         self.assertEqual(ie.kind, "tree-reference")
+
+
+class ImportGitObjectsTests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(ImportGitObjectsTests, self).setUp()
+        self.git_repo = self.make_git_repo()
+        self.repo = self.make_repository('bzr', format='2a')
+
+    def make_git_repo(self):
+        os.mkdir('git')
+        git_repo = GitRepo.init('git')
+        blobs = [Blob.from_string(b'text %d\n' % i) for i in range(4)]
+        trees = {
+            1: [(b'a', blobs[0]), (b'dir/b', blobs[1])],
+            2: [(b'a', blobs[2]), (b'dir/b', blobs[1]), (b'c', blobs[3])],
+            3: [(b'a', blobs[2]), (b'dir/b', blobs[0]), (b'c', blobs[3])],
+            }
+        self.commits = [c.id for c in build_commit_graph(
+            git_repo.object_store, [[1], [2, 1], [3, 2]], trees)]
+        return git_repo
+
+    def import_objects(self, jobs):
+        store = get_object_store(self.repo, default_mapping)
+        with store.lock_write():
+            import_git_objects(
+                self.repo, default_mapping, self.git_repo.object_store,
+                store, [self.commits[-1]], jobs=jobs)
+
+    def get_texts(self):
+        with self.repo.lock_read():
+            keys = self.repo.texts.keys()
+            return (
+                self.repo.texts.get_parent_map(keys),
+                dict((record.key, record.get_bytes_as('fulltext'))
+                     for record in self.repo.texts.get_record_stream(
+                         keys, 'unordered', True)))
+
+    def assertImported(self):
+        revids = [default_mapping.revision_id_foreign_to_bzr(c)
+                  for c in self.commits]
+        self.assertEqual(set(revids), set(self.repo.all_revision_ids()))
+        tree = self.repo.revision_tree(revids[-1])
+        with tree.lock_read():
+            self.assertEqual(b'text 2\n', tree.get_file_text('a'))
+            self.assertEqual(b'text 0\n', tree.get_file_text('dir/b'))
+            self.assertEqual(revids[1], tree.get_file_revision('a'))
+            self.assertEqual(revids[2], tree.get_file_revision('dir/b'))
+            self.assertEqual(revids[1], tree.get_file_revision('c'))
+        a_id = default_mapping.generate_file_id('a')
+        parent_map, texts = self.get_texts()
+        self.assertEqual(((a_id, revids[0]),), parent_map[(a_id, revids[1])])
+        self.assertEqual(b'text 0\n', texts[(a_id, revids[0])])
+
+    def test_import(self):
+        self.import_objects(jobs=1)
+        self.assertImported()
+
+    def test_import_in_processes(self):
+        self.overrideAttr(fetch, '_TEXT_PARTITION_SIZE', 1)
+        self.import_objects(jobs=2)
+        self.assertImported()
+
+    def test_jobs_from_config(self):
+        jobs = []
+
+        class RecordingPendingTexts(fetch._PendingTexts):
+
+            def __init__(self, texts, jobs_, stats):
+                jobs.append(jobs_)
+                super(RecordingPendingTexts, self).__init__(
+                    texts, jobs_, stats)
+
+        self.overrideAttr(fetch, '_PendingTexts', RecordingPendingTexts)
+        config.GlobalStack().set('git.fetch_jobs', '3')
+        self.import_objects(jobs=None)
+        self.assertEqual([3], jobs)
+        self.assertImported()
+
+    def test_import_flushes_large_texts(self):
+        self.overrideAttr(fetch, '_MAX_PENDING_TEXT_BYTES', 1)
+        self.import_objects(jobs=1)
+        self.assertImported()
@@ -0,0 +1,175 @@
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for finding the last changes of files in Git history."""
+
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.repo import (
+    Repo as GitRepo,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+
+from ...repository import (
+    Repository,
+    )
+from ...tests import (
+    TestCaseInTempDir,
+    )
+
+from .. import (
+    filegraph,
+    )
+from ..cache import (
+    from_git_repository,
+    )
+from ..filegraph import (
+    GitFileLastChangeScanner,
+    )
+
+
+class GitFileLastChangeScannerTests(TestCaseInTempDir):
+
+    def setUp(self):
+        super(GitFileLastChangeScannerTests, self).setUp()
+        git_repo = GitRepo.init(self.test_dir)
+        a1 = Blob.from_string(b'a1\n')
+        b1 = Blob.from_string(b'b1\n')
+        b2 = Blob.from_string(b'b2\n')
+        c1 = Blob.from_string(b'c1\n')
+        d1 = Blob.from_string(b'd1\n')
+        d2 = Blob.from_string(b'd2\n')
+        trees = {
+            1: [(b'a', a1), (b'dir/b', b1), (b'dir/c', c1),
+                (b'other/d', d1)],
+            2: [(b'a', a1), (b'dir/b', b2), (b'dir/c', c1),
+                (b'other/d', d1)],
+            3: [(b'a', a1, 0o100755), (b'dir/b', b2), (b'dir/c', c1),
+                (b'other/d', d1)],
+            4: [(b'a', a1), (b'dir/b', b1), (b'dir/c', c1),
+                (b'other/d', d2)],
+            5: [(b'a', a1, 0o100755), (b'dir/b', b2), (b'dir/c', c1),
+                (b'other/d', d2)],
+            }
+        (self.first, self.second, self.third, self.side, self.merge) = [
+            c.id for c in build_commit_graph(
+                git_repo.object_store,
+                [[1], [2, 1], [3, 2], [4, 1], [5, 3, 4]], trees)]
+        self.repo = Repository.open('.')
+
+    def test_batched(self):
+        scanner = GitFileLastChangeScanner(self.repo)
+        self.assertEqual({
+            b'a': self.merge,
+            b'dir': self.first,
+            b'dir/b': self.merge,
+            b'dir/c': self.first,
+            b'other/d': self.merge,
+            }, scanner.find_last_change_revisions(
+                [b'a', b'dir', b'dir/b', b'dir/c', b'other/d'], self.merge))
+
+    def test_matches_single(self):
+        paths = [b'', b'a', b'dir', b'dir/b', b'dir/c', b'other', b'other/d']
+        for commit_id in [self.first, self.second, self.side, self.merge]:
+            batched = GitFileLastChangeScanner(
+                self.repo).find_last_change_revisions(paths, commit_id)
+            for path in paths:
+                scanner = GitFileLastChangeScanner(self.repo)
+                self.assertEqual(
+                    (path, batched[path]),
+                    scanner.find_last_change_revision(path, commit_id))
+
+    def test_missing_path(self):
+        scanner = GitFileLastChangeScanner(self.repo)
+        self.assertRaises(
+            KeyError, scanner.find_last_change_revisions,
+            [b'a', b'nonexistent'], self.merge)
+        self.assertRaises(
+            KeyError, scanner.find_last_change_revision, b'a/b', self.merge)
+
+    def test_persistent(self):
+        with self.repo.lock_read():
+            self.repo._file_change_scanner.find_last_change_revisions(
+                [b'a', b'dir/c'], self.third)
+        idmap = from_git_repository(self.repo).idmap
+        self.assertEqual(
+            self.third, idmap.lookup_last_change(self.third, b'a'))
+        self.assertEqual(
+            self.first, idmap.lookup_last_change(self.third, b'dir/c'))
+        self.assertEqual(
+            self.third,
+            idmap.lookup_last_change(self.third, filegraph._SCANNED_MARKER))
+
+    def test_reuses_scanned(self):
+        # Pretend an earlier scan of the third commit found a different
+        # answer, to check that it is used rather than walking the history
+        # again.
+        cache = from_git_repository(self.repo)
+        cache.idmap.start_write_group()
+        cache.idmap.add_last_changes([
+            (self.third, filegraph._SCANNED_MARKER, self.third),
+            (self.third, b'dir/c', self.second)])
+        cache.idmap.commit_write_group()
+        scanner = GitFileLastChangeScanner(self.repo)
+        self.assertEqual(
+            {b'a': self.merge, b'dir/b': self.merge, b'dir/c': self.second},
+            scanner.find_last_change_revisions(
+                [b'a', b'dir/b', b'dir/c'], self.merge))
+        self.assertEqual(
+            {b'dir/c': self.first},
+            scanner.find_last_change_revisions([b'dir/c'], self.side))
+
+    def test_record_commit(self):
+        scanner = GitFileLastChangeScanner(self.repo)
+        for commit_id in [self.first, self.merge]:
+            scanner.record_commit(self.repo._git.object_store[commit_id])
+        scanner.flush()
+        idmap = from_git_repository(self.repo).idmap
+        for path in [b'a', b'dir/b', b'dir/c', b'other/d']:
+            self.assertEqual(
+                self.first, idmap.lookup_last_change(self.first, path))
+        self.assertEqual(
+            self.merge, idmap.lookup_last_change(self.merge, b'a'))
+        self.assertEqual(
+            self.merge, idmap.lookup_last_change(self.merge, b'dir/b'))
+        self.assertRaises(
+            KeyError, idmap.lookup_last_change, self.merge, b'dir/c')
+        # Paths the merge did not change are traced from there.
+        scanner = GitFileLastChangeScanner(self.repo)
+        self.assertEqual(
+            {b'a': self.merge, b'dir/c': self.first, b'other/d': self.merge},
+            scanner.find_last_change_revisions(
+                [b'a', b'dir/c', b'other/d'], self.merge))
+
+    def test_revision_tree(self):
+        revid = self.repo.lookup_foreign_revision_id(self.merge)
+        tree = self.repo.revision_tree(revid)
+        with tree.lock_read():
+            self.assertEqual(
+                self.repo.lookup_foreign_revision_id(self.first),
+                tree.get_file_revision('dir/c'))
+            # The siblings have been looked up along with dir/c.
+            self.assertEqual(
+                {b'dir/b': self.merge, b'dir/c': self.first},
+                tree._file_revisions)
+            self.assertEqual(
+                self.repo.lookup_foreign_revision_id(self.merge),
+                tree.get_file_revision('dir/b'))
+            self.assertRaises(
+                KeyError, tree.get_file_revision, 'dir/nonexistent')
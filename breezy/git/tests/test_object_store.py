@@ -20,9 +20,13 @@ import os
 import shutil
 import stat
 
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
 from dulwich.objects import (
     Blob,
     Tree,
+    sha_to_hex,
     )
 
 from ...branchbuilder import (
@@ -51,6 +55,8 @@ from ..cache import (
 from ..object_store import (
     BazaarObjectStore,
     LRUTreeCache,
+    SharedExportCache,
+    create_git_delta,
     directory_to_tree,
     _check_expected_sha,
     _find_missing_bzr_revids,
@@ -141,6 +147,32 @@ class LRUTreeCacheTests(TestCaseWithTransport):
         tree = self.cache.revision_tree(revid)
         self.assertEqual(revid, tree.get_revision_id())
 
+    def test_shared(self):
+        shared = SharedExportCache()
+        bb = BranchBuilder(branch=self.branch)
+        bb.start_series()
+        revid = bb.build_snapshot(None,
+                                  [('add', ('', None, 'directory', None)),
+                                   ('add', ('foo', b'foo-id',
+                                            'file', b'a\nb\nc\nd\ne\n')),
+                                   ])
+        bb.finish_series()
+        LRUTreeCache(self.branch.repository, shared).revision_tree(revid)
+        self.assertEqual(
+            (0, 1), (shared.hits["tree"], shared.misses["tree"]))
+        # A cache for another instance of the same repository uses the
+        # trees that were already loaded
+        repo = self.branch.repository.controldir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        tree = LRUTreeCache(repo, shared).revision_tree(revid)
+        self.assertEqual(
+            (1, 1), (shared.hits["tree"], shared.misses["tree"]))
+        self.assertEqual(revid, tree.get_revision_id())
+        self.assertIs(repo, tree._repository)
+        self.assertEqual(b'a\nb\nc\nd\ne\n', tree.get_file_text('foo'))
+        self.assertEqual(1, shared.stats()["tree_hits"])
+
 
 class BazaarObjectStoreTests(TestCaseWithTransport):
 
@@ -234,6 +266,95 @@ class BazaarObjectStoreTests(TestCaseWithTransport):
         self.store.lock_read()
         self.assertTrue(b.id in self.store)
 
+    def build_history(self):
+        text = b''.join(b'line %d\n' % i for i in range(100))
+        bb = BranchBuilder(branch=self.branch)
+        bb.start_series()
+        bb.build_snapshot(None,
+                          [('add', ('', None, 'directory', None)),
+                           ('add', ('foo', b'foo-id', 'file', text)),
+                           ], revision_id=b'rev1')
+        bb.build_snapshot([b'rev1'],
+                          [('modify', ('foo', text + b'more\n'))],
+                          revision_id=b'rev2')
+        bb.build_snapshot([b'rev2'],
+                          [('rename', ('foo', 'bar')),
+                           ('modify', ('bar', b'first\n' + text))],
+                          revision_id=b'rev3')
+        bb.finish_series()
+
+    def fetch_pack_data(self, ofs_delta):
+        self.build_history()
+        self.store.lock_read()
+        self.addCleanup(self.store.unlock)
+        want = self.store._lookup_revision_sha1(b'rev3')
+        count, records = self.store.generate_lossy_pack_data(
+            [], [want], ofs_delta=ofs_delta)
+        records = list(records)
+        self.assertEqual(count, len(records))
+        target = MemoryObjectStore()
+        target.add_pack_data(count, iter(records))
+        for (type_num, sha, delta_base, chunks) in records:
+            obj = target[sha_to_hex(sha)]
+            self.assertEqual(type_num, obj.type_num)
+            self.assertEqual(self.store[obj.id], obj)
+        return records
+
+    def test_generate_pack_data(self):
+        records = self.fetch_pack_data(ofs_delta=True)
+        # 3 commits, 3 root trees and 3 blobs
+        self.assertEqual(9, len(records))
+        deltas = [r for r in records if r[2] is not None]
+        # The blobs are deltas against their parent texts, including
+        # the renamed one.
+        self.assertEqual(
+            2, len([r for r in deltas if r[0] == Blob.type_num]))
+        shas = [r[1] for r in records]
+        for delta in deltas:
+            self.assertLess(shas.index(delta[2]), shas.index(delta[1]))
+
+    def test_shared_cache(self):
+        self.build_history()
+        shared = SharedExportCache()
+        store = BazaarObjectStore(self.branch.repository, shared_cache=shared)
+        with store.lock_read():
+            want = store._lookup_revision_sha1(b'rev3')
+            objects = list(store.generate_pack_contents([], [want], lossy=True))
+        self.assertEqual(9, len(objects))
+        self.assertEqual(0, shared.misses["object"])
+        self.assertEqual(9, shared.hits["object"])
+        # Another object store for the same repository uses the same
+        # objects and trees
+        tree_hits = shared.hits["tree"]
+        store = BazaarObjectStore(self.branch.repository, shared_cache=shared)
+        with store.lock_read():
+            self.assertEqual(
+                objects[0][0], store[objects[0][0].id])
+            store.tree_cache.revision_tree(b'rev1')
+        self.assertEqual(10, shared.hits["object"])
+        self.assertEqual(tree_hits + 1, shared.stats()["tree_hits"])
+
+    def test_generate_pack_data_no_ofs_delta(self):
+        records = self.fetch_pack_data(ofs_delta=False)
+        self.assertEqual(9, len(records))
+        self.assertEqual([], [r for r in records if r[2] is not None])
+
+
+class CreateGitDeltaTests(TestCase):
+
+    def test_delta(self):
+        from dulwich.pack import apply_delta
+        base = b''.join(b'line %d\n' % i for i in range(100))
+        target = base.replace(b'line 50\n', b'changed\n')
+        delta = create_git_delta(base, target)
+        self.assertLess(len(delta), len(target) // 2)
+        self.assertEqual(target, b''.join(apply_delta(base, delta)))
+
+    def test_too_big(self):
+        base = b''.join(b'line %d\n' % i for i in range(100))
+        target = b''.join(b'other %d\n' % i for i in range(100))
+        self.assertIs(None, create_git_delta(base, target))
+
 
 class TreeToObjectsTests(TestCaseWithTransport):
 
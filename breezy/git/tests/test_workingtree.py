@@ -19,8 +19,9 @@
 
 import os
 import stat
+import time
 
-from dulwich.index import IndexEntry
+from dulwich.index import IndexEntry, index_entry_from_stat
 from dulwich.objects import (
     S_IFGITLINK,
     Blob,
@@ -37,6 +38,7 @@ from ...tree import TreeChange
 from ..mapping import (
     default_mapping,
     )
+from .. import workingtree as _mod_git_workingtree
 from ..tree import (
     changes_between_git_tree_and_working_copy,
     tree_delta_from_git_changes,
@@ -285,3 +287,69 @@ class ChangesBetweenGitTreeAndWorkingCopyTests(TestCaseWithTransport):
         t.add(b"a", S_IFGITLINK, a.id)
         self.store.add_object(t)
         self.expectDelta([], tree_id=t.id)
+
+
+class IndexStatCacheTests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(IndexStatCacheTests, self).setUp()
+        # Pretend all files were changed long ago.
+        self.overrideAttr(_mod_git_workingtree, '_INDEX_CUTOFF_SECONDS', -60)
+        self.wt = self.make_branch_and_tree('.', format='git')
+        self.build_tree(['a'])
+        then = time.time() - 10
+        os.utime('a', (then, then))
+        a = Blob.from_string(b'contents of a\n')
+        with self.wt.lock_tree_write():
+            # Stat information that doesn't match the file
+            self.wt.index[b'a'] = index_entry_from_stat(
+                os.stat_result((stat.S_IFREG | 0o644, ) + (0, ) * 9), a.id, 0)
+            self.wt._index_dirty = True
+        self.hashed = []
+        orig = _mod_git_workingtree.blob_from_path_and_stat
+
+        def blob_from_path_and_stat(path, st):
+            self.hashed.append(path)
+            return orig(path, st)
+        self.overrideAttr(_mod_git_workingtree, 'blob_from_path_and_stat',
+                          blob_from_path_and_stat)
+
+    def get_sha(self, path=b'a'):
+        del self.hashed[:]
+        wt = _mod_workingtree.WorkingTree.open('.')
+        with wt.lock_read():
+            return wt._live_entry(path).sha
+
+    def test_unchanged_file_hashed_once(self):
+        a = Blob.from_string(b'contents of a\n')
+        self.assertEqual(a.id, self.get_sha())
+        self.assertEqual(1, len(self.hashed))
+        self.assertEqual(a.id, self.get_sha())
+        self.assertEqual([], self.hashed)
+        wt = _mod_workingtree.WorkingTree.open('.')
+        with wt.lock_read():
+            self.assertEqual(a.id, wt.index[b'a'].sha)
+            self.assertEqual(os.lstat('a').st_size, wt.index[b'a'].size)
+
+    def test_modified_file(self):
+        self.get_sha()
+        self.build_tree_contents([('a', b'contents of A\n')])
+        self.assertEqual(
+            Blob.from_string(b'contents of A\n').id, self.get_sha())
+        self.assertEqual(1, len(self.hashed))
+        # The index still refers to the old contents.
+        self.assertEqual(
+            Blob.from_string(b'contents of A\n').id, self.get_sha())
+        self.assertEqual(1, len(self.hashed))
+
+    def test_recent_file_hashed_again(self):
+        self.overrideAttr(_mod_git_workingtree, '_INDEX_CUTOFF_SECONDS', 60)
+        self.get_sha()
+        self.get_sha()
+        self.assertEqual(1, len(self.hashed))
+
+    def test_index_locked(self):
+        with self.wt.lock_tree_write():
+            self.get_sha()
+        self.get_sha()
+        self.assertEqual(1, len(self.hashed))
@@ -262,6 +262,7 @@ class GitRevisionTree(revisiontree.RevisionTree):
         self._revision_id = revision_id
         self._repository = repository
         self._submodules = None
+        self._file_revisions = {}
         self.store = repository._git.object_store
         if not isinstance(revision_id, bytes):
             raise TypeError(revision_id)
@@ -317,14 +318,45 @@ class GitRevisionTree(revisiontree.RevisionTree):
         return False
 
     def get_file_revision(self, path):
-        change_scanner = self._repository._file_change_scanner
         if self.commit_id == ZERO_SHA:
             return NULL_REVISION
-        (unused_path, commit_id) = change_scanner.find_last_change_revision(
-            path.encode('utf-8'), self.commit_id)
+        encoded_path = path.encode('utf-8')
+        try:
+            commit_id = self._file_revisions[encoded_path]
+        except KeyError:
+            self._find_file_revisions(encoded_path)
+            commit_id = self._file_revisions[encoded_path]
         return self._repository.lookup_foreign_revision_id(
             commit_id, self.mapping)
 
+    def _find_file_revisions(self, encoded_path):
+        """Find the commits that last changed a path and its siblings.
+
+        Callers that ask about one entry in a directory (e.g. ls -v, or
+        export with per-file timestamps) usually go on to ask about the
+        others, and finding them together only takes a single walk of the
+        history.
+        """
+        change_scanner = self._repository._file_change_scanner
+        paths = [encoded_path]
+        if encoded_path:
+            dirname = posixpath.dirname(encoded_path)
+            try:
+                (store, mode, hexsha) = self._lookup_path(
+                    dirname.decode('utf-8'))
+            except (errors.NoSuchFile, NotTreeError):
+                pass
+            else:
+                if store is self.store and (
+                        mode is None or stat.S_ISDIR(mode)):
+                    paths.extend(
+                        posixpath.join(dirname, entry.path)
+                        for entry in store[hexsha].iteritems()
+                        if posixpath.join(dirname, entry.path) not in
+                        self._file_revisions)
+        self._file_revisions.update(
+            change_scanner.find_last_change_revisions(paths, self.commit_id))
+
     def get_file_mtime(self, path):
         try:
             revid = self.get_file_revision(path)
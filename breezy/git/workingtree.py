@@ -28,7 +28,9 @@ from dulwich.file import GitFile, FileLocked
 from dulwich.index import (
     Index,
     SHA1Writer,
+    blob_from_path_and_stat,
     build_index_from_tree,
+    cleanup_mode,
     index_entry_from_path,
     index_entry_from_stat,
     FLAG_STAGEMASK,
@@ -46,6 +48,7 @@ import os
 import posixpath
 import stat
 import sys
+import time
 
 from .. import (
     branch as _mod_branch,
@@ -84,6 +87,34 @@ from .mapping import (
     )
 
 
+# Files changed less than this many seconds ago may still be changing
+# without that being visible in their stat information, so their hashes
+# are not recorded in the index. See also DirState._cutoff_time.
+_INDEX_CUTOFF_SECONDS = 3
+
+
+def _index_time(t):
+    """Convert a time in an index entry to a (seconds, nanoseconds) tuple."""
+    if isinstance(t, tuple):
+        return t
+    if isinstance(t, int):
+        return (t, 0)
+    (secs, nsecs) = divmod(t, 1.0)
+    return (int(secs), int(nsecs * 1000000000))
+
+
+def _stat_time(ns):
+    return divmod(ns, 1000000000)
+
+
+def _file_stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
 class GitWorkingTree(MutableGitIndexTree, workingtree.WorkingTree):
     """A Git working tree."""
 
@@ -112,7 +143,9 @@ class GitWorkingTree(MutableGitIndexTree, workingtree.WorkingTree):
         return False
 
     def _read_index(self):
-        self.index = Index(self.control_transport.local_abspath('index'))
+        index_path = self.control_transport.local_abspath('index')
+        self._index_stat_key = _file_stat_key(index_path)
+        self.index = Index(index_path)
         self._index_dirty = False
 
     def _get_submodule_index(self, relpath):
@@ -205,6 +238,8 @@ class GitWorkingTree(MutableGitIndexTree, workingtree.WorkingTree):
                     # file by calling .flush()
                     self._index_file.abort()
                 self._index_file = None
+            elif self._index_dirty:
+                self._save_observed_index()
             self._lock_mode = None
             self.index = None
         finally:
@@ -602,6 +637,22 @@ class GitWorkingTree(MutableGitIndexTree, workingtree.WorkingTree):
         # Note that _flush will close the file
         self._flush(f)
 
+    def _save_observed_index(self):
+        """Write refreshed stat information to the index, if possible.
+
+        This is used after hashing files with just a read lock, and gives up
+        silently if the index is locked or changed since it was read.
+        """
+        index_path = self.control_transport.local_abspath('index')
+        try:
+            f = GitFile(index_path, 'wb')
+        except (FileLocked, OSError):
+            return
+        if _file_stat_key(index_path) != self._index_stat_key:
+            f.abort()
+            return
+        self._flush(f)
+
     def _flush(self, f):
         try:
             shaf = SHA1Writer(f)
@@ -725,7 +776,53 @@ class GitWorkingTree(MutableGitIndexTree, workingtree.WorkingTree):
     def _live_entry(self, path):
         encoded_path = self.abspath(path.decode('utf-8')).encode(
             osutils._fs_enc)
-        return index_entry_from_path(encoded_path)
+        st = os.lstat(encoded_path)
+        if not stat.S_ISREG(st.st_mode):
+            return index_entry_from_path(encoded_path)
+        try:
+            index_entry = self.index[path]
+        except KeyError:
+            index_entry = None
+        if index_entry is not None and self._index_entry_is_fresh(
+                index_entry, st):
+            return index_entry_from_stat(st, index_entry.sha, 0)
+        blob = blob_from_path_and_stat(encoded_path, st)
+        if index_entry is not None and index_entry.sha == blob.id:
+            self._observed_sha(path, index_entry, st)
+        return index_entry_from_stat(st, blob.id, 0)
+
+    def _index_entry_is_fresh(self, index_entry, st):
+        """Check whether an index entry still describes a file on disk."""
+        if self._index_stat_key is None:
+            return False
+        mtime = _stat_time(st.st_mtime_ns)
+        # Files changed in the same instant the index was written may have
+        # changed after they were hashed ("racy git").
+        if mtime >= _stat_time(self._index_stat_key[2]):
+            return False
+        return (
+            (index_entry.size & 0xFFFFFFFF) == (st.st_size & 0xFFFFFFFF) and
+            _index_time(index_entry.mtime) == mtime and
+            _index_time(index_entry.ctime) == _stat_time(st.st_ctime_ns) and
+            (index_entry.ino & 0xFFFFFFFF) == (st.st_ino & 0xFFFFFFFF) and
+            index_entry.mode == cleanup_mode(st.st_mode))
+
+    def _observed_sha(self, path, index_entry, st):
+        """Record the stat information of a file known to match the index.
+
+        This allows later comparisons to skip hashing the file.
+        """
+        cutoff = (time.time() - _INDEX_CUTOFF_SECONDS) * 1000000000
+        if st.st_mtime_ns >= cutoff or st.st_ctime_ns >= cutoff:
+            return
+        if index_entry.mode != cleanup_mode(st.st_mode):
+            return
+        self.index[path] = index_entry._replace(
+            ctime=_stat_time(st.st_ctime_ns),
+            mtime=_stat_time(st.st_mtime_ns),
+            dev=st.st_dev, ino=st.st_ino, uid=st.st_uid, gid=st.st_gid,
+            size=st.st_size)
+        self._index_dirty = True
 
     def is_executable(self, path):
         with self.lock_read():
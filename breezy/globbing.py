@@ -242,22 +242,53 @@ class Globster(object):
                 if match:
                     return patterns[match.lastindex - 1]
         except lazy_regex.InvalidPattern as e:
-            # We can't show the default e.msg to the user as thats for
-            # the combined pattern we sent to regex. Instead we indicate to
-            # the user that an ignore file needs fixing.
-            mutter('Invalid pattern found in regex: %s.', e.msg)
-            e.msg = (
-                "File ~/.config/breezy/ignore or "
-                ".bzrignore contains error(s).")
-            bad_patterns = ''
-            for _, patterns in self._regex_patterns:
-                for p in patterns:
-                    if not Globster.is_pattern_valid(p):
-                        bad_patterns += ('\n  %s' % p)
-            e.msg += bad_patterns
+            self._report_invalid_pattern(e)
             raise e
         return None
 
+    def match_many(self, filenames):
+        """Search for the patterns that match each of several filenames.
+
+        This gives the same results as calling match() for each filename,
+        but tries each regex against all the filenames in turn.
+
+        :return: A list with the matching pattern or None for each filename.
+        """
+        result = [None] * len(filenames)
+        pending = range(len(filenames))
+        try:
+            for regex, patterns in self._regex_patterns:
+                if not pending:
+                    break
+                regex_match = regex.match
+                unmatched = []
+                for i in pending:
+                    match = regex_match(filenames[i])
+                    if match:
+                        result[i] = patterns[match.lastindex - 1]
+                    else:
+                        unmatched.append(i)
+                pending = unmatched
+        except lazy_regex.InvalidPattern as e:
+            self._report_invalid_pattern(e)
+            raise e
+        return result
+
+    def _report_invalid_pattern(self, e):
+        # We can't show the default e.msg to the user as thats for
+        # the combined pattern we sent to regex. Instead we indicate to
+        # the user that an ignore file needs fixing.
+        mutter('Invalid pattern found in regex: %s.', e.msg)
+        e.msg = (
+            "File ~/.config/breezy/ignore or "
+            ".bzrignore contains error(s).")
+        bad_patterns = ''
+        for _, patterns in self._regex_patterns:
+            for p in patterns:
+                if not Globster.is_pattern_valid(p):
+                    bad_patterns += ('\n  %s' % p)
+        e.msg += bad_patterns
+
     @staticmethod
     def identify(pattern):
         """Returns pattern category.
@@ -328,6 +359,24 @@ class ExceptionGlobster(object):
         else:
             return self._ignores[0].match(filename)
 
+    def match_many(self, filenames):
+        """Search for the patterns that match each of several filenames.
+
+        :return: A list with the matching pattern or None for each filename.
+        """
+        double_negs = self._ignores[2].match_many(filenames)
+        negs = self._ignores[1].match_many(filenames)
+        matches = self._ignores[0].match_many(filenames)
+        result = []
+        for double_neg, neg, match in zip(double_negs, negs, matches):
+            if double_neg:
+                result.append("!!%s" % double_neg)
+            elif neg:
+                result.append(None)
+            else:
+                result.append(match)
+        return result
+
 
 class _OrderedGlobster(Globster):
     """A Globster that keeps pattern order."""
@@ -1700,6 +1700,13 @@ class GraphThunkIdsToKeys(object):
     def add_node(self, revision, parents):
         self._graph.add_node((revision,), [(p,) for p in parents])
 
+    def get_parent_keys(self, revision):
+        """See KnownGraph.get_parent_keys()"""
+        parent_keys = self._graph.get_parent_keys((revision,))
+        if parent_keys is None:
+            return None
+        return [p for (p,) in parent_keys]
+
 
 _counters = [0, 0, 0, 0, 0, 0, 0]
 try:
@@ -136,6 +136,13 @@ class LRUCache(object):
         """Get a new dict with the same key:value pairs as the cache"""
         return dict((k, n.value) for k, n in self._cache.items())
 
+    def remove(self, key):
+        """Remove key from the cache.
+
+        :raises KeyError: If key is not in the cache.
+        """
+        self._remove_node(self._cache[key])
+
     def cleanup(self):
         """Clear the cache until it shrinks to the requested size.
 
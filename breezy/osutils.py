@@ -1836,13 +1836,17 @@ class DirReader(object):
 _selected_dir_reader = None
 
 
-def _walkdirs_utf8(top, prefix=""):
+def _walkdirs_utf8(top, prefix="", executor=None, readahead=0):
     """Yield data about all the directories in a tree.
 
     This yields the same information as walkdirs() only each entry is yielded
     in utf-8. On platforms which have a filesystem encoding of utf8 the paths
     are returned as exact byte-strings.
 
+    :param executor: Optional concurrent.futures executor used to read
+        the directories that will be yielded next ahead of time. The
+        directories are still yielded in the same order.
+    :param readahead: Maximum number of directories to read ahead
     :return: yields a tuple of (dir_info, [file_info])
         dir_info is (utf8_relpath, path-from-top)
         file_info is (utf8_relpath, utf8_name, kind, lstat, path-from-top)
@@ -1875,16 +1879,54 @@ def _walkdirs_utf8(top, prefix=""):
     pending = [[_selected_dir_reader.top_prefix_to_starting_dir(top, prefix)]]
     read_dir = _selected_dir_reader.read_dir
     _directory = _directory_kind
-    while pending:
-        relroot, _, _, _, top = pending[-1].pop()
-        if not pending[-1]:
-            pending.pop()
-        dirblock = sorted(read_dir(relroot, top))
-        yield (relroot, top), dirblock
-        # push the user specified dirs from dirblock
-        next = [d for d in reversed(dirblock) if d[2] == _directory]
-        if next:
-            pending.append(next)
+    if executor is None:
+        while pending:
+            relroot, _, _, _, top = pending[-1].pop()
+            if not pending[-1]:
+                pending.pop()
+            dirblock = sorted(read_dir(relroot, top))
+            yield (relroot, top), dirblock
+            # push the user specified dirs from dirblock
+            next = [d for d in reversed(dirblock) if d[2] == _directory]
+            if next:
+                pending.append(next)
+        return
+
+    def read_sorted(relroot, top):
+        return sorted(read_dir(relroot, top))
+
+    # Directories that are being read, by path-from-top. Only directories
+    # that the caller has not pruned are in pending, so none of this work
+    # is wasted unless the caller stops iterating.
+    in_flight = {}
+    try:
+        while pending:
+            for dirs in reversed(pending):
+                for d in reversed(dirs):
+                    if len(in_flight) >= readahead:
+                        break
+                    if d[4] not in in_flight:
+                        in_flight[d[4]] = executor.submit(
+                            read_sorted, d[0], d[4])
+                else:
+                    continue
+                break
+            relroot, _, _, _, top = pending[-1].pop()
+            if not pending[-1]:
+                pending.pop()
+            future = in_flight.pop(top, None)
+            if future is None:
+                dirblock = read_sorted(relroot, top)
+            else:
+                dirblock = future.result()
+            yield (relroot, top), dirblock
+            # push the user specified dirs from dirblock
+            next = [d for d in reversed(dirblock) if d[2] == _directory]
+            if next:
+                pending.append(next)
+    finally:
+        for future in in_flight.values():
+            future.cancel()
 
 
 class UnicodeDirReader(DirReader):
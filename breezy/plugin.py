@@ -22,6 +22,11 @@ Which plugins to load can be configured by setting these environment variables:
 - BRZ_DISABLE_PLUGINS: Plugin names to block from being loaded.
 - BRZ_PLUGINS_AT: Name and paths for plugins to load from specific locations.
 
+Plugins that only register commands, hooks and other registry entries lazily
+are not imported at startup once their registrations have been recorded in
+the plugin manifest; see `_PluginManifest`. The -Dno_plugin_manifest debug
+flag imports every plugin instead.
+
 The interfaces this module exports include:
 
 - disable_plugins: Load no plugins and stop future automatic loading.
@@ -45,11 +50,17 @@ from .lazy_import import lazy_import
 lazy_import(globals(), """
 import imp
 from importlib import util as importlib_util
+import inspect
+import json
 
 from breezy import (
+    atomicfile,
     bedding,
     debug,
     help_topics,
+    hooks,
+    pyutils,
+    registry,
     trace,
     )
 """)
@@ -102,7 +113,7 @@ def load_plugins(path=None, state=None):
     _load_plugins_from_path(state, path)
     if (None, 'entrypoints') in _env_plugin_path():
         _load_plugins_from_entrypoints(state)
-    state.plugins = plugins()
+    state.plugins = _imported_plugins()
 
 
 def _load_plugins_from_entrypoints(state):
@@ -277,13 +288,22 @@ def _install_importer_if_needed(plugin_details):
 
 def _load_plugins_from_path(state, paths):
     """Do the importing all plugins from paths."""
+    if 'no_plugin_manifest' in debug.debug_flags:
+        manifest = None
+    else:
+        manifest = _PluginManifest.from_cache()
     imported_names = set()
     for name, path in _iter_possible_plugins(paths):
         if name not in imported_names:
-            msg = _load_plugin_module(name, path)
+            if manifest is None:
+                msg = _load_plugin_module(name, path)
+            else:
+                msg = manifest.load_plugin(name, path)
             if msg is not None:
                 state.plugin_warnings.setdefault(name, []).append(msg)
             imported_names.add(name)
+    if manifest is not None:
+        manifest.save()
 
 
 def _block_plugins(names):
@@ -351,6 +371,7 @@ def describe_plugins(show_paths=False, state=None):
     """
     if state is None:
         state = breezy.get_global_state()
+    load_deferred_plugins(state)
     loaded_plugins = getattr(state, 'plugins', {})
     plugin_warnings = set(getattr(state, 'plugin_warnings', []))
     all_names = sorted(set(loaded_plugins.keys()).union(plugin_warnings))
@@ -447,11 +468,557 @@ def _load_plugin_module(name, dir):
                 'Unable to load plugin %r from %r: %s' % (name, dir, e))
 
 
+# Registration functions that plugins call with arguments that can be
+# recorded and replayed later, as (module, function) pairs.
+_LAZY_REGISTRATION_FUNCTIONS = [
+    ('breezy.transport', 'register_transport_proto'),
+    ('breezy.transport', 'register_lazy_transport'),
+    ]
+
+# Registrations of objects or classes, which need the plugin to be imported.
+_EAGER_REGISTRATION_FUNCTIONS = [
+    ('breezy.transport', 'register_transport'),
+    ]
+_EAGER_REGISTRATION_METHODS = [
+    ('breezy.bzr.bzrdir', 'BzrFormat', 'register_feature'),
+    ('breezy.controldir', 'ControlDirFormat', 'register_prober'),
+    ('breezy.hooks', 'Hooks', 'install_named_hook'),
+    ('breezy.hooks', 'Hooks', 'install_named_hook_lazy'),
+    ('breezy.hooks', 'HookPoint', 'hook'),
+    ('breezy.hooks', 'HookPoint', 'hook_lazy'),
+    ]
+_EAGER_REGISTRY_METHODS = [
+    'register', 'register_alias', 'register_extra', 'register_extra_lazy',
+    'register_transport_provider', 'register_lazy_transport_provider',
+    ]
+
+
+def _all_subclasses(klass):
+    """Generate klass and all its subclasses."""
+    seen = set()
+    pending = [klass]
+    while pending:
+        klass = pending.pop()
+        if klass not in seen:
+            seen.add(klass)
+            pending.extend(klass.__subclasses__())
+            yield klass
+
+
+def _defining_class(klass, name):
+    """Return the class in the mro of klass that defines attribute name."""
+    for base in klass.__mro__:
+        if name in base.__dict__:
+            return base
+    return None
+
+
+def _is_plain_data(value):
+    """Can value be stored in the manifest and compared after loading?"""
+    if value is None or isinstance(value, (str, bool, int)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain_data(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and _is_plain_data(v)
+                   for k, v in value.items())
+    return False
+
+
+def _bind_arguments(func, args, kwargs):
+    """Map the arguments of a call to func to its parameter names.
+
+    :return: A dict of arguments, or None if func takes variable arguments.
+    """
+    signature = inspect.signature(func)
+    for param in signature.parameters.values():
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            return None
+    return dict(signature.bind(*args, **kwargs).arguments)
+
+
+class _RegistrationRecorder(object):
+    """Track the registrations made while a plugin is imported.
+
+    While active, the registration functions and methods plugins use are
+    wrapped. Lazy registrations with plain arguments are recorded as entries
+    that `_replay_registration` can repeat without importing the plugin;
+    anything else marks the plugin as one that has to be imported at
+    startup.
+
+    If skip is given, lazy registrations matching those entries are dropped
+    rather than recorded, as they were already replayed from the manifest.
+
+    Registrations made by other modules that are first imported while
+    recording are not the plugin's; they are made again whenever those
+    modules are imported, so they are neither recorded nor skipped.
+    """
+
+    def __init__(self, skip=None):
+        self.registrations = []
+        self.eager = False
+        if skip is not None:
+            skip = set(json.dumps(entry, sort_keys=True) for entry in skip)
+        self._skip = skip
+        self._active = False
+        self._depth = 0
+        self._patches = []
+        self._registry_names = None
+        self._modules_before = None
+
+    def __enter__(self):
+        self._modules_before = set(sys.modules)
+        for module_name, name in _LAZY_REGISTRATION_FUNCTIONS:
+            self._patch(pyutils.get_named_object(module_name), name,
+                        self._function_entry)
+        for module_name, name in _EAGER_REGISTRATION_FUNCTIONS:
+            self._patch(pyutils.get_named_object(module_name), name, None)
+        self._patch(hooks, 'install_lazy_named_hook', self._hook_entry)
+        for module_name, class_name, name in _EAGER_REGISTRATION_METHODS:
+            self._patch(pyutils.get_named_object(module_name, class_name),
+                        name, None)
+        for klass in _all_subclasses(registry.Registry):
+            if 'register_lazy' in klass.__dict__:
+                self._patch(klass, 'register_lazy', self._registry_entry)
+            for name in _EAGER_REGISTRY_METHODS:
+                if name in klass.__dict__:
+                    self._patch(klass, name, None)
+        self._active = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._active = False
+        for obj, name, original in reversed(self._patches):
+            setattr(obj, name, original)
+        del self._patches[:]
+        return False
+
+    def _patch(self, obj, name, get_entry):
+        """Wrap the registration function obj.name.
+
+        :param get_entry: Callable returning the manifest entry for a call,
+            or None if the call can't be replayed. None for registrations
+            that can never be replayed.
+        """
+        original = obj.__dict__[name]
+        kind = type(original)
+        if kind in (classmethod, staticmethod):
+            func = original.__func__
+        else:
+            func = original
+
+        def wrapper(*args, **kwargs):
+            if not self._active or self._depth:
+                return func(*args, **kwargs)
+            self._depth += 1
+            try:
+                if (not self._called_by_new_module(sys._getframe(1))
+                        and self._registered(obj, name, func, get_entry,
+                                             args, kwargs)):
+                    return None
+                return func(*args, **kwargs)
+            finally:
+                self._depth -= 1
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        if kind in (classmethod, staticmethod):
+            wrapper = kind(wrapper)
+        self._patches.append((obj, name, original))
+        setattr(obj, name, wrapper)
+
+    def _called_by_new_module(self, frame):
+        """Was frame's module first imported while recording, by a plugin?"""
+        module_name = frame.f_globals.get('__name__')
+        return (module_name is not None
+                and module_name not in self._modules_before
+                and not module_name.startswith(_MODULE_PREFIX))
+
+    def _registered(self, obj, name, func, get_entry, args, kwargs):
+        """Note a registration call.
+
+        :return: True if the call should be skipped.
+        """
+        if get_entry is None:
+            entry = None
+        else:
+            try:
+                entry = get_entry(obj, name, func, args, kwargs)
+            except (AttributeError, ImportError, TypeError):
+                entry = None
+        if self._skip is not None:
+            if entry is not None:
+                key = json.dumps(entry, sort_keys=True)
+                if key in self._skip:
+                    self._skip.remove(key)
+                    return True
+        elif entry is None:
+            self.eager = True
+        else:
+            self.registrations.append(entry)
+        return False
+
+    def _function_entry(self, module, name, func, args, kwargs):
+        arguments = _bind_arguments(func, args, kwargs)
+        if arguments is None or not _is_plain_data(arguments):
+            return None
+        return ['function', module.__name__, name, arguments]
+
+    def _hook_entry(self, module, name, func, args, kwargs):
+        arguments = _bind_arguments(func, args, kwargs)
+        a_callable = arguments['a_callable']
+        callable_module = a_callable.__module__
+        callable_member = a_callable.__qualname__
+        if (pyutils.get_named_object(callable_module, callable_member)
+                is not a_callable):
+            return None
+        entry = ['hook', arguments['hookpoints_module'],
+                 arguments['hookpoints_name'], arguments['hook_name'],
+                 callable_module, callable_member, arguments['name']]
+        if not _is_plain_data(entry):
+            return None
+        return entry
+
+    def _registry_entry(self, klass, name, func, args, kwargs):
+        a_registry = args[0]
+        if _defining_class(type(a_registry), name) is not klass:
+            # Called from an override that wasn't wrapped, which may do more
+            # than just this registration.
+            return None
+        registry_name = self._get_registry_name(a_registry)
+        if registry_name is None:
+            return None
+        arguments = _bind_arguments(func, args, kwargs)
+        if arguments is None:
+            return None
+        del arguments[list(arguments)[0]]
+        if not _is_plain_data(arguments):
+            return None
+        return ['registry', registry_name[0], registry_name[1], name,
+                arguments]
+
+    def _get_registry_name(self, a_registry):
+        """Find a module global that refers to a_registry.
+
+        Registries defined by plugins aren't considered, using them would
+        import the plugin anyway.
+        """
+        if (self._registry_names is None
+                or id(a_registry) not in self._registry_names):
+            self._registry_names = names = {}
+            for module_name, module in sorted(sys.modules.items()):
+                if (module is None or module_name == '__main__'
+                        or module_name.startswith(_MODULE_PREFIX)):
+                    continue
+                for attr, value in list(vars(module).items()):
+                    # Check the type so lazy imports aren't resolved.
+                    if issubclass(type(value), registry.Registry):
+                        names.setdefault(id(value), (module_name, attr))
+        return self._registry_names.get(id(a_registry))
+
+
+def _save_registries(registries):
+    """Save the state of registries.
+
+    :return: A function restoring the registries to the saved state.
+    """
+    def copy_value(value):
+        if isinstance(value, list):
+            return list(value)
+        if isinstance(value, dict):
+            # Transport registries keep lists of providers as values.
+            return dict((k, copy_value(v)) for k, v in value.items())
+        return value
+    saved = [(a_registry, dict((k, copy_value(v))
+                               for k, v in vars(a_registry).items()))
+             for a_registry in registries]
+
+    def restore():
+        for a_registry, state in saved:
+            vars(a_registry).clear()
+            vars(a_registry).update(state)
+    return restore
+
+
+def _replay_registration(entry):
+    """Repeat a registration recorded by `_RegistrationRecorder`.
+
+    :return: A function undoing the registration.
+    """
+    kind = entry[0]
+    if kind == 'function':
+        module_name, name, arguments = entry[1:]
+        func = pyutils.get_named_object(module_name, name)
+        undo = _save_registries(
+            [value for value in list(vars(sys.modules[module_name]).values())
+             if issubclass(type(value), registry.Registry)])
+    elif kind == 'hook':
+        (hookpoints_module, hookpoints_name, hook_name, callable_module,
+         callable_member, label) = entry[1:]
+        obj_getter = registry._LazyObjectGetter(
+            callable_module, callable_member)
+        key = (hookpoints_module, hookpoints_name, hook_name)
+        hook = (obj_getter, label)
+        hooks._lazy_hooks.setdefault(key, []).append(hook)
+
+        def undo():
+            hooks._lazy_hooks[key].remove(hook)
+            if not hooks._lazy_hooks[key]:
+                del hooks._lazy_hooks[key]
+        return undo
+    elif kind == 'registry':
+        module_name, registry_name, method, arguments = entry[1:]
+        a_registry = pyutils.get_named_object(module_name, registry_name)
+        func = getattr(a_registry, method)
+        undo = _save_registries([a_registry])
+    else:
+        raise ValueError('unknown registration %r' % (entry,))
+    try:
+        func(**arguments)
+    except BaseException:
+        undo()
+        raise
+    return undo
+
+
+def _plugin_stamp(name, path):
+    """Return the modification times that identify a version of a plugin.
+
+    :param name: The plugin name.
+    :param path: The plugin package directory, module file or the directory
+        containing the module file.
+    """
+    paths = [path]
+    if os.path.isdir(path):
+        init_path = _get_package_init(path)
+        if init_path is not None:
+            paths.append(init_path)
+        else:
+            paths = [osutils.pathjoin(path, name + ext)
+                     for ext in ('.py', COMPILED_EXT)]
+    stamp = []
+    for path in paths:
+        try:
+            stamp.append(os.stat(path).st_mtime)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+
+def _get_manifest_path():
+    return osutils.pathjoin(bedding.cache_dir(), 'plugin-manifest.json')
+
+
+class _PluginManifest(object):
+    """Record of the registrations plugins make when they are imported.
+
+    Plugins usually register their commands, hooks, options and other
+    objects lazily, so most of their code is only imported once it is used.
+    The plugin package itself still has to be imported at startup to make
+    the registrations. When a plugin is imported, the registrations it makes
+    are recorded in this manifest, stored in the cache directory. On later
+    runs the registrations of a plugin whose modification times haven't
+    changed are replayed instead, and the plugin is imported when one of them
+    is first used.
+
+    Only plugins that made nothing but lazy registrations with plain
+    arguments are deferred. Plugins that register objects, probers, features
+    or eager hooks, that import other plugins, or that registered nothing we
+    know about, are always imported.
+    """
+
+    def __init__(self, path, plugins):
+        self.path = path
+        self._plugins = plugins
+        self._changed = False
+
+    @classmethod
+    def from_cache(cls):
+        """Read the manifest from the cache directory.
+
+        A missing, unreadable or outdated manifest results in an empty one.
+        """
+        try:
+            path = _get_manifest_path()
+            with open(path, 'r') as f:
+                content = json.load(f)
+        except EnvironmentError:
+            return cls(None, {})
+        except ValueError as e:
+            trace.mutter('Ignoring invalid plugin manifest: %s', e)
+            return cls(path, {})
+        if (not isinstance(content, dict)
+                or content.get('breezy') != breezy.__version__
+                or content.get('python') != list(sys.version_info[:2])):
+            return cls(path, {})
+        return cls(path, content.get('plugins', {}))
+
+    def save(self):
+        """Write the manifest back if it was updated, ignoring failures."""
+        if not self._changed:
+            return
+        content = {
+            'breezy': breezy.__version__,
+            'python': list(sys.version_info[:2]),
+            'plugins': self._plugins,
+            }
+        try:
+            if self.path is None:
+                self.path = _get_manifest_path()
+            with atomicfile.AtomicFile(self.path) as f:
+                f.write(json.dumps(content, indent=1,
+                                   sort_keys=True).encode('utf-8'))
+        except EnvironmentError as e:
+            trace.mutter('Unable to write plugin manifest: %s', e)
+        self._changed = False
+
+    def load_plugin(self, name, path):
+        """Load a plugin, deferring its import if the manifest allows it.
+
+        :return: A warning message if the plugin failed to load, or None.
+        """
+        fullname = _MODULE_PREFIX + name
+        if fullname in sys.modules:
+            return None
+        stamp = _plugin_stamp(name, path)
+        details = self._plugins.get(name)
+        if (details is not None and details['path'] == path
+                and details['stamp'] == stamp):
+            registrations = details['registrations']
+            if registrations is None:
+                return _load_plugin_module(name, path)
+            replayed = []
+            try:
+                for entry in registrations:
+                    replayed.append(_replay_registration(entry))
+            except Exception:
+                trace.mutter('Unable to replay registrations of plugin %s',
+                             name)
+                trace.log_exception_quietly()
+                # The plugin will make these registrations itself.
+                for undo in reversed(replayed):
+                    undo()
+            else:
+                _get_deferred_plugin_finder().deferred[fullname] = (
+                    name, path, details['version'], registrations)
+                return None
+        plugin_modules = set(_imported_plugins())
+        recorder = _RegistrationRecorder()
+        with recorder:
+            msg = _load_plugin_module(name, path)
+        details = {'path': path, 'stamp': stamp, 'registrations': None,
+                   'version': None}
+        module = sys.modules.get(fullname)
+        if module is not None:
+            details['version'] = PlugIn(name, module).__version__
+            other_plugins = set(_imported_plugins()) - plugin_modules
+            other_plugins.discard(name)
+            if (msg is None and not recorder.eager and not other_plugins
+                    and recorder.registrations):
+                details['registrations'] = recorder.registrations
+        self._plugins[name] = details
+        self._changed = True
+        return msg
+
+
+class _DeferredPluginLoader(object):
+    """Loader for a deferred plugin, wrapping the one that would be used.
+
+    The registrations made when the plugin was deferred are skipped while it
+    is imported, as they are already in place.
+    """
+
+    def __init__(self, loader, registrations):
+        self.loader = loader
+        self.registrations = registrations
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.loader)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        module.__loader__ = module.__spec__.loader = self.loader
+        with _RegistrationRecorder(skip=self.registrations):
+            self.loader.exec_module(module)
+
+
+class _DeferredPluginFinder(object):
+    """Meta path finder that imports deferred plugins when first used."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # Maps full module names to tuples of name, path, version and
+        # replayed registrations.
+        self.deferred = {}
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.prefix)
+
+    def find_spec(self, fullname, paths, target=None):
+        """New module spec returning find method."""
+        details = self.deferred.pop(fullname, None)
+        if details is None:
+            return None
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, 'find_spec', None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(fullname, paths, target)
+            if spec is not None:
+                spec.loader = _DeferredPluginLoader(spec.loader, details[3])
+                return spec
+        return None
+
+
+def _find_deferred_plugin_finder():
+    for finder in sys.meta_path:
+        if (isinstance(finder, _DeferredPluginFinder)
+                and finder.prefix == _MODULE_PREFIX):
+            return finder
+    return None
+
+
+def _get_deferred_plugin_finder():
+    finder = _find_deferred_plugin_finder()
+    if finder is None:
+        finder = _DeferredPluginFinder(_MODULE_PREFIX)
+        sys.meta_path.insert(0, finder)
+    return finder
+
+
+def load_deferred_plugins(state=None):
+    """Import the plugins whose import was deferred by the plugin manifest.
+
+    :param state: The library state object that records loaded plugins.
+    """
+    finder = _find_deferred_plugin_finder()
+    if finder is None or not finder.deferred:
+        return
+    if state is None:
+        state = breezy.get_global_state()
+    for name, path, version, registrations in list(finder.deferred.values()):
+        msg = _load_plugin_module(name, path)
+        if msg is not None:
+            warnings = getattr(state, 'plugin_warnings', None)
+            if warnings is not None:
+                warnings.setdefault(name, []).append(msg)
+    if getattr(state, 'plugins', None) is not None:
+        state.plugins = _imported_plugins()
+
+
 def plugins():
     """Return a dictionary of the plugins.
 
-    Each item in the dictionary is a PlugIn object.
+    Each item in the dictionary is a PlugIn object. Plugins whose import was
+    deferred are imported first.
     """
+    load_deferred_plugins()
+    return _imported_plugins()
+
+
+def _imported_plugins():
+    """Return a dictionary of the plugins that have been imported."""
     result = {}
     for fullname in sys.modules:
         if fullname.startswith(_MODULE_PREFIX):
@@ -480,10 +1047,19 @@ def format_concise_plugin_list(state=None):
     """
     if state is None:
         state = breezy.get_global_state()
+    versions = {}
+    finder = _find_deferred_plugin_finder()
+    if finder is not None:
+        # Don't import plugins just to report on them, this is used when
+        # reporting crashes.
+        for fullname, (name, path, version, registrations) in (
+                finder.deferred.items()):
+            versions[name] = version
+    for name, a_plugin in getattr(state, 'plugins', {}).items():
+        versions[name] = a_plugin.__version__
     items = []
-    for name, a_plugin in sorted(getattr(state, 'plugins', {}).items()):
-        items.append("%s[%s]" %
-                     (name, a_plugin.__version__))
+    for name, version in sorted(versions.items()):
+        items.append("%s[%s]" % (name, version))
     return ', '.join(items)
 
 
@@ -1004,7 +1004,7 @@ class Repository(controldir.ControlComponent, _RelockDebugMixin):
         """
         raise NotImplementedError(self.revision_trees)
 
-    def pack(self, hint=None, clean_obsolete_packs=False):
+    def pack(self, hint=None, clean_obsolete_packs=False, jobs=None):
         """Compress the data within the repository.
 
         This operation only makes sense for some repository types. For other
@@ -1023,6 +1023,10 @@ class Repository(controldir.ControlComponent, _RelockDebugMixin):
 
         :param clean_obsolete_packs: Clean obsolete packs immediately after
             the pack operation.
+
+        :param jobs: The number of processes that may be used to compress
+            the data. None (the default) compresses in this process.
+            Repositories that cannot compress in parallel ignore this.
         """
 
     def get_transaction(self):
@@ -1474,6 +1478,11 @@ format_registry.register_lazy(
     'breezy.bzr.groupcompress_repo',
     'RepositoryFormat2aSubtree',
     )
+format_registry.register_lazy(
+    b'Bazaar development format 9 (2a with bloom filter indices)\n',
+    'breezy.bzr.groupcompress_repo',
+    'RepositoryFormat2aBloom',
+    )
 
 
 class InterRepository(InterObject):
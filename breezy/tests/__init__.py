@@ -3968,6 +3968,7 @@ def _test_suite_testmod_names():
         'breezy.git.tests.test_cache',
         'breezy.git.tests.test_dir',
         'breezy.git.tests.test_fetch',
+        'breezy.git.tests.test_filegraph',
         'breezy.git.tests.test_git_remote_helper',
         'breezy.git.tests.test_mapping',
         'breezy.git.tests.test_memorytree',
@@ -4032,6 +4033,7 @@ def _test_suite_testmod_names():
         'breezy.tests.test_bzrdir',
         'breezy.tests.test__chunks_to_lines',
         'breezy.tests.test_cache_utf8',
+        'breezy.tests.test_changemonitor',
         'breezy.tests.test_chk_map',
         'breezy.tests.test_chk_serializer',
         'breezy.tests.test_chunk_writer',
@@ -4134,6 +4136,7 @@ def _test_suite_testmod_names():
         'breezy.tests.test_rename_map',
         'breezy.tests.test_repository',
         'breezy.tests.test_revert',
+        'breezy.tests.test_revno_cache',
         'breezy.tests.test_revision',
         'breezy.tests.test_revisionspec',
         'breezy.tests.test_revisiontree',
@@ -4173,6 +4176,7 @@ def _test_suite_testmod_names():
         'breezy.tests.test_transactions',
         'breezy.tests.test_transform',
         'breezy.tests.test_transport',
+        'breezy.tests.test_transport_cache',
         'breezy.tests.test_transport_log',
         'breezy.tests.test_tree',
         'breezy.tests.test_treebuilder',
@@ -84,6 +84,22 @@ class TestPack(tests.TestCaseWithTransport):
         pack_names = t.list_dir('repository/obsolete_packs')
         self.assertTrue(len(pack_names) == 0)
 
+    def test_pack_jobs(self):
+        wt = self.make_branch_and_tree('.')
+        self._make_versioned_file('file0.txt')
+        for i in range(3):
+            self._update_file('file0.txt', 'HELLO %d\n' % i)
+        out, err = self.run_bzr(['pack', '--jobs', '2'])
+        self.assertEqual('', out)
+        self.assertEqual('', err)
+        t = wt.branch.repository.controldir.transport
+        self.assertLength(1, t.list_dir('repository/packs'))
+
+    def test_pack_jobs_must_be_positive(self):
+        self.make_branch('.')
+        out, err = self.run_bzr(['pack', '--jobs', '0'], retcode=3)
+        self.assertContainsRe(err, '--jobs must be at least 1')
+
 
 class TestSmartServerPack(tests.TestCaseWithTransport):
 
@@ -18,6 +18,7 @@
 
 import breezy
 from breezy import tests
+from breezy.bzr.smart.message import available_body_compression_codecs
 
 
 class TestSmartServerPing(tests.TestCaseWithTransport):
@@ -34,5 +35,9 @@ class TestSmartServerPing(tests.TestCaseWithTransport):
         self.assertLength(1, self.hpss_connections)
         self.assertEqual(out,
                          "Response: (b'ok', b'2')\n"
-                         "Headers: {'Software version': '%s'}\n" % (breezy.version_string,))
+                         "Headers: {'Body compression codecs': '%s', "
+                         "'Pipelining': 'yes', "
+                         "'Software version': '%s'}\n" % (
+                             ' '.join(available_body_compression_codecs()),
+                             breezy.version_string))
         self.assertEqual(err, "")
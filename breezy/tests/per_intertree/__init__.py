@@ -164,6 +164,13 @@ def load_tests(loader, standard_tests, pattern):
                  optimiser._matching_from_tree_format,
                  optimiser._matching_to_tree_format,
                  optimiser.make_source_parent_tree_python_dirstate))
+            # python version, reading the disk in threads
+            test_intertree_permutations.append(
+                (optimiser.__name__ + "(PY-threads)",
+                 optimiser,
+                 optimiser._matching_from_tree_format,
+                 optimiser._matching_to_tree_format,
+                 optimiser.make_source_parent_tree_threaded_dirstate))
         elif (optimiser._matching_from_tree_format is not None and
               optimiser._matching_to_tree_format is not None):
             test_intertree_permutations.append(
@@ -1163,6 +1163,11 @@ def load_tests(loader, basic_tests, pattern):
              "(needs bzr 1.16 or later)\n",
              format_supports_external_lookups=True,
              index_class=BTreeGraphIndex),
+        dict(format_name='development-bloom',
+             format_string="Bazaar development format 9 "
+             "(2a with bloom filter indices)\n",
+             format_supports_external_lookups=True,
+             index_class=BTreeGraphIndex),
         ]
     # name of the scenario is the format name
     scenarios = [(s['format_name'], s) for s in scenarios_params]
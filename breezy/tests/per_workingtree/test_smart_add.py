@@ -235,6 +235,23 @@ class TestSmartAddTree(per_workingtree.TestCaseWithWorkingTree):
             self.assertFalse(wt.is_versioned(path.rstrip('/')),
                              'Accidentally added path: %s' % (path,))
 
+    def test_add_with_jobs(self):
+        """Scanning directories in threads adds the same files."""
+        ignores._set_user_ignores(['*.py[co]'])
+        paths = ['a', 'b/', 'b/c', 'b/c.pyc', 'b/d/', 'b/d/e/', 'b/d/e/f',
+                 'b/d/g', 'h/', 'h/i.pyc', 'j']
+        self.build_tree(['one/', 'two/'] + ['one/' + p for p in paths] +
+                        ['two/' + p for p in paths])
+        one = self.make_branch_and_tree('one')
+        two = self.make_branch_and_tree('two')
+        one.add(['b'])
+        two.add(['b'])
+        two.branch.get_config_stack().set('add.jobs', 4)
+        self.assertEqual(one.smart_add(['one']), two.smart_add(['two']))
+        with one.lock_read(), two.lock_read():
+            self.assertEqual(sorted(one.all_versioned_paths()),
+                             sorted(two.all_versioned_paths()))
+
     def test_add_file_in_unknown_dir(self):
         # Test that parent directory addition is implicit
         tree = self.make_branch_and_tree('.')
@@ -17,6 +17,7 @@
 
 """Tests for btree indices."""
 
+import mmap
 import pprint
 import zlib
 
@@ -739,6 +740,60 @@ class TestBTreeIndex(BTreeTestCase):
                                             nodes=self.make_nodes(200, 1, 1))
         self.assertEqual(200, index.key_count())
 
+    def test_mmap_local_index(self):
+        self.overrideAttr(btree_index, '_MMAP_MIN_SIZE', 0)
+        nodes = self.make_nodes(400, 1, 1)
+        index = self.make_index_with_offset(key_elements=1, ref_lists=1,
+                                            nodes=nodes)
+        self.assertEqual(sorted(nodes),
+                         sorted(entry[1:] for entry in
+                                index.iter_all_entries()))
+        self.assertIsInstance(index._mmap, mmap.mmap)
+        self.assertEqual([(index, nodes[10][0], nodes[10][1], nodes[10][2])],
+                         list(index.iter_entries([nodes[10][0]])))
+
+    def test_clear_cache_closes_mmap(self):
+        self.overrideAttr(btree_index, '_MMAP_MIN_SIZE', 0)
+        nodes = self.make_nodes(400, 1, 1)
+        index = self.make_index_with_offset(key_elements=1, ref_lists=1,
+                                            nodes=nodes)
+        self.assertEqual(400, len(list(index.iter_all_entries())))
+        mapped = index._mmap
+        self.assertIsInstance(mapped, mmap.mmap)
+        index.clear_cache()
+        self.assertIs(None, index._mmap)
+        self.assertTrue(mapped.closed)
+        # The file is mapped again when it is next read.
+        self.assertEqual([(index, nodes[10][0], nodes[10][1], nodes[10][2])],
+                         list(index.iter_entries([nodes[10][0]])))
+        self.assertIsInstance(index._mmap, mmap.mmap)
+
+    def test_mmap_local_index_with_offset(self):
+        self.overrideAttr(btree_index, '_MMAP_MIN_SIZE', 0)
+        nodes = self.make_nodes(400, 1, 1)
+        index = self.make_index_with_offset(key_elements=1, ref_lists=1,
+                                            offset=1234, nodes=nodes)
+        self.assertEqual(400, index.key_count())
+        self.assertEqual(sorted(nodes),
+                         sorted(entry[1:] for entry in
+                                index.iter_all_entries()))
+        self.assertIsInstance(index._mmap, mmap.mmap)
+
+    def test_no_mmap_for_small_index(self):
+        index = self.make_index_with_offset(
+            key_elements=1, ref_lists=1, nodes=self.make_nodes(400, 1, 1))
+        self.assertEqual(400, index.key_count())
+        self.assertIs(False, index._mmap)
+
+    def test_no_mmap_for_remote_index(self):
+        self.overrideAttr(btree_index, '_MMAP_MIN_SIZE', 0)
+        nodes = self.make_nodes(400, 1, 1)
+        index = self.make_index(ref_lists=1, nodes=nodes)
+        self.assertEqual(400, len(list(index.iter_all_entries())))
+        self.assertIs(False, index._mmap)
+        self.assertTrue(
+            [op for op in index._transport._activity if op[0] == 'readv'])
+
     def test__read_nodes_no_size_one_page_reads_once(self):
         self.make_index(nodes=[((b'key',), b'value', ())])
         trans = transport.get_transport_from_url('trace+' + self.get_url())
@@ -1206,6 +1261,174 @@ class TestBTreeIndex(BTreeTestCase):
         self.assertEqual(500, len(entries))
 
 
+class TestBloomFilter(BTreeTestCase):
+
+    def make_index(self, nodes, ref_lists=1, key_elements=1, offset=0):
+        builder = btree_index.BTreeBuilder(
+            reference_lists=ref_lists, key_elements=key_elements,
+            bloom_bits_per_key=10)
+        builder.add_nodes(nodes)
+        content = builder.finish().read()
+        t = transport.get_transport_from_url('trace+' + self.get_url(''))
+        t.put_bytes('index', b' ' * offset + content)
+        return btree_index.BTreeGraphIndex(t, 'index', len(content),
+                                           offset=offset)
+
+    def test_filter(self):
+        bloom = btree_index._BloomFilter.for_key_count(1000, 10)
+        self.assertEqual(7, bloom.hash_count)
+        self.assertEqual(1250, len(bloom.bits))
+        keys = [(b'key-%d' % i, b'rev') for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertTrue(key in bloom)
+        false_positives = [i for i in range(1000)
+                           if (b'missing-%d' % i, b'rev') in bloom]
+        # About 1% is expected with 10 bits per key.
+        self.assertTrue(len(false_positives) < 50)
+
+    def test_header(self):
+        builder = btree_index.BTreeBuilder(
+            reference_lists=0, key_elements=1, bloom_bits_per_key=10)
+        builder.add_node((b'key',), b'value')
+        content = builder.finish().read()
+        self.assertEqualDiff(
+            b'B+Tree Graph Index 3\n'
+            b'node_ref_lists=0\n'
+            b'key_elements=1\n'
+            b'len=1\n'
+            b'row_lengths=1\n'
+            b'bloom=7,2\n', content[:83])
+        # The filter starts after the padded root page.
+        self.assertEqual(4096 + 2, len(content))
+
+    def test_empty_index_has_no_filter(self):
+        builder = btree_index.BTreeBuilder(
+            reference_lists=0, key_elements=1, bloom_bits_per_key=10)
+        self.assertStartsWith(builder.finish().read(),
+                              b'B+Tree Graph Index 2\n')
+
+    def test_iter_entries(self):
+        nodes = self.make_nodes(800, 1, 1)
+        index = self.make_index(nodes)
+        self.assertEqual(800, index.key_count())
+        self.assertTrue(len(index._row_lengths) > 1)
+        self.assertEqual(sorted(nodes),
+                         sorted(entry[1:] for entry in
+                                index.iter_all_entries()))
+        self.assertEqual([(index,) + nodes[20]],
+                         list(index.iter_entries([nodes[20][0]])))
+
+    def test_missing_keys_read_no_leaves(self):
+        nodes = self.make_nodes(800, 1, 1)
+        index = self.make_index(nodes)
+        index.key_count()
+        # Read the filter.
+        self.assertEqual([], list(index.iter_entries([(b'missing',)])))
+        leaves = len(index._leaf_node_cache)
+        del index._transport._activity[:]
+        missing = [(b'missing-%d' % i,) for i in range(100)]
+        self.assertTrue(len(list(index.iter_entries(missing))) <= 5)
+        self.assertTrue(len(index._leaf_node_cache) - leaves <= 5)
+
+    def test_find_ancestors_marks_filtered_keys_missing(self):
+        nodes = self.make_nodes(800, 1, 1)
+        index = self.make_index(nodes)
+        parent_map = {}
+        missing_keys = set()
+        search_keys = index._find_ancestors(
+            [(b'missing',), nodes[0][0]], 0, parent_map, missing_keys)
+        self.assertEqual(set(), search_keys)
+        self.assertEqual({(b'missing',)}, missing_keys)
+        self.assertEqual({nodes[0][0]: ()}, parent_map)
+
+    def test_with_offset(self):
+        nodes = self.make_nodes(800, 2, 1)
+        index = self.make_index(nodes, key_elements=2, offset=1234)
+        self.assertEqual(sorted(nodes),
+                         sorted(entry[1:] for entry in
+                                index.iter_all_entries()))
+        self.assertEqual([], list(index.iter_entries([(b'a', b'b')])))
+        self.assertIsNot(None, index._bloom)
+        index.validate()
+
+    def test_read_all_pages_at_once(self):
+        # Small indices are read in one go, including the filter pages.
+        nodes = self.make_nodes(200, 1, 1)
+        index = self.make_index(nodes)
+        index._recommended_pages = 100
+        self.assertEqual(200, len(list(index.iter_all_entries())))
+        self.assertEqual([(index,) + nodes[5]],
+                         list(index.iter_entries([nodes[5][0]])))
+
+    def test_bloom_builder(self):
+        builder = btree_index.BloomBTreeBuilder(reference_lists=1)
+        builder.add_node((b'key',), b'value', ([],))
+        self.assertStartsWith(builder.finish().read(),
+                              b'B+Tree Graph Index 3\n')
+
+
+class TestSharedNodeCache(BTreeTestCase):
+
+    def setUp(self):
+        super(TestSharedNodeCache, self).setUp()
+        self.overrideAttr(btree_index, '_shared_node_cache',
+                          btree_index._SharedNodeCache(1024 * 1024))
+
+    def make_index(self, nodes, shared=True):
+        builder = btree_index.BTreeBuilder(reference_lists=2, key_elements=2)
+        for key, value, references in nodes:
+            builder.add_node(key, value, references)
+        t = transport.get_transport_from_url('trace+' + self.get_url())
+        if not t.has('index'):
+            self.index_size = t.put_file('index', builder.finish())
+        index = btree_index.BTreeGraphIndex(t, 'index', self.index_size)
+        index._shared_nodes = shared
+        return index
+
+    def test_nodes_shared_between_indices(self):
+        nodes = self.make_nodes(160, 2, 2)
+        index = self.make_index(nodes)
+        self.assertEqual(1, len(list(index.iter_entries([nodes[30][0]]))))
+        other = self.make_index(nodes)
+        del other._transport._activity[:]
+        self.assertEqual([(other, ) + nodes[30]],
+                         list(other.iter_entries([nodes[30][0]])))
+        self.assertEqual(320, other.key_count())
+        self.assertEqual([], other._transport._activity)
+        self.assertEqual(2, btree_index._shared_node_cache.hits)
+
+    def test_unshared_index_reads(self):
+        nodes = self.make_nodes(160, 2, 2)
+        index = self.make_index(nodes)
+        list(index.iter_entries([nodes[30][0]]))
+        other = self.make_index(nodes, shared=False)
+        del other._transport._activity[:]
+        self.assertEqual(1, len(list(other.iter_entries([nodes[30][0]]))))
+        self.assertNotEqual([], other._transport._activity)
+        self.assertEqual(0, btree_index._shared_node_cache.hits)
+
+    def test_invalidate(self):
+        nodes = self.make_nodes(160, 2, 2)
+        index = self.make_index(nodes)
+        list(index.iter_entries([nodes[30][0]]))
+        btree_index.invalidate_shared_nodes(['other-index'])
+        self.assertNotEqual([], btree_index._shared_node_cache._cache.keys())
+        btree_index.invalidate_shared_nodes(['index'])
+        self.assertEqual([], btree_index._shared_node_cache._cache.keys())
+
+    def test_bounded_by_size(self):
+        self.overrideAttr(btree_index, '_shared_node_cache',
+                          btree_index._SharedNodeCache(20000))
+        nodes = self.make_nodes(160, 2, 2)
+        index = self.make_index(nodes)
+        list(index.iter_entries([node[0] for node in nodes]))
+        cache = btree_index._shared_node_cache._cache
+        self.assertTrue(0 < len(cache) < 5)
+        self.assertTrue(cache._value_size <= 20000)
+
+
 class TestBTreeNodes(BTreeTestCase):
 
     scenarios = btreeparser_scenarios()
@@ -0,0 +1,205 @@
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the inotify based change monitor."""
+
+import socket
+import threading
+
+from ..bzr import changemonitor
+from . import (
+    TestCaseWithTransport,
+    features,
+    )
+
+
+class _InotifyFeature(features.Feature):
+
+    def _probe(self):
+        if getattr(socket, 'AF_UNIX', None) is None:
+            return False
+        try:
+            changemonitor.Inotify().close()
+        except (changemonitor.InotifyUnavailable, OSError):
+            return False
+        return True
+
+    def feature_name(self):
+        return 'inotify'
+
+
+InotifyFeature = _InotifyFeature()
+
+
+class TestChangeMonitor(TestCaseWithTransport):
+
+    _test_needs_features = [InotifyFeature]
+
+    def make_monitor(self, tree):
+        monitor = changemonitor.ChangeMonitor(
+            tree.basedir, tree._transport.local_abspath('.'))
+        self.addCleanup(monitor.close)
+        return monitor
+
+    def test_changes_since(self):
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'b/'])
+        monitor = self.make_monitor(tree)
+        token, paths = monitor.changes_since(None)
+        self.assertIs(None, paths)
+        self.build_tree_contents([('a', b'new contents\n'), ('b/c', b'c\n')])
+        token, paths = monitor.changes_since(token)
+        self.assertEqual({b'a', b'b/c'}, paths)
+        token, paths = monitor.changes_since(token)
+        self.assertEqual(set(), paths)
+
+    def test_new_directory(self):
+        tree = self.make_branch_and_tree('.')
+        monitor = self.make_monitor(tree)
+        token = monitor.changes_since(None)[0]
+        self.build_tree(['d/'])
+        token, paths = monitor.changes_since(token)
+        self.assertEqual({b'd'}, paths)
+        self.build_tree(['d/e'])
+        self.assertEqual({b'd/e'}, monitor.changes_since(token)[1])
+
+    def test_dirstate_change(self):
+        tree = self.make_branch_and_tree('.')
+        monitor = self.make_monitor(tree)
+        token = monitor.changes_since(None)[0]
+        self.build_tree(['a'])
+        tree.add(['a'])
+        self.assertIn(b'.bzr', monitor.changes_since(token)[1])
+
+    def test_unknown_epoch(self):
+        tree = self.make_branch_and_tree('.')
+        monitor = self.make_monitor(tree)
+        token = monitor.changes_since(None)[0]
+        self.assertIs(None, monitor.changes_since(b'other:1')[1])
+        self.assertIs(None, monitor.changes_since(b'garbage')[1])
+        self.assertEqual(set(), monitor.changes_since(token)[1])
+
+    def test_too_many_changes(self):
+        self.overrideAttr(changemonitor, 'MAX_CHANGED_PATHS', 2)
+        tree = self.make_branch_and_tree('.')
+        monitor = self.make_monitor(tree)
+        token = monitor.changes_since(None)[0]
+        self.build_tree(['a', 'b', 'c'])
+        self.assertIs(None, monitor.changes_since(token)[1])
+
+
+class TestIterChangesWithMonitor(TestCaseWithTransport):
+
+    _test_needs_features = [InotifyFeature]
+
+    def start_monitor(self, tree):
+        monitor = changemonitor.ChangeMonitor(
+            tree.basedir, tree._transport.local_abspath('.'))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        changemonitor._socket_call(
+            sock.bind, tree._transport.local_abspath(changemonitor.SOCKET_NAME))
+        sock.listen(5)
+        stopped = threading.Event()
+        thread = threading.Thread(
+            target=monitor.serve, args=(sock, stopped.is_set))
+        thread.start()
+
+        def stop():
+            stopped.set()
+            thread.join()
+            sock.close()
+            monitor.close()
+        self.addCleanup(stop)
+        return monitor
+
+    def make_tree(self):
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'b/', 'b/c', 'd'])
+        tree.add(['a', 'b', 'b/c', 'd'])
+        tree.commit('initial')
+        return tree
+
+    def get_changes(self, tree):
+        with tree.lock_read():
+            basis = tree.basis_tree()
+            with basis.lock_read():
+                return sorted(
+                    ((c.path, c.changed_content, c.versioned)
+                     for c in tree.iter_changes(basis, want_unversioned=True)),
+                    key=lambda c: c[0][1])
+
+    def record_searches(self):
+        searches = []
+        orig = changemonitor.iter_changes_with_monitor
+
+        def iter_changes_with_monitor(tree, state, source_revid,
+                                      want_unversioned, make_iter_changes):
+            def recording_make_iter_changes(search):
+                searches.append(set(search))
+                return make_iter_changes(search)
+            return orig(tree, state, source_revid, want_unversioned,
+                        recording_make_iter_changes)
+        self.overrideAttr(changemonitor, 'iter_changes_with_monitor',
+                          iter_changes_with_monitor)
+        return searches
+
+    def test_only_changed_paths_searched(self):
+        tree = self.make_tree()
+        self.start_monitor(tree)
+        searches = self.record_searches()
+        self.build_tree_contents([('a', b'changed\n')])
+        self.assertEqual([(('a', 'a'), True, (True, True))],
+                         self.get_changes(tree))
+        self.assertEqual([{b''}], searches)
+        # Saving the dirstate (e.g. with updated hashes) needs another full
+        # comparison.
+        self.get_changes(tree)
+        del searches[:]
+        self.build_tree_contents([('b/c', b'changed\n'), ('e', b'new\n')])
+        self.assertEqual(
+            [(('a', 'a'), True, (True, True)),
+             (('b/c', 'b/c'), True, (True, True)),
+             ((None, 'e'), True, (False, False))],
+            self.get_changes(tree))
+        self.assertEqual([{b'a', b'b/c', b'e'}], searches)
+
+    def test_unversioned_directory(self):
+        tree = self.make_tree()
+        self.start_monitor(tree)
+        self.get_changes(tree)
+        self.get_changes(tree)
+        searches = self.record_searches()
+        self.build_tree(['f/', 'f/g/', 'f/g/h'])
+        self.assertEqual([((None, 'f'), True, (False, False))],
+                         self.get_changes(tree))
+        self.assertEqual([{b'f'}], searches)
+
+    def test_reverted_change(self):
+        tree = self.make_tree()
+        self.start_monitor(tree)
+        self.build_tree_contents([('a', b'changed\n')])
+        self.get_changes(tree)
+        self.get_changes(tree)
+        self.build_tree_contents([('a', b'contents of a\n')])
+        self.assertEqual([], self.get_changes(tree))
+
+    def test_no_monitor(self):
+        tree = self.make_tree()
+        searches = self.record_searches()
+        self.build_tree_contents([('a', b'changed\n')])
+        self.assertEqual([(('a', 'a'), True, (True, True))],
+                         self.get_changes(tree))
+        self.assertEqual([], searches)
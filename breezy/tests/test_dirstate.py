@@ -2176,6 +2176,126 @@ class TestBisect(TestCaseWithDirState):
                                    state, [b'b'])
 
 
+class TestBisectBinary(TestBisect):
+    """Run the bisect tests against the binary (format 5) dirstate."""
+
+    def setUp(self):
+        super(TestBisectBinary, self).setUp()
+        initialize = dirstate.DirState.initialize.__func__
+
+        def binary_initialize(cls, path, sha1_provider=None, binary=True):
+            return initialize(cls, path, sha1_provider, binary=binary)
+        self.overrideAttr(dirstate.DirState, 'initialize',
+                          classmethod(binary_initialize))
+
+    def create_basic_dirstate(self):
+        tree, state, expected = super(
+            TestBisectBinary, self).create_basic_dirstate()
+        state._read_header_if_needed()
+        self.assertTrue(state._binary)
+        return tree, state, expected
+
+    def test_bisect_does_not_read_dirblocks(self):
+        tree, state, expected = self.create_basic_dirstate()
+        self.assertBisect(expected, [[b'b/c']], state, [b'b/c'])
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+
+    def test_get_entry_does_not_read_dirblocks(self):
+        tree, state, expected = self.create_basic_dirstate()
+        self.assertEqual(expected[b'b/c'],
+                         state._get_entry(0, path_utf8=b'b/c'))
+        self.assertEqual(expected[b'b/d/e'],
+                         state._get_entry(1, path_utf8=b'b/d/e'))
+        self.assertEqual((None, None),
+                         state._get_entry(0, path_utf8=b'b/nonexistent'))
+        self.assertRaises(errors.BzrError, state._get_entry, 0,
+                          fileid_utf8=b'a-id', path_utf8=b'b/c')
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+        # Changed hashes of entries found that way are not kept
+        state._mark_modified([expected[b'b/c']])
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+        # Lookups by file id need the dirblocks
+        self.assertEqual(expected[b'b/c'],
+                         state._get_entry(0, fileid_utf8=b'c-id'))
+        self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
+                         state._dirblock_state)
+
+
+class TestBinaryFormat(TestCaseWithDirState):
+
+    def test_round_trip(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/b/', 'tree/b/c'])
+        tree.add(['a', 'b', 'b/c'], [b'a-id', b'b-id', b'c-id'])
+        tree.commit('first', rev_id=b'rev-1')
+        state = dirstate.DirState.from_tree(tree, 'text')
+        try:
+            state.save()
+            self.assertFalse(state._binary)
+            expected_parents = state.get_parent_ids()
+            expected = list(state._iter_entries())
+        finally:
+            state.unlock()
+        state = dirstate.DirState.on_file('text')
+        state.lock_write()
+        try:
+            state._read_dirblocks_if_needed()
+            state._binary = True
+            state._mark_modified(header_modified=True)
+            state.save()
+        finally:
+            state.unlock()
+        with open('text', 'rb') as f:
+            self.assertEqual(dirstate.DirState.HEADER_FORMAT_5, f.readline())
+        state = dirstate.DirState.on_file('text')
+        state.lock_read()
+        try:
+            self.assertEqual(expected_parents, state.get_parent_ids())
+            self.assertEqual(expected, list(state._iter_entries()))
+            self.assertTrue(state._binary)
+        finally:
+            state.unlock()
+
+    def test_corrupt_crc(self):
+        state = self.create_dirstate_with_root()
+        try:
+            state._binary = True
+            state._mark_modified(header_modified=True)
+            state.save()
+        finally:
+            state.unlock()
+        with open('dirstate', 'rb') as f:
+            content = f.read()
+        with open('dirstate', 'wb') as f:
+            f.write(content[:-1] + bytes([content[-1] ^ 1]))
+        state = dirstate.DirState.on_file('dirstate')
+        state.lock_read()
+        self.addCleanup(state.unlock)
+        self.assertRaises(dirstate.DirstateCorrupt,
+                          state._read_dirblocks_if_needed)
+
+    def test_crc_covers_parents(self):
+        state = self.create_dirstate_with_root()
+        try:
+            state._binary = True
+            state.set_parent_trees([(b'parent-1', None)], [b'parent-1'])
+            state.save()
+        finally:
+            state.unlock()
+        with open('dirstate', 'rb') as f:
+            content = f.read()
+        with open('dirstate', 'wb') as f:
+            f.write(content.replace(b'parent-1', b'parent-2'))
+        state = dirstate.DirState.on_file('dirstate')
+        state.lock_read()
+        self.addCleanup(state.unlock)
+        self.assertRaises(dirstate.DirstateCorrupt,
+                          state._read_dirblocks_if_needed)
+
+
 class TestDirstateValidation(TestCaseWithDirState):
 
     def test_validate_correct_dirstate(self):
@@ -2480,6 +2600,65 @@ class _Repo(object):
         pass
 
 
+class TestUpdateByDelta(TestCaseWithDirState):
+
+    def make_add_delta(self, paths):
+        dir_ids = {'': b'TREE_ROOT'}
+        delta = []
+        for path in paths:
+            dirname, basename = osutils.split(path.rstrip('/'))
+            file_id = basename.encode('ascii') + b'-id'
+            if path.endswith('/'):
+                ie = inventory.InventoryDirectory(
+                    file_id, basename, dir_ids[dirname])
+                dir_ids[path.rstrip('/')] = file_id
+            else:
+                ie = inventory.InventoryFile(
+                    file_id, basename, dir_ids[dirname])
+            delta.append((None, path.rstrip('/'), file_id, ie))
+        return delta
+
+    def apply_deltas(self, deltas):
+        state = dirstate.DirState.initialize('dirstate-%d' % len(deltas))
+        self.addCleanup(state.unlock)
+        for delta in deltas:
+            state.update_by_delta(delta)
+        state._validate()
+        return state
+
+    def test_add_many(self):
+        delta = self.make_add_delta(
+            ['b/', 'b/c', 'b/d/', 'b/d/e', 'a', 'b-c', 'f/'])
+        state = self.apply_deltas([delta])
+        expected = self.apply_deltas([[item] for item in delta])
+        self.assertEqual(expected._dirblocks, state._dirblocks)
+        self.assertEqual(expected._get_id_index(), state._get_id_index())
+
+    def test_add_many_to_existing_directories(self):
+        delta = self.make_add_delta(
+            ['b/', 'b/c', 'b/d/', 'b/d/e', 'a', 'b-c', 'f/', 'f/g', 'h'])
+        state = self.apply_deltas([delta[:2], delta[2:4], delta[4:]])
+        expected = self.apply_deltas([[item] for item in delta])
+        self.assertEqual(expected._dirblocks, state._dirblocks)
+
+    def test_add_many_path_occupied(self):
+        delta = self.make_add_delta(['a', 'b'])
+        state = self.apply_deltas([delta[:1]])
+        delta[0] = (None, 'a', b'other-a-id', inventory.InventoryFile(
+            b'other-a-id', 'a', b'TREE_ROOT'))
+        self.assertRaises(errors.InconsistentDelta,
+                          state.update_by_delta, delta)
+
+    def test_add_many_missing_parent(self):
+        delta = self.make_add_delta(['a', 'b'])
+        delta.append((None, 'x/y', b'y-id', inventory.InventoryFile(
+            b'y-id', 'y', b'x-id')))
+        state = dirstate.DirState.initialize('dirstate')
+        self.addCleanup(state.unlock)
+        self.assertRaises(errors.InconsistentDelta,
+                          state.update_by_delta, delta)
+
+
 class TestUpdateBasisByDelta(tests.TestCase):
 
     def path_to_ie(self, path, file_id, rev_id, dir_ids):
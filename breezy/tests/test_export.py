@@ -24,12 +24,16 @@ import time
 import zipfile
 
 from .. import (
+    archive,
     errors,
     export,
     tests,
     )
 from ..export import get_root_name
-from ..archive.tar import tarball_generator
+from ..archive.tar import (
+    prepare_tarball_item,
+    tarball_generator,
+    )
 from . import features
 
 
@@ -275,6 +279,42 @@ class TarExporterTests(tests.TestCaseWithTransport):
         self.addCleanup(ball2.close)
         self.assertEqual(["bar/a"], ball2.getnames())
 
+    def make_tree_with_contents(self):
+        wt = self.make_branch_and_tree('.')
+        self.build_tree_contents([
+            ('a', b'a' * 1000), ('b/',), ('b/c', b'c' * 513),
+            ('b/empty', b''), ('d', b'd')])
+        wt.add(['a', 'b', 'b/c', 'b/empty', 'd'])
+        wt.commit("1", timestamp=42)
+        return wt.basis_tree()
+
+    def test_tarball_generator_matches_tarfile(self):
+        tree = self.make_tree_with_contents()
+        expected = BytesIO()
+        with tree.lock_read(), tarfile.open(None, "w", expected) as ball:
+            for final_path, tree_path, entry in export._export_iter_entries(
+                    tree, None):
+                ball.addfile(*prepare_tarball_item(
+                    tree, "bar", final_path, tree_path, entry, 42))
+        with tree.lock_read():
+            self.assertEqualDiff(
+                expected.getvalue(),
+                b''.join(tarball_generator(tree, "bar", force_mtime=42)))
+
+    def test_tarball_generator_small_batches_and_chunks(self):
+        self.overrideAttr(export, '_EXPORT_BATCH_COUNT', 2)
+        self.overrideAttr(archive, '_CHUNK_SIZE', 100)
+        tree = self.make_tree_with_contents()
+        with tree.lock_read():
+            data = b''.join(tarball_generator(tree, "bar", format='gz'))
+        ball = tarfile.open(None, "r:gz", BytesIO(data))
+        self.addCleanup(ball.close)
+        self.assertEqual(
+            ["bar/a", "bar/b", "bar/d", "bar/b/c", "bar/b/empty"],
+            ball.getnames())
+        self.assertEqual(b'c' * 513, ball.extractfile("bar/b/c").read())
+        self.assertEqual(b'a' * 1000, ball.extractfile("bar/a").read())
+
 
 class ZipExporterTests(tests.TestCaseWithTransport):
 
@@ -291,6 +331,52 @@ class ZipExporterTests(tests.TestCaseWithTransport):
         info = zfile.getinfo("test/har")
         self.assertEqual(time.localtime(timestamp)[:6], info.date_time)
 
+    def test_contents(self):
+        self.overrideAttr(archive, '_CHUNK_SIZE', 100)
+        tree = self.make_branch_and_tree('.')
+        self.build_tree_contents([
+            ('a', b'a' * 1000), ('b/',), ('b/c', b'c'), ('b/empty', b'')])
+        tree.add(['a', 'b', 'b/c', 'b/empty'])
+        tree.commit('setup')
+        export.export(tree.basis_tree(), 'test.zip', format='zip')
+        zfile = zipfile.ZipFile('test.zip')
+        self.addCleanup(zfile.close)
+        self.assertEqual(
+            ['test/a', 'test/b/', 'test/b/c', 'test/b/empty'],
+            zfile.namelist())
+        self.assertIs(None, zfile.testzip())
+        self.assertEqual(b'a' * 1000, zfile.read('test/a'))
+        self.assertEqual(b'', zfile.read('test/b/empty'))
+
+
+class IterInThreadTests(tests.TestCase):
+
+    def test_items(self):
+        self.assertEqual(
+            list(range(100)), list(archive.iter_in_thread(range(100), 3)))
+
+    def test_error(self):
+        def produce():
+            yield 1
+            raise errors.BzrError('failed')
+        items = archive.iter_in_thread(produce())
+        self.assertEqual(1, next(items))
+        self.assertRaises(errors.BzrError, next, items)
+
+    def test_close_stops_producer(self):
+        closed = []
+
+        def produce():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                closed.append(True)
+        items = archive.iter_in_thread(produce(), 1)
+        self.assertEqual(0, next(items))
+        items.close()
+        self.assertEqual([True], closed)
+
 
 class RootNameTests(tests.TestCase):
 
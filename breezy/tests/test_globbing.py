@@ -312,6 +312,22 @@ class TestGlobster(TestCase):
             self.assertEqual(patterns[x], globster.match(filename))
         self.assertEqual(None, globster.match('foobar.300'))
 
+    def test_match_many(self):
+        patterns = [u'*.%03d' % i for i in range(300)] + [u'./foo', u'*~']
+        globster = Globster(patterns)
+        filenames = [u'foo.000', u'foo', u'bar/foo', u'foo.299', u'foo~',
+                     u'foo.300', u'foo.099']
+        self.assertEqual([globster.match(f) for f in filenames],
+                         globster.match_many(filenames))
+        self.assertEqual([], globster.match_many([]))
+
+    def test_bad_pattern_match_many(self):
+        g = Globster([u'RE:[', u'/home/foo'])
+        e = self.assertRaises(lazy_regex.InvalidPattern, g.match_many,
+                              ['filename'])
+        self.assertContainsRe(e.msg, r"File.*ignore.*contains error.*RE:\[",
+                              flags=re.DOTALL)
+
     def test_bad_pattern(self):
         """Ensure that globster handles bad patterns cleanly."""
         patterns = [u'RE:[', u'/home/foo', u'RE:*.cpp']
@@ -335,6 +351,15 @@ class TestExceptionGlobster(TestCase):
         self.assertEqual(None, globster.match('.zfunctions/fiddle/flam'))
         self.assertEqual(u'!!./.zcompdump', globster.match('.zcompdump'))
 
+    def test_match_many(self):
+        patterns = [u'*', u'!./local', u'!./local/**/*',
+                    u'!RE:\\.z.*', u'!!./.zcompdump']
+        globster = ExceptionGlobster(patterns)
+        self.assertEqual(
+            [u'*', None, None, None, u'!!./.zcompdump'],
+            globster.match_many(['tmp/foo.txt', 'local', 'local/bin/wombat',
+                                 '.zshrc', '.zcompdump']))
+
     def test_exclusion_order(self):
         """test that ordering of exclusion patterns does not matter"""
         patterns = [u'static/**/*.html', u'!static/**/versionable.html']
@@ -822,6 +822,97 @@ class TestRangeRequestServer(TestSpecificRequestHandler):
         self.assertEqual(2, server.GET_request_nb)
 
 
+class TestParallelRangeRequestServer(TestRangeRequestServer):
+    """Tests readv requests spread over several connections."""
+
+    def setUp(self):
+        super(TestParallelRangeRequestServer, self).setUp()
+        conf = config.GlobalStack()
+        conf.set('http.readv_connections', '3')
+        conf.set('http.readv_window', '2')
+
+    def get_readonly_transport(self):
+        t = super(TestParallelRangeRequestServer,
+                  self).get_readonly_transport()
+        self.addCleanup(t.disconnect)
+        return t
+
+    def test_uses_pool(self):
+        t = self.get_readonly_transport()
+        self.assertEqual(3, t._readv_pool.connections)
+        self.assertIs(t._readv_pool, t.clone('foo')._readv_pool)
+
+    def test_disconnect_closes_pool(self):
+        t = self.get_readonly_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        self.assertEqual([(0, b'0'), (9, b'9')],
+                         list(t.readv('a', [(0, 1), (9, 1)])))
+        self.assertIsNot(None, t._readv_pool._executor)
+        t.disconnect()
+        self.assertIs(None, t._readv_pool._executor)
+        self.assertTrue(t._readv_pool._idle.empty())
+        # The pool is started again when needed
+        self.assertEqual([(0, b'0'), (9, b'9')],
+                         list(t.readv('a', [(0, 1), (9, 1)])))
+
+    def test_workers_have_own_opener(self):
+        t = self.get_readonly_transport()
+        worker = t._clone_for_readv_pool()
+        self.assertIsNot(t._opener, worker._opener)
+        self.assertIs(None, worker._readv_pool)
+
+    def test_workers_negotiate_own_digest_nonce(self):
+        t = self.get_readonly_transport()
+        t._update_credentials((
+            {'scheme': 'digest', 'user': 'joe', 'password': 'secret',
+             'nonce': 'abc', 'nonce_count': 3},
+            {'scheme': 'basic', 'user': 'proxy'}))
+        auth, proxy_auth = t._clone_for_readv_pool()._get_credentials()
+        self.assertEqual({'user': 'joe', 'password': 'secret'}, auth)
+        self.assertEqual({'scheme': 'basic', 'user': 'proxy'}, proxy_auth)
+
+    def test_activity_reported_by_calling_thread(self):
+        t = self.get_readonly_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        activity = []
+
+        def report_activity(bytes, direction):
+            activity.append((threading.current_thread(), direction))
+        t._report_activity = report_activity
+        self.assertEqual([(0, b'0'), (9, b'9')],
+                         list(t.readv('a', [(0, 1), (9, 1)])))
+        self.assertEqual({(threading.current_thread(), 'read'),
+                          (threading.current_thread(), 'write')},
+                         set(activity))
+
+    def test_readv_in_order_with_many_requests(self):
+        self.build_tree_contents([('b', bytes(range(256)) * 4)])
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        offsets = [(i * 10, 3) for i in range(100)]
+        offsets.reverse()
+        self.assertEqual(
+            [(start, (bytes(range(256)) * 4)[start:start + length])
+             for start, length in offsets],
+            list(t.readv('b', offsets)))
+        self.assertEqual(100, server.GET_request_nb)
+
+    def test_incomplete_readv_leave_pipe_clean(self):
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        # force transport to issue multiple requests
+        t._get_max_size = 2
+        ireadv = iter(t.readv('a', ((0, 1), (1, 1), (2, 4), (6, 4))))
+        self.assertEqual((0, b'0'), next(ireadv))
+        # At most a window of requests were issued so far
+        self.assertTrue(server.GET_request_nb <= 2)
+        self.assertEqual(b'0123456789', t.get_bytes('a'))
+
+
 class SingleRangeRequestHandler(http_server.TestingHTTPRequestHandler):
     """Always reply to range request as if they were single.
 
@@ -859,6 +950,29 @@ class TestSingleOnlyRangeRequestServer(TestRangeRequestServer):
     _req_handler_class = SingleOnlyRangeRequestHandler
 
 
+class TestParallelSingleOnlyRangeRequestServer(
+        TestParallelRangeRequestServer):
+    """Test parallel readv against a server only accepting single ranges"""
+
+    _req_handler_class = SingleOnlyRangeRequestHandler
+
+    def test_readv_in_order_with_many_requests(self):
+        content = bytes(range(256)) * 100
+        self.build_tree_contents([('b', content)])
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        # Far enough apart not to be coalesced
+        offsets = [(i * 250, 3) for i in range(100)]
+        self.assertEqual(
+            [(start, content[start:start + length])
+             for start, length in offsets],
+            list(t.readv('b', offsets)))
+        self.assertEqual('single', t._range_hint)
+        # The multi range request failed, then every range was requested on
+        # its own.
+        self.assertEqual(101, server.GET_request_nb)
+
+
 class NoRangeRequestHandler(http_server.TestingHTTPRequestHandler):
     """Ignore range requests without notice"""
 
@@ -1614,6 +1728,20 @@ class TestAuth(http_utils.TestCaseWithWebserver):
         # Only one 'Authentication Required' error should occur
         self.assertEqual(1, self.server.auth_required_errors)
 
+    def test_parallel_readv_does_not_prompt_again(self):
+        config.GlobalStack().set('http.readv_connections', '2')
+        self.server.add_user('joe', 'foo')
+        t = self.get_user_transport('joe', None)
+        self.addCleanup(t.disconnect)
+        ui.ui_factory = tests.TestUIFactory(stdin='foo\n')
+        self.assertEqual(b'contents of a\n', t.get('a').read())
+        # force transport to issue multiple requests
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        self.assertEqual([(0, b'co'), (9, b'of'), (4, b'en')],
+                         list(t.readv('b', [(0, 2), (9, 2), (4, 2)])))
+        self.assertEqual('', ui.ui_factory.stdin.readline())
+
     def _check_password_prompt(self, scheme, user, actual_prompt):
         expected_prompt = (self._password_prompt_prefix
                            + ("%s %s@%s:%d, Realm: '%s' password: "
@@ -228,6 +228,21 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual(10, cache.get(1))
         self.assertEqual([1, 2], [n.key for n in walk_lru(cache)])
 
+    def test_remove(self):
+        cache = lru_cache.LRUCache(max_cache=5)
+        cache[1] = 10
+        cache[2] = 20
+        cache[3] = 30
+        cache.remove(2)
+        self.assertEqual([3, 1], [n.key for n in walk_lru(cache)])
+        self.assertIs(None, cache.get(2))
+        self.assertRaises(KeyError, cache.remove, 2)
+        cache.remove(3)
+        cache.remove(1)
+        self.assertEqual([], list(walk_lru(cache)))
+        cache[4] = 40
+        self.assertEqual([4], [n.key for n in walk_lru(cache)])
+
     def test_keys(self):
         cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=5)
 
@@ -308,6 +323,15 @@ class TestLRUSizeCache(tests.TestCase):
         cache._remove_node(node)
         self.assertEqual(0, cache._value_size)
 
+    def test_remove_by_key_tracks_size(self):
+        cache = lru_cache.LRUSizeCache()
+        cache['my key'] = 'my value text'
+        cache['other key'] = 'other'
+        self.assertEqual(18, cache._value_size)
+        cache.remove('my key')
+        self.assertEqual(5, cache._value_size)
+        self.assertEqual(['other key'], cache.keys())
+
     def test_no_add_over_size(self):
         """Adding a large value may not be cached at all."""
         cache = lru_cache.LRUSizeCache(max_size=10, after_cleanup_size=5)
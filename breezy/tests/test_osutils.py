@@ -1269,6 +1269,32 @@ class TestWalkDirs(tests.TestCaseInTempDir):
             result.append(dirblock)
         self.assertExpectedBlocks(expected_dirblocks[1:], result)
 
+    def test__walkdirs_utf8_readahead(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.build_tree([
+            '0file', '1dir/', '1dir/0file', '1dir/1dir/', '1dir/1dir/0file',
+            '2dir/', '2dir/0dir/', '2dir/0dir/0file', '3dir/', '3dir/0file'])
+
+        def walk(**kwargs):
+            result = []
+            for dirdetail, dirblock in osutils._walkdirs_utf8(
+                    b'.', **kwargs):
+                result.append(
+                    (dirdetail, [(entry[0], entry[2]) for entry in dirblock]))
+                # Don't descend into 2dir
+                for i, entry in enumerate(dirblock):
+                    if entry[1] == b'2dir':
+                        del dirblock[i]
+            return result
+        expected = walk()
+        self.assertEqual(
+            [b'', b'1dir', b'1dir/1dir', b'3dir'],
+            [dirdetail[0] for dirdetail, dirblock in expected])
+        executor = ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        self.assertEqual(expected, walk(executor=executor, readahead=2))
+        self.assertEqual(expected, walk(executor=executor, readahead=0))
+
     def _filter_out_stat(self, result):
         """Filter out the stat value from the walkdirs result"""
         for dirdetail, dirblock in result:
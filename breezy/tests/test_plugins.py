@@ -26,8 +26,11 @@ import types
 
 import breezy
 from .. import (
+    debug,
+    hooks,
     osutils,
     plugin,
+    registry,
     tests,
     )
 from ..tests.features import pkg_resources_feature
@@ -897,6 +900,153 @@ good 0.1.0
 """, ''.join(plugin.describe_plugins(state=self)))
 
 
+# Registry the plugins in TestPluginManifest register with
+lazy_registry = None
+
+
+def lazy_hook():
+    pass
+
+
+class TestPluginManifest(BaseTestPlugins):
+
+    lazy_source = '''\
+from breezy.tests import test_plugins
+test_plugins.lazy_registry.register_lazy('lazy', __name__ + '.sub', 'value')
+'''
+
+    def setUp(self):
+        super(TestPluginManifest, self).setUp()
+        self.overrideAttr(sys.modules[__name__], 'lazy_registry',
+                          registry.Registry())
+
+    def create_lazy_plugin(self, source=None):
+        if source is None:
+            source = self.lazy_source
+        self.create_plugin_package('lazy', source=source)
+        self.create_plugin('sub', "value = 'a value'\n", dir='lazy')
+
+    def reload(self):
+        self.reset()
+        for key in lazy_registry.keys():
+            lazy_registry.remove(key)
+        self.load_with_paths(['.'])
+
+    def test_lazy_plugin_deferred(self):
+        self.create_lazy_plugin()
+        self.load_with_paths(['.'])
+        self.assertPluginKnown('lazy')
+        self.reload()
+        self.assertPluginUnknown('lazy')
+        self.assertEqual(['lazy'], lazy_registry.keys())
+        # Using the registration imports the plugin, which doesn't register
+        # it again.
+        self.assertEqual('a value', lazy_registry.get('lazy'))
+        self.assertPluginKnown('lazy')
+        self.assertEqual(['lazy'], lazy_registry.keys())
+
+    def test_eager_plugin_imported(self):
+        self.create_lazy_plugin(self.lazy_source + '''\
+test_plugins.lazy_registry.register('eager', 'value')
+''')
+        self.load_with_paths(['.'])
+        self.reload()
+        self.assertPluginKnown('lazy')
+        self.assertEqual(['eager', 'lazy'], lazy_registry.keys())
+
+    def test_changed_plugin_imported(self):
+        self.create_lazy_plugin()
+        self.load_with_paths(['.'])
+        mtime = os.path.getmtime('lazy/__init__.py')
+        os.utime('lazy/__init__.py', (mtime + 10, mtime + 10))
+        self.reload()
+        self.assertPluginKnown('lazy')
+        # The new version is recorded
+        self.reload()
+        self.assertPluginUnknown('lazy')
+
+    def test_disabled(self):
+        self.overrideAttr(debug, 'debug_flags', {'no_plugin_manifest'})
+        self.create_lazy_plugin()
+        self.load_with_paths(['.'])
+        self.reload()
+        self.assertPluginKnown('lazy')
+
+    def test_load_deferred_plugins(self):
+        self.create_lazy_plugin()
+        self.load_with_paths(['.'])
+        self.reload()
+        self.assertEqual({}, self.plugins)
+        self.assertEqual('lazy[unknown]',
+                         plugin.format_concise_plugin_list(state=self))
+        plugin.load_deferred_plugins(state=self)
+        self.assertPluginKnown('lazy')
+        self.assertEqual(['lazy'], list(self.plugins))
+
+    def test_registrations_of_imported_modules_not_recorded(self):
+        # A module that isn't a plugin, imported for the first time by the
+        # plugin. It registers in a registry of its own, like
+        # breezy.version_info_formats does.
+        os.mkdir('modules')
+        with open('modules/lazy_module.py', 'w') as f:
+            f.write('from breezy import registry\n'
+                    'module_registry = registry.Registry()\n'
+                    'module_registry.register_lazy(\n'
+                    '    "module", __name__, "module_registry")\n')
+        self.overrideAttr(sys, 'path', [osutils.abspath('modules')] + sys.path)
+        self.addCleanup(sys.modules.pop, 'lazy_module', None)
+        self.create_lazy_plugin(self.lazy_source + 'import lazy_module\n')
+        self.load_with_paths(['.'])
+        del sys.modules['lazy_module']
+        self.reload()
+        self.assertPluginUnknown('lazy')
+        self.assertNotIn('lazy_module', sys.modules)
+        self.assertEqual('a value', lazy_registry.get('lazy'))
+        self.assertPluginKnown('lazy')
+        self.assertEqual(
+            ['module'], sys.modules['lazy_module'].module_registry.keys())
+
+    def test_replayed_registrations_undone_on_failure(self):
+        self.create_lazy_plugin()
+        self.load_with_paths(['.'])
+        manifest = plugin._PluginManifest.from_cache()
+        manifest._plugins['lazy']['registrations'].append(
+            ['registry', __name__, 'no_such_registry', 'register_lazy',
+             {'key': 'other', 'module_name': 'lazy', 'member_name': 'value'}])
+        manifest._changed = True
+        manifest.save()
+        self.reload()
+        # The plugin was imported instead, and could make its registration.
+        self.assertPluginKnown('lazy')
+        self.assertEqual({}, self.plugin_warnings)
+        self.assertEqual(['lazy'], lazy_registry.keys())
+
+    def test_record_hook(self):
+        key = (__name__, 'hooks', 'lazy_hook')
+        self.addCleanup(hooks._lazy_hooks.pop, key, None)
+        with plugin._RegistrationRecorder() as recorder:
+            hooks.install_lazy_named_hook(
+                __name__, 'hooks', 'lazy_hook', lazy_hook, 'label')
+        self.assertFalse(recorder.eager)
+        entry = ['hook', __name__, 'hooks', 'lazy_hook', __name__,
+                 'lazy_hook', 'label']
+        self.assertEqual([entry], recorder.registrations)
+        del hooks._lazy_hooks[key]
+        plugin._replay_registration(entry)
+        [(obj_getter, label)] = hooks._lazy_hooks[key]
+        self.assertEqual('label', label)
+        self.assertIs(lazy_hook, obj_getter.get_obj())
+
+    def test_record_unnamed_hook(self):
+        key = (__name__, 'hooks', 'lazy_hook')
+        self.addCleanup(hooks._lazy_hooks.pop, key, None)
+        with plugin._RegistrationRecorder() as recorder:
+            hooks.install_lazy_named_hook(
+                __name__, 'hooks', 'lazy_hook', lambda: None, 'label')
+        self.assertTrue(recorder.eager)
+        self.assertEqual([], recorder.registrations)
+
+
 class DummyPlugin(object):
     """Plugin."""
 
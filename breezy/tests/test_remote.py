@@ -2231,6 +2231,52 @@ class TestBranchRevisionIdToRevno(RemoteBranchTestCase):
                           branch.revision_id_to_dotted_revno, b'revid')
         self.assertFinished(client)
 
+    def test_dotted_many(self):
+        transport = MemoryTransport()
+        client = FakeClient(transport.base)
+        client.add_expected_call(
+            b'Branch.get_stacked_on_url', (b'quack/',),
+            b'error', (b'NotStacked',),)
+        client.add_expected_call(
+            b'Branch.revision_id_to_revno', (b'quack/', b'null:'),
+            b'success', (b'ok', b'0',),)
+        client.add_expected_call(
+            b'Branch.revision_id_to_revno', (b'quack/', b'unknown'),
+            b'error', (b'NoSuchRevision', b'unknown',),)
+        client.add_expected_call(
+            b'Branch.revision_id_to_revno', (b'quack/', b'revid'),
+            b'error', (b'error', b'GhostRevisionsHaveNoRevno',
+                       b'The reivison {revid} was not found because there was '
+                       b'a ghost at {ghost-revid}'))
+        transport.mkdir('quack')
+        transport = transport.clone('quack')
+        branch = self.make_remote_branch(transport, client)
+        self.assertEqual(
+            {b'null:': (0, )},
+            branch.revision_ids_to_dotted_revnos(
+                [b'null:', b'unknown', b'revid']))
+        self.assertFinished(client)
+
+    def test_dotted_many_pipelined(self):
+        self.setup_smart_server_with_call_log()
+        tree = self.make_branch_and_memory_tree('.')
+        tree.lock_write()
+        tree.add('')
+        rev1 = tree.commit('one')
+        rev2 = tree.commit('two')
+        tree.unlock()
+        branch = Branch.open(self.get_url('.'))
+        # Learn that the server accepts pipelined requests.
+        branch.last_revision_info()
+        self.reset_smart_call_log()
+        self.assertEqual(
+            {rev1: (1, ), rev2: (2, )},
+            branch.revision_ids_to_dotted_revnos([rev1, rev2, b'unknown']))
+        self.assertEqual(
+            3, len([call for call in self.hpss_calls
+                    if call.call.method == b'Branch.revision_id_to_revno']))
+        self.assertTrue(branch._client._medium._remote_accepts_pipelining)
+
     def test_dotted_no_smart_verb(self):
         self.setup_smart_server_with_call_log()
         branch = self.make_branch('.')
@@ -3069,6 +3115,19 @@ class TestRepositoryHasSignatureForRevisionId(TestRemoteRepository):
             client._calls)
         self.assertEqual(True, result)
 
+    def test_has_signatures(self):
+        transport_path = 'quack'
+        repo, client = self.setup_fake_client_and_repository(transport_path)
+        client.add_success_response(b'yes')
+        client.add_success_response(b'no')
+        self.assertEqual({b'A'}, repo._has_signatures([b'A', b'B']))
+        self.assertEqual(
+            [('call', b'Repository.has_signature_for_revision_id',
+              (b'quack/', b'A')),
+             ('call', b'Repository.has_signature_for_revision_id',
+              (b'quack/', b'B'))],
+            client._calls)
+
     def test_is_not_shared(self):
         # ('no', ) for Repository.has_signature_for_revision_id -> 'False'.
         transport_path = 'qwack'
@@ -4165,8 +4224,9 @@ class TestStacking(tests.TestCaseWithTransport):
         rev_ord, expected_revs = self.get_ordered_revs('knit', 'topological')
         self.assertEqual(expected_revs, rev_ord)
         # Getting topological sort requires VFS calls still - one of which is
-        # pushing up from the bound branch.
-        self.assertLength(14, self.hpss_calls)
+        # pushing up from the bound branch. Index pages read earlier in the
+        # test come from the local transport cache.
+        self.assertLength(9, self.hpss_calls)
 
     def test_stacked_get_stream_groupcompress(self):
         # Repository._get_source.get_stream() from a stacked repository with
@@ -836,6 +836,39 @@ class TestKnitPackStreamSource(tests.TestCaseWithMemoryTransport):
         self.assertIs(type(stream), vf_repository.StreamSource)
 
 
+class TestBloomFormat(TestCaseWithTransport):
+
+    def test_indices_have_bloom_filters(self):
+        tree = self.make_branch_and_tree('tree', format='development-bloom')
+        self.build_tree(['tree/file'])
+        tree.add(['file'])
+        tree.commit('one')
+        repo = tree.branch.repository
+        self.assertIsInstance(repo._format,
+                              groupcompress_repo.RepositoryFormat2aBloom)
+        t = repo._transport
+        for name in t.list_dir('indices'):
+            if name.endswith('.six'):
+                # The signature index is empty, so has no filter.
+                continue
+            self.assertStartsWith(t.get_bytes('indices/' + name),
+                                  b'B+Tree Graph Index 3\n')
+
+    def test_fetch_from_2a(self):
+        source = self.make_branch_and_tree('source', format='2a')
+        self.build_tree(['source/file'])
+        source.add(['file'])
+        revid = source.commit('one')
+        target = self.make_repository('target', format='development-bloom')
+        target.fetch(source.branch.repository, revid)
+        with target.lock_read():
+            self.assertEqual({revid: (b'null:',)},
+                             target.get_parent_map([revid, b'missing']))
+            self.assertEqual(
+                b'contents of source/file\n',
+                target.revision_tree(revid).get_file_text('file'))
+
+
 class TestDevelopment6FindParentIdsOfRevisions(TestCaseWithTransport):
     """Tests for _find_parent_ids_of_revisions."""
 
@@ -1295,6 +1328,27 @@ class TestRepositoryPackCollection(TestCaseWithTransport):
         self.assertEqual({revs[-1]: (revs[-2],)}, r.get_parent_map([revs[-1]]))
         self.assertFalse(packs.reload_pack_names())
 
+    def test_reload_pack_names_invalidates_shared_nodes(self):
+        self.overrideAttr(btree_index, '_shared_node_cache',
+                          btree_index._SharedNodeCache(1024 * 1024))
+        tree = self.make_branch_and_tree('.', format='2a')
+        tree.commit('one')
+        revid = tree.commit('two')
+        r = repository.Repository.open('.')
+        r.lock_read()
+        self.addCleanup(r.unlock)
+        self.assertEqual(
+            [revid], list(r.get_parent_map([revid])))
+        cache = btree_index._shared_node_cache._cache
+        names = r._pack_collection.names()
+        self.assertSubset([name + '.rix' for name in names],
+                          {key[0] for key in cache.keys()})
+        tree.branch.repository.pack()
+        self.assertTrue(r._pack_collection.reload_pack_names())
+        self.assertEqual(set(),
+                         {key[0] for key in cache.keys()}.intersection(
+                            name + '.rix' for name in names))
+
     def test_reload_pack_names_preserves_pending(self):
         # TODO: Update this to also test for pending-deleted names
         tree, r, packs, revs = self.make_packs_and_alt_repo(write_lock=True)
@@ -1648,6 +1702,80 @@ class TestGCCHKPacker(TestCaseWithTransport):
         self.assertContainsRe(str(e),
                               r"We are missing inventories for revisions: .*'A'")
 
+    def make_multi_file_repository(self, path):
+        tree = self.make_branch_and_tree(path, format='2a')
+        tree.set_root_id(b'root-id')
+        self.build_tree(['%s/%s' % (path, name) for name in 'abcd'])
+        tree.add(list('abcd'), [b'%s-id' % (name.encode('ascii'),)
+                                for name in 'abcd'])
+        for i in range(3):
+            for name in 'abcd':
+                self.build_tree_contents([
+                    ('%s/%s' % (path, name),
+                     b'content of %s, version %d\n' % (
+                         name.encode('ascii'), i) * 50)])
+            tree.commit('commit %d' % (i,), rev_id=b'rev-%d' % (i,),
+                        timestamp=1234567890, timezone=0,
+                        committer='Joe Foo <joe@foo.com>')
+        return tree.branch.repository
+
+    def pack_with_jobs(self, repo, jobs):
+        repo.lock_write()
+        self.addCleanup(repo.unlock)
+        packer = groupcompress_repo.GCCHKPacker(
+            repo._pack_collection, repo._pack_collection.all_packs(),
+            '.test-pack', jobs=jobs)
+        packer._partition_size = 2
+        return packer.pack()
+
+    def test_partition_keys_keeps_files_together(self):
+        repo = self.make_multi_file_repository('repo')
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        packer = groupcompress_repo.GCCHKPacker(
+            repo._pack_collection, repo._pack_collection.all_packs(),
+            '.test-pack')
+        packer._partition_size = 2
+        keys = [key for key in repo.texts.keys() if key[0] != b'root-id']
+        partitions = packer._partition_keys(repo.texts, keys)
+        self.assertEqual(
+            [[(b'%s-id' % name, b'rev-%d' % i) for i in (2, 1, 0)]
+             for name in (b'a', b'b', b'c', b'd')],
+            partitions)
+        partitions = packer._partition_keys(repo.revisions,
+                                            repo.revisions.keys())
+        self.assertEqual([[(b'rev-2',), (b'rev-1',)], [(b'rev-0',)]],
+                         partitions)
+
+    def test_pack_in_parallel(self):
+        repo = self.make_multi_file_repository('serial')
+        self.make_multi_file_repository('parallel')
+        serial_pack = self.pack_with_jobs(repo, None)
+        parallel_repo = repository.Repository.open('parallel')
+        parallel_pack = self.pack_with_jobs(parallel_repo, 2)
+        self.assertNotEqual(None, parallel_pack)
+        self.assertEqual(serial_pack.text_index.key_count(),
+                         parallel_pack.text_index.key_count())
+        for name in parallel_repo._pack_collection.names():
+            if name != parallel_pack.name:
+                parallel_repo._pack_collection._remove_pack_from_memory(
+                    parallel_repo._pack_collection.get_pack_by_name(name))
+        for i in range(3):
+            tree = parallel_repo.revision_tree(b'rev-%d' % (i,))
+            with tree.lock_read():
+                self.assertEqual(
+                    b'content of a, version %d\n' % (i,) * 50,
+                    tree.get_file_text('a'))
+        self.assertEqual(3, len(parallel_repo.all_revision_ids()))
+
+    def test_parallel_pack_is_deterministic(self):
+        # Use the same branch nick, so the revisions are identical too.
+        self.build_tree(['two/', 'three/'])
+        repo_two = self.make_multi_file_repository('two/tree')
+        repo_three = self.make_multi_file_repository('three/tree')
+        self.assertEqual(self.pack_with_jobs(repo_two, 2).name,
+                         self.pack_with_jobs(repo_three, 3).name)
+
 
 class TestCrossFormatPacks(TestCaseWithTransport):
 
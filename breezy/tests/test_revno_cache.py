@@ -0,0 +1,143 @@
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the persistent revno cache."""
+
+from .. import (
+    branch as _mod_branch,
+    tests,
+    )
+from ..bzr import revno_cache
+
+
+def node_tuples(nodes):
+    return [(n.key, n.merge_depth, n.revno, n.end_of_merge) for n in nodes]
+
+
+class TestSerialization(tests.TestCase):
+
+    def test_roundtrip(self):
+        nodes = [
+            revno_cache.MergeSortedRevision(b'rev-3', 0, (3,), False),
+            revno_cache.MergeSortedRevision(b'rev 1.1.1', 1, (1, 1, 1), True),
+            revno_cache.MergeSortedRevision(b'rev-2', 0, (2,), False),
+            revno_cache.MergeSortedRevision(b'rev-1', 0, (1,), True),
+            ]
+        data = revno_cache.serialize(3, b'rev-3', nodes)
+        last_revno, last_revision_id, result = revno_cache.deserialize(data)
+        self.assertEqual((3, b'rev-3'), (last_revno, last_revision_id))
+        self.assertEqual(node_tuples(nodes), node_tuples(result))
+
+    def test_corrupt(self):
+        self.assertRaises(ValueError, revno_cache.deserialize, b'garbage')
+
+
+class TestMergeSort(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestMergeSort, self).setUp()
+        self.overrideAttr(revno_cache, '_MIN_CACHED_REVISIONS', 0)
+        builder = self.make_branch_builder('branch')
+        builder.start_series()
+        builder.build_snapshot(None, [
+            ('add', ('', b'root-id', 'directory', None))],
+            revision_id=b'1')
+        builder.build_snapshot([b'1'], [], revision_id=b'1.1.1')
+        builder.build_snapshot([b'1'], [], revision_id=b'2')
+        builder.build_snapshot([b'2', b'1.1.1'], [], revision_id=b'3')
+        builder.finish_series()
+        self.builder = builder
+        self.branch = builder.get_branch()
+
+    def merge_sorted(self):
+        branch = _mod_branch.Branch.open('branch')
+        with branch.lock_read():
+            return list(branch.iter_merge_sorted_revisions())
+
+    def uncached_merge_sorted(self):
+        branch = _mod_branch.Branch.open('branch')
+        with branch.lock_read():
+            known_graph = branch.repository.get_known_graph_ancestry(
+                [branch.last_revision()])
+            return node_tuples(known_graph.merge_sort(branch.last_revision()))
+
+    def cached_tip(self):
+        data = self.branch._transport.get_bytes(revno_cache.FILENAME)
+        return revno_cache.deserialize(data)[:2]
+
+    def test_writes_cache(self):
+        self.assertEqual(self.uncached_merge_sorted(), self.merge_sorted())
+        self.assertEqual((3, b'3'), self.cached_tip())
+
+    def test_uses_cache(self):
+        self.merge_sorted()
+        nodes = [revno_cache.MergeSortedRevision(b'3', 0, (42,), True)]
+        self.branch._transport.put_bytes(
+            revno_cache.FILENAME, revno_cache.serialize(3, b'3', nodes))
+        self.assertEqual([(b'3', 0, (42,), True)], self.merge_sorted())
+
+    def test_ignores_corrupt_cache(self):
+        self.branch._transport.put_bytes(revno_cache.FILENAME, b'garbage')
+        self.assertEqual(self.uncached_merge_sorted(), self.merge_sorted())
+        self.assertEqual((3, b'3'), self.cached_tip())
+
+    def test_small_history_not_cached(self):
+        self.overrideAttr(revno_cache, '_MIN_CACHED_REVISIONS', 5)
+        self.merge_sorted()
+        self.assertFalse(self.branch._transport.has(revno_cache.FILENAME))
+
+    def test_ghosts_not_cached(self):
+        self.builder.build_snapshot(
+            [b'3', b'ghost'], [], revision_id=b'4')
+        self.merge_sorted()
+        self.assertFalse(self.branch._transport.has(revno_cache.FILENAME))
+
+    def test_linear_extension(self):
+        self.merge_sorted()
+        self.builder.build_snapshot([b'3'], [], revision_id=b'4')
+        self.builder.build_snapshot([b'4'], [], revision_id=b'5')
+        self.overrideAttr(
+            self.branch.repository.__class__, 'get_known_graph_ancestry',
+            None)
+        self.assertEqual(
+            [(b'5', 0, (5,), False), (b'4', 0, (4,), False),
+             (b'3', 0, (3,), False), (b'1.1.1', 1, (1, 1, 1), True),
+             (b'2', 0, (2,), False), (b'1', 0, (1,), True)],
+            self.merge_sorted())
+        self.assertEqual((5, b'5'), self.cached_tip())
+
+    def test_merge_recomputes(self):
+        self.merge_sorted()
+        self.builder.build_snapshot([b'1.1.1'], [], revision_id=b'1.1.2')
+        self.builder.build_snapshot([b'3', b'1.1.2'], [], revision_id=b'4')
+        self.assertEqual(self.uncached_merge_sorted(), self.merge_sorted())
+        self.assertEqual((4, b'4'), self.cached_tip())
+
+    def test_tip_moved_back(self):
+        self.merge_sorted()
+        self.branch.set_last_revision_info(2, b'2')
+        self.assertEqual(
+            [(b'2', 0, (2,), False), (b'1', 0, (1,), True)],
+            self.merge_sorted())
+        self.assertEqual((2, b'2'), self.cached_tip())
+
+    def test_revision_id_to_dotted_revno(self):
+        self.merge_sorted()
+        branch = _mod_branch.Branch.open('branch')
+        self.assertEqual(
+            (1, 1, 1), branch.revision_id_to_dotted_revno(b'1.1.1'))
+        self.assertEqual(
+            b'1.1.1', branch.dotted_revno_to_revision_id((1, 1, 1)))
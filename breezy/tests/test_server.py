@@ -145,6 +145,14 @@ class BrokenRenameServer(DecoratorServer):
         return brokenrename.BrokenRenameTransportDecorator
 
 
+class CachingServer(DecoratorServer):
+    """Server for the CachingTransportDecorator for testing with."""
+
+    def get_decorator_class(self):
+        from breezy.transport import cache
+        return cache.CachingTransportDecorator
+
+
 class FakeNFSServer(DecoratorServer):
     """Server for the FakeNFSTransportDecorator for testing with."""
 
@@ -420,6 +420,59 @@ class ReadvFile(object):
         pass
 
 
+class PipelinedSFTPFile(object):
+    """Acts like Paramiko's SFTPFile and SFTPClient for pipelined requests.
+
+    Replies are sent most recent request first, to exercise out of order
+    completion.
+    """
+
+    def __init__(self, data=b''):
+        self.data = data
+        self.sftp = self
+        self.handle = b'handle'
+        self.in_flight = {}
+        self.max_in_flight = 0
+        self._next_num = 0
+
+    def _async_request(self, fileobj, t, *args):
+        num = self._next_num
+        self._next_num += 1
+        self.in_flight[num] = (fileobj, t, args)
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        return num
+
+    def _reply(self, t, args):
+        import paramiko
+        msg = paramiko.Message()
+        handle, offset, payload = args
+        if t == _mod_sftp.CMD_READ:
+            msg.add_string(self.data[offset:offset + payload])
+            t = _mod_sftp.CMD_DATA
+        else:
+            self.data = (self.data[:offset].ljust(offset, b'\0') + payload
+                         + self.data[offset + len(payload):])
+            msg.add_int(0)
+            t = _mod_sftp.CMD_STATUS
+        msg.rewind()
+        return t, msg
+
+    def _read_response(self, waitfor):
+        while True:
+            num = max(self.in_flight)
+            fileobj, t, args = self.in_flight.pop(num)
+            t, msg = self._reply(t, args)
+            if num == waitfor:
+                return t, msg
+            fileobj._async_response(t, msg, num)
+
+    def _convert_status(self, msg):
+        pass
+
+    def close(self):
+        pass
+
+
 def _null_report_activity(*a, **k):
     pass
 
@@ -468,6 +521,63 @@ class Test_SFTPReadvHelper(tests.TestCase):
             [(0, b'a'), (10, b'k'), (4, b'efg'), (1, b'bcd')],
             data, [(0, 1), (10, 1), (4, 3), (1, 3)])
 
+    def test_pipelined_request_and_yield_offsets(self):
+        self.requireFeature(features.paramiko)
+        data = bytes(bytearray(range(256))) * 1024
+        offsets = [(0, 10), (120000, 5000), (40000, 70000), (200000, 1)]
+        stats = _mod_sftp._SFTPTransferStats()
+        helper = _mod_sftp._SFTPReadvHelper(offsets, 'artificial_test',
+                                            _null_report_activity,
+                                            window_size=2, stats=stats)
+        data_f = PipelinedSFTPFile(data)
+        result = list(helper.request_and_yield_offsets(data_f))
+        self.assertEqual([(start, data[start:start + length])
+                          for start, length in offsets], result)
+        self.assertEqual(2, data_f.max_in_flight)
+        self.assertEqual(2, stats.max_in_flight)
+        self.assertEqual(10 + 5000 + 70000 + 1, stats.bytes['read'])
+
+    def test_pipelined_short_read(self):
+        self.requireFeature(features.paramiko)
+        helper = _mod_sftp._SFTPReadvHelper([(0, 5), (8, 5)],
+                                            'artificial_test',
+                                            _null_report_activity,
+                                            window_size=4)
+        data_f = PipelinedSFTPFile(b'0123456789')
+        self.assertRaises(errors.ShortReadvError, list,
+                          helper.request_and_yield_offsets(data_f))
+
+
+class Test_SFTPPipelinedWriter(tests.TestCase):
+
+    def setUp(self):
+        super(Test_SFTPPipelinedWriter, self).setUp()
+        self.requireFeature(features.paramiko)
+
+    def test_write(self):
+        fout = PipelinedSFTPFile()
+        stats = _mod_sftp._SFTPTransferStats()
+        writer = _mod_sftp._SFTPPipelinedWriter(fout, 3, stats=stats)
+        data = b'abcdefghij' * 20000
+        writer.write(data[:150000])
+        writer.write(data[150000:])
+        self.assertEqual(200000, writer.tell())
+        writer.close()
+        self.assertEqual(data, fout.data)
+        self.assertEqual({}, fout.in_flight)
+        self.assertEqual(3, fout.max_in_flight)
+        self.assertEqual(200000, stats.bytes['write'])
+        # 150000 bytes take five requests, 50000 bytes two
+        self.assertEqual(7, stats.requests)
+
+    def test_write_at_offset(self):
+        fout = PipelinedSFTPFile(b'0123')
+        writer = _mod_sftp._SFTPPipelinedWriter(fout, 3, offset=4)
+        writer.write(b'4567')
+        writer.flush()
+        self.assertEqual(b'01234567', fout.data)
+        self.assertEqual(8, writer.tell())
+
 
 class TestUsesAuthConfig(TestCaseWithSFTPServer):
     """Test that AuthenticationConfig can supply default usernames."""
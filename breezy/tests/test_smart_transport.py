@@ -22,6 +22,7 @@ import errno
 from io import BytesIO
 import os
 import socket
+import struct
 import subprocess
 import sys
 import threading
@@ -707,6 +708,26 @@ class TestSmartClientStreamMediumRequest(tests.TestCase):
         request.finished_reading()
         self.assertEqual(None, client_medium._current_request)
 
+    def test_pipelined_requests_become_current_in_turn(self):
+        # pipelined requests may be constructed while another is active; they
+        # become the current request in order as the earlier ones finish.
+        output = BytesIO()
+        client_medium = medium.SmartSimplePipesClientMedium(
+            None, output, 'base')
+        request = client_medium.get_request()
+        request.finished_writing()
+        request2 = client_medium.get_request(pipelined=True)
+        request2.finished_writing()
+        request3 = client_medium.get_request(pipelined=True)
+        request3.finished_writing()
+        self.assertIs(request, client_medium._current_request)
+        request.finished_reading()
+        self.assertIs(request2, client_medium._current_request)
+        request2.finished_reading()
+        self.assertIs(request3, client_medium._current_request)
+        request3.finished_reading()
+        self.assertEqual(None, client_medium._current_request)
+
     def test_finished_read_before_finished_write_errors(self):
         # calling finished_reading before calling finished_writing triggers a
         # WritingNotComplete error.
@@ -1039,6 +1060,24 @@ class TestSmartServerStreamMedium(tests.TestCase):
         server._disconnect_client()
         self.assertEqual(b'', client_sock.recv(1))
 
+    def test_socket_build_protocol_for_pushed_back_request(self):
+        # If the client pipelined its requests, the next one may already have
+        # been read. _build_protocol must not wait for more bytes then.
+        transport = local.LocalTransport(urlutils.local_path_to_url('/'))
+        server, client_sock = self.create_socket_context(
+            transport, timeout=0.01)
+        hello_request = (b'bzr message 3 (bzr 1.6)\n'
+                         b'\x00\x00\x00\x02de'
+                         b's\x00\x00\x00\tl5:helloee')
+        client_sock.sendall(hello_request * 2)
+        server._serve_one_request(server._build_protocol())
+        server._serve_one_request(server._build_protocol())
+        self.assertFalse(server.finished)
+        self.assertEqual(None, server._push_back_buffer)
+        server._disconnect_client()
+        response = client_sock.recv(4096)
+        self.assertEqual(2, response.count(b'bzr message 3 (bzr 1.6)\n'))
+
     def test_pipe_like_stream_error_handling(self):
         # Use plain python BytesIO so we can monkey-patch the close method to
         # not discard the contents.
@@ -1488,6 +1527,232 @@ class TestSmartTCPServer(tests.TestCase):
         server_thread.join()
 
 
+class TestPooledSmartTCPServer(tests.TestCase):
+
+    ensure_client_disconnected = TestSmartTCPServer.ensure_client_disconnected
+    connect_to_server = TestSmartTCPServer.connect_to_server
+    connect_to_server_and_hangup = (
+        TestSmartTCPServer.connect_to_server_and_hangup)
+    say_hello = TestSmartTCPServer.say_hello
+    shutdown_server_cleanly = TestSmartTCPServer.shutdown_server_cleanly
+
+    def make_server(self, workers=1, max_connections=None, max_pending=None):
+        t = _mod_transport.get_transport_from_url('memory:///')
+        server = _mod_server.PooledSmartTCPServer(
+            t, client_timeout=4.0, workers=workers,
+            max_connections=max_connections, max_pending=max_pending)
+        server._ACCEPT_TIMEOUT = 0.1
+        server.start_server('127.0.0.1', 0)
+        server_thread = threading.Thread(target=server.serve,
+                                         args=(self.id(),))
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server._stop_gracefully)
+        server._started.wait()
+        return server, server_thread
+
+    def test_rejects_zero_workers(self):
+        self.assertRaises(ValueError, _mod_server.PooledSmartTCPServer,
+                          None, client_timeout=4.0, workers=0)
+
+    def test_idle_clients_do_not_hold_workers(self):
+        server, server_thread = self.make_server(workers=1)
+        client_socks = [self.connect_to_server(server) for i in range(3)]
+        for client_sock in client_socks:
+            self.say_hello(client_sock)
+        # All three stay connected, and can make further requests.
+        for client_sock in reversed(client_socks):
+            self.say_hello(client_sock)
+        stats = server.get_stats()
+        self.assertEqual(3, stats['accepted'])
+        self.assertEqual(6, stats['requests'])
+        self.assertEqual(0, stats['rejected'])
+        for client_sock in client_socks:
+            client_sock.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_slow_clients_do_not_hold_workers(self):
+        server, server_thread = self.make_server(workers=1)
+        slow_sock = self.connect_to_server(server)
+        # Only part of the request is sent for now.
+        slow_sock.send(b'hel')
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        slow_sock.send(b'lo\n')
+        self.assertEqual(b'ok\x012\n', slow_sock.recv(5))
+        self.assertEqual(2, server.get_stats()['requests'])
+        slow_sock.close()
+        client_sock.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_request_complete(self):
+        request = (protocol.MESSAGE_VERSION_THREE +
+                   struct.pack('!L', 2) + b'de' +
+                   b's' + struct.pack('!L', 9) + b'l5:helloe' +
+                   b'o' + b'x' +
+                   b'b' + struct.pack('!L', 3) + b'abc' +
+                   b'e')
+        for i in range(len(request)):
+            self.assertFalse(_mod_server._request_complete(request[:i]))
+        self.assertTrue(_mod_server._request_complete(request))
+        self.assertTrue(_mod_server._request_complete(request + b'bzr'))
+        self.assertFalse(_mod_server._request_complete(
+            protocol.REQUEST_VERSION_TWO + b'hello'))
+        self.assertTrue(_mod_server._request_complete(
+            protocol.REQUEST_VERSION_TWO + b'hello\n'))
+        self.assertFalse(_mod_server._request_complete(b'hello'))
+        self.assertTrue(_mod_server._request_complete(b'hello\n'))
+
+    def test_request_dispatched_hook(self):
+        calls = []
+        _mod_server.SmartTCPServer.hooks.install_named_hook(
+            'request_dispatched',
+            lambda server, wait, depth: calls.append((server, depth)), None)
+        server, server_thread = self.make_server()
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        self.assertEqual([(server, 0)], calls)
+        client_sock.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_pending_client_admitted_when_slot_frees(self):
+        server, server_thread = self.make_server(
+            max_connections=1, max_pending=1)
+        client_sock1 = self.connect_to_server(server)
+        self.say_hello(client_sock1)
+        client_sock2 = self.connect_to_server(server)
+        client_sock2.send(b'hello\n')
+        # The second client only gets its answer once the first hangs up.
+        client_sock1.close()
+        self.assertEqual(b'ok\x012\n', client_sock2.recv(5))
+        stats = server.get_stats()
+        self.assertEqual(1, stats['queued'])
+        self.assertEqual(0, stats['rejected'])
+        client_sock2.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_rejects_clients_beyond_pending_limit(self):
+        rejected = []
+        _mod_server.SmartTCPServer.hooks.install_named_hook(
+            'connection_rejected',
+            lambda server, addr: rejected.append(server), None)
+        server, server_thread = self.make_server(
+            max_connections=1, max_pending=0)
+        client_sock1 = self.connect_to_server(server)
+        self.say_hello(client_sock1)
+        client_sock2 = self.connect_to_server(server)
+        # The server hangs up without answering.
+        try:
+            client_sock2.send(b'hello\n')
+            self.assertEqual(b'', client_sock2.recv(5))
+        except socket.error:
+            pass
+        self.assertEqual([server], rejected)
+        self.assertEqual(1, server.get_stats()['rejected'])
+        self.say_hello(client_sock1)
+        client_sock1.close()
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_disconnects_idle_clients(self):
+        server, server_thread = self.make_server()
+        offset = [0.0]
+        server._timer = lambda: time.time() + offset[0]
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        while server.get_stats()['idle'] != 1:
+            time.sleep(0.01)
+        # Pretend the client has been idle for too long.
+        offset[0] = 10.0
+        self.assertEqual(b'', client_sock.recv(5))
+        self.assertEqual(0, server.get_stats()['idle'])
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_graceful_shutdown_waits_for_clients_to_stop(self):
+        server, server_thread = self.make_server()
+        server.backing_transport.put_bytes('bigfile',
+                                           b'a' * 1024 * 1024)
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        client_medium = medium.SmartClientAlreadyConnectedSocketMedium(
+            'base', client_sock)
+        client_client = client._SmartClient(client_medium)
+        resp, response_handler = client_client.call_expecting_body(b'get',
+                                                                   b'bigfile')
+        self.assertEqual((b'ok',), resp)
+        server._stop_gracefully()
+        self.connect_to_server_and_hangup(server)
+        server._stopped.wait()
+        self.assertRaises(socket.error, self.connect_to_server, server)
+        response_handler.read_body_bytes()
+        server_thread.join()
+        self.assertTrue(server._fully_stopped.isSet())
+        self.assertEqual(0, server.get_stats()['busy'])
+
+
+class TestPreforkingSmartTCPServer(tests.TestCase):
+
+    connect_to_server = TestSmartTCPServer.connect_to_server
+    ensure_client_disconnected = TestSmartTCPServer.ensure_client_disconnected
+    say_hello = TestSmartTCPServer.say_hello
+
+    def setUp(self):
+        super(TestPreforkingSmartTCPServer, self).setUp()
+        if getattr(os, 'fork', None) is None:
+            raise tests.TestNotApplicable('os.fork() is not available')
+
+    def make_server(self, processes=2, max_requests_per_process=None):
+        t = _mod_transport.get_transport_from_url('memory:///')
+        server = _mod_server.PreforkingSmartTCPServer(
+            t, client_timeout=4.0, processes=processes,
+            max_requests_per_process=max_requests_per_process, workers=1)
+        server._ACCEPT_TIMEOUT = 0.1
+        server.start_server('127.0.0.1', 0)
+        server_thread = threading.Thread(target=server.serve,
+                                         args=(self.id(),))
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server._stop_gracefully)
+        server._started.wait()
+        return server, server_thread
+
+    def test_rejects_zero_processes(self):
+        self.assertRaises(ValueError, _mod_server.PreforkingSmartTCPServer,
+                          None, client_timeout=4.0, processes=0)
+
+    def test_serves_clients(self):
+        server, server_thread = self.make_server()
+        client_socks = [self.connect_to_server(server) for i in range(3)]
+        for client_sock in client_socks:
+            self.say_hello(client_sock)
+        self.assertEqual(2, server.processes_started)
+        for client_sock in client_socks:
+            client_sock.close()
+
+    def test_replaces_processes_after_max_requests(self):
+        server, server_thread = self.make_server(
+            processes=1, max_requests_per_process=1)
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        # Having served its request, the process hangs up and exits.
+        self.assertEqual(b'', client_sock.recv(5))
+        while server.processes_started < 2:
+            time.sleep(0.01)
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        client_sock.close()
+
+    def test_graceful_stop_waits_for_processes(self):
+        server, server_thread = self.make_server()
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        server._stop_gracefully()
+        # The worker process hangs up on the idle client, and exits.
+        self.assertEqual(b'', client_sock.recv(5))
+        server_thread.join()
+        self.assertTrue(server._fully_stopped.is_set())
+        self.assertEqual(set(), server._children)
+
+
 class SmartTCPTests(tests.TestCase):
     """Tests for connection/end to end behaviour using the TCP server.
 
@@ -3280,6 +3545,51 @@ class TestClientEncodingProtocolThree(TestSmartProtocol):
             b'e',  # end
             output.getvalue())
 
+    def test_call_with_compressed_body_stream(self):
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.set_body_compression('zlib', 9)
+        stream = [b'chunk 1', b'chunk two' * 100]
+        requester.call_with_body_stream((b'one arg',), stream)
+        request_bytes = output.getvalue()
+        self.assertStartsWith(
+            request_bytes,
+            b'bzr message 3 (bzr 1.6)\n'  # protocol version
+            b'\x00\x00\x00\x1bd16:Body compression4:zlibe')  # headers
+        self.assertTrue(len(request_bytes) < 200)
+        # The server decompresses the stream again.
+        request_handler = InstrumentedRequestHandler()
+        request_handler.response = _mod_request.SuccessfulSmartServerResponse(
+            (b'ok',))
+        decoder = protocol.ProtocolThreeDecoder(
+            message.ConventionalRequestHandler(
+                request_handler, FakeResponder()))
+        decoder.accept_bytes(
+            request_bytes[len(protocol.MESSAGE_VERSION_THREE):])
+        self.assertEqual(
+            stream,
+            [call_info[1] for call_info in request_handler.calls
+             if call_info[0] == 'accept_body'])
+
+    def test_call_with_compressed_body_stream_splits_large_parts(self):
+        self.overrideAttr(message, 'MAX_BODY_PART_SIZE', 1000)
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.set_body_compression('zlib')
+        requester.call_with_body_stream((b'arg',), [b'a' * 2500, b'b'])
+        request_handler = InstrumentedRequestHandler()
+        request_handler.response = _mod_request.SuccessfulSmartServerResponse(
+            (b'ok',))
+        decoder = protocol.ProtocolThreeDecoder(
+            message.ConventionalRequestHandler(
+                request_handler, FakeResponder()))
+        decoder.accept_bytes(
+            output.getvalue()[len(protocol.MESSAGE_VERSION_THREE):])
+        self.assertEqual(
+            [b'a' * 1000, b'a' * 1000, b'a' * 500, b'b'],
+            [call_info[1] for call_info in request_handler.calls
+             if call_info[0] == 'accept_body'])
+
     def test_call_with_body_stream_empty_stream(self):
         """call_with_body_stream with an empty stream."""
         requester, output = self.make_client_encoder_and_output()
@@ -3417,6 +3727,79 @@ class TestResponseEncodingProtocolThree(tests.TestCase):
         self.assertEqual(expected_response, out_stream.getvalue())
 
 
+    def test_send_compressed_body_stream(self):
+        encoder, out_stream = self.make_response_encoder()
+        encoder.accept_body_compression(b'zlib:1')
+        chunks = [b'aaa' * 1000, b'bbb' * 1000]
+        response = _mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body_stream=iter(chunks))
+        encoder.send_response(response)
+        response_bytes = out_stream.getvalue()
+        self.assertTrue(len(response_bytes) < 1000)
+        response_handler = message.ConventionalResponseHandler()
+        decoder = protocol.ProtocolThreeDecoder(
+            response_handler, expect_version_marker=True)
+        client_medium = medium.SmartSimplePipesClientMedium(
+            BytesIO(response_bytes), BytesIO(), 'base')
+        medium_request = client_medium.get_request()
+        medium_request.finished_writing()
+        response_handler.setProtoAndMediumRequest(decoder, medium_request)
+        self.assertEqual((b'args',), response_handler.read_response_tuple(
+            expect_body=True))
+        self.assertEqual(b'zlib', response_handler.headers[b'Body compression'])
+        self.assertEqual(chunks, list(response_handler.read_streamed_body()))
+        self.assertEqual(6000, response_handler.body_bytes)
+        self.assertTrue(response_handler.wire_body_bytes < 1000)
+
+    def test_ignore_unsupported_body_compression(self):
+        encoder, out_stream = self.make_response_encoder()
+        encoder.accept_body_compression(b'unknown:1')
+        response = _mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body_stream=iter([b'aaa']))
+        encoder.send_response(response)
+        self.assertNotContainsString(
+            out_stream.getvalue(), b'Body compression4:')
+        self.assertEndsWith(out_stream.getvalue(), b'b\x00\x00\x00\x03aaae')
+
+
+class TestBodyCompression(tests.TestCase):
+
+    def test_parse_body_compression(self):
+        self.assertEqual(('zlib', None),
+                         message.parse_body_compression('zlib'))
+        self.assertEqual(('zlib', 9),
+                         message.parse_body_compression('zlib:9'))
+        self.assertRaises(ValueError, message.parse_body_compression, 'lzma')
+        self.assertRaises(ValueError, message.parse_body_compression,
+                          'zlib:high')
+
+    def test_zlib_round_trip(self):
+        compress = message.make_body_compressor('zlib', None)
+        decompress = message._body_decompressor_for_headers(
+            {b'Body compression': b'zlib'})
+        # Each part decompresses on its own, in order.
+        for part in [b'', b'first part', b'second part' * 10]:
+            self.assertEqual(part, decompress(compress(part)))
+
+    def test_zlib_part_too_large(self):
+        self.overrideAttr(message, 'MAX_BODY_PART_SIZE', 1000)
+        compress = message.make_body_compressor('zlib', None)
+        decompress = message._body_decompressor_for_headers(
+            {b'Body compression': b'zlib'})
+        self.assertEqual(b'a' * 1000, decompress(compress(b'a' * 1000)))
+        self.assertRaises(
+            errors.SmartProtocolError, decompress, compress(b'a' * 1001))
+
+    def test_unknown_codec_in_headers(self):
+        self.assertRaises(
+            errors.SmartProtocolError,
+            message._body_decompressor_for_headers,
+            {b'Body compression': b'unknown'})
+
+    def test_no_codec_in_headers(self):
+        self.assertIs(None, message._body_decompressor_for_headers({}))
+
+
 class TestResponseEncoderBufferingProtocolThree(tests.TestCase):
     """Tests for buffering of responses.
 
@@ -3777,6 +4160,79 @@ class Test_SmartClient(tests.TestCase):
         # XXX: need a test that smart_client._headers is passed to the request
         # encoder.
 
+    def make_response(self, args):
+        response_io = BytesIO()
+        if args[0] == b'error':
+            response = _mod_request.FailedSmartServerResponse(args[1:])
+        else:
+            response = _mod_request.SuccessfulSmartServerResponse(args)
+        responder = protocol.ProtocolThreeResponder(response_io.write)
+        responder.send_response(response)
+        return response_io.getvalue()
+
+    def make_client(self, responses):
+        output = BytesIO()
+        written_before_reads = []
+
+        class RecordingInput(BytesIO):
+
+            def read(self, count=-1):
+                written_before_reads.append(len(output.getvalue()))
+                # Like a socket, return whatever is available.
+                return BytesIO.read(self)
+
+        response_bytes = b''.join(
+            self.make_response(args) for args in responses)
+        client_medium = medium.SmartSimplePipesClientMedium(
+            RecordingInput(response_bytes), output, 'base')
+        return client._SmartClient(client_medium), written_before_reads
+
+    def test_call_many_pipelines_requests(self):
+        smart_client, written = self.make_client(
+            [(b'ok', b'1'), (b'ok', b'2'), (b'error', b'nope')])
+        client_medium = smart_client._medium
+        client_medium._protocol_version = 3
+        client_medium._remote_accepts_pipelining = True
+        results = smart_client.call_many(
+            [(b'foo', (b'1',)), (b'foo', (b'2',)), (b'foo', (b'3',))])
+        self.assertEqual([(b'ok', b'1'), (b'ok', b'2')], results[:2])
+        self.assertIsInstance(results[2], errors.ErrorFromSmartServer)
+        self.assertEqual((b'nope',), results[2].error_tuple)
+        # All three requests were sent before reading the first response.
+        self.assertEqual(
+            3, client_medium._writeable_pipe.getvalue().count(
+                b'bzr message 3'))
+        self.assertEqual(
+            len(client_medium._writeable_pipe.getvalue()), written[0])
+        self.assertEqual(None, client_medium._current_request)
+
+    def test_call_many_learns_server_accepts_pipelining(self):
+        smart_client, written = self.make_client(
+            [(b'ok', b'1'), (b'ok', b'2'), (b'ok', b'3')])
+        client_medium = smart_client._medium
+        results = smart_client.call_many(
+            [(b'foo', (b'1',)), (b'foo', (b'2',)), (b'foo', (b'3',))])
+        self.assertEqual([(b'ok', b'1'), (b'ok', b'2'), (b'ok', b'3')],
+                         results)
+        # The first call told us the server's protocol version and that it
+        # accepts pipelined requests, so the other two were pipelined.
+        self.assertEqual(3, client_medium._protocol_version)
+        self.assertTrue(client_medium._remote_accepts_pipelining)
+        self.assertEqual(None, client_medium._current_request)
+
+    def test_call_many_without_pipelining(self):
+        debug.debug_flags.add('nopipeline')
+        smart_client, written = self.make_client(
+            [(b'ok', b'1'), (b'ok', b'2')])
+        client_medium = smart_client._medium
+        client_medium._protocol_version = 3
+        client_medium._remote_accepts_pipelining = True
+        results = smart_client.call_many(
+            [(b'foo', (b'1',)), (b'foo', (b'2',))])
+        self.assertEqual([(b'ok', b'1'), (b'ok', b'2')], results)
+        output = client_medium._writeable_pipe.getvalue()
+        self.assertTrue(written[0] < len(output))
+
 
 class Test_SmartClientRequest(tests.TestCase):
 
@@ -708,6 +708,35 @@ class TestWorkingTreeFormat4(TestCaseWithTransport):
                               tree_iter_changes, tree, [u'\xa7', u'\u03c0'])
         self.assertEqual(set(e.paths), set([u'\xa7', u'\u03c0']))
 
+    def test_iter_changes_in_threads(self):
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['a/', 'a/foo', 'a/bar', 'b/', 'b/baz', 'qux'])
+        tree.add(['a', 'a/foo', 'a/bar', 'b', 'b/baz', 'qux'])
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        # Make the hashes of the unmodified files cachable
+        tree.current_dirstate()._cutoff_time = time.time() + 60
+        tree.commit('one')
+        self.build_tree_contents([
+            ('a/foo', b'new foo\n'), ('b/baz', b'new baz\n')])
+        tree.get_config_stack().set('dirstate.iter_changes_jobs', 4)
+        basis = tree.basis_tree()
+        basis.lock_read()
+        self.addCleanup(basis.unlock)
+        provider = tree.current_dirstate()._sha1_provider
+        prepared = []
+
+        def prepare_stat_and_sha1(abspath):
+            prepared.append(osutils.basename(abspath))
+            return orig(abspath)
+        orig = self.overrideAttr(
+            provider, 'prepare_stat_and_sha1', prepare_stat_and_sha1)
+        changes = [c.path for c in tree.iter_changes(basis)]
+        self.assertEqual([('a/foo', 'a/foo'), ('b/baz', 'b/baz')], changes)
+        self.assertEqual(['foo', 'baz'], prepared)
+        # The original provider is used again afterwards
+        self.assertIs(provider, tree.current_dirstate()._sha1_provider)
+
     def get_tree_with_cachable_file_foo(self):
         tree = self.make_branch_and_tree('.')
         tree.lock_write()
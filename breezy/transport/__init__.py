@@ -1689,6 +1689,10 @@ register_transport_proto('readonly+',
 register_lazy_transport('readonly+', 'breezy.transport.readonly',
                         'ReadonlyTransportDecorator')
 
+register_transport_proto('cache+')
+register_lazy_transport('cache+', 'breezy.transport.cache',
+                        'CachingTransportDecorator')
+
 register_transport_proto('fakenfs+')
 register_lazy_transport('fakenfs+', 'breezy.transport.fakenfs',
                         'FakeNFSTransportDecorator')
@@ -0,0 +1,567 @@
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Transport decorator that keeps a local copy of the data it reads.
+
+This is requested via the 'cache+' prefix to get_transport(). The byte
+ranges read from the decorated transport are stored on local disk, under
+the breezy cache directory, and later reads of the same ranges (in this or
+another process) are served from there.
+
+This is only correct for files that never change once written, such as the
+packs and indices of a pack repository. Changes made through the decorator
+itself invalidate the cached data, changes made behind its back do not.
+"""
+
+import binascii
+import bisect
+import contextlib
+import errno
+import os
+import time
+from io import BytesIO
+
+from .. import (
+    bedding,
+    config,
+    errors,
+    lock,
+    osutils,
+    urlutils,
+    )
+from ..trace import mutter
+from . import decorator
+
+
+opt_transport_cache_size = config.Option(
+    'transport.cache_size', default=u'100MB',
+    from_unicode=config.int_SI_from_store,
+    help="""\
+Size of the local cache of immutable files read from remote locations.
+
+Parts of pack files and pack indices read from a remote repository are kept
+in the breezy cache directory, so later commands do not download them again.
+The least recently used files are removed when the cache grows larger than
+this. Set to 0 to disable the cache.
+""")
+
+
+def get_cache_dir():
+    """Return the directory holding the cached files."""
+    return osutils.pathjoin(bedding.cache_dir(), 'transport')
+
+
+def strip_credentials(url):
+    """Return url without the user name and password in it.
+
+    Cached files are keyed by their url, which is also recorded on disk, so
+    credentials must not end up in there.
+    """
+    parsed = urlutils.URL.from_string(url)
+    parsed.user = parsed.quoted_user = None
+    parsed.password = parsed.quoted_password = None
+    return str(parsed)
+
+
+# Every data file starts with a header holding a random token, which its map
+# file records too. Files are only ever replaced or removed, never truncated,
+# so a data file whose token matches that of a map holds the ranges listed
+# in the map, even if other processes have changed the cache since.
+_HEADER = b'Breezy transport cache 1\n'
+_TOKEN_SIZE = 32
+_HEADER_SIZE = len(_HEADER) + _TOKEN_SIZE + 1
+
+# How long to wait for another process to finish updating the cache, in
+# seconds.
+_LOCK_TIMEOUT = 5.0
+
+
+class CacheEntry(object):
+    """The cached ranges of a single file.
+
+    The data is kept in a sparse ``.data`` file; the accompanying ``.map``
+    file records the url and size of the file, the token of the data file
+    and which ranges of the data file are valid.
+
+    Data written to an entry is kept in memory until it is flushed. The data
+    file and map are then updated together while holding the cache lock,
+    adding to whatever other processes stored in the meantime.
+    """
+
+    def __init__(self, cache, url, size):
+        self._cache = cache
+        self.url = strip_credentials(url)
+        self.size = size
+        key = osutils.sha_string(self.url.encode('utf-8')).decode('ascii')
+        self._data_path = osutils.pathjoin(cache.path, key + '.data')
+        self._map_path = osutils.pathjoin(cache.path, key + '.map')
+        # Token of the data file the ranges below are valid in
+        self._token = None
+        # Sorted, non-overlapping [start, end) ranges of valid data
+        self._starts = []
+        self._ends = []
+        # (offset, data) tuples that have not been written to disk yet
+        self._pending = []
+        self._dirty = False
+        self._load()
+
+    def _read_map(self):
+        """Read the map file.
+
+        :return: Tuple with the size, data file token and ranges, or None if
+            there is no usable map for this url.
+        """
+        try:
+            with open(self._map_path, 'rb') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            url = lines[0].decode('utf-8')
+            size = None if lines[1] == b'-' else int(lines[1])
+            token = lines[2]
+            if len(token) != _TOKEN_SIZE:
+                raise ValueError(token)
+            ranges = [tuple(int(v) for v in line.split(b' '))
+                      for line in lines[3:]]
+        except (IndexError, ValueError):
+            mutter('ignoring corrupt cache entry %s', self._map_path)
+            return None
+        if url != self.url:
+            # A hash collision, this is not our file
+            return None
+        return size, token, ranges
+
+    def _set_ranges(self, token, ranges):
+        self._token = token
+        self._starts = [start for start, end in ranges]
+        self._ends = [end for start, end in ranges]
+
+    def _load(self):
+        on_disk = self._read_map()
+        if on_disk is None:
+            return
+        size, token, ranges = on_disk
+        if size is not None:
+            if self.size is None:
+                self.size = size
+            elif self.size != size:
+                mutter('size of %s changed from %d to %d, discarding cache',
+                       self.url, size, self.size)
+                self._dirty = True
+                return
+        self._set_ranges(token, ranges)
+        if self.size != size:
+            self._dirty = True
+        # Mark the entry as recently used.
+        try:
+            os.utime(self._map_path, None)
+        except (IOError, OSError):
+            pass
+
+    def _covered(self, offset, length):
+        index = bisect.bisect_right(self._starts, offset) - 1
+        return index >= 0 and self._ends[index] >= offset + length
+
+    def covers(self, offset, length):
+        """Is the range [offset, offset+length) fully cached?"""
+        if self._covered(offset, length):
+            return True
+        for start, data in self._pending:
+            if start <= offset and start + len(data) >= offset + length:
+                return True
+        return False
+
+    def read(self, offset, length):
+        """Return the cached bytes of a range, or None if unavailable."""
+        for start, data in self._pending:
+            if start <= offset and start + len(data) >= offset + length:
+                return data[offset - start:offset - start + length]
+        if not self._covered(offset, length):
+            return None
+        try:
+            with open(self._data_path, 'rb') as f:
+                header = f.read(_HEADER_SIZE)
+                if header == _HEADER + self._token + b'\n':
+                    f.seek(_HEADER_SIZE + offset)
+                    data = f.read(length)
+                else:
+                    data = b''
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = b''
+        if len(data) != length:
+            # Evicted or replaced by another process
+            self._set_ranges(None, [])
+            return None
+        return data
+
+    def write(self, offset, data):
+        """Add the bytes of a range to the cache.
+
+        The data is stored on disk when the entry is flushed.
+        """
+        if not data or self.covers(offset, len(data)):
+            return
+        self._pending.append((offset, data))
+
+    def flush(self):
+        """Write the pending data and the map of cached ranges to disk."""
+        if not self._pending and not self._dirty:
+            return
+        pending = self._pending
+        self._pending = []
+        self._dirty = False
+        try:
+            with self._cache.lock():
+                self._write(pending)
+        except (errors.LockError, IOError, OSError) as e:
+            # The cache is only an optimisation
+            mutter('unable to write to the transport cache: %s', e)
+
+    def _data_token(self):
+        """Return the token of the data file on disk, or None."""
+        try:
+            with open(self._data_path, 'rb') as f:
+                header = f.read(_HEADER_SIZE)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if len(header) != _HEADER_SIZE or not header.startswith(_HEADER):
+            return None
+        return header[len(_HEADER):-1]
+
+    def _write(self, pending):
+        """Store data and update the map; the cache lock must be held."""
+        on_disk = self._read_map()
+        if on_disk is not None:
+            size, token, ranges = on_disk
+            if ((size is None or self.size is None or size == self.size) and
+                    token == self._data_token()):
+                # Include the ranges other processes have stored; the ranges
+                # we know of are among them, unless the data file was
+                # replaced since.
+                self._set_ranges(token, ranges)
+                if self.size is None:
+                    self.size = size
+                if not pending and size == self.size:
+                    return
+                on_disk = True
+            else:
+                on_disk = None
+        added = 0
+        if on_disk is None:
+            self._set_ranges(
+                binascii.hexlify(os.urandom(_TOKEN_SIZE // 2)), [])
+            self._cache.ensure_dir()
+            tmp_path = self._data_path + '.tmp.%d' % os.getpid()
+            with open(tmp_path, 'wb') as f:
+                f.write(_HEADER + self._token + b'\n')
+            osutils.rename(tmp_path, self._data_path)
+            # The data file replaced may have been of any size.
+            self._cache.forget_usage()
+            added += _HEADER_SIZE
+        if pending:
+            with open(self._data_path, 'r+b') as f:
+                for offset, data in pending:
+                    if self._covered(offset, len(data)):
+                        continue
+                    f.seek(_HEADER_SIZE + offset)
+                    f.write(data)
+                    self._add_range(offset, offset + len(data))
+                    added += len(data)
+        lines = [self.url.encode('utf-8'),
+                 b'-' if self.size is None else b'%d' % self.size,
+                 self._token]
+        lines.extend(b'%d %d' % r for r in zip(self._starts, self._ends))
+        tmp_path = self._map_path + '.tmp.%d' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\n'.join(lines) + b'\n')
+        osutils.rename(tmp_path, self._map_path)
+        self._cache.account(self, added)
+
+    def _add_range(self, start, end):
+        # Merge with every range overlapping or touching the new one
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_right(self._starts, end)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def discard(self):
+        """Remove the cached data of this file."""
+        self._set_ranges(None, [])
+        self._pending = []
+        self._dirty = False
+        try:
+            with self._cache.lock():
+                self._cache.remove(self._data_path, self._map_path)
+        except errors.LockError as e:
+            mutter('unable to lock the transport cache: %s', e)
+            self._cache.remove(self._data_path, self._map_path)
+
+
+class RangeCache(object):
+    """A size-bounded directory of partially cached files.
+
+    When the cache grows larger than its maximum size, the files used least
+    recently are removed. Changes to the cache are made while holding a lock
+    on the cache directory, so that several processes can share it.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._usage = None
+
+    def get_entry(self, url, size=None):
+        """Return the CacheEntry for a url.
+
+        :param size: The size of the file if known. Cached data recorded for
+            a different size is discarded.
+        """
+        return CacheEntry(self, url, size)
+
+    def ensure_dir(self):
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Lock the cache against changes by other processes.
+
+        :raise LockContention: if the lock can not be taken within
+            _LOCK_TIMEOUT seconds
+        """
+        self.ensure_dir()
+        lock_path = osutils.pathjoin(self.path, 'lock')
+        deadline = time.time() + _LOCK_TIMEOUT
+        while True:
+            try:
+                cache_lock = lock.WriteLock(lock_path)
+            except errors.LockContention:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+            else:
+                break
+        try:
+            yield
+        finally:
+            cache_lock.unlock()
+
+    def _iter_data_files(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if not name.endswith('.data'):
+                continue
+            data_path = osutils.pathjoin(self.path, name)
+            map_path = data_path[:-len('.data')] + '.map'
+            try:
+                st = os.stat(data_path)
+            except OSError:
+                continue
+            try:
+                last_used = os.stat(map_path).st_mtime
+            except OSError:
+                last_used = 0
+            yield last_used, st.st_size, data_path, map_path
+
+    def forget_usage(self):
+        """Recount the size of the cache when it is next needed."""
+        self._usage = None
+
+    def account(self, entry, added):
+        """Record that bytes were added to an entry, evicting if needed.
+
+        The cache lock must be held.
+        """
+        if self._usage is None:
+            self._usage = sum(
+                size for _, size, _, _ in self._iter_data_files())
+        else:
+            self._usage += added
+        if self._usage <= self.max_size:
+            return
+        for last_used, size, data_path, map_path in sorted(
+                self._iter_data_files()):
+            if self._usage <= self.max_size:
+                break
+            if data_path == entry._data_path:
+                continue
+            mutter('evicting %s from the transport cache', data_path)
+            self.remove(data_path, map_path)
+            self._usage -= size
+
+    def remove(self, data_path, map_path):
+        for path in (map_path, data_path):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class CachingTransportDecorator(decorator.TransportDecorator):
+    """A decorator that keeps a local copy of the data it reads.
+
+    Cached data is keyed by the url of the file and, when known, its size.
+    """
+
+    def __init__(self, url, _decorated=None, _from_transport=None):
+        super(CachingTransportDecorator, self).__init__(
+            url, _decorated=_decorated, _from_transport=_from_transport)
+        if _from_transport is not None:
+            self._cache = _from_transport._cache
+        else:
+            max_size = config.GlobalStack().get('transport.cache_size')
+            if max_size:
+                self._cache = RangeCache(get_cache_dir(), max_size)
+            else:
+                self._cache = None
+
+    @classmethod
+    def _get_url_prefix(self):
+        """Caching transport decorators are invoked via 'cache+'"""
+        return 'cache+'
+
+    def _get_entry(self, relpath, size=None):
+        return self._cache.get_entry(self._decorated.abspath(relpath), size)
+
+    def _invalidate(self, relpath):
+        if self._cache is not None:
+            self._get_entry(relpath).discard()
+
+    def get(self, relpath):
+        """See Transport.get()."""
+        if self._cache is None:
+            return self._decorated.get(relpath)
+        entry = self._get_entry(relpath)
+        if entry.size is not None:
+            data = entry.read(0, entry.size)
+            if data is not None:
+                return BytesIO(data)
+        data = self._decorated.get_bytes(relpath)
+        if entry.size is not None and entry.size != len(data):
+            entry.discard()
+            entry = self._get_entry(relpath, len(data))
+        entry.size = len(data)
+        if len(data) <= self._cache.max_size:
+            entry.write(0, data)
+            entry.flush()
+        return BytesIO(data)
+
+    def readv(self, relpath, offsets, adjust_for_latency=False,
+              upper_limit=None):
+        """See Transport.readv()."""
+        if self._cache is None:
+            return self._decorated.readv(relpath, offsets,
+                                         adjust_for_latency, upper_limit)
+        if adjust_for_latency:
+            offsets = self._sort_expand_and_combine(offsets, upper_limit)
+        return self._cached_readv(relpath, offsets, upper_limit)
+
+    def _readv(self, relpath, offsets):
+        """See Transport._readv."""
+        if self._cache is None:
+            return self._decorated._readv(relpath, offsets)
+        return self._cached_readv(relpath, offsets, None)
+
+    def _cached_readv(self, relpath, offsets, size):
+        offsets = list(offsets)
+        if not offsets:
+            return
+        entry = self._get_entry(relpath, size)
+        cached = [entry.covers(start, length) for start, length in offsets]
+        missing = [offset for offset, hit in zip(offsets, cached) if not hit]
+        if missing:
+            fetched = iter(self._decorated.readv(relpath, missing))
+        for (start, length), hit in zip(offsets, cached):
+            if hit:
+                data = entry.read(start, length)
+                if data is None:
+                    data = next(iter(self._decorated.readv(
+                        relpath, [(start, length)])))[1]
+                    entry.write(start, data)
+            else:
+                pos, data = next(fetched)
+                entry.write(pos, data)
+            # Store what was fetched before handing it out, so that later
+            # reads find it no matter when this generator is finished with.
+            entry.flush()
+            yield start, data
+
+    def append_file(self, relpath, f, mode=None):
+        """See Transport.append_file()."""
+        self._invalidate(relpath)
+        return self._decorated.append_file(relpath, f, mode=mode)
+
+    def append_bytes(self, relpath, bytes, mode=None):
+        """See Transport.append_bytes()."""
+        self._invalidate(relpath)
+        return self._decorated.append_bytes(relpath, bytes, mode=mode)
+
+    def delete(self, relpath):
+        """See Transport.delete()."""
+        self._invalidate(relpath)
+        return self._decorated.delete(relpath)
+
+    def move(self, rel_from, rel_to):
+        """See Transport.move()."""
+        self._invalidate(rel_from)
+        self._invalidate(rel_to)
+        return self._decorated.move(rel_from, rel_to)
+
+    def open_write_stream(self, relpath, mode=None):
+        """See Transport.open_write_stream."""
+        self._invalidate(relpath)
+        return self._decorated.open_write_stream(relpath, mode=mode)
+
+    def put_file(self, relpath, f, mode=None):
+        """See Transport.put_file()."""
+        self._invalidate(relpath)
+        return self._decorated.put_file(relpath, f, mode)
+
+    def put_bytes(self, relpath, bytes, mode=None):
+        """See Transport.put_bytes()."""
+        self._invalidate(relpath)
+        return self._decorated.put_bytes(relpath, bytes, mode)
+
+    def rename(self, rel_from, rel_to):
+        """See Transport.rename()."""
+        self._invalidate(rel_from)
+        self._invalidate(rel_to)
+        return self._decorated.rename(rel_from, rel_to)
+
+
+def get_test_permutations():
+    """Return the permutations to be used in testing."""
+    from ..tests import test_server
+    return [(CachingTransportDecorator, test_server.CachingServer), ]
@@ -23,8 +23,11 @@ DEBUG = 0
 
 import base64
 import cgi
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import errno
 import os
+import queue
 import re
 import socket
 import ssl
@@ -153,6 +156,27 @@ Possible values:
  * required: Certificates required and validated
 """)
 
+opt_http_readv_connections = config.Option(
+    'http.readv_connections', default=1,
+    from_unicode=config.int_from_store,
+    help="""\
+Number of connections used to read parts of a file over http.
+
+When greater than one, the GET requests needed to read many parts of a
+file (e.g. when fetching from a pack) are spread over that many keep-alive
+connections and issued in parallel. This helps on high latency links.
+""")
+
+opt_http_readv_window = config.Option(
+    'http.readv_window', default=4,
+    from_unicode=config.int_from_store,
+    help="""\
+Maximum number of GET requests in flight when reading parts of a file.
+
+Only used when http.readv_connections is greater than one. The answers
+are buffered in memory until they are consumed in order.
+""")
+
 checked_kerberos = False
 kerberos = None
 
@@ -1772,6 +1796,122 @@ class Opener(object):
             pprint.pprint(self._opener.__dict__)
 
 
+class _RangeData(object):
+    """The data read for a coalesced range, seekable at its file offsets."""
+
+    def __init__(self, start, data):
+        self._start = start
+        self._data = data
+        self._pos = start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise AssertionError('unsupported whence %r' % (whence,))
+        self._pos = offset
+
+    def read(self, size):
+        start = self._pos - self._start
+        data = self._data[start:start + size]
+        self._pos += len(data)
+        return data
+
+
+class _ReadvPool(object):
+    """Keep-alive connections used to issue readv requests in parallel.
+
+    Each connection belongs to a transport of its own, so that requests
+    issued in different threads never share an HTTP connection.
+    """
+
+    def __init__(self, connections, window):
+        self.connections = connections
+        self.window = max(window, 1)
+        self._executor = None
+        self._idle = queue.Queue()
+
+    def get(self, transport, relpath, batches):
+        """Issue a GET request for each batch of coalesced offsets.
+
+        :return: An iterator over (coalesced offset, file) tuples, in the
+            order of batches.
+        """
+        path = transport._parsed_url.clone(relpath).quoted_path
+        range_hint = transport._range_hint
+        batches = iter(batches)
+        in_flight = collections.deque()
+        try:
+            while True:
+                for batch in batches:
+                    in_flight.append(self._submit(
+                        self._get, transport, path, batch, range_hint))
+                    if len(in_flight) >= self.window:
+                        break
+                if not in_flight:
+                    return
+                result, activity = in_flight.popleft().result()
+                # Workers only record their activity, it is reported here so
+                # that the UI is only used from the calling thread.
+                for bytes, direction in activity:
+                    transport._report_activity(bytes, direction)
+                for coal, rfile in result:
+                    yield coal, rfile
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def _submit(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.connections)
+        return self._executor.submit(fn, *args)
+
+    def close(self):
+        """Stop the worker threads and close their connections.
+
+        The pool can still be used afterwards; threads and connections are
+        created again as needed.
+        """
+        executor = self._executor
+        self._executor = None
+        if executor is not None:
+            executor.shutdown()
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.disconnect()
+
+    def _get(self, transport, path, coalesced, range_hint):
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            worker = transport._clone_for_readv_pool()
+        try:
+            worker._range_hint = range_hint
+            code, rfile = worker._get(path, coalesced)
+            # Read everything now so that the connection can be reused.
+            result = []
+            for coal in coalesced:
+                rfile.seek(coal.start, os.SEEK_SET)
+                result.append(
+                    (coal, _RangeData(coal.start, rfile.read(coal.length))))
+            return result, list(worker._pooled_activity)
+        finally:
+            del worker._pooled_activity[:]
+            self._idle.put(worker)
+
+
+def _auth_for_readv_pool(auth):
+    """Copy negotiated authentication parameters for a pooled transport."""
+    auth = dict(auth)
+    if auth.get('scheme', None) == 'digest':
+        # Nonce counts must not be reused, and they are counted per
+        # transport; let the pooled transport get a nonce of its own.
+        for key in ('scheme', 'nonce', 'nonce_count'):
+            auth.pop(key, None)
+    return auth
+
+
 class HttpTransport(ConnectedTransport):
     """HTTP Client implementations.
 
@@ -1804,11 +1944,46 @@ class HttpTransport(ConnectedTransport):
         # propagated to clones.
         if _from_transport is not None:
             self._range_hint = _from_transport._range_hint
+            self._ca_certs = _from_transport._ca_certs
             self._opener = _from_transport._opener
+            self._readv_pool = _from_transport._readv_pool
         else:
             self._range_hint = 'multi'
+            self._ca_certs = ca_certs
             self._opener = Opener(
                 report_activity=self._report_activity, ca_certs=ca_certs)
+            self._readv_pool = self._create_readv_pool()
+
+    def _create_readv_pool(self):
+        conf = config.GlobalStack()
+        connections = conf.get('http.readv_connections')
+        if connections <= 1:
+            return None
+        return _ReadvPool(connections, conf.get('http.readv_window'))
+
+    def _clone_for_readv_pool(self):
+        """Create a transport that does not share our connection.
+
+        It has an opener of its own, as the authentication handlers of an
+        opener keep state and are not meant to be used from several threads.
+        Its activity is recorded in _pooled_activity rather than reported.
+        """
+        result = self.__class__(self.base, _from_transport=self)
+        # The pool is only used by the transports it belongs to.
+        result._readv_pool = None
+        activity = result._pooled_activity = []
+        result._opener = Opener(
+            report_activity=lambda bytes, direction: activity.append(
+                (bytes, direction)),
+            ca_certs=self._ca_certs)
+        credentials = self._get_credentials()
+        if credentials is not None:
+            # Reuse what was negotiated, but let the authentication
+            # handlers update it independently.
+            credentials = tuple(_auth_for_readv_pool(c) for c in credentials)
+        result._shared_connection = transport._SharedConnection(
+            None, credentials, result.base)
+        return result
 
     def request(self, method, url, fields=None, headers=None, **urlopen_kw):
         if fields is not None:
@@ -1830,6 +2005,9 @@ class HttpTransport(ConnectedTransport):
             # Clean the httplib.HTTPConnection pipeline in case the previous
             # request couldn't do it
             connection.cleanup_pipe()
+        elif self._get_credentials() is not None:
+            # A new connection for credentials we already know about
+            (auth, proxy_auth) = self._get_credentials()
         else:
             # First request, initialize credentials.
             # scheme and realm will be set by the _urllib2_wrappers.AuthHandler
@@ -1915,6 +2093,8 @@ class HttpTransport(ConnectedTransport):
         connection = self._get_connection()
         if connection is not None:
             connection.close()
+        if self._readv_pool is not None:
+            self._readv_pool.close()
 
     def has(self, relpath):
         """Does the target location exist?
@@ -2138,27 +2318,43 @@ class HttpTransport(ConnectedTransport):
 
     def _coalesce_readv(self, relpath, coalesced):
         """Issue several GET requests to satisfy the coalesced offsets"""
+        if self._readv_pool is not None and self._range_hint is not None:
+            batches = self._readv_batches(coalesced, parallel=True)
+            return self._readv_pool.get(self, relpath, batches)
+        return self._get_batches(relpath, self._readv_batches(coalesced))
+
+    def _get_batches(self, relpath, batches):
+        """Issue one GET request per batch of coalesced offsets."""
+        for coalesced in batches:
+            # Note that the _get below may raise
+            # errors.InvalidHttpRange. It's the caller's responsibility to
+            # decide how to retry since it may provide different coalesced
+            # offsets.
+            code, rfile = self._get(relpath, coalesced)
+            for coal in coalesced:
+                yield coal, rfile
 
-        def get_and_yield(relpath, coalesced):
-            if coalesced:
-                # Note that the _get below may raise
-                # errors.InvalidHttpRange. It's the caller's responsibility to
-                # decide how to retry since it may provide different coalesced
-                # offsets.
-                code, rfile = self._get(relpath, coalesced)
-                for coal in coalesced:
-                    yield coal, rfile
+    def _readv_batches(self, coalesced, parallel=False):
+        """Split coalesced offsets into the ranges of each GET request.
 
+        :param parallel: Whether the requests will be issued in parallel.
+            If so, a server that only handles single ranges gets one
+            request per coalesced offset, rather than a single request
+            for a range encompassing all of them.
+        """
         if self._range_hint is None:
             # Download whole file
-            for c, rfile in get_and_yield(relpath, coalesced):
-                yield c, rfile
+            if coalesced:
+                yield coalesced
         else:
             total = len(coalesced)
             if self._range_hint == 'multi':
                 max_ranges = self._max_get_ranges
             elif self._range_hint == 'single':
-                max_ranges = total
+                if parallel:
+                    max_ranges = 1
+                else:
+                    max_ranges = total
             else:
                 raise AssertionError("Unknown _range_hint %r"
                                      % (self._range_hint,))
@@ -2172,18 +2368,17 @@ class HttpTransport(ConnectedTransport):
                 if ((self._get_max_size > 0
                      and cumul + coal.length > self._get_max_size) or
                         len(ranges) >= max_ranges):
-                    # Get that much and yield
-                    for c, rfile in get_and_yield(relpath, ranges):
-                        yield c, rfile
+                    # Get that much
+                    yield ranges
                     # Restart with the current offset
                     ranges = [coal]
                     cumul = coal.length
                 else:
                     ranges.append(coal)
                     cumul += coal.length
-            # Get the rest and yield
-            for c, rfile in get_and_yield(relpath, ranges):
-                yield c, rfile
+            # Get the rest
+            if ranges:
+                yield ranges
 
     def recommended_page_size(self):
         """See Transport.recommended_page_size().
@@ -24,6 +24,7 @@
 # these methods when we officially drop support for those formats.
 
 import bisect
+import collections
 import errno
 import itertools
 import os
@@ -75,9 +76,15 @@ except ImportError as e:
 else:
     from paramiko.sftp import (SFTP_FLAG_WRITE, SFTP_FLAG_CREATE,
                                SFTP_FLAG_EXCL, SFTP_FLAG_TRUNC,
-                               CMD_HANDLE, CMD_OPEN)
+                               CMD_DATA, CMD_HANDLE, CMD_OPEN, CMD_READ,
+                               CMD_STATUS, CMD_WRITE, SFTPError)
     from paramiko.sftp_attr import SFTPAttributes
     from paramiko.sftp_file import SFTPFile
+    try:
+        from paramiko.sftp import int64
+    except ImportError:
+        # paramiko < 3.0
+        from paramiko.py3compat import long as int64
 
 
 # GZ 2017-05-25: Some dark hackery to monkeypatch out issues with paramiko's
@@ -117,6 +124,154 @@ else:
     _bad_asbytes.__code__ = _asbytes_for_broken_paramiko.__code__
 
 
+class _SFTPTransferStats(object):
+    """Throughput of the pipelined transfers made by a transport.
+
+    The statistics are shared by the clones of a transport and logged with
+    -Dsftp.
+    """
+
+    def __init__(self):
+        self.bytes = {'read': 0, 'write': 0}
+        self.seconds = {'read': 0.0, 'write': 0.0}
+        self.requests = 0
+        self.max_in_flight = 0
+
+    def record(self, direction, nbytes, seconds):
+        """Record a completed transfer.
+
+        :param direction: 'read' or 'write'.
+        """
+        self.bytes[direction] += nbytes
+        self.seconds[direction] += seconds
+        if 'sftp' in debug.debug_flags:
+            mutter('SFTP %s of %d bytes in %.3fs, %s', direction, nbytes,
+                   seconds, self)
+
+    def throughput(self, direction):
+        """Return the average transfer rate in bytes per second, or None."""
+        seconds = self.seconds[direction]
+        if not seconds:
+            return None
+        return self.bytes[direction] / seconds
+
+    def __str__(self):
+        rates = []
+        for direction in ('read', 'write'):
+            rate = self.throughput(direction)
+            if rate is not None:
+                rates.append('%s %.1fkB/s' % (direction, rate / 1024))
+        return '%s (%d requests, at most %d in flight)' % (
+            ', '.join(rates) or 'no transfers', self.requests,
+            self.max_in_flight)
+
+
+class _SFTPRequestWindow(object):
+    """Keep a bounded number of asynchronous SFTP requests in flight.
+
+    Replies are consumed in the order the requests were issued. Paramiko
+    hands replies that arrive before the one being waited for to the
+    _async_response() method of the object the request was issued for, so
+    replies completing out of order are kept here until they are wanted.
+
+    WARNING: This uses private methods of paramiko's SFTPClient, the same
+    way paramiko's own SFTPFile pipelining does.
+    """
+
+    def __init__(self, sftp, size, stats=None):
+        self._sftp = sftp
+        self._size = max(1, size)
+        self._stats = stats
+        self._pending = collections.deque()
+        self._responses = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def full(self):
+        """Is the window full, i.e. should we wait before the next request?"""
+        return len(self._pending) >= self._size
+
+    def issue(self, t, *args):
+        """Send a request without waiting for its reply."""
+        num = self._sftp._async_request(self, t, *args)
+        self._pending.append(num)
+        if self._stats is not None:
+            self._stats.requests += 1
+            self._stats.max_in_flight = max(self._stats.max_in_flight,
+                                            len(self._pending))
+
+    def _async_response(self, t, msg, num):
+        """Keep the reply to a request issued through this window."""
+        self._responses[num] = (t, msg)
+
+    def wait(self):
+        """Return the (type, message) reply to the oldest request.
+
+        :raises IOError: or EOFError for an error status.
+        """
+        num = self._pending.popleft()
+        try:
+            t, msg = self._responses.pop(num)
+        except KeyError:
+            return self._sftp._read_response(num)
+        if t == CMD_STATUS:
+            self._sftp._convert_status(msg)
+        return t, msg
+
+
+class _SFTPPipelinedWriter(object):
+    """A file-like object writing to an open SFTPFile.
+
+    Data is sent in 32kB write requests, with up to window_size of them in
+    flight. Errors are reported by the write, flush or close call that
+    waits for the failing reply.
+    """
+
+    _max_request_size = 32768
+
+    def __init__(self, fout, window_size, offset=0, stats=None):
+        self._fout = fout
+        self._window = _SFTPRequestWindow(fout.sftp, window_size, stats)
+        self._offset = offset
+        self._written = 0
+        self._stats = stats
+        self._start = time.time()
+
+    def _wait(self):
+        t, msg = self._window.wait()
+        if t != CMD_STATUS:
+            raise SFTPError('Expected status')
+
+    def write(self, data):
+        for start in range(0, len(data), self._max_request_size):
+            chunk = data[start:start + self._max_request_size]
+            if self._window.full():
+                self._wait()
+            self._window.issue(CMD_WRITE, self._fout.handle,
+                               int64(self._offset), chunk)
+            self._offset += len(chunk)
+            self._written += len(chunk)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        while self._window:
+            self._wait()
+        if self._stats is not None and self._written:
+            self._stats.record('write', self._written,
+                               time.time() - self._start)
+            self._written = 0
+            self._start = time.time()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._fout.close()
+
+
 class SFTPLock(object):
     """This fakes a lock in a remote location.
 
@@ -157,7 +312,8 @@ class _SFTPReadvHelper(object):
     # See _get_requests for an explanation.
     _max_request_size = 32768
 
-    def __init__(self, original_offsets, relpath, _report_activity):
+    def __init__(self, original_offsets, relpath, _report_activity,
+                 window_size=None, stats=None):
         """Create a new readv helper.
 
         :param original_offsets: The original requests given by the caller of
@@ -165,10 +321,16 @@ class _SFTPReadvHelper(object):
         :param relpath: The name of the file (if known)
         :param _report_activity: A Transport._report_activity bound method,
             to be called as data arrives.
+        :param window_size: The number of read requests to keep in flight.
+            If None, leave that to paramiko's readv().
+        :param stats: An optional _SFTPTransferStats to record the transfer
+            in.
         """
         self.original_offsets = list(original_offsets)
         self.relpath = relpath
         self._report_activity = _report_activity
+        self._window_size = window_size
+        self._stats = stats
 
     def _get_requests(self):
         """Break up the offsets into individual requests over sftp.
@@ -206,6 +368,38 @@ class _SFTPReadvHelper(object):
                    len(requests))
         return requests
 
+    def _pipelined_readv(self, fp, requests):
+        """Yield the data of requests, in order, keeping a window in flight.
+        """
+        window = _SFTPRequestWindow(fp.sftp, self._window_size, self._stats)
+        start_time = time.time()
+        total = 0
+        try:
+            for start, length in requests:
+                if window.full():
+                    data = self._read_data(window)
+                    total += len(data)
+                    yield data
+                window.issue(CMD_READ, fp.handle, int64(start), int(length))
+            while window:
+                data = self._read_data(window)
+                total += len(data)
+                yield data
+        finally:
+            # The caller stops reading as soon as it has all it asked for
+            if self._stats is not None:
+                self._stats.record('read', total, time.time() - start_time)
+
+    def _read_data(self, window):
+        try:
+            t, msg = window.wait()
+        except EOFError:
+            # Reading past the end of the file, reported as a short read
+            return b''
+        if t != CMD_DATA:
+            raise SFTPError('Expected data')
+        return msg.get_string()
+
     def request_and_yield_offsets(self, fp):
         """Request the data from the remote machine, yielding the results.
 
@@ -230,8 +424,11 @@ class _SFTPReadvHelper(object):
         # Create an 'unlimited' data stream, so we stop based on requests,
         # rather than just because the data stream ended. This lets us detect
         # short readv.
-        data_stream = itertools.chain(fp.readv(requests),
-                                      itertools.repeat(None))
+        if self._window_size is None:
+            data_stream = fp.readv(requests)
+        else:
+            data_stream = self._pipelined_readv(fp, requests)
+        data_stream = itertools.chain(data_stream, itertools.repeat(None))
         for (start, length), data in zip(requests, data_stream):
             if data is None:
                 if cur_coalesced is not None:
@@ -367,6 +564,17 @@ class SFTPTransport(ConnectedTransport):
     # up the request itself, rather than us having to worry about it
     _max_request_size = 32768
 
+    def __init__(self, base, _from_transport=None):
+        super(SFTPTransport, self).__init__(base,
+                                            _from_transport=_from_transport)
+        if _from_transport is not None:
+            self._request_window = _from_transport._request_window
+            self._transfer_stats = _from_transport._transfer_stats
+        else:
+            self._request_window = config.GlobalStack().get(
+                'sftp.request_window')
+            self._transfer_stats = _SFTPTransferStats()
+
     def _remote_path(self, relpath):
         """Return the path to be passed along the sftp protocol for relpath.
 
@@ -495,9 +703,15 @@ class SFTPTransport(ConnectedTransport):
         does not support ranges > 64K, so it caps the request size, and
         just reads until it gets all the stuff it wants.
         """
-        helper = _SFTPReadvHelper(offsets, relpath, self._report_activity)
+        helper = _SFTPReadvHelper(offsets, relpath, self._report_activity,
+                                  self._request_window, self._transfer_stats)
         return helper.request_and_yield_offsets(fp)
 
+    def _pipelined_writer(self, fout, offset=0):
+        """Return a file-like object writing to fout in pipelined requests."""
+        return _SFTPPipelinedWriter(fout, self._request_window, offset,
+                                    self._transfer_stats)
+
     def put_file(self, relpath, f, mode=None):
         """
         Copy the file-like object into the location.
@@ -517,8 +731,9 @@ class SFTPTransport(ConnectedTransport):
         closed = False
         try:
             try:
-                fout.set_pipelined(True)
-                length = self._pump(f, fout)
+                writer = self._pipelined_writer(fout)
+                length = self._pump(f, writer)
+                writer.flush()
             except (IOError, paramiko.SSHException) as e:
                 self._translate_io_exception(e, tmp_abspath)
             # XXX: This doesn't truly help like we would like it to.
@@ -532,8 +747,6 @@ class SFTPTransport(ConnectedTransport):
             #      paramiko decides to expose an async chmod()
 
             # This is designed to chmod() right before we close.
-            # Because we set_pipelined() earlier, theoretically we might
-            # avoid the round trip for fout.close()
             if mode is not None:
                 self._get_sftp().chmod(tmp_abspath, mode)
             fout.close()
@@ -621,7 +834,9 @@ class SFTPTransport(ConnectedTransport):
                         create it, and then try again.
         """
         def writer(fout):
-            self._pump(f, fout)
+            pipelined = self._pipelined_writer(fout)
+            self._pump(f, pipelined)
+            pipelined.flush()
         self._put_non_atomic_helper(relpath, writer, mode=mode,
                                     create_parent_dir=create_parent_dir,
                                     dir_mode=dir_mode)
@@ -700,7 +915,7 @@ class SFTPTransport(ConnectedTransport):
         handle = None
         try:
             handle = self._get_sftp().file(abspath, mode='wb')
-            handle.set_pipelined(True)
+            handle = self._pipelined_writer(handle)
         except (paramiko.SSHException, IOError) as e:
             self._translate_io_exception(e, abspath,
                                          ': unable to open')
@@ -757,7 +972,9 @@ class SFTPTransport(ConnectedTransport):
             if mode is not None:
                 self._get_sftp().chmod(path, mode)
             result = fout.tell()
-            self._pump(f, fout)
+            writer = self._pipelined_writer(fout, result)
+            self._pump(f, writer)
+            writer.flush()
             return result
         except (IOError, paramiko.SSHException) as e:
             self._translate_io_exception(e, relpath, ': unable to append')
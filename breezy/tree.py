@@ -296,6 +296,14 @@ class Tree(object):
         """
         return False
 
+    def _iter_ignored(self, filenames):
+        """Check several filenames against the ignore rules at once.
+
+        :param filenames: A list of relative filenames within the tree.
+        :return: An iterator over the is_ignored() result for each filename.
+        """
+        return map(self.is_ignored, filenames)
+
     def all_file_ids(self):
         """Iterate through all file ids, including ids for missing files."""
         raise NotImplementedError(self.all_file_ids)
@@ -1472,6 +1472,8 @@ format_registry.register_lazy(b"Bazaar Working Tree Format 5 (bzr 1.11)\n",
                               "breezy.bzr.workingtree_4", "WorkingTreeFormat5")
 format_registry.register_lazy(b"Bazaar Working Tree Format 6 (bzr 1.14)\n",
                               "breezy.bzr.workingtree_4", "WorkingTreeFormat6")
+format_registry.register_lazy(b"Bazaar Working Tree Format 7 (bzr 3.2)\n",
+                              "breezy.bzr.workingtree_4", "WorkingTreeFormat7")
 format_registry.register_lazy(b"Bazaar-NG Working Tree format 3",
                               "breezy.bzr.workingtree_3", "WorkingTreeFormat3")
 format_registry.set_default_key(b"Bazaar Working Tree Format 6 (bzr 1.14)\n")
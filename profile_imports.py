@@ -15,7 +15,11 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-"""A custom importer and regex compiler which logs time spent."""
+"""A custom importer and regex compiler which logs time spent.
+
+Each import records its time, including that of the imports it triggers, and
+the number of modules it added to sys.modules.
+"""
 
 import re
 import sys
@@ -25,10 +29,10 @@ import time
 _parent_stack = []
 _total_stack = {}
 _info = {}
+# Absolute names of the modules imported, by stack entry
+_module_names = {}
 _cur_id = 0
-_timer = time.time
-if sys.platform == 'win32':
-    _timer = time.clock
+_timer = getattr(time, 'perf_counter', time.time)
 
 
 def stack_add(name, frame_name, frame_lineno, scope_name=None):
@@ -42,26 +46,28 @@ def stack_add(name, frame_name, frame_lineno, scope_name=None):
     _total_stack[this_stack] = []
     _parent_stack.append(this_stack)
     _info[this_stack] = [len(_parent_stack) - 1, frame_name, frame_lineno,
-                         scope_name]
+                         scope_name, len(sys.modules)]
 
     return this_stack
 
 
 def stack_finish(this, cost):
-    """Finish a given entry, and record its cost in time"""
+    """Finish a given entry, and record its cost in time and modules"""
     global _parent_stack
 
     assert _parent_stack[-1] == this, \
         'import stack does not end with this %s: %s' % (this, _parent_stack)
     _parent_stack.pop()
-    _info[this].append(cost)
+    info = _info[this]
+    info[4] = len(sys.modules) - info[4]
+    info.append(cost)
 
 
 def log_stack_info(out_file, sorted=True, hide_fast=True):
     # Find all of the roots with import = 0
     out_file.write(
-        '%5s %5s %-40s @ %s:%s\n'
-        % ('cum', 'local', 'name', 'file', 'line'))
+        '%5s %5s %4s %-40s @ %s:%s\n'
+        % ('cum', 'local', 'mods', 'name', 'file', 'line'))
     todo = [(value[-1], key) for key, value in _info.items() if value[0] == 0]
 
     if sorted:
@@ -84,11 +90,11 @@ def log_stack_info(out_file, sorted=True, hide_fast=True):
             mod_time -= c_info[-1]
             c_times.append((c_info[-1], child))
 
-        # indent, cum_time, mod_time, name,
+        # indent, cum_time, mod_time, modules, name,
         # scope_name, frame_name, frame_lineno
         out_file.write(
-            '%5.1f %5.1f %-40s @ %s:%d\n' % (
-                info[-1] * 1000., mod_time * 1000.,
+            '%5.1f %5.1f %4d %-40s @ %s:%d\n' % (
+                info[-1] * 1000., mod_time * 1000., info[4],
                 ('+' * info[0] + cur[1]), info[1], info[2]))
 
         if sorted:
@@ -98,8 +104,91 @@ def log_stack_info(out_file, sorted=True, hide_fast=True):
         todo.extend(c_times)
 
 
+def _module_group(name):
+    """Return the package a module is counted under in log_module_summary."""
+    parts = name.split('.')
+    if parts[0] != 'breezy':
+        return parts[0]
+    elif parts[1:2] == ['plugins']:
+        return '.'.join(parts[:3])
+    else:
+        return '.'.join(parts[:2])
+
+
+def log_module_summary(out_file, limit=20):
+    """Write the number of modules loaded per package and the time taken.
+
+    Modules in breezy are grouped by module or subpackage, plugins by plugin
+    and others by top level package. The time of a group includes the imports
+    its modules trigger, so the times of nested groups overlap.
+    """
+    counts = {}
+    for name, module in list(sys.modules.items()):
+        if module is not None:
+            group = _module_group(name)
+            counts[group] = counts.get(group, 0) + 1
+    times = {}
+    total_time = 0.0
+    todo = [(key, frozenset()) for key, value in _info.items()
+            if value[0] == 0]
+    while todo:
+        cur, outer_groups = todo.pop()
+        info = _info[cur]
+        if len(info) < 6:
+            # Still being imported
+            continue
+        if info[0] == 0:
+            total_time += info[-1]
+        name = _module_names.get(cur)
+        if name is not None:
+            group = _module_group(name)
+            if group not in outer_groups:
+                times[group] = times.get(group, 0.0) + info[-1]
+                outer_groups = outer_groups.union([group])
+        todo.extend((child, outer_groups) for child in _total_stack[cur])
+    out_file.write('%d modules loaded, %.1fms in timed imports\n' % (
+        sum(counts.values()), total_time * 1000.))
+    out_file.write('%5s %4s %s\n' % ('cum', 'mods', 'package'))
+    groups = sorted(counts, key=lambda g: (-times.get(g, 0.0), -counts[g], g))
+    for group in groups[:limit]:
+        out_file.write('%5.1f %4d %s\n' % (
+            times.get(group, 0.0) * 1000., counts[group], group))
+    if len(groups) > limit:
+        out_file.write('%5s %4d (%d more packages)\n' % (
+            '', sum(counts[group] for group in groups[limit:]),
+            len(groups) - limit))
+
+
 _real_import = __import__
 
+
+def _imported_name(name, globals, fromlist, level):
+    """Return the absolute name of the module an import loads.
+
+    Relative imports are resolved like __import__ does. When a single
+    submodule is imported from a package, that is the module imported.
+    """
+    if level:
+        if globals is None:
+            return None
+        package = globals.get('__package__')
+        if not package:
+            package = globals.get('__name__')
+            if package is None:
+                return None
+            if '__path__' not in globals:
+                package = package.rpartition('.')[0]
+        base = package.rsplit('.', level - 1)[0]
+        if name:
+            name = base + '.' + name
+        else:
+            name = base
+    if fromlist and len(fromlist) == 1 and fromlist[0] != '*':
+        submodule = '%s.%s' % (name, fromlist[0])
+        if submodule in sys.modules:
+            return submodule
+    return name
+
 def timed_import(name, globals=None, locals=None, fromlist=None, level=0):
     """Wrap around standard importer to log import time"""
     # normally there are 4, but if this is called as __import__ eg by
@@ -149,6 +238,7 @@ def timed_import(name, globals=None, locals=None, fromlist=None, level=0):
     finally:
         tload = _timer() - tstart
         stack_finish(this, tload)
+        _module_names[this] = _imported_name(name, globals, fromlist, level)
 
 
 def _repr_regexp(pattern, max_len=30):
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# Copyright (C) 2020 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Measure the startup time and memory use of brz for no-op commands.
+
+Each command is run several times in an empty tree, recording the wall
+clock time and the peak resident set size of the brz process, and once more
+to count the modules it imports. Results can be saved as a baseline and
+later runs compared against it, e.g.:
+
+  tools/startup_benchmark.py --save startup.json
+  (make changes)
+  tools/startup_benchmark.py --compare startup.json
+
+The comparison exits with status 1 if a command got slower, bigger or
+imports more modules by more than the tolerance.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+COMMANDS = [
+    ['version'],
+    ['revno'],
+    ['status'],
+    ]
+
+
+def run_once(brz, args, cwd, env):
+    """Run brz once.
+
+    :return: Tuple of wall clock time in seconds and peak RSS in KiB, or
+        None if that is unknown on this platform.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, brz] + args, cwd=cwd, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if getattr(os, 'wait4', None) is None:
+        stderr = proc.communicate()[1]
+        status = proc.returncode
+        rss = None
+    else:
+        stderr = proc.stderr.read()
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        rss = usage.ru_maxrss
+        if sys.platform == 'darwin':
+            # Reported in bytes rather than kilobytes
+            rss //= 1024
+    elapsed = time.perf_counter() - start
+    proc.stderr.close()
+    if status != 0:
+        raise RuntimeError('brz %s failed:\n%s' % (
+            ' '.join(args), stderr.decode('utf-8', 'replace')))
+    return elapsed, rss
+
+
+def count_modules(brz, args, cwd, env):
+    """Count the modules brz imports, using python's -X importtime.
+
+    :return: The number of modules imported, or None if the python version
+        doesn't support -X importtime.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', brz] + args, cwd=cwd, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = proc.communicate()[1]
+    # Each module imported gets a line, after a header line
+    count = stderr.count(b'\nimport time:')
+    if stderr.startswith(b'import time:'):
+        count += 1
+    if not count:
+        return None
+    return count - 1
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmarks(brz, commands, runs, global_options):
+    """Run each command in an empty tree.
+
+    :return: Dict mapping command lines to dicts with the minimum and
+        median wall clock time in seconds, the largest peak RSS in KiB and
+        the number of modules imported.
+    """
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='brz-startup-')
+    try:
+        env = dict(os.environ)
+        env['BRZ_EMAIL'] = 'Startup Benchmark <startup@example.com>'
+        tree = os.path.join(tmpdir, 'tree')
+        subprocess.check_call(
+            [sys.executable, brz] + global_options + ['init', '-q', tree],
+            env=env)
+        # Populate caches, like the plugin manifest, before measuring.
+        run_once(brz, global_options + ['version'], tree, env)
+        for args in commands:
+            times = []
+            rss = []
+            for i in range(runs):
+                elapsed, max_rss = run_once(
+                    brz, global_options + args, tree, env)
+                times.append(elapsed)
+                rss.append(max_rss)
+            if None in rss:
+                max_rss = None
+            else:
+                max_rss = max(rss)
+            results[' '.join(args)] = {
+                'min': min(times),
+                'median': median(times),
+                'rss': max_rss,
+                'modules': count_modules(
+                    brz, global_options + args, tree, env),
+                }
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def format_results(results, baseline=None, tolerance=0.1):
+    """Format results as a table.
+
+    :return: Tuple of the lines and the commands that regressed compared to
+        the baseline.
+    """
+    lines = ['%-10s %9s %9s %9s %7s' % ('command', 'min ms', 'median ms',
+                                         'RSS KiB', 'modules')]
+    regressions = []
+    for command, result in results.items():
+        line = '%-10s %9.1f %9.1f %9s %7s' % (
+            command, result['min'] * 1000., result['median'] * 1000.,
+            result['rss'] if result['rss'] is not None else '-',
+            result['modules'] if result['modules'] is not None else '-')
+        old = (baseline or {}).get(command)
+        if old is not None:
+            changes = []
+            for key in ('min', 'rss', 'modules'):
+                if result[key] is None or not old.get(key):
+                    continue
+                change = (result[key] - old[key]) / float(old[key])
+                changes.append('%s %+.1f%%' % (key, change * 100.))
+                if change > tolerance:
+                    regressions.append(command)
+            line += '  (' + ', '.join(changes) + ')'
+        lines.append(line)
+    return lines, sorted(set(regressions))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [COMMAND...]',
+                                   description=__doc__.split('\n')[0])
+    parser.add_option('--brz', default=None,
+                      help='The brz script to run (default: the one in this '
+                           'source tree).')
+    parser.add_option('--runs', default=10, type=int,
+                      help='How often to run each command (default: 10).')
+    parser.add_option('--no-plugins', action='store_true', default=False,
+                      help='Run the commands without loading plugins.')
+    parser.add_option('--save', metavar='FILE',
+                      help='Save the results as a baseline in FILE.')
+    parser.add_option('--compare', metavar='FILE',
+                      help='Compare the results to the baseline in FILE.')
+    parser.add_option('--tolerance', default=10.0, type=float,
+                      help='Percentage by which time, RSS or the number of '
+                           'modules may grow before it is reported as a '
+                           'regression (default: 10).')
+    opts, args = parser.parse_args(argv)
+    brz = opts.brz
+    if brz is None:
+        brz = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'brz')
+    if args:
+        commands = [arg.split() for arg in args]
+    else:
+        commands = COMMANDS
+    global_options = []
+    if opts.no_plugins:
+        global_options.append('--no-plugins')
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run_benchmarks(brz, commands, opts.runs, global_options)
+    lines, regressions = format_results(
+        results, baseline, opts.tolerance / 100.)
+    for line in lines:
+        print(line)
+
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0],
+                       'global_options': global_options,
+                       'runs': opts.runs,
+                       'results': results}, f, indent=1, sort_keys=True)
+    if regressions:
+        print('Regressed by more than %.0f%%: %s' % (
+            opts.tolerance, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))